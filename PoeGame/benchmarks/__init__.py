@@ -0,0 +1,2 @@
+# benchmarks/__init__.py
+"""Микробенчмарки горячих путей бота. Запуск из папки PoeGame: python -m benchmarks.<модуль>"""
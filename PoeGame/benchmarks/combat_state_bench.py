@@ -0,0 +1,115 @@
+# benchmarks/combat_state_bench.py
+"""
+Сравнение старого формата состояния боя (россыпь ключей + до трех update_data за ход)
+с записью CombatState (одна запись set_data за ход).
+Хранилище сериализует данные в JSON, как это делают персистентные хранилища (Redis/SQLite),
+и считает записи и байты.
+
+Запуск из папки PoeGame:
+    python -m benchmarks.combat_state_bench --turns 20000
+"""
+import json
+import time
+import asyncio
+import argparse
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from combat_state import CombatState, load_combat_state, save_combat_state
+from combat_effects import EffectScheduler
+
+
+class JsonCountingStorage(BaseStorage):
+    """FSM-хранилище в памяти, которое хранит данные JSON-строкой и считает записи."""
+    def __init__(self):
+        self._states = {}
+        self._data = {}
+        self.writes = 0
+        self.bytes_written = 0
+
+    async def set_state(self, key: StorageKey, state=None):
+        self._states[key] = state.state if hasattr(state, "state") else state
+
+    async def get_state(self, key: StorageKey):
+        return self._states.get(key)
+
+    async def set_data(self, key: StorageKey, data):
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        self._data[key] = payload
+        self.writes += 1
+        self.bytes_written += len(payload.encode())
+
+    async def get_data(self, key: StorageKey) -> dict:
+        payload = self._data.get(key)
+        return json.loads(payload) if payload else {}
+
+    async def close(self):
+        pass
+
+    def stored_size(self, key: StorageKey) -> int:
+        return len(self._data.get(key, "").encode())
+
+
+LEGACY_START = {
+    "monster_key": "Гниющий Зомби", "monster_hp": 10 ** 6, "monster_max_hp": 10 ** 6, "monster_damage": 12,
+    "monster_xp_reward": 40, "monster_gold_reward": 15, "player_buffs": {},
+}
+TURN_BUFFS = {"buff_next_attack": 1.5, "temp_armor": {"value": 20, "duration": 3}}
+
+
+async def _legacy_turn(state: FSMContext, damage: int):
+    """Ход в старом формате: как handle_combat_action до перехода на CombatState."""
+    state_data = await state.get_data()
+    current_buffs = state_data.get("player_buffs", {})
+    if "buff_next_attack" in current_buffs:
+        del current_buffs["buff_next_attack"]
+        await state.update_data(player_buffs=current_buffs)
+    await state.update_data(player_buffs=dict(TURN_BUFFS))
+    await state.update_data(monster_hp=state_data["monster_hp"] - damage)
+
+async def _compact_turn(state: FSMContext, damage: int):
+    """Ход с CombatState: одно чтение, одна запись."""
+    combat = await load_combat_state(state)
+    combat.effects.consume_attack_multiplier()
+    combat.effects = EffectScheduler.from_legacy_buffs(TURN_BUFFS)
+    combat.enemy_hp -= damage
+    await save_combat_state(state, combat)
+
+async def _run(kind: str, turns: int) -> dict:
+    storage = JsonCountingStorage()
+    key = StorageKey(bot_id=1, chat_id=1, user_id=1)
+    state = FSMContext(storage, key)
+    if kind == "legacy":
+        await state.set_data(dict(LEGACY_START))
+        turn = _legacy_turn
+    else:
+        await save_combat_state(state, CombatState.from_legacy_data(LEGACY_START))
+        turn = _compact_turn
+    storage.writes = storage.bytes_written = 0
+
+    started = time.perf_counter()
+    for _ in range(turns):
+        await turn(state, 1)
+    elapsed = time.perf_counter() - started
+    return {
+        'format': kind,
+        'stored_bytes': storage.stored_size(key),
+        'writes_per_turn': storage.writes / turns,
+        'bytes_written_per_turn': storage.bytes_written / turns,
+        'us_per_turn': elapsed / turns * 1e6,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.combat_state_bench")
+    parser.add_argument("--turns", type=int, default=20000)
+    args = parser.parse_args(argv)
+    rows = [asyncio.run(_run(kind, args.turns)) for kind in ("legacy", "compact")]
+    print(f"{'format':<8} {'stored_B':>9} {'writes/turn':>12} {'written_B/turn':>15} {'us/turn':>9}")
+    for row in rows:
+        print(f"{row['format']:<8} {row['stored_bytes']:>9} {row['writes_per_turn']:>12.2f} "
+              f"{row['bytes_written_per_turn']:>15.1f} {row['us_per_turn']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
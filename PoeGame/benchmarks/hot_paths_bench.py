@@ -0,0 +1,217 @@
+# benchmarks/hot_paths_bench.py
+"""
+Микробенчмарки горячих функций db_manager и game_data на синтетической БД (synthetic_db.py).
+Прогрев, затем --rounds раундов; в раунде - по --number вызовов каждой операции; по раундам считаются
+минимум, медиана и межквартильный размах времени одного вызова. Сравнение с базой
+(benchmarks/baseline/hot_paths.json) - по минимуму раунда (как timeit: шум соседних процессов и
+потоков aiosqlite только добавляет время) и по медиане: REGRESSION - если обе выросли больше
+--threshold; код возврата 1. Скорость машины между прогонами плавает - поэтому в каждом раунде
+меряется и эталонный цикл (calibration), и база пересчитывается на его отношение. База снята на конкретной машине - после смены железа/Python
+перезаписать ее через --save-baseline.
+
+Запуск из папки PoeGame:
+    python -m benchmarks.hot_paths_bench
+    python -m benchmarks.hot_paths_bench --save-baseline
+    python -m benchmarks.hot_paths_bench --only get_player --only get_inventory_items
+"""
+import os
+import gc
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import asyncio
+import argparse
+import platform
+import statistics
+import tempfile
+
+from benchmarks import synthetic_db
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline", "hot_paths.json")
+THRESHOLD = 0.20 # Допустимый рост минимума и медианы относительно базы
+PURE_NUMBER = 20000 # Вызовов в раунде для функций без БД (микросекунды - нужно больше повторов)
+CALIBRATION = "calibration" # Эталонный цикл на чистом Python: меряет скорость машины в этом прогоне
+
+
+def _calibration(i: int) -> int:
+    total = 0
+    for n in range(2000):
+        total += n * n % 7
+    return total
+
+
+def _db_ops(dbm, players: list[int], rng: random.Random) -> dict:
+    """Имя -> async-вызов от номера итерации. Аргументы детерминированы (rng с фиксированным seed)."""
+    users = [rng.choice(players) for _ in range(4096)]
+    fragments = [boss['fragment_item_id'] for boss in synthetic_db.BOSSES[:3]]
+    # Пары (игрок, фрагмент) по кругу: запаса FRAGMENTS_PER_PLAYER хватает на все раунды
+    fragment_pairs = [(p, f) for f in fragments for p in players]
+
+    def user(i: int) -> int:
+        return users[i % len(users)]
+
+    async def remove_fragment(i: int):
+        player_id, fragment = fragment_pairs[i % len(fragment_pairs)]
+        if not await dbm.remove_player_fragments(player_id, fragment, 1):
+            raise RuntimeError(f"no fragments left for {player_id} - increase --players")
+
+    return {
+        'get_player': lambda i: dbm.get_player(user(i)),
+        'get_player_effective_stats': lambda i: dbm.get_player_effective_stats(user(i)),
+        'get_inventory_items': lambda i: dbm.get_inventory_items(user(i)),
+        'get_inventory_items(equipped)': lambda i: dbm.get_inventory_items(user(i), equipped=True),
+        'update_player_vitals': lambda i: dbm.update_player_vitals(user(i), hp_change=-1 if i % 2 else 1, mana_change=-3),
+        'update_player_xp': lambda i: dbm.update_player_xp(user(i), gained_xp=1, gained_gold=5),
+        'get_top_players': lambda i: dbm.get_top_players('gold' if i % 2 else 'level_xp'),
+        'remove_player_fragments': remove_fragment,
+    }
+
+def _pure_ops(game_data, rng: random.Random) -> dict:
+    return {
+        'get_random_loot_item_id': lambda i: game_data.get_random_loot_item_id(rng),
+        'calculate_damage_with_crit': lambda i: game_data.calculate_damage_with_crit(40 + i % 60, 5.0 + i % 20, 150.0, rng),
+    }
+
+async def _async_calibration(i: int) -> int:
+    return _calibration(i)
+
+async def _round_async(call, start: int, number: int) -> float:
+    started = time.perf_counter()
+    for i in range(start, start + number):
+        await call(i)
+    return (time.perf_counter() - started) / number
+
+def _round_sync(call, start: int, number: int) -> float:
+    started = time.perf_counter()
+    for i in range(start, start + number):
+        call(i)
+    return (time.perf_counter() - started) / number
+
+def _summary(samples: list[float]) -> dict:
+    q1, median, q3 = statistics.quantiles(samples, n=4, method="inclusive")
+    return {'median_us': median * 1e6, 'iqr_us': (q3 - q1) * 1e6, 'min_us': min(samples) * 1e6, 'rounds': len(samples)}
+
+async def _measure_db(ops: dict, rounds: int, number: int, warmup: int) -> dict:
+    # Раунды чередуют операции: всплеск шума попадает в один раунд каждой, а не во все раунды одной
+    ops = {CALIBRATION: _async_calibration, **ops}
+    samples: dict[str, list[float]] = {name: [] for name in ops}
+    offset = 0
+    for call in ops.values():
+        for i in range(warmup):
+            await call(offset + i)
+        offset += warmup
+    gc.collect()
+    for r in range(rounds):
+        for name, call in ops.items():
+            samples[name].append(await _round_async(call, offset, number))
+            offset += number
+        print(f"  round {r + 1}/{rounds}", file=sys.stderr)
+    return {name: _summary(s) for name, s in samples.items()}
+
+def _measure_pure(ops: dict, rounds: int, number: int) -> dict:
+    samples: dict[str, list[float]] = {name: [] for name in ops}
+    for call in ops.values():
+        _round_sync(call, 0, number // 10)
+    gc.collect()
+    for r in range(rounds):
+        for name, call in ops.items():
+            samples[name].append(_round_sync(call, r * number, number))
+    return {name: _summary(s) for name, s in samples.items()}
+
+def run(players: int, items: int, rounds: int, number: int, seed: int = 1, only: list[str] | None = None) -> dict:
+    import game_data
+    import database.db_manager as dbm
+
+    workdir = tempfile.mkdtemp(prefix="hot_paths_bench_")
+    path = os.path.join(workdir, "synthetic.db")
+    try:
+        started = time.perf_counter()
+        counts = synthetic_db.build(path, players, items, seed)
+        print(f"Synthetic DB: {counts} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        dbm.DB_NAME = path
+        logging.disable(logging.CRITICAL) # Предупреждения db_manager (фрагменты не в ALL_ITEMS) - шум в выводе
+        rng = random.Random(seed)
+        db_ops = _db_ops(dbm, list(synthetic_db.player_ids(players)), rng)
+        pure_ops = _pure_ops(game_data, rng)
+        if only:
+            db_ops = {k: v for k, v in db_ops.items() if k in only}
+            pure_ops = {k: v for k, v in pure_ops.items() if k in only}
+        results = asyncio.run(_measure_db(db_ops, rounds, number, warmup=max(1, number // 5)))
+        results.update(_measure_pure(pure_ops, rounds, PURE_NUMBER))
+    finally:
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'params': {'players': players, 'items': items, 'rounds': rounds, 'number': number, 'seed': seed},
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+
+def compare(report: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Печатает таблицу с дельтами к базе; возвращает имена операций с регрессией.
+    Дельты - с поправкой на скорость машины: база умножается на отношение калибровочных циклов.
+    """
+    if baseline and baseline.get('params') != report['params']:
+        print(f"Warning: baseline params {baseline.get('params')} differ from {report['params']}")
+    base = baseline.get('results', {})
+    results = report['results']
+    scale = {'min_us': 1.0, 'median_us': 1.0}
+    if CALIBRATION in base and CALIBRATION in results:
+        scale = {key: results[CALIBRATION][key] / base[CALIBRATION][key] for key in scale}
+        print(f"Machine speed vs baseline: x{1 / scale['min_us']:.2f} (calibration loop)")
+    regressions = []
+    print(f"{'operation':<30} {'min_us':>9} {'median_us':>10} {'iqr_us':>9} {'base_min':>9} {'delta':>8}")
+    for name, r in results.items():
+        line = f"{name:<30} {r['min_us']:>9.1f} {r['median_us']:>10.1f} {r['iqr_us']:>9.1f}"
+        if name not in base or name == CALIBRATION:
+            print(f"{line} {'-':>9} {'-':>8}")
+            continue
+        delta = {key: r[key] / (base[name][key] * scale[key]) - 1 for key in scale}
+        flag = ""
+        if delta['min_us'] > threshold and delta['median_us'] > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{line} {base[name]['min_us']:>9.1f} {delta['min_us']:>+7.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.hot_paths_bench")
+    parser.add_argument("--players", type=int, default=2000)
+    parser.add_argument("--items", type=int, default=40, help="предметов у каждого игрока")
+    parser.add_argument("--rounds", type=int, default=21)
+    parser.add_argument("--number", type=int, default=40, help="вызовов функций БД в раунде")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", action="append", help="только эта операция (можно несколько раз)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--save-baseline", action="store_true", help="записать результат как новую базу")
+    parser.add_argument("--out", help="JSON с результатами")
+    args = parser.parse_args(argv)
+
+    report = run(args.players, args.items, args.rounds, args.number, args.seed, args.only)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = compare(report, baseline, args.threshold)
+    if regressions:
+        print(f"Regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
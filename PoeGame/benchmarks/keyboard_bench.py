@@ -0,0 +1,84 @@
+# benchmarks/keyboard_bench.py
+"""
+Стоимость клавиатуры действий за ход боя:
+  - uncached: как до кэша - запрос изученных спеллов в БД и сборка InlineKeyboardMarkup каждый ход;
+  - cached: кэш изученных спеллов игрока + кэш готовых клавиатур (keyboard_cache).
+Мана игрока меняется по кругу, поэтому часть ходов меняет набор доступных спеллов.
+БД - временный файл, боевая poe_bot.db не трогается.
+
+Запуск из папки PoeGame:
+    python -m benchmarks.keyboard_bench --turns 2000
+"""
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+import database.db_manager as db_manager
+from game_data import SPELLS
+from keyboard_cache import combat_keyboards, spell_rows_key
+from handlers.combat import get_combat_action_keyboard, build_combat_action_keyboard
+
+USER_ID = 1
+MONSTER_KEY = "Гниющий Зомби"
+MANA_CYCLE = (60, 45, 30, 15, 5, 0) # Мана по ходам: спеллы постепенно становятся недоступны
+
+
+async def _uncached_turn(mana: int):
+    db_manager.invalidate_learned_spells(USER_ID)
+    learned_spells = await db_manager.get_learned_spells(USER_ID)
+    return build_combat_action_keyboard(MONSTER_KEY, spell_rows_key(learned_spells, 1.0, mana), learned_spells)
+
+async def _cached_turn(mana: int):
+    learned_spells = await db_manager.get_learned_spells(USER_ID)
+    return await get_combat_action_keyboard(USER_ID, MONSTER_KEY, mana, {}, learned_spells)
+
+async def _measure(turn, turns: int) -> dict:
+    combat_keyboards.clear()
+    started = time.perf_counter()
+    for i in range(turns):
+        await turn(MANA_CYCLE[i % len(MANA_CYCLE)])
+    elapsed = time.perf_counter() - started
+
+    # Отдельный проход под tracemalloc: пик выделенной памяти за ход
+    peak_sum = 0
+    tracemalloc.start()
+    for i in range(turns):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        await turn(MANA_CYCLE[i % len(MANA_CYCLE)])
+        _, peak = tracemalloc.get_traced_memory()
+        peak_sum += peak - before
+    tracemalloc.stop()
+    return {'us_per_turn': elapsed / turns * 1e6, 'peak_alloc_per_turn': peak_sum / turns}
+
+async def _run(turns: int) -> list[dict]:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_manager.DB_NAME = os.path.join(tmp, "bench.db")
+        await db_manager.init_db()
+        await db_manager.add_player(USER_ID, "bench")
+        for spell_id in list(SPELLS)[1:6]:
+            await db_manager.learn_spell(USER_ID, spell_id)
+        rows = []
+        for kind, turn in (("uncached", _uncached_turn), ("cached", _cached_turn)):
+            row = await _measure(turn, turns)
+            row['mode'] = kind
+            rows.append(row)
+        row['hit_rate'] = combat_keyboards.hits / max(1, combat_keyboards.hits + combat_keyboards.misses)
+        return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.keyboard_bench")
+    parser.add_argument("--turns", type=int, default=2000)
+    args = parser.parse_args(argv)
+    rows = asyncio.run(_run(args.turns))
+    print(f"{'mode':<9} {'us/turn':>10} {'peak_alloc_B/turn':>18}")
+    for row in rows:
+        print(f"{row['mode']:<9} {row['us_per_turn']:>10.1f} {row['peak_alloc_per_turn']:>18.0f}")
+    print(f"keyboard cache hit rate: {rows[-1]['hit_rate']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# benchmarks/logging_bench.py
+"""
+Стоимость логирования на ход боя: как было и как стало (log_setup.py).
+Ход = апдейт через player_context (расчет эффективных статов) + хендлер атаки: те же вызовы логов,
+что в db_manager/handlers.combat. "before" - f-строки, трассы на INFO, basicConfig с синхронной
+записью в файл; "after" - %-стиль, трассы на DEBUG, QueueHandler + поток слушателя, сэмплинг.
+caller_us - время на вызывающем потоке (цикл событий) на ход; total_us - с дописыванием очереди
+(на одном ядре поток слушателя делит CPU с циклом, но не стоит на пути хендлера).
+
+Запуск из папки PoeGame:
+    python -m benchmarks.logging_bench --turns 20000
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+import log_setup
+from log_setup import hot_log
+
+EFFECTS = {'mana_cost_multiplier': 0.5, 'regen_multiplier': 1.5, 'crit_multiplier_bonus': 50}
+
+
+def _turn_before(user_id: int, turn: int):
+    # get_player_effective_stats + handle_combat_action до изменения
+    logging.debug(f"Calculating effective stats for {user_id}. Found {9} items.")
+    logging.info(f"Effective stats calculated for {user_id}. Final MaxHP: {412}, Final MaxES: {130}, Effects dictionary: {EFFECTS}")
+    logging.debug(f"[handle_combat_action] Before player vitals update: HP change={0}, Mana change={-12}")
+    logging.debug(f"[handle_combat_action] After player vitals update.")
+    logging.debug(f"Monster HP updated: {300 - turn % 300}/{300}")
+    logging.debug(f"[handle_combat_action after monster] User {user_id}: HP={350}, Mana={120}, ES={80}")
+    if turn % 4 == 0:
+        logging.info(f"Effects expired for user {user_id}: {', '.join(['Ярость', 'Стойкость'])}")
+
+def _turn_after(user_id: int, turn: int):
+    logging.debug("Calculating effective stats for %s. Found %d items.", user_id, 9)
+    logging.debug("Effective stats calculated for %s. Final MaxHP: %s, Final MaxES: %s, Effects dictionary: %s",
+                  user_id, 412, 130, EFFECTS)
+    logging.debug("[handle_combat_action] Before player vitals update: HP change=%s, Mana change=%s", 0, -12)
+    logging.debug("[handle_combat_action] After player vitals update.")
+    logging.debug("Monster HP updated: %s/%s", 300 - turn % 300, 300)
+    logging.debug("[handle_combat_action after monster] User %s: HP=%s, Mana=%s, ES=%s", user_id, 350, 120, 80)
+    if turn % 4 == 0:
+        hot_log.info("Effects expired for user %s: %s", user_id, ', '.join(['Ярость', 'Стойкость']))
+
+def _measure(turn, turns: int, users: int) -> float:
+    started = time.perf_counter()
+    for i in range(turns):
+        turn(1000 + i % users, i)
+    return time.perf_counter() - started
+
+def run_mode(mode: str, turns: int, users: int, path: str) -> dict:
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, "w") # Консольный вывод слушателя не нужен - пишем в файл
+    try:
+        if mode == "before":
+            root = logging.getLogger()
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            logging.basicConfig(level=logging.INFO, format=log_setup.LOG_FORMAT, filename=path)
+            turn = _turn_before
+        else:
+            sampling = log_setup.setup_logging(logging.INFO, path)
+            if mode == "after-nosample":
+                sampling.burst = turns # Все записи проходят - видна цена очереди без сэмплинга
+            turn = _turn_after
+        started = time.perf_counter()
+        caller = _measure(turn, turns, users)
+        log_setup.stop_logging() # Дописать очередь
+        for handler in logging.getLogger().handlers[:]:
+            handler.close()
+            logging.getLogger().removeHandler(handler)
+        total = time.perf_counter() - started
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    with open(path, encoding="utf-8") as f:
+        lines = sum(1 for _ in f)
+    os.remove(path)
+    return {'mode': mode, 'caller_us': caller / turns * 1e6, 'total_us': total / turns * 1e6, 'lines': lines}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.logging_bench")
+    parser.add_argument("--turns", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=200)
+    args = parser.parse_args(argv)
+    path = os.path.join(tempfile.mkdtemp(prefix="logging_bench_"), "bench.log")
+    rows = [run_mode(mode, args.turns, args.users, path) for mode in ("before", "after-nosample", "after")]
+    print(f"{'mode':<15} {'caller_us/turn':>14} {'total_us/turn':>14} {'log_lines':>10}")
+    for r in rows:
+        print(f"{r['mode']:<15} {r['caller_us']:>14.2f} {r['total_us']:>14.2f} {r['lines']:>10}")
+
+
+if __name__ == "__main__":
+    main()
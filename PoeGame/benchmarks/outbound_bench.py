@@ -0,0 +1,83 @@
+# benchmarks/outbound_bench.py
+"""
+Исходящие запросы под всплеском: напрямую против OutboundScheduler (outbound.py).
+Поддельный Bot API в процессе (tools/fake_bot_api.py) ограничивает частоту как Telegram (скользящее окно 1 с:
+не больше --api-chat-limit запросов в чат и --api-global-limit на бота) и отвечает 429 с retry_after.
+Сценарий: --chats игроков жмут "атака" каждые --click-ms, каждое нажатие - edit_text того же сообщения.
+Сравниваются: запросы, дошедшие до API, число 429, ошибки у вызывающих, время и финальный текст сообщений.
+
+Запуск из папки PoeGame:
+    python -m benchmarks.outbound_bench --chats 50 --clicks 10
+"""
+import time
+import asyncio
+import argparse
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+
+from outbound import OutboundScheduler
+from tools.fake_bot_api import FakeBotAPI, start_fake_api
+
+TOKEN = "42:BENCH"
+
+
+async def _scenario(bot: Bot, chats: int, clicks: int, click_ms: float) -> tuple[int, float]:
+    """Каждый чат жмет clicks раз; возвращает (ошибок у вызывающих, время до последнего ответа)."""
+    errors = 0
+
+    async def player(chat_id: int):
+        nonlocal errors
+        calls = []
+        for k in range(clicks):
+            calls.append(asyncio.create_task(bot.edit_message_text(text=f"turn {k}", chat_id=chat_id, message_id=1)))
+            await asyncio.sleep(click_ms / 1000)
+        for call in calls:
+            try:
+                await call
+            except TelegramRetryAfter:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(player(1000 + i) for i in range(chats)))
+    return errors, time.perf_counter() - started
+
+async def _run_mode(scheduled: bool, args) -> dict:
+    api = FakeBotAPI(chat_limit=args.api_chat_limit, global_limit=args.api_global_limit, record_params=False)
+    runner, url = await start_fake_api(api)
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    scheduler = None
+    if scheduled:
+        scheduler = OutboundScheduler()
+        bot.session.middleware(scheduler)
+    errors, elapsed = await _scenario(bot, args.chats, args.clicks, args.click_ms)
+    await bot.session.close()
+    await runner.cleanup()
+    final_ok = sum(1 for i in range(args.chats)
+                   if api.messages[str(1000 + i)].get(1, {}).get('text') == f"turn {args.clicks - 1}")
+    return {'mode': "scheduled" if scheduled else "direct", 'api_requests': len(api.calls), 'http_429': api.flood_errors,
+            'caller_errors': errors, 'seconds': elapsed, 'final_ok': final_ok,
+            'coalesced': scheduler.coalesced if scheduler else 0}
+
+async def _run(args) -> list[dict]:
+    return [await _run_mode(False, args), await _run_mode(True, args)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.outbound_bench")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--clicks", type=int, default=10, help="нажатий на чат")
+    parser.add_argument("--click-ms", type=float, default=100.0, help="интервал нажатий")
+    parser.add_argument("--api-chat-limit", type=int, default=3, help="запросов в чат за 1 с")
+    parser.add_argument("--api-global-limit", type=int, default=30, help="запросов на бота за 1 с")
+    args = parser.parse_args(argv)
+    rows = asyncio.run(_run(args))
+    print(f"{'mode':<10} {'api_req':>8} {'429':>6} {'caller_err':>10} {'coalesced':>9} {'final_ok':>9} {'seconds':>8}")
+    for r in rows:
+        print(f"{r['mode']:<10} {r['api_requests']:>8} {r['http_429']:>6} {r['caller_errors']:>10} {r['coalesced']:>9} "
+              f"{r['final_ok']:>5}/{args.chats:<3} {r['seconds']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
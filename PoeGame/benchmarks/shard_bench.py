@@ -0,0 +1,155 @@
+# benchmarks/shard_bench.py
+"""
+Пропускная способность шардированного режима (sharding.py) в зависимости от числа воркеров.
+Поднимает настоящий супервизор: фронт на aiohttp + N процессов-воркеров (этот же модуль с --worker),
+апдейты раздаются по хешу user_id. Хендлер воркера нагружает CPU как бой: --fights
+симуляций combat_engine.simulate_fight на апдейт (в одном процессе это блокирует цикл событий).
+Клиент шлет --updates апдейтов от --users игроков, до --connections параллельно, как Telegram;
+воркер отвечает после обработки (handle_in_background=False), поэтому апдейты/с - реальная обработка.
+Рост с N ограничен числом ядер машины (os.cpu_count()).
+
+Запуск из папки PoeGame:
+    python -m benchmarks.shard_bench --workers 1 2 4 --updates 2000
+"""
+import os
+import sys
+import time
+import socket
+import random
+import asyncio
+import argparse
+
+from aiohttp import ClientSession
+
+from sharding import run_supervisor
+
+SECRET = "bench-secret"
+WEBHOOK_PATH = "/webhook"
+
+
+# --- Воркер ---
+def _worker_main(fights: int):
+    from aiogram import Bot, Dispatcher
+    from aiogram.types import Message
+    from game_data import MONSTERS
+    from combat_engine import simulate_fight, scale_monster
+    from sim.presets import build_player
+    from webhook_server import run_webhook
+
+    player = build_player("Marauder", 20, "rare")
+    monster_keys = list(MONSTERS)
+    rng = random.Random(os.getpid())
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message: Message):
+        for _ in range(fights):
+            simulate_fight(player, scale_monster(rng.choice(monster_keys), player['level'], rng), rng=rng)
+
+    async def serve():
+        bot = Bot("42:BENCH")
+        try:
+            await run_webhook(dp, bot, ["message"], url="", path=os.environ["BOT_WEBHOOK_PATH"],
+                              host="127.0.0.1", port=int(os.environ["BOT_WEBHOOK_PORT"]),
+                              secret_token=os.environ["BOT_WEBHOOK_SECRET"], handle_in_background=False,
+                              set_webhook=False)
+        finally:
+            await bot.session.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass # Супервизор останавливает воркеры SIGINT-ом
+
+
+# --- Клиент ---
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _free_port_range(count: int) -> int:
+    """Первый из count подряд свободных портов (воркеры слушают base_port + i)."""
+    while True:
+        base = random.randint(20000, 60000)
+        try:
+            for port in range(base, base + count):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+
+def make_update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": "attack",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+        },
+    }
+
+async def run_shards(workers: int, args) -> dict:
+    port = _free_port()
+    base_port = _free_port_range(workers)
+    ready = asyncio.Event()
+
+    async def on_ready():
+        ready.set()
+
+    command = [sys.executable, "-m", "benchmarks.shard_bench", "--worker", "--fights", str(args.fights)]
+    supervisor = asyncio.create_task(run_supervisor(workers, command=command, base_port=base_port, path=WEBHOOK_PATH,
+                                                    host="127.0.0.1", port=port, telegram_secret=SECRET, on_ready=on_ready))
+    await asyncio.wait({supervisor, asyncio.create_task(ready.wait())}, return_when=asyncio.FIRST_COMPLETED)
+    if supervisor.done():
+        supervisor.result() # Ошибка запуска воркеров
+
+    url = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+    slots = asyncio.Semaphore(args.connections)
+    failed = 0
+    async with ClientSession() as http:
+        async def send(i: int):
+            nonlocal failed
+            async with slots:
+                async with http.post(url, json=make_update(i, 1000 + i % args.users),
+                                     headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as response:
+                    if response.status != 200:
+                        failed += 1
+
+        await asyncio.gather(*(send(i) for i in range(1, min(args.updates, 100) + 1))) # Прогрев
+        started = time.perf_counter()
+        await asyncio.gather(*(send(i) for i in range(1, args.updates + 1)))
+        elapsed = time.perf_counter() - started
+
+    supervisor.cancel()
+    try:
+        await supervisor
+    except asyncio.CancelledError:
+        pass
+    return {'workers': workers, 'seconds': elapsed, 'rate': args.updates / elapsed, 'failed': failed}
+
+async def _run(args) -> list[dict]:
+    return [await run_shards(n, args) for n in args.workers]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.shard_bench")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="числа воркеров для сравнения")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=500, help="разных игроков (ключ шардирования)")
+    parser.add_argument("--connections", type=int, default=40, help="параллельных POST (webhook max_connections)")
+    parser.add_argument("--fights", type=int, default=20, help="симуляций боя на апдейт (нагрузка CPU)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.worker:
+        return _worker_main(args.fights)
+
+    rows = asyncio.run(_run(args))
+    print(f"cpu_count={os.cpu_count()} fights/update={args.fights}")
+    print(f"{'workers':>7} {'updates/s':>10} {'speedup':>8} {'failed':>7} {'seconds':>8}")
+    for r in rows:
+        print(f"{r['workers']:>7} {r['rate']:>10.1f} {r['rate'] / rows[0]['rate']:>7.2f}x {r['failed']:>7} {r['seconds']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
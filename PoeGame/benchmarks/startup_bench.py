@@ -0,0 +1,89 @@
+# benchmarks/startup_bench.py
+"""
+Холодный старт бота: --runs раз запускает новый процесс, который проходит те же фазы, что bot.py
+до приема апдейтов (импорты, init_db, restore FSM, диспетчер, gc.freeze), и печатает профиль startup.py.
+Сеть не нужна: работа идет с временной копией poe_bot.db и пустым FSM-файлом.
+Итог - медианы фаз и время от запуска процесса до готовности; код возврата 1, если медиана
+готовности выше бюджета (config.STARTUP_BUDGET или --budget).
+
+Запуск из папки PoeGame:
+    python -m benchmarks.startup_bench --runs 5
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+
+def _child(db_path: str, fsm_path: str):
+    from startup import startup # Первым, как в bot.py
+    startup.pause_gc()
+    import bot
+    import database.db_manager as dbm
+    from fsm_storage import SQLiteStorage
+
+    dbm.DB_NAME = db_path
+
+    async def warm_up():
+        with startup.phase("init_db"):
+            await dbm.init_db()
+        storage = SQLiteStorage(fsm_path)
+        with startup.phase("restore FSM"):
+            await storage.restore()
+        with startup.phase("dispatcher"):
+            bot.build_dispatcher(storage)
+        startup.freeze_heap()
+        startup.mark_ready()
+
+    asyncio.run(warm_up())
+    print(json.dumps({'phases': startup.phases, 'ready': startup.ready_after, 'frozen': startup.frozen_objects}))
+
+def _run_once(db_path: str, fsm_path: str) -> dict:
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-m", "benchmarks.startup_bench", "--child", db_path, fsm_path],
+                            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - started # Включая запуск интерпретатора и выход
+    return result
+
+def main(argv=None):
+    from config import DB_NAME, STARTUP_BUDGET
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.startup_bench")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET, help="сек до готовности (медиана)")
+    parser.add_argument("--child", nargs=2, metavar=("DB", "FSM"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        return _child(*args.child)
+
+    workdir = tempfile.mkdtemp(prefix="startup_bench_")
+    try:
+        db_path = os.path.join(workdir, "poe_bot.db")
+        if os.path.exists(DB_NAME):
+            shutil.copy(DB_NAME, db_path) # Настоящая БД не трогается
+        runs = [_run_once(db_path, os.path.join(workdir, "fsm_state.db")) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"runs={args.runs} frozen_objects={runs[-1]['frozen']}")
+    print(f"{'phase':<24} {'median_ms':>10} {'max_ms':>10}")
+    for i, (name, _) in enumerate(runs[0]['phases']):
+        values = [run['phases'][i][1] * 1000 for run in runs]
+        print(f"{name:<24} {statistics.median(values):>10.1f} {max(values):>10.1f}")
+    ready = statistics.median(run['ready'] for run in runs)
+    process = statistics.median(run['process'] for run in runs)
+    print(f"{'ready (in process)':<24} {ready * 1000:>10.1f}")
+    print(f"{'process spawn..exit':<24} {process * 1000:>10.1f}")
+    print(f"budget {args.budget:.2f}s: {'OK' if ready <= args.budget else 'OVER'}")
+    return 0 if ready <= args.budget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
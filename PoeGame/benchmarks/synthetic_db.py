@@ -0,0 +1,104 @@
+# benchmarks/synthetic_db.py
+"""
+Синтетическая БД для бенчмарков: --players игроков со случайными классами и уровнями,
+по --items предметов у каждого (слоты экипировки заполнены, остальное - рюкзак и фрагменты боссов),
+выученные спеллы и кулдауны боссов. Схема - из init_db(), данные - пакетными вставками sqlite3
+(быстро и без логов add_player). Генерация детерминирована (--seed).
+
+Запуск из папки PoeGame:
+    python -m benchmarks.synthetic_db /tmp/synthetic.db --players 2000 --items 40
+"""
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+
+from game_data import ALL_ITEMS, BASE_STATS, SPELLS, BOSSES, ITEM_SLOTS
+
+FRAGMENTS_PER_PLAYER = 6 # Фрагментов каждого из первых боссов - хватает на remove_player_fragments
+PLAYER_ID_BASE = 100_000_000 # user_id игроков: PLAYER_ID_BASE + i
+
+
+def player_ids(players: int) -> range:
+    return range(PLAYER_ID_BASE, PLAYER_ID_BASE + players)
+
+def _equipment(rng: random.Random) -> list[tuple[str, str]]:
+    """(item_id, слот) - по предмету на каждый слот экипировки."""
+    by_slot: dict[str, list[str]] = {}
+    for item_id, item in ALL_ITEMS.items():
+        for slot in ITEM_SLOTS.get(item.get('type'), []):
+            by_slot.setdefault(slot, []).append(item_id)
+    return [(rng.choice(items), slot) for slot, items in sorted(by_slot.items())]
+
+def _player_row(user_id: int, rng: random.Random, now: float) -> tuple:
+    chosen_class = rng.choice(sorted(BASE_STATS))
+    base = BASE_STATS[chosen_class]
+    level = rng.randint(1, 60)
+    hp, mana = base['hp'] + level * 12, base['mana'] + level * 6
+    return (
+        user_id, f"bench_{user_id}", chosen_class, level, rng.randint(0, 900), 100 + level * 50,
+        hp, rng.randint(1, hp), mana, rng.randint(0, mana), base['str'] + level, base['dex'] + level,
+        base['int'] + level, rng.randint(0, 50_000), rng.randint(0, 300), 0, 0, 5.0, 150.0,
+        0, 0, rng.randint(0, level), now, now, rng.randint(0, len(BOSSES) - 1),
+    )
+
+def populate(path: str, players: int, items: int, seed: int = 1) -> dict:
+    """Заполняет БД (схема уже создана init_db). Возвращает число строк по таблицам."""
+    rng = random.Random(seed)
+    now = time.time()
+    loot = sorted(i for i, item in ALL_ITEMS.items() if item.get('drop_chance', 0) > 0) or sorted(ALL_ITEMS)
+    spells = sorted(SPELLS)
+    fragments = [boss['fragment_item_id'] for boss in BOSSES[:3]]
+
+    player_rows, inventory_rows, spell_rows, cooldown_rows = [], [], [], []
+    for user_id in player_ids(players):
+        player_rows.append(_player_row(user_id, rng, now))
+        equipped = _equipment(rng)
+        inventory_rows += [(user_id, item_id, True, slot) for item_id, slot in equipped]
+        bag = max(0, items - len(equipped) - FRAGMENTS_PER_PLAYER * len(fragments))
+        inventory_rows += [(user_id, rng.choice(loot), False, None) for _ in range(bag)]
+        inventory_rows += [(user_id, frag, False, None) for frag in fragments for _ in range(FRAGMENTS_PER_PLAYER)]
+        spell_rows += [(user_id, spell_id) for spell_id in spells[:rng.randint(1, len(spells))]]
+        cooldown_rows += [(user_id, boss['id'], now - rng.randint(0, 86400))
+                          for boss in rng.sample(BOSSES, rng.randint(0, len(BOSSES)))]
+
+    with sqlite3.connect(path) as db:
+        db.executemany(f"INSERT INTO players (user_id, username, class, level, xp, xp_to_next_level, "
+                       f"max_hp, current_hp, max_mana, current_mana, strength, dexterity, intelligence, gold, armor, "
+                       f"max_energy_shield, energy_shield, crit_chance, crit_damage, last_daily_reward_time, "
+                       f"last_quest_time, stat_points, last_hp_regen_time, last_mana_regen_time, "
+                       f"highest_unlocked_boss_index) VALUES ({', '.join('?' * 25)})", player_rows)
+        db.executemany("INSERT INTO inventory (player_id, item_id, is_equipped, equipped_slot) VALUES (?, ?, ?, ?)",
+                       inventory_rows)
+        db.executemany("INSERT OR IGNORE INTO player_spells (player_id, spell_id) VALUES (?, ?)", spell_rows)
+        db.executemany("INSERT INTO boss_cooldowns (player_id, boss_id, last_kill_time) VALUES (?, ?, ?)", cooldown_rows)
+        db.execute("ANALYZE")
+    return {'players': len(player_rows), 'inventory': len(inventory_rows),
+            'player_spells': len(spell_rows), 'boss_cooldowns': len(cooldown_rows)}
+
+def build(path: str, players: int, items: int, seed: int = 1) -> dict:
+    """Создает схему через init_db() по пути path и заполняет ее. Вызывать вне цикла событий."""
+    import database.db_manager as dbm
+
+    previous, dbm.DB_NAME = dbm.DB_NAME, path
+    try:
+        asyncio.run(dbm.init_db())
+    finally:
+        dbm.DB_NAME = previous
+    return populate(path, players, items, seed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.synthetic_db")
+    parser.add_argument("path")
+    parser.add_argument("--players", type=int, default=2000)
+    parser.add_argument("--items", type=int, default=40, help="предметов у каждого игрока")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    started = time.perf_counter()
+    counts = build(args.path, args.players, args.items, args.seed)
+    print(f"{args.path}: {counts} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
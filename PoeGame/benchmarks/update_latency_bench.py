@@ -0,0 +1,147 @@
+# benchmarks/update_latency_bench.py
+"""
+Задержка доставки апдейта до хендлера: polling против webhook.
+Поднимает в процессе поддельный Bot API (tools/fake_bot_api.py, getUpdates с long polling), подает апдейты
+с заданной частотой и меряет время от появления апдейта до конца хендлера:
+  - polling: апдейт кладется в очередь getUpdates, бот забирает его dp.start_polling;
+  - webhook: апдейт POST-ится на webhook_server (как это делает Telegram, до max_connections параллельно).
+Хендлер имитирует работу (--handler-ms). Бот, БД и сеть Telegram не используются.
+
+Запуск из папки PoeGame:
+    python -m benchmarks.update_latency_bench --updates 2000 --rate 400
+"""
+import time
+import asyncio
+import argparse
+import statistics
+
+from aiohttp import web, ClientSession
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Message
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from shutdown import InFlightTracker
+from webhook_server import build_app
+from tools.fake_bot_api import FakeBotAPI, make_message_update, start_fake_api
+
+TOKEN = "42:BENCH"
+SECRET = "bench-secret"
+WEBHOOK_PATH = "/webhook"
+
+
+def make_update(update_id: int) -> dict:
+    user_id = 1000 + update_id % 500 # Разные пользователи - апдейты не сериализуются по чату
+    return make_message_update(update_id, user_id, "ping")
+
+def make_dispatcher(sent_at: dict, latencies: list, done: asyncio.Event, total: int, handler_ms: float,
+                    concurrency: int | None = None) -> Dispatcher:
+    dp = Dispatcher()
+    dp.update.outer_middleware(InFlightTracker(concurrency)) # Лимит обработок, как в bot.py
+
+    @dp.message(F.text == "ping")
+    async def on_ping(message: Message):
+        if handler_ms:
+            await asyncio.sleep(handler_ms / 1000)
+        latencies.append(time.perf_counter() - sent_at[message.message_id])
+        if len(latencies) >= total:
+            done.set()
+
+    return dp
+
+async def _start_site(app: web.Application) -> tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+async def _feed(total: int, rate: float, send):
+    """Подает апдейты равномерно с частотой rate (send - корутина или функция)."""
+    started = time.perf_counter()
+    pending = set()
+    for i in range(1, total + 1):
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        result = send(i)
+        if asyncio.iscoroutine(result):
+            task = asyncio.create_task(result)
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.gather(*pending)
+
+async def run_polling(total: int, rate: float, handler_ms: float, concurrency: int | None) -> list[float]:
+    api = FakeBotAPI(record_params=False)
+    api_runner, api_url = await start_fake_api(api)
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)))
+    sent_at, latencies, done = {}, [], asyncio.Event()
+    dp = make_dispatcher(sent_at, latencies, done, total, handler_ms, concurrency)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=10))
+
+    def send(i: int):
+        sent_at[i] = time.perf_counter()
+        api.push(make_update(i))
+
+    await asyncio.sleep(0.2) # Первый getUpdates уже висит
+    await _feed(total, rate, send)
+    await asyncio.wait_for(done.wait(), 60)
+    await dp.stop_polling()
+    await polling
+    await api_runner.cleanup()
+    return latencies
+
+async def run_webhook(total: int, rate: float, handler_ms: float, concurrency: int | None, connections: int) -> list[float]:
+    bot = Bot(TOKEN)
+    sent_at, latencies, done = {}, [], asyncio.Event()
+    dp = make_dispatcher(sent_at, latencies, done, total, handler_ms, concurrency)
+    app, _ = build_app(dp, bot, WEBHOOK_PATH, SECRET, handle_in_background=True)
+    runner, port = await _start_site(app)
+    url = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+    connection_slots = asyncio.Semaphore(connections) # Telegram держит не больше max_connections запросов
+
+    async with ClientSession() as http:
+        async def send(i: int):
+            async with connection_slots:
+                sent_at[i] = time.perf_counter()
+                async with http.post(url, json=make_update(i), headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as resp:
+                    resp.raise_for_status()
+
+        await _feed(total, rate, send)
+        await asyncio.wait_for(done.wait(), 60)
+    await runner.cleanup()
+    await bot.session.close()
+    return latencies
+
+def _summary(mode: str, latencies: list[float]) -> str:
+    ms = sorted(x * 1000 for x in latencies)
+    q = statistics.quantiles(ms, n=100)
+    return f"{mode:<8} {len(ms):>7} {q[49]:>9.2f} {q[94]:>9.2f} {q[98]:>9.2f} {ms[-1]:>9.2f}"
+
+async def _run(args) -> list[str]:
+    concurrency = args.concurrency or None
+    rows = []
+    if args.mode in ("polling", "both"):
+        rows.append(_summary("polling", await run_polling(args.updates, args.rate, args.handler_ms, concurrency)))
+    if args.mode in ("webhook", "both"):
+        rows.append(_summary("webhook", await run_webhook(args.updates, args.rate, args.handler_ms, concurrency, args.connections)))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.update_latency_bench")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=400.0, help="апдейтов в секунду")
+    parser.add_argument("--handler-ms", type=float, default=5.0, help="имитация работы хендлера")
+    parser.add_argument("--concurrency", type=int, default=64, help="лимит одновременных обработок (0 - без лимита)")
+    parser.add_argument("--connections", type=int, default=40, help="параллельных POST (webhook max_connections)")
+    parser.add_argument("--mode", choices=("polling", "webhook", "both"), default="both")
+    args = parser.parse_args(argv)
+    rows = asyncio.run(_run(args))
+    print(f"{'mode':<8} {'updates':>7} {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9} {'max_ms':>9}")
+    for row in rows:
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
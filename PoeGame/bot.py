@@ -1,53 +1,77 @@
 # bot.py
+from startup import startup, FirstUpdateMiddleware # Первым: отсчет холодного старта и замер фаз
+if __name__ == "__main__":
+    startup.pause_gc() # До тяжелых импортов; сборщик включится после прогрева (on_startup)
+    # --- Настройка логирования ---
+    # Через очередь: время, шаблон и вывод - в отдельном потоке (log_setup.py); уровень и файл - в config.py
+    from config import LOG_LEVEL, LOG_FILE
+    from log_setup import setup_logging
+    setup_logging(LOG_LEVEL, LOG_FILE)
+
 import asyncio
 import logging # Импортируем модуль логирования
 
-# Импортируем компоненты aiogram
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-# Импортируем DefaultBotProperties для настроек бота по умолчанию
-from aiogram.client.default import DefaultBotProperties
+with startup.phase("import aiogram"):
+    # Импортируем компоненты aiogram
+    from aiogram import Bot, Dispatcher
+    # Импортируем DefaultBotProperties для настроек бота по умолчанию
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
 
-# Импортируем токен из конфига и функцию инициализации БД
-from config import BOT_TOKEN
-from database.db_manager import init_db
-
-# Импортируем все роутеры из папки handlers
-# Убедись, что все эти файлы существуют в папке handlers
-from handlers import common, profile, combat, daily, city, stats, inventory, ranking, boss, shop, gambler, blacksmith, magic_school
-
-# --- Основная асинхронная функция ---
-async def main():
-    # --- Настройка логирования ---
-    # Устанавливаем уровень INFO. Для более детальной отладки можно поставить logging.DEBUG
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s", # Добавили имя файла и строку
-        # filename='bot.log', # Раскомментируй для записи логов в файл
-        # filemode='a' # 'a' - дописывать в файл, 'w' - перезаписывать
+with startup.phase("import core"):
+    # Импортируем токен из конфига и функцию инициализации БД
+    from config import (
+        BOT_TOKEN, TELEGRAM_API_URL, FSM_DB_NAME, RUN_MODE, UPDATE_CONCURRENCY_LIMIT, STARTUP_BUDGET, DROP_PENDING_UPDATES,
+        SHUTDOWN_DRAIN_TIMEOUT,
+        WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+        WEBHOOK_HANDLE_IN_BACKGROUND, WEBHOOK_MAX_CONNECTIONS,
+        SHARD_WORKERS, SHARD_BASE_PORT, SHARD_INDEX, SHARD_COUNT, METRICS_HOST, METRICS_PORT
     )
-    logging.info("Initializing bot...")
-
-    # Инициализируем базу данных (создаем/обновляем таблицы)
-    try:
-        await init_db()
-        logging.info("Database initialization complete.")
-    except Exception as e:
-        logging.critical(f"CRITICAL: Failed to initialize database: {e}", exc_info=True)
-        return # Завершаем работу, если БД не готова
+    from database.db_manager import init_db, checkpoint_wal
+    from fsm_storage import SQLiteStorage # FSM в SQLite: LRU в памяти + пакетная запись
+    from combat_session import combat_sessions # Реестр живых боев (TTL + контрольные точки)
+    from combat_log import combat_events # Бинарный журнал боев (пакетная запись)
+    from outbound import outbound, GLOBAL_RATE, GLOBAL_BURST # Исходящие запросы: лимиты Telegram, склейка правок, повтор на 429
+    from middlewares.callback_guard import callback_guard # Дубли нажатий и лимит очереди нажатий на чат
+    from middlewares.user_lock import user_locks # Апдейты одного игрока - строго по очереди
+    from middlewares.player_context import player_context # Проверка регистрации + player_ctx для хендлеров
+    from middlewares.query_budget import query_budget # Запросы к БД на апдейт: бюджет и самые дорогие хендлеры
+    from shutdown import shutdown, in_flight # Остановка по SIGTERM/SIGINT: дообработка апдейтов, сброс буферов
+    from metrics import handler_metrics, telegram_metrics # Время хендлеров и запросов к Bot API (/metrics)
+    # webhook_server и sharding (тянут aiohttp.web) импортируются только в своем режиме запуска
 
-    # Используем MemoryStorage для хранения состояний FSM
-    storage = MemoryStorage()
-
-    # Создаем объект с настройками по умолчанию для бота (ParseMode=HTML)
-    default_properties = DefaultBotProperties(parse_mode="HTML")
-
-    # Инициализируем объект бота
-    bot = Bot(token=BOT_TOKEN, default=default_properties)
+with startup.phase("import handlers"):
+    # Импортируем все роутеры из папки handlers
+    # Убедись, что все эти файлы существуют в папке handlers
+    from handlers import common, profile, combat, daily, city, stats, inventory, ranking, boss, shop, gambler, blacksmith, magic_school
 
+# --- Диспетчер: middleware и роутеры ---
+def build_dispatcher(storage=None) -> Dispatcher | None:
+    """Диспетчер со всеми middleware и роутерами; None - роутеры не подключились."""
     # Инициализируем диспетчер
     dp = Dispatcher(storage=storage)
 
+    # --- Middleware ---
+    # Учет обрабатываемых апдейтов и их лимит - первым, чтобы при остановке дождаться и ждущих замка игрока
+    in_flight.set_limit(UPDATE_CONCURRENCY_LIMIT)
+    dp.update.outer_middleware(in_flight)
+    dp.update.outer_middleware(FirstUpdateMiddleware(startup))
+    # Лишние нажатия отсекаются до замка пользователя - не ждут очереди и не доходят до хендлеров
+    dp.update.outer_middleware(callback_guard)
+    # Замок пользователя - на уровне update, чтобы покрыть все типы событий и остальные middleware
+    dp.update.outer_middleware(user_locks)
+    # Счетчики БД апдейта - до player_context: его запросы тоже в счет апдейта
+    dp.update.outer_middleware(query_budget)
+    # Outer: срабатывает до фильтров, один раз на апдейт (event_from_user уже заполнен диспетчером)
+    dp.message.outer_middleware(player_context)
+    dp.callback_query.outer_middleware(player_context)
+    # Inner: время и ошибки хендлера (только апдейты, дошедшие до хендлера)
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
+    dp.message.middleware(query_budget.probe)
+    dp.callback_query.middleware(query_budget.probe)
+
     # --- Регистрация роутеров ---
     logging.info("Registering handlers (routers)...")
     try:
@@ -69,31 +93,205 @@ async def main():
         logging.info("All handlers registered successfully.")
     except Exception as e:
         logging.critical(f"CRITICAL: Failed to register handlers: {e}", exc_info=True)
+        return None
+    return dp
+
+
+# --- Сессия Bot API ---
+def make_session() -> AiohttpSession | None:
+    """Свой адрес Bot API (BOT_TELEGRAM_API_URL - например tools/fake_bot_api.py); None - api.telegram.org."""
+    if not TELEGRAM_API_URL:
+        return None
+    logging.warning(f"Using custom Bot API server: {TELEGRAM_API_URL}")
+    return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL.rstrip("/")))
+
+
+# --- Супервизор шардов ---
+async def run_shard_supervisor():
+    """
+    BOT_SHARD_WORKERS > 0: этот процесс только принимает вебхук и раздает апдейты воркерам
+    (sharding.py). Миграции БД - здесь, один раз до запуска воркеров.
+    """
+    from sharding import run_supervisor
+
+    await init_db()
+    logging.info("Database initialization complete.")
+    dp = build_dispatcher() # Только чтобы узнать allowed_updates для вебхука
+    if dp is None:
+        return
+    used_update_types = dp.resolve_used_update_types()
+    bot = Bot(token=BOT_TOKEN, session=make_session())
+
+    async def register_webhook():
+        await bot.set_webhook(url=WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                              allowed_updates=used_update_types, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                              drop_pending_updates=DROP_PENDING_UPDATES)
+        logging.info(f"Webhook set to {WEBHOOK_BASE_URL.rstrip('/') + WEBHOOK_PATH} ({SHARD_WORKERS} shards).")
+
+    try:
+        await run_supervisor(SHARD_WORKERS, base_port=SHARD_BASE_PORT, path=WEBHOOK_PATH, host=WEBHOOK_HOST,
+                             port=WEBHOOK_PORT, telegram_secret=WEBHOOK_SECRET or None, on_ready=register_webhook,
+                             stop=shutdown.requested) # Воркеры получают SIGINT и останавливаются сами
+    finally:
+        await bot.session.close()
+
+# --- Основная асинхронная функция ---
+async def main():
+    is_shard_worker = SHARD_INDEX >= 0
+    if SHARD_WORKERS > 0 and not is_shard_worker:
+        if not WEBHOOK_BASE_URL:
+            logging.critical("CRITICAL: BOT_SHARD_WORKERS requires BOT_WEBHOOK_BASE_URL.")
+            return
+        logging.info(f"Starting shard supervisor with {SHARD_WORKERS} workers...")
+        shutdown.install_signal_handlers()
+        try:
+            await run_shard_supervisor()
+        except Exception as e:
+            logging.critical(f"CRITICAL: Shard supervisor failed: {e}", exc_info=True)
+        return
+    logging.info(f"Initializing bot{f' (shard {SHARD_INDEX + 1}/{SHARD_COUNT})' if is_shard_worker else ''}...")
+
+    # Инициализируем базу данных (создаем/обновляем таблицы); воркеру шарда это уже сделал супервизор
+    if not is_shard_worker:
+        try:
+            with startup.phase("init_db"):
+                await init_db()
+            logging.info("Database initialization complete.")
+        except Exception as e:
+            logging.critical(f"CRITICAL: Failed to initialize database: {e}", exc_info=True)
+            return # Завершаем работу, если БД не готова
+
+    # FSM-хранилище в SQLite: живые записи поднимаются в память одним запросом (у шарда - свой файл)
+    if is_shard_worker:
+        from sharding import shard_path
+        storage = SQLiteStorage(shard_path(FSM_DB_NAME, SHARD_INDEX))
+    else:
+        storage = SQLiteStorage(FSM_DB_NAME)
+    try:
+        with startup.phase("restore FSM"):
+            await storage.restore()
+    except Exception as e:
+        logging.critical(f"CRITICAL: Failed to restore FSM storage: {e}", exc_info=True)
+        return
+
+    # Создаем объект с настройками по умолчанию для бота (ParseMode=HTML)
+    default_properties = DefaultBotProperties(parse_mode="HTML")
+
+    # Инициализируем объект бота
+    bot = Bot(token=BOT_TOKEN, session=make_session(), default=default_properties)
+    bot.session.middleware(outbound)
+    bot.session.middleware(telegram_metrics) # После outbound: время самого запроса, без ожидания лимитов
+    if is_shard_worker:
+        # Лимит Telegram общий на бота - каждый шард шлет не больше своей доли
+        outbound.set_global_rate(GLOBAL_RATE / SHARD_COUNT, max(1, GLOBAL_BURST // SHARD_COUNT))
+
+    with startup.phase("dispatcher"):
+        dp = build_dispatcher(storage)
+    if dp is None:
         return # Завершаем работу, если хендлеры не подключены
 
     # Определяем типы обновлений, которые будет обрабатывать бот
     used_update_types = dp.resolve_used_update_types()
     logging.info(f"Bot will process update types: {used_update_types}")
 
-    # Удаляем вебхук перед запуском поллинга
-    try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        logging.info("Webhook deleted (if existed). Starting polling.")
-    except Exception as e:
-        logging.error(f"Error deleting webhook: {e}. Continuing...", exc_info=False)
+    # Прогрев закончен (оба режима: перед первым getUpdates / приемом вебхуков):
+    # замораживаем кучу и пишем профиль старта
+    async def on_startup():
+        startup.freeze_heap()
+        startup.mark_ready(STARTUP_BUDGET)
+
+    dp.startup.register(on_startup)
 
     # --- Запуск бота ---
-    logging.info("Starting bot polling...")
+    shutdown.install_signal_handlers() # SIGTERM/SIGINT -> shutdown.requested, дальше - фазы в finally
+    session_expiry_task = asyncio.create_task(combat_sessions.run_expiry_loop())
+    combat_log_task = asyncio.create_task(combat_events.run_flush_loop())
+    fsm_flush_task = asyncio.create_task(storage.run_flush_loop())
+    metrics_server = None # Сервер /metrics
+    loop_lag_task = None
+    if METRICS_PORT:
+        from metrics import register_module_stats, run_loop_lag_monitor, start_metrics_server
+        register_module_stats(storage)
+        loop_lag_task = asyncio.create_task(run_loop_lag_monitor())
+        try:
+            metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT + max(SHARD_INDEX, 0))
+        except OSError as e: # Порт занят - бот работает и без метрик
+            logging.error(f"Failed to start metrics server: {e}")
+    server = None # Сервер вебхука
+    polling = None # Задача поллинга
     try:
-        # Запускаем поллинг
-        await dp.start_polling(bot, allowed_updates=used_update_types)
+        if RUN_MODE == "webhook":
+            if not WEBHOOK_BASE_URL and not is_shard_worker:
+                logging.critical("CRITICAL: BOT_RUN_MODE=webhook requires BOT_WEBHOOK_BASE_URL.")
+                return
+            logging.info("Starting bot in webhook mode...")
+            from webhook_server import start_webhook
+            server = await start_webhook(
+                dp, bot, used_update_types,
+                url=WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH, path=WEBHOOK_PATH,
+                host=WEBHOOK_HOST, port=WEBHOOK_PORT, secret_token=WEBHOOK_SECRET or None,
+                handle_in_background=WEBHOOK_HANDLE_IN_BACKGROUND,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                set_webhook=not is_shard_worker, # Вебхук шардов регистрирует супервизор
+                drop_pending_updates=DROP_PENDING_UPDATES,
+            )
+            await shutdown.requested.wait()
+        else:
+            # Удаляем вебхук перед запуском поллинга
+            try:
+                with startup.phase("delete_webhook"):
+                    await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+                logging.info("Webhook deleted (if existed). Starting polling.")
+            except Exception as e:
+                logging.error(f"Error deleting webhook: {e}. Continuing...", exc_info=False)
+            logging.info("Starting bot polling...")
+            # Сигналы ловит shutdown, а не aiogram: после остановки поллинга еще дообработка и сброс буферов
+            polling = asyncio.create_task(dp.start_polling(
+                bot, allowed_updates=used_update_types, # Лимит обработок - в in_flight (общий с вебхуком)
+                close_bot_session=False, handle_signals=False,
+            ))
+            stop_requested = asyncio.create_task(shutdown.requested.wait())
+            await asyncio.wait((polling, stop_requested), return_when=asyncio.FIRST_COMPLETED)
+            stop_requested.cancel()
+            if polling.done():
+                polling.result() # Поллинг упал сам - ошибка в лог ниже
     except Exception as e:
-        logging.critical(f"CRITICAL: Polling failed with error: {e}", exc_info=True)
+        logging.critical(f"CRITICAL: Bot failed with error ({RUN_MODE}): {e}", exc_info=True)
     finally:
-        # Корректное завершение сессии бота при остановке
+        # --- Упорядоченная остановка (каждая фаза замеряется и ограничена по времени) ---
         logging.info("Stopping bot...")
-        await bot.session.close()
-        logging.info("Bot session closed.")
+        # 1. Новые апдейты не принимаем
+        if polling is not None and not polling.done():
+            async def stop_polling():
+                try:
+                    await dp.stop_polling()
+                except RuntimeError: # Сигнал пришел до запуска поллинга
+                    polling.cancel()
+            await shutdown.phase("stop polling", stop_polling())
+        if server is not None:
+            await shutdown.phase("stop webhook", server.stop_accepting())
+        # 2. Принятые апдейты дообрабатываются (и ждущие лимита), не успевшие - отменяются
+        await shutdown.phase("drain updates", in_flight.drain(SHUTDOWN_DRAIN_TIMEOUT), timeout=None)
+        if server is not None:
+            await shutdown.phase("close webhook server", server.cleanup())
+        # 3. Буферы в памяти - на диск (бои пишут в FSM, поэтому их контрольные точки - до сброса FSM)
+        session_expiry_task.cancel()
+        await shutdown.phase("checkpoint combats", combat_sessions.checkpoint_all())
+        fsm_flush_task.cancel()
+        await shutdown.phase("flush FSM", storage.close())
+        combat_log_task.cancel()
+        await shutdown.phase("flush combat log", combat_events.close()) # Остаток буфера журнала боев
+        await shutdown.phase("flush outbound", outbound.close()) # Дослать очередь исходящих
+        # 4. WAL -> основные файлы БД
+        await shutdown.phase("WAL checkpoint", checkpoint_wal())
+        await shutdown.phase("WAL checkpoint FSM", storage.checkpoint_wal())
+        # 5. Соединения: отдельного пула БД нет (соединение на вызов) - остается HTTP-сессия бота и /metrics
+        if loop_lag_task is not None:
+            loop_lag_task.cancel()
+        if metrics_server is not None:
+            await shutdown.phase("close metrics server", metrics_server.cleanup())
+        await shutdown.phase("close bot session", bot.session.close())
+        logging.info(f"Shutdown profile ({shutdown.reason or RUN_MODE + ' stopped'}):\n{shutdown.report()}")
 
 
 # --- Точка входа в приложение ---
@@ -0,0 +1,209 @@
+# combat_effects.py
+"""
+Планировщик временных эффектов боя: лечение со временем (HoT), урон со временем (DoT),
+временные прибавки к статам и призванные союзники, которые атакуют каждый ход.
+Эффекты лежат в min-куче по ходу следующего срабатывания/истечения, поэтому ход стоит
+O(log n) на сработавший эффект, а не пересборку всех баффов.
+
+Порядок хода: действие игрока (может добавить эффекты) -> advance() -> атака противника.
+Эффект, наложенный на ходу T с длительностью d:
+  - HoT/DoT/призыв срабатывают на ходах T..T+d-1;
+  - прибавка к стату действует на атаки противника ходов T..T+d-1 и снимается в advance() хода T+d.
+Повторное наложение эффекта с тем же ключом заменяет старый (не стакается).
+"""
+import heapq
+import logging
+
+from game_data import SUMMONS, calculate_final_spell_damage
+
+# --- Типы эффектов ---
+EFFECT_HOT = "hot"         # Лечение игрока каждый ход
+EFFECT_DOT = "dot"         # Урон противнику каждый ход
+EFFECT_STAT = "stat"       # Временная прибавка к стату (armor, ...)
+EFFECT_SUMMON = "summon"   # Союзник, атакующий противника каждый ход
+TICKING_EFFECTS = (EFFECT_HOT, EFFECT_DOT, EFFECT_SUMMON)
+
+
+class TimedEffect:
+    """Один эффект. value - HP/урон за ход или прибавка к стату; due - ход срабатывания/истечения."""
+    __slots__ = ('kind', 'key', 'name', 'value', 'remaining', 'due')
+
+    def __init__(self, kind: str, key: str, name: str, value: int, remaining: int, due: int = 0):
+        self.kind = kind
+        self.key = key
+        self.name = name
+        self.value = value
+        self.remaining = remaining # Для тикающих - сколько срабатываний осталось
+        self.due = due
+
+    def __repr__(self):
+        return f"TimedEffect({self.kind}:{self.key}, value={self.value}, remaining={self.remaining}, due={self.due})"
+
+    def encode(self) -> list:
+        return [self.kind, self.key, self.name, self.value, self.remaining, self.due]
+
+    @classmethod
+    def decode(cls, record) -> "TimedEffect":
+        return cls(*record)
+
+
+class EffectTick:
+    """Итог advance(): сколько вылечено/нанесено эффектами и что истекло."""
+    __slots__ = ('healed', 'enemy_damage', 'events', 'expired')
+
+    def __init__(self):
+        self.healed = 0
+        self.enemy_damage = 0
+        self.events = [] # (эффект, величина) в порядке срабатывания
+        self.expired = [] # Имена истекших эффектов
+
+
+class EffectScheduler:
+    """Эффекты одного боя. attack_multiplier - бафф следующей атаки (тратится при атаке, не по времени)."""
+    __slots__ = ('turn', 'attack_multiplier', '_heap', '_active', '_stat_bonuses', '_seq')
+
+    def __init__(self, turn: int = 0, attack_multiplier: float = 1.0):
+        self.turn = turn
+        self.attack_multiplier = attack_multiplier
+        self._heap = [] # (due, seq, effect); seq разводит равные due и не дает сравнивать эффекты
+        self._active = {} # (kind, key) -> effect; запись кучи, чей эффект заменен, пропускается
+        self._stat_bonuses = {}
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._active)
+
+    def __bool__(self):
+        return bool(self._active) or self.attack_multiplier != 1.0
+
+    def _push(self, effect: TimedEffect):
+        self._seq += 1
+        heapq.heappush(self._heap, (effect.due, self._seq, effect))
+
+    def _remove_stat(self, effect: TimedEffect):
+        self._stat_bonuses[effect.key] = self._stat_bonuses.get(effect.key, 0) - effect.value
+
+    def add(self, effect: TimedEffect):
+        """Накладывает эффект на текущем ходу (заменяя эффект того же типа и ключа)."""
+        slot = (effect.kind, effect.key)
+        old = self._active.get(slot)
+        if old is not None and old.kind == EFFECT_STAT:
+            self._remove_stat(old)
+        if effect.kind == EFFECT_STAT:
+            effect.due = self.turn + effect.remaining
+            self._stat_bonuses[effect.key] = self._stat_bonuses.get(effect.key, 0) + effect.value
+        else:
+            effect.due = self.turn
+        self._active[slot] = effect
+        self._push(effect)
+
+    def advance(self) -> EffectTick:
+        """Срабатывания и истечения текущего хода, затем переход на следующий ход."""
+        tick = EffectTick()
+        heap = self._heap
+        while heap and heap[0][0] <= self.turn:
+            _, _, effect = heapq.heappop(heap)
+            slot = (effect.kind, effect.key)
+            if self._active.get(slot) is not effect:
+                continue # Эффект заменен повторным наложением
+            if effect.kind == EFFECT_STAT:
+                self._remove_stat(effect)
+                del self._active[slot]
+                tick.expired.append(effect.name)
+                continue
+            if effect.kind == EFFECT_HOT:
+                tick.healed += effect.value
+            else:
+                tick.enemy_damage += effect.value
+            tick.events.append((effect, effect.value))
+            effect.remaining -= 1
+            if effect.remaining > 0:
+                effect.due = self.turn + 1
+                self._push(effect)
+            else:
+                del self._active[slot]
+                tick.expired.append(effect.name)
+        self.turn += 1
+        return tick
+
+    def stat_bonus(self, stat_name: str) -> int:
+        return self._stat_bonuses.get(stat_name, 0)
+
+    def consume_attack_multiplier(self) -> float:
+        multiplier = self.attack_multiplier
+        self.attack_multiplier = 1.0
+        return multiplier
+
+    def active_effects(self) -> list[TimedEffect]:
+        return sorted(self._active.values(), key=lambda e: (e.due, e.kind, e.key))
+
+    def turns_left(self, effect: TimedEffect) -> int:
+        """Сколько ходов эффект еще действует после advance() (текущий ход бафф стата еще действует)."""
+        return effect.due - self.turn + 1 if effect.kind == EFFECT_STAT else effect.remaining
+
+    def describe(self) -> list[str]:
+        """Строки для сообщения боя: 'Armor (+20) [2 ход]', 'Каменный голем (8 урона) [3 ход]'."""
+        texts = []
+        for effect in self.active_effects():
+            left = self.turns_left(effect)
+            if effect.kind == EFFECT_STAT:
+                texts.append(f"{effect.name.capitalize()} (+{effect.value}) [{left} ход]")
+            elif effect.kind == EFFECT_HOT:
+                texts.append(f"{effect.name} (+{effect.value} HP) [{left} ход]")
+            else:
+                texts.append(f"{effect.name} ({effect.value} урона) [{left} ход]")
+        if self.attack_multiplier != 1.0:
+            texts.append(f"Усиление атаки (x{self.attack_multiplier:.1f})")
+        return texts
+
+    # --- Кодирование (для CombatState) ---
+    def encode(self) -> list:
+        return [self.turn, self.attack_multiplier, [effect.encode() for effect in self._active.values()]]
+
+    @classmethod
+    def decode(cls, record) -> "EffectScheduler":
+        turn, attack_multiplier, effects = record
+        scheduler = cls(turn, attack_multiplier)
+        for effect_record in effects:
+            effect = TimedEffect.decode(effect_record)
+            scheduler._active[(effect.kind, effect.key)] = effect
+            if effect.kind == EFFECT_STAT:
+                scheduler._stat_bonuses[effect.key] = scheduler._stat_bonuses.get(effect.key, 0) + effect.value
+            scheduler._push(effect)
+        return scheduler
+
+    @classmethod
+    def from_legacy_buffs(cls, buffs: dict) -> "EffectScheduler":
+        """Старый словарь баффов {'buff_next_attack': x, 'temp_armor': {'value', 'duration'}}."""
+        scheduler = cls(attack_multiplier=float(buffs.get("buff_next_attack", 1.0)))
+        for buff_key, buff_data in buffs.items():
+            if isinstance(buff_data, dict) and buff_key.startswith("temp_"):
+                stat_name = buff_key[len("temp_"):]
+                # В старом формате бафф с duration=d снимался на d-1 ходу от текущего
+                if buff_data['duration'] > 1:
+                    scheduler.add(TimedEffect(EFFECT_STAT, stat_name, stat_name, buff_data['value'], buff_data['duration'] - 1))
+        return scheduler
+
+
+# --- Эффекты заклинаний ---
+def make_spell_effects(spell_data: dict, intelligence: int) -> list[TimedEffect]:
+    """Временные эффекты заклинания (temp_buff, heal_over_time, damage_over_time, summon). Пустой список - эффекта нет."""
+    effect_type = spell_data.get('effect_type')
+    effect_value = spell_data.get('effect_value')
+    duration = spell_data.get('duration', 0)
+    try:
+        if effect_type == "temp_buff" and isinstance(effect_value, dict) and duration > 0:
+            return [TimedEffect(EFFECT_STAT, stat_name, stat_name, int(value), duration) for stat_name, value in effect_value.items()]
+        if effect_type == "heal_over_time":
+            return [TimedEffect(EFFECT_HOT, spell_data['name'], spell_data['name'],
+                                int(effect_value['hp_per_turn']), int(effect_value['duration']))]
+        if effect_type == "damage_over_time":
+            damage = calculate_final_spell_damage(effect_value['damage_per_turn'], intelligence)
+            return [TimedEffect(EFFECT_DOT, spell_data['name'], spell_data['name'], damage, int(effect_value['duration']))]
+        if effect_type == "summon":
+            summon = SUMMONS[effect_value]
+            damage = calculate_final_spell_damage(summon['damage'], intelligence)
+            return [TimedEffect(EFFECT_SUMMON, effect_value, summon['name'], damage, summon['duration'])]
+    except (KeyError, TypeError, ValueError) as e:
+        logging.error(f"Bad effect data for spell '{spell_data.get('name')}': {e}")
+    return []
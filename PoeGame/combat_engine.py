@@ -0,0 +1,489 @@
+# combat_engine.py
+"""
+Чистая боевая математика без aiogram и БД.
+Используется хендлерами боя, симулятором баланса и авто-боем,
+чтобы формулы жили в одном месте.
+"""
+import math
+import random
+import logging
+
+from game_data import (
+    BASE_STATS, MONSTERS, BOSSES, SPELLS, ALL_ITEMS, FARM_REGEN_SECONDS_PER_FIGHT,
+    calculate_final_spell_damage, calculate_damage_with_crit, get_random_loot_item_id
+)
+
+from combat_effects import EffectScheduler, make_spell_effects
+
+# --- Константы ---
+HP_GAIN_PER_LEVEL = 10
+MANA_GAIN_PER_LEVEL = 5
+BASE_CRIT_CHANCE = 5.0
+BASE_CRIT_DAMAGE = 150.0
+MAX_DODGE_CHANCE = 75.0
+DEFAULT_MAX_TURNS = 200 # Защита от бесконечного боя в симуляциях
+MAX_LEVEL = 100
+STAT_POINTS_PER_LEVEL = 2
+XP_TO_NEXT_LEVEL_GROWTH = 1.5 # Множитель требуемого опыта за уровень
+HP_REGEN_INTERVAL = 30 # Секунд на 1 HP пассивного регена
+MANA_REGEN_INTERVAL = 60 # Секунд на 1 ману пассивного регена
+
+
+# --- Базовые формулы ---
+def calculate_player_attack_damage(strength: int, crit_chance: float, crit_damage: float, rng=random) -> tuple[int, bool]:
+    """Рассчитывает базовый урон атаки, а затем применяет крит."""
+    base_damage = max(1, strength // 2)
+    return calculate_damage_with_crit(base_damage, crit_chance, crit_damage, rng=rng)
+
+def calculate_dodge_chance(dexterity: int) -> float:
+    return min(MAX_DODGE_CHANCE, dexterity / 5.0)
+
+def calculate_damage_reduction(armor: int) -> int:
+    return armor // 20
+
+
+# --- Прогрессия ---
+def calculate_level_progress(level: int, xp: int, xp_needed: int, gained_xp: int) -> tuple[int, int, int, int]:
+    """
+    Начисляет опыт и считает левел-апы.
+    Возвращает (новый_уровень, новый_опыт, опыт_до_след_уровня, полученные_очки_статов).
+    """
+    if level >= MAX_LEVEL:
+        gained_xp = 0
+    new_xp = xp + max(0, gained_xp)
+    new_level = level
+    gained_stat_points = 0
+    while new_xp >= xp_needed and new_level < MAX_LEVEL:
+        new_xp -= xp_needed
+        new_level += 1
+        gained_stat_points += STAT_POINTS_PER_LEVEL
+        xp_needed = int(xp_needed * XP_TO_NEXT_LEVEL_GROWTH)
+    return new_level, new_xp, xp_needed, gained_stat_points
+
+def calculate_base_max_vitals(class_name: str, strength: int, intelligence: int, level: int) -> tuple[int, int]:
+    """Max HP/Mana без предметов (как хранятся в таблице players)."""
+    base_class_stats = BASE_STATS.get(class_name, BASE_STATS['Scion'])
+    max_hp = base_class_stats['hp'] + int(strength * 0.5) + (level * HP_GAIN_PER_LEVEL)
+    max_mana = base_class_stats['mana'] + intelligence + (level * MANA_GAIN_PER_LEVEL)
+    return max_hp, max_mana
+
+def calculate_death_penalty(level: int, xp: int, gold: int) -> tuple[int, int]:
+    """Штраф за смерть: 10% опыта и 5% золота; на 1 уровне без штрафа."""
+    if level <= 1:
+        return 0, 0
+    return math.floor(xp * 0.10), math.floor(gold * 0.05)
+
+
+# --- Эффективные статы ---
+def calculate_effective_stats(player_base: dict, equipped_item_ids: list[str]) -> dict:
+    """
+    Считает полные статы игрока из базовой записи и списка надетых предметов.
+    Возвращает словарь статов с ключом 'active_effects'.
+    """
+    effective_stats = dict(player_base)
+    active_effects = {}
+
+    # Шаг 1: База + Уровень + Прокачка
+    base_class_stats = BASE_STATS.get(player_base['class'], BASE_STATS['Scion'])
+    level = player_base['level']
+    effective_stats['max_hp'] = base_class_stats['hp'] + int(effective_stats['strength'] * 0.5) + (level * HP_GAIN_PER_LEVEL)
+    effective_stats['max_mana'] = base_class_stats['mana'] + effective_stats['intelligence'] + (level * MANA_GAIN_PER_LEVEL)
+    effective_stats['armor'] = 0
+    effective_stats['max_energy_shield'] = 0
+    # Сбрасываем криты до базовых перед добавлением бонусов
+    effective_stats['crit_chance'] = BASE_CRIT_CHANCE
+    effective_stats['crit_damage'] = BASE_CRIT_DAMAGE
+
+    # Шаг 2: Добавляем статы и ЭФФЕКТЫ от экипированных предметов
+    for item_id in equipped_item_ids:
+        item_data = ALL_ITEMS.get(item_id, {})
+        for stat_name, value in item_data.get('stats', {}).items():
+            if stat_name in effective_stats:
+                # Проверяем, что стат числовой перед сложением
+                if isinstance(effective_stats[stat_name], (int, float)) and isinstance(value, (int, float)):
+                    effective_stats[stat_name] += value
+                else:
+                    logging.warning(f"Non-numeric stat addition skipped: {stat_name} (item: {item_data.get('name', '?')})")
+
+        item_effect = item_data.get('effect')
+        if item_effect and isinstance(item_effect, dict) and item_effect.get('type'):
+            effect_type = item_effect['type']
+            # TODO: Продумать стакание (суммировать? брать макс/мин?) Пока перезапись.
+            if effect_type in active_effects:
+                logging.warning(f"Effect '{effect_type}' overwritten by item '{item_data.get('name', '?')}'. Stacking logic needed.")
+            active_effects[effect_type] = item_effect.get('value')
+
+    # Шаг 3: Применение некоторых эффектов к статам
+    # Конвертация маны в ES ('mana_to_es') - от максимальной маны Шага 1
+    if 'mana_to_es' in active_effects:
+        try:
+            conversion_rate = float(active_effects['mana_to_es'])
+            mana_for_conversion = base_class_stats['mana'] + effective_stats['intelligence'] + (level * MANA_GAIN_PER_LEVEL)
+            effective_stats['max_energy_shield'] += int(mana_for_conversion * conversion_rate)
+        except (ValueError, TypeError) as e:
+            logging.error(f"Error applying 'mana_to_es' effect: {e}")
+
+    # Бонус к множителю крита ('crit_multiplier_bonus')
+    if 'crit_multiplier_bonus' in active_effects:
+        try:
+            effective_stats['crit_damage'] += float(active_effects['crit_multiplier_bonus'])
+        except (ValueError, TypeError) as e:
+            logging.error(f"Error applying 'crit_multiplier_bonus' effect: {e}")
+
+    # Шаг 4: Коррекция текущих значений
+    effective_stats['current_hp'] = min(effective_stats['current_hp'], effective_stats['max_hp'])
+    effective_stats['current_mana'] = min(effective_stats['current_mana'], effective_stats['max_mana'])
+    effective_stats['energy_shield'] = min(effective_stats['energy_shield'], effective_stats['max_energy_shield'])
+
+    effective_stats['active_effects'] = active_effects
+    return effective_stats
+
+def get_effect_modifiers(active_effects: dict) -> tuple[float, float]:
+    """Возвращает (множитель стоимости маны, бонус к множителю крита) из эффектов предметов."""
+    try: mana_multiplier = max(0.0, float(active_effects.get('mana_cost_multiplier', 1.0)))
+    except (ValueError, TypeError): mana_multiplier = 1.0
+    try: crit_mult_bonus = float(active_effects.get('crit_multiplier_bonus', 0))
+    except (ValueError, TypeError): crit_mult_bonus = 0.0
+    return mana_multiplier, crit_mult_bonus
+
+def get_regen_multiplier(active_effects: dict) -> float:
+    """Множитель пассивной регенерации от эффектов ('regen_multiplier'); <= 0 отключает реген."""
+    try:
+        return max(0.0, float(active_effects.get('regen_multiplier', 1.0)))
+    except (ValueError, TypeError):
+        return 1.0
+
+def calculate_regen_vitals(player: dict, now: int) -> tuple[int, int]:
+    """
+    Ленивая пассивная регенерация: текущие (HP, мана) из якорей.
+    current_hp/current_mana в БД - значения на момент last_hp_regen_time/last_mana_regen_time;
+    реген с тех пор считается при чтении (с учетом regen_multiplier и cannot_regen_mana), не выше максимумов.
+    """
+    hp, mana = player['current_hp'], player['current_mana']
+    active_effects = player.get('active_effects', {})
+    regen_multiplier = get_regen_multiplier(active_effects)
+    if regen_multiplier <= 0:
+        return hp, mana
+    if hp < player['max_hp']:
+        hp_regen = math.floor(max(0, now - player['last_hp_regen_time']) / HP_REGEN_INTERVAL * regen_multiplier)
+        hp = min(player['max_hp'], hp + hp_regen)
+    if mana < player['max_mana'] and 'cannot_regen_mana' not in active_effects:
+        mana_regen = math.floor(max(0, now - player['last_mana_regen_time']) / MANA_REGEN_INTERVAL * regen_multiplier)
+        mana = min(player['max_mana'], mana + mana_regen)
+    return hp, mana
+
+def get_spell_mana_cost(spell_data: dict, mana_multiplier: float) -> int:
+    """Фактическая стоимость заклинания с учетом множителя маны."""
+    try:
+        return math.ceil(int(spell_data['mana_cost']) * mana_multiplier)
+    except (KeyError, ValueError, TypeError):
+        return 99999
+
+
+# --- Противники ---
+def scale_monster(monster_key: str, player_level: int, rng=random) -> dict:
+    """Скалирует монстра под уровень игрока. Возвращает словарь с hp/damage/xp/gold."""
+    base_monster = MONSTERS[monster_key]
+    # Формулы скалирования (можно настраивать)
+    hp_multiplier = 1 + (player_level - 1) * 0.15
+    damage_multiplier = 1 + (player_level - 1) * 0.10
+    xp_multiplier = 1 + (player_level - 1) * 0.08
+    gold_multiplier = 1 + (player_level - 1) * 0.05
+    base_gold_drop = rng.randint(1, 5) + (base_monster['xp_reward'] // 3)
+    return {
+        'key': monster_key,
+        'name': monster_key,
+        'hp': math.ceil(base_monster['hp'] * hp_multiplier),
+        'damage': math.ceil(base_monster['damage'] * damage_multiplier),
+        'xp_reward': math.ceil(base_monster['xp_reward'] * xp_multiplier),
+        'gold_reward': math.ceil(base_gold_drop * gold_multiplier),
+    }
+
+def scale_boss(boss_index: int) -> dict:
+    """Скалирует босса по его месту в списке BOSSES."""
+    boss_data = BOSSES[boss_index]
+    scale_factor = 2 ** boss_index
+    return {
+        'key': str(boss_index),
+        'name': boss_data['name'],
+        'hp': math.ceil(boss_data['base_hp'] * scale_factor),
+        'damage': math.ceil(boss_data['base_damage'] * scale_factor),
+        'xp_reward': math.ceil(100 * (scale_factor * 1.5)),
+        'gold_reward': math.ceil(50 * scale_factor),
+        'fragment_item_id': boss_data['fragment_item_id'],
+    }
+
+
+# --- Ход игрока ---
+def resolve_player_action(player: dict, vitals: dict, effects: EffectScheduler, action: str, rng=random) -> dict:
+    """
+    Рассчитывает действие игрока ('attack' или spell_id).
+    vitals - текущие {'hp', 'mana'}; effects - эффекты боя (изменяется только тратой баффа атаки).
+    Новые эффекты возвращаются в 'new_effects' и накладываются через apply_turn_effects.
+    Возвращает словарь результата; при ошибке ключ 'error' ('no_spell' / 'no_mana').
+    """
+    mana_multiplier, crit_mult_bonus = get_effect_modifiers(player.get('active_effects', {}))
+    crit_damage = player['crit_damage'] + crit_mult_bonus
+    result = {'action': action, 'error': None, 'damage': 0, 'is_crit': False, 'mana_cost': 0,
+              'healed': 0, 'new_effects': [], 'attack_buff': None, 'attack_multiplier': 1.0, 'spell': None}
+
+    if action == "attack":
+        attack_multiplier = effects.consume_attack_multiplier()
+        damage, is_crit = calculate_player_attack_damage(player['strength'], player['crit_chance'], crit_damage, rng=rng)
+        result['damage'] = math.ceil(damage * attack_multiplier)
+        result['is_crit'] = is_crit
+        result['attack_multiplier'] = attack_multiplier
+        return result
+
+    spell_data = SPELLS.get(action)
+    if not spell_data:
+        result['error'] = "no_spell"
+        return result
+    mana_cost = get_spell_mana_cost(spell_data, mana_multiplier)
+    if vitals['mana'] < mana_cost:
+        result['error'] = "no_mana"
+        return result
+
+    result['spell'] = spell_data
+    result['mana_cost'] = mana_cost
+    effect_type = spell_data.get('effect_type')
+    effect_value = spell_data.get('effect_value')
+    duration = spell_data.get('duration', 0)
+
+    if effect_type == "damage":
+        final_base_damage = calculate_final_spell_damage(effect_value, player['intelligence'])
+        result['damage'], result['is_crit'] = calculate_damage_with_crit(final_base_damage, player['crit_chance'], crit_damage, rng=rng)
+    elif effect_type == "heal_percent":
+        heal_calc = math.ceil(player['max_hp'] * (effect_value / 100.0))
+        result['healed'] = max(0, min(heal_calc, player['max_hp'] - vitals['hp']))
+    elif effect_type == "buff_next_attack":
+        result['attack_buff'] = effect_value
+    else:
+        result['new_effects'] = make_spell_effects(spell_data, player['intelligence'])
+    return result
+
+def apply_turn_effects(effects: EffectScheduler, turn_result: dict):
+    """Накладывает эффекты хода игрока и продвигает планировщик. Возвращает EffectTick (HoT, DoT/призывы, истекшие)."""
+    if turn_result['attack_buff'] is not None:
+        effects.attack_multiplier = turn_result['attack_buff']
+    for effect in turn_result['new_effects']:
+        effects.add(effect)
+    return effects.advance()
+
+
+# --- Ход противника ---
+def resolve_enemy_attack(player: dict, enemy_damage: int, effects: EffectScheduler, rng=random) -> dict:
+    """Рассчитывает атаку противника: уворот, снижение урона броней (с учетом временной брони)."""
+    dodge_chance = calculate_dodge_chance(player['dexterity'])
+    armor = player['armor'] + effects.stat_bonus('armor')
+    reduction = calculate_damage_reduction(armor)
+    if rng.uniform(0, 100) < dodge_chance:
+        return {'dodged': True, 'damage': 0, 'reduction': reduction}
+    return {'dodged': False, 'damage': max(1, enemy_damage - reduction), 'reduction': reduction}
+
+def apply_damage_to_vitals(hp: int, es: int, damage: int) -> tuple[int, int]:
+    """Урон сначала снимает энергощит, остаток - здоровье (как в update_player_vitals)."""
+    es_damage = min(es, damage)
+    return max(0, hp - (damage - es_damage)), es - es_damage
+
+
+# --- Полный ход ---
+def resolve_turn(player: dict, vitals: dict, enemy_hp: int, enemy_damage: int, effects: EffectScheduler,
+                 action: str, rng=random) -> dict:
+    """
+    Один ход ручного боя целиком (хендлеры, симулятор и переигровка журнала): действие игрока,
+    эффекты, урон противнику и, если он выжил, его атака. vitals - {'hp', 'mana', 'es'} до хода.
+    Возвращает {'error', 'turn', 'tick', 'effect_healed', 'attack' (None - противник убит),
+    'hp', 'mana', 'es', 'enemy_hp'}; при ошибке действия ход не состоялся и эффекты не тронуты.
+    """
+    turn = resolve_player_action(player, vitals, effects, action, rng=rng)
+    if turn['error']:
+        return {'error': turn['error'], 'turn': turn}
+    hp = min(player['max_hp'], vitals['hp'] + turn['healed'])
+    mana = vitals['mana'] - turn['mana_cost']
+    es = vitals['es']
+    tick = apply_turn_effects(effects, turn)
+    effect_healed = min(tick.healed, max(0, player['max_hp'] - hp))
+    hp += effect_healed
+    enemy_hp = max(0, enemy_hp - turn['damage'] - tick.enemy_damage)
+    attack = None
+    if enemy_hp > 0:
+        attack = resolve_enemy_attack(player, enemy_damage, effects, rng=rng)
+        hp, es = apply_damage_to_vitals(hp, es, attack['damage'])
+    return {'error': None, 'turn': turn, 'tick': tick, 'effect_healed': effect_healed, 'attack': attack,
+            'hp': hp, 'mana': mana, 'es': es, 'enemy_hp': enemy_hp}
+
+
+# --- Политики выбора действия ---
+POLICY_ATTACK = "attack"
+POLICY_BEST_SPELL = "best_spell"
+POLICIES = (POLICY_ATTACK, POLICY_BEST_SPELL)
+
+def get_damage_spells_by_power(spell_ids: list[str], intelligence: int) -> list[str]:
+    """Сортирует урон-заклинания по урону (с учетом интеллекта) по убыванию."""
+    damage_spells = [s for s in spell_ids if SPELLS.get(s, {}).get('effect_type') == "damage"]
+    return sorted(damage_spells, key=lambda s: calculate_final_spell_damage(SPELLS[s]['effect_value'], intelligence), reverse=True)
+
+def choose_action(policy: str, player: dict, mana: int, ranked_spells: list[str]) -> str:
+    """Выбирает действие для политики: атака или самый сильный доступный по мане урон-спелл."""
+    if policy == POLICY_BEST_SPELL:
+        mana_multiplier, _ = get_effect_modifiers(player.get('active_effects', {}))
+        attack_damage = max(1, player['strength'] // 2)
+        for spell_id in ranked_spells:
+            spell_damage = calculate_final_spell_damage(SPELLS[spell_id]['effect_value'], player['intelligence'])
+            if spell_damage <= attack_damage:
+                break # Дальше только слабее атаки
+            if mana >= get_spell_mana_cost(SPELLS[spell_id], mana_multiplier):
+                return spell_id
+    return "attack"
+
+
+# --- Полный бой без интерфейса ---
+def simulate_fight(player: dict, enemy: dict, policy: str = POLICY_ATTACK, spell_ids: list[str] | None = None,
+                   rng=random, max_turns: int = DEFAULT_MAX_TURNS, ranked_spells: list[str] | None = None,
+                   es: int | None = None, effects: EffectScheduler | None = None) -> dict:
+    """
+    Проводит бой целиком по тем же правилам, что и хендлеры.
+    Игрок начинает с текущими HP/маной из player; ES - полный, если не передан явно.
+    enemy['hp'] - текущее HP противника (можно продолжить начатый бой);
+    effects - эффекты начатого боя (изменяются), по умолчанию пустые.
+    """
+    if ranked_spells is None:
+        ranked_spells = get_damage_spells_by_power(spell_ids or [], player['intelligence'])
+    hp = player['current_hp']
+    mana = player['current_mana']
+    if es is None:
+        es = player['max_energy_shield']
+    enemy_hp = enemy['hp']
+    if effects is None:
+        effects = EffectScheduler()
+    turns = 0
+    mana_spent = 0
+    damage_taken = 0
+    damage_dealt = 0
+    crits = 0
+    actions = {}
+
+    while turns < max_turns:
+        turns += 1
+        action = choose_action(policy, player, mana, ranked_spells)
+        vitals = {'hp': hp, 'mana': mana, 'es': es}
+        result = resolve_turn(player, vitals, enemy_hp, enemy['damage'], effects, action, rng=rng)
+        if result['error']:
+            result = resolve_turn(player, vitals, enemy_hp, enemy['damage'], effects, "attack", rng=rng)
+        turn, attack = result['turn'], result['attack']
+        actions[turn['action']] = actions.get(turn['action'], 0) + 1
+        damage_dealt += turn['damage'] + result['tick'].enemy_damage
+        crits += turn['is_crit']
+        mana_spent += turn['mana_cost']
+        hp, mana, es, enemy_hp = result['hp'], result['mana'], result['es'], result['enemy_hp']
+        if attack is None:
+            break
+        damage_taken += attack['damage']
+        if hp <= 0:
+            break
+
+    # Победа - только если противник убит; лимит ходов считается проигрышем
+    return {'won': enemy_hp <= 0, 'turns': turns, 'hp': hp, 'mana': mana, 'es': es, 'enemy_hp': enemy_hp,
+            'mana_spent': mana_spent, 'damage_taken': damage_taken, 'damage_dealt': damage_dealt,
+            'crits': crits, 'actions': actions}
+
+
+# --- Фарм-забег ---
+def simulate_farm_run(player_row: dict, equipped_item_ids: list[str], spell_ids: list[str], fights: int,
+                      policy: str = POLICY_BEST_SPELL, rng=random,
+                      regen_seconds: int = FARM_REGEN_SECONDS_PER_FIGHT) -> dict:
+    """
+    Проводит до fights боев подряд по правилам ручного боя: ES полный перед каждым боем,
+    награды/квест/левел-ап после каждой победы, пассивный реген за regen_seconds между боями.
+    Смерть останавливает забег и применяет штраф. player_row - сырая запись из players (не изменяется).
+    Намеренно отличается от N одиночных боев фиксированным регеном между боями и опытом квеста
+    в одном шаге левел-апа с опытом монстра (сверка - python -m sim.farm_check).
+    Возвращает итоги и 'final' - новые значения колонок игрока.
+    """
+    raw = dict(player_row)
+    player = calculate_effective_stats(raw, equipped_item_ids)
+    active_effects = player['active_effects']
+    ranked_spells = get_damage_spells_by_power(spell_ids, player['intelligence'])
+    regen_multiplier = get_regen_multiplier(active_effects)
+    can_regen_mana = 'cannot_regen_mana' not in active_effects
+    try: triple_gold_chance = float(active_effects.get('triple_gold_chance', 0))
+    except (ValueError, TypeError): triple_gold_chance = 0.0
+    monster_keys = list(MONSTERS)
+    hp, mana = player['current_hp'], player['current_mana']
+
+    run = {'fights': 0, 'wins': 0, 'died': False, 'stopped': None, 'turns': 0, 'xp_gain': 0, 'gold_gain': 0,
+           'loot_item_ids': [], 'kills': {}, 'quest': None, 'start_level': raw['level'], 'gained_stat_points': 0,
+           'xp_penalty': 0, 'gold_penalty': 0, 'damage_taken': 0}
+
+    for _ in range(fights):
+        if hp <= 0:
+            run['stopped'] = "no_hp"
+            break
+        player['current_hp'], player['current_mana'] = hp, mana
+        monster = scale_monster(rng.choice(monster_keys), raw['level'], rng=rng)
+        result = simulate_fight(player, monster, policy, rng=rng, ranked_spells=ranked_spells)
+        run['fights'] += 1
+        run['turns'] += result['turns']
+        run['damage_taken'] += result['damage_taken']
+        hp, mana = result['hp'], result['mana']
+
+        if not result['won']:
+            if hp <= 0:
+                run['died'] = True
+                run['xp_penalty'], run['gold_penalty'] = calculate_death_penalty(raw['level'], raw['xp'], raw['gold'])
+                raw['xp'] = max(0, raw['xp'] - run['xp_penalty'])
+                raw['gold'] = max(0, raw['gold'] - run['gold_penalty'])
+            else:
+                run['stopped'] = "turn_limit"
+            break
+
+        # --- Награды за победу ---
+        run['wins'] += 1
+        run['kills'][monster['key']] = run['kills'].get(monster['key'], 0) + 1
+        xp_gain = monster['xp_reward']
+        gold_gain = monster['gold_reward'] * 3 if rng.uniform(0, 100) < triple_gold_chance else monster['gold_reward']
+        loot_item_id = get_random_loot_item_id(rng=rng)
+        if loot_item_id:
+            run['loot_item_ids'].append(loot_item_id)
+
+        # Квест (как update_quest_progress: только активный и невыполненный)
+        if (raw['quest_monster_key'] == monster['key'] and
+                raw['quest_current_count'] < raw['quest_target_count']):
+            raw['quest_current_count'] += 1
+            if raw['quest_current_count'] >= raw['quest_target_count']:
+                run['quest'] = {'completed': True, 'gold_reward': raw['quest_gold_reward'], 'xp_reward': raw['quest_xp_reward']}
+                xp_gain += raw['quest_xp_reward']
+                gold_gain += raw['quest_gold_reward']
+                raw.update(quest_monster_key=None, quest_target_count=0, quest_current_count=0,
+                           quest_gold_reward=0, quest_xp_reward=0)
+            else:
+                run['quest'] = {'completed': False, 'current_count': raw['quest_current_count'],
+                                'target_count': raw['quest_target_count']}
+
+        run['xp_gain'] += xp_gain
+        run['gold_gain'] += gold_gain
+        raw['gold'] += gold_gain
+        old_level = raw['level']
+        raw['level'], raw['xp'], raw['xp_to_next_level'], stat_points = calculate_level_progress(
+            raw['level'], raw['xp'], raw['xp_to_next_level'], xp_gain
+        )
+        run['gained_stat_points'] += stat_points
+        if raw['level'] > old_level:
+            # Левел-ап: новые Max HP/Mana и восстановление до них (как update_player_xp)
+            raw['max_hp'], raw['max_mana'] = calculate_base_max_vitals(raw['class'], raw['strength'], raw['intelligence'], raw['level'])
+            raw['current_hp'], raw['current_mana'] = raw['max_hp'], raw['max_mana']
+            player = calculate_effective_stats(raw, equipped_item_ids)
+            hp, mana = player['current_hp'], player['current_mana']
+
+        # --- Пассивный реген между боями ---
+        if regen_multiplier > 0:
+            hp = min(player['max_hp'], hp + math.floor(regen_seconds / HP_REGEN_INTERVAL * regen_multiplier))
+            if can_regen_mana:
+                mana = min(player['max_mana'], mana + math.floor(regen_seconds / MANA_REGEN_INTERVAL * regen_multiplier))
+
+    raw['current_hp'], raw['current_mana'] = max(0, hp), max(0, mana)
+    raw['energy_shield'] = player['max_energy_shield'] # ES восстанавливается после боя
+    run['end_level'] = raw['level']
+    run['final'] = raw
+    return run
@@ -0,0 +1,384 @@
+# combat_log.py
+"""
+Бинарный журнал боевых событий (append-only, сегменты с ротацией по размеру).
+Каждый бой пишет: START (сид RNG сессии, статы игрока, спеллы, CombatState), TURN на каждый
+ручной ход (действие, броски, урон, виталы после хода), AUTO для авто-боя и END с исходом.
+Так как все броски боя идут из random.Random(seed) сессии, бой можно переиграть по правилам
+combat_engine и сверить с журналом (replay_fight, tools/combat_replay.py).
+
+Запись: emit() только упаковывает событие в буфер памяти; на диск буфер пишется пачкой
+в отдельном потоке (run_flush_loop / при переполнении буфера / close()).
+Формат сегмента: MAGIC, затем записи [crc32][заголовок][payload]. Рядом с сегментом лежит
+индекс .idx с (user_id, fight_id, ts_ms, смещение) каждого START - по нему ищутся бои игрока
+за период без чтения сегментов целиком. Недописанный хвост (падение процесса) при чтении отбрасывается.
+"""
+import os
+import json
+import time
+import zlib
+import random
+import struct
+import asyncio
+import logging
+
+from combat_engine import resolve_turn, simulate_fight
+from combat_state import CombatState
+from config import COMBAT_LOG_DIR
+
+SEGMENT_MAX_BYTES = 8 * 1024 * 1024 # Ротация сегмента по размеру
+FLUSH_INTERVAL = 1.0 # Период фоновой записи буфера, сек
+FLUSH_BUFFER_BYTES = 64 * 1024 # Буфер больше этого пишется сразу, не дожидаясь периода
+
+SEGMENT_MAGIC = b"PCLOG001"
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+# --- Типы событий и исходы ---
+EVENT_START = 1
+EVENT_TURN = 2
+EVENT_AUTO = 3
+EVENT_END = 4
+EVENT_NAMES = {EVENT_START: "START", EVENT_TURN: "TURN", EVENT_AUTO: "AUTO", EVENT_END: "END"}
+
+OUTCOME_WON = 1
+OUTCOME_DIED = 2
+OUTCOME_ABORTED = 3 # Бой прерван ошибкой/сбросом
+OUTCOME_SUSPENDED = 4 # Сессия выгружена по TTL или переснята (refresh), бой продолжится новым START (resumed)
+OUTCOME_NAMES = {OUTCOME_WON: "won", OUTCOME_DIED: "died", OUTCOME_ABORTED: "aborted", OUTCOME_SUSPENDED: "suspended"}
+
+# crc32 | длина payload, тип, user_id, fight_id, время (мс)
+RECORD_CRC = struct.Struct("<I")
+RECORD_HEADER = struct.Struct("<IBqIQ")
+# TURN: урон действия, крит, урон эффектов, хил, хил эффектов, мана, уворот, полученный урон, hp, mana, es, hp противника
+TURN_BODY = struct.Struct("<i?iiii?iiiii")
+# AUTO: победа, ходов, hp, mana, es, hp противника
+AUTO_BODY = struct.Struct("<?iiiii")
+# END: исход, hp, mana, es, hp противника
+END_BODY = struct.Struct("<Biiii")
+# Индекс: user_id, fight_id, время (мс), смещение START в сегменте
+INDEX_ENTRY = struct.Struct("<qIQQ")
+
+# Статы игрока, от которых зависят правила боя (пишутся в START)
+PLAYER_LOG_KEYS = ('level', 'strength', 'dexterity', 'intelligence', 'armor', 'crit_chance', 'crit_damage',
+                   'max_hp', 'max_mana', 'max_energy_shield', 'current_hp', 'current_mana', 'energy_shield', 'active_effects')
+
+
+def _pack_str(value: str) -> bytes:
+    raw = value.encode()[:255]
+    return bytes((len(raw),)) + raw
+
+def _unpack_str(payload: bytes, offset: int = 0) -> tuple[str, int]:
+    length = payload[offset]
+    return payload[offset + 1:offset + 1 + length].decode(errors="replace"), offset + 1 + length
+
+
+class CombatEvent:
+    """Одно прочитанное событие. data - разобранный payload (словарь)."""
+    __slots__ = ('kind', 'user_id', 'fight_id', 'ts_ms', 'data')
+
+    def __init__(self, kind: int, user_id: int, fight_id: int, ts_ms: int, data: dict):
+        self.kind = kind
+        self.user_id = user_id
+        self.fight_id = fight_id
+        self.ts_ms = ts_ms
+        self.data = data
+
+    def __repr__(self):
+        return f"CombatEvent({EVENT_NAMES.get(self.kind, self.kind)}, user={self.user_id}, fight={self.fight_id:08x}, {self.data})"
+
+
+def decode_payload(kind: int, payload: bytes) -> dict:
+    if kind == EVENT_START:
+        return json.loads(payload)
+    if kind == EVENT_TURN:
+        action, offset = _unpack_str(payload)
+        (damage, is_crit, effect_damage, healed, effect_healed, mana_cost, dodged, damage_taken,
+         hp, mana, es, enemy_hp) = TURN_BODY.unpack_from(payload, offset)
+        return {'action': action, 'damage': damage, 'is_crit': is_crit, 'effect_damage': effect_damage,
+                'healed': healed, 'effect_healed': effect_healed, 'mana_cost': mana_cost, 'dodged': dodged,
+                'damage_taken': damage_taken, 'hp': hp, 'mana': mana, 'es': es, 'enemy_hp': enemy_hp}
+    if kind == EVENT_AUTO:
+        policy, offset = _unpack_str(payload)
+        won, turns, hp, mana, es, enemy_hp = AUTO_BODY.unpack_from(payload, offset)
+        return {'policy': policy, 'won': won, 'turns': turns, 'hp': hp, 'mana': mana, 'es': es, 'enemy_hp': enemy_hp}
+    if kind == EVENT_END:
+        outcome, hp, mana, es, enemy_hp = END_BODY.unpack(payload)
+        return {'outcome': OUTCOME_NAMES.get(outcome, outcome), 'hp': hp, 'mana': mana, 'es': es, 'enemy_hp': enemy_hp}
+    return {'raw': payload.hex()}
+
+
+# --- Запись ---
+class CombatEventLog:
+    """Журнал одного процесса. directory=None - журнал выключен (emit ничего не делает)."""
+    def __init__(self, directory: str | None, segment_max_bytes: int = SEGMENT_MAX_BYTES,
+                 flush_buffer_bytes: int = FLUSH_BUFFER_BYTES):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.flush_buffer_bytes = flush_buffer_bytes
+        self._buffer = [] # (запись, запись индекса или None)
+        self._buffered_bytes = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._segment_path = None
+        self._segment_size = 0
+        self.events = 0
+        self.bytes_written = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def emit(self, kind: int, user_id: int, fight_id: int, payload: bytes):
+        """Добавляет событие в буфер (без I/O)."""
+        if self.directory is None:
+            return
+        ts_ms = int(time.time() * 1000)
+        body = RECORD_HEADER.pack(len(payload), kind, user_id, fight_id, ts_ms) + payload
+        record = RECORD_CRC.pack(zlib.crc32(body)) + body
+        index_entry = (user_id, fight_id, ts_ms) if kind == EVENT_START else None
+        self._buffer.append((record, index_entry))
+        self._buffered_bytes += len(record)
+        self.events += 1
+        if self._buffered_bytes >= self.flush_buffer_bytes and (self._flush_task is None or self._flush_task.done()):
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+            except RuntimeError:
+                pass # Нет цикла событий (скрипты) - допишется в close()
+
+    # --- События боя ---
+    def fight_start(self, session, resumed: bool = False):
+        """START: все, что нужно для переигровки боя с этого места."""
+        player = {key: session.player.get(key) for key in PLAYER_LOG_KEYS}
+        player['current_hp'], player['current_mana'], player['energy_shield'] = session.hp, session.mana, session.es
+        kind = "boss" if session.combat.fragment_item_id is not None else "monster"
+        payload = json.dumps({
+            'kind': kind, 'seed': session.seed, 'resumed': resumed, 'player': player,
+            'spells': [spell['id'] for spell in session.learned_spells], 'combat': session.combat.encode(),
+        }, ensure_ascii=False, separators=(",", ":"), default=str).encode()
+        self.emit(EVENT_START, session.user_id, session.fight_id, payload)
+
+    def turn(self, session, action: str, damage: int, is_crit: bool, effect_damage: int, healed: int,
+             effect_healed: int, mana_cost: int, dodged: bool = False, damage_taken: int = 0):
+        """TURN: итог ручного хода; виталы и HP противника берутся из сессии (после хода)."""
+        payload = _pack_str(action) + TURN_BODY.pack(
+            damage, is_crit, effect_damage, healed, effect_healed, mana_cost, dodged, damage_taken,
+            session.hp, session.mana, session.es, session.combat.enemy_hp)
+        self.emit(EVENT_TURN, session.user_id, session.fight_id, payload)
+
+    def auto(self, session, policy: str, result: dict):
+        """AUTO: итог авто-боя (combat_engine.simulate_fight) с RNG сессии."""
+        payload = _pack_str(policy) + AUTO_BODY.pack(
+            result['won'], result['turns'], result['hp'], result['mana'], result['es'], result['enemy_hp'])
+        self.emit(EVENT_AUTO, session.user_id, session.fight_id, payload)
+
+    def fight_end(self, session, outcome: int):
+        payload = END_BODY.pack(outcome, session.hp, session.mana, session.es, session.combat.enemy_hp)
+        self.emit(EVENT_END, session.user_id, session.fight_id, payload)
+
+    # --- Сброс на диск ---
+    async def flush(self):
+        """Пишет накопленный буфер одной пачкой (файловый I/O - в отдельном потоке)."""
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer, self._buffered_bytes = self._buffer, [], 0
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                logging.error(f"Failed to write {len(batch)} combat log events: {e}", exc_info=True)
+
+    def flush_sync(self):
+        """Синхронный сброс (остановка процесса, скрипты)."""
+        if self._buffer:
+            batch, self._buffer, self._buffered_bytes = self._buffer, [], 0
+            self._write_batch(batch)
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        ts_ms = int(time.time() * 1000)
+        while True: # Имя = время открытия; два сегмента за одну мс разводим сдвигом
+            self._segment_path = os.path.join(self.directory, f"combat-{ts_ms:013d}-{os.getpid()}{SEGMENT_SUFFIX}")
+            try:
+                with open(self._segment_path, "xb") as f:
+                    f.write(SEGMENT_MAGIC)
+                break
+            except FileExistsError:
+                ts_ms += 1
+        self._segment_size = len(SEGMENT_MAGIC)
+        logging.info(f"Combat log segment opened: {self._segment_path}")
+
+    def _write_batch(self, batch: list):
+        """Раскладывает пачку по сегментам (с ротацией) и дописывает индексы START."""
+        if self._segment_path is None:
+            self._open_segment()
+        chunk, index_chunk = [], []
+        for record, index_entry in batch:
+            if self._segment_size + len(record) > self.segment_max_bytes and self._segment_size > len(SEGMENT_MAGIC):
+                self._append(chunk, index_chunk)
+                chunk, index_chunk = [], []
+                self._open_segment()
+            if index_entry is not None:
+                index_chunk.append(INDEX_ENTRY.pack(*index_entry, self._segment_size))
+            chunk.append(record)
+            self._segment_size += len(record)
+        self._append(chunk, index_chunk)
+
+    def _append(self, chunk: list, index_chunk: list):
+        if chunk:
+            data = b"".join(chunk)
+            with open(self._segment_path, "ab") as f:
+                f.write(data)
+            self.bytes_written += len(data)
+        if index_chunk:
+            with open(self._segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX, "ab") as f:
+                f.write(b"".join(index_chunk))
+
+    async def run_flush_loop(self, interval: float = FLUSH_INTERVAL):
+        """Фоновая задача: периодически пишет буфер на диск."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    async def close(self):
+        await self.flush()
+
+
+# --- Чтение ---
+def list_segments(directory: str) -> list[tuple[int, int, str]]:
+    """Сегменты каталога: (время открытия мс, pid, путь), по времени."""
+    segments = []
+    if not os.path.isdir(directory):
+        return segments
+    for name in os.listdir(directory):
+        if not (name.startswith("combat-") and name.endswith(SEGMENT_SUFFIX)):
+            continue
+        try:
+            _, ts_ms, pid = name[:-len(SEGMENT_SUFFIX)].split("-")
+            segments.append((int(ts_ms), int(pid), os.path.join(directory, name)))
+        except ValueError:
+            logging.warning(f"Skipping unexpected combat log file: {name}")
+    segments.sort()
+    return segments
+
+def read_records(path: str, offset: int = 0):
+    """Генератор (смещение, CombatEvent) из сегмента. Битый/недописанный хвост обрывает чтение."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(SEGMENT_MAGIC):
+        raise ValueError(f"Not a combat log segment: {path}")
+    position = max(offset, len(SEGMENT_MAGIC))
+    head_size = RECORD_CRC.size + RECORD_HEADER.size
+    while position + head_size <= len(data):
+        (crc,) = RECORD_CRC.unpack_from(data, position)
+        length, kind, user_id, fight_id, ts_ms = RECORD_HEADER.unpack_from(data, position + RECORD_CRC.size)
+        end = position + head_size + length
+        if end > len(data) or zlib.crc32(data[position + RECORD_CRC.size:end]) != crc:
+            logging.warning(f"Combat log {path}: torn or corrupt record at offset {position}, stopping.")
+            return
+        yield position, CombatEvent(kind, user_id, fight_id, ts_ms, decode_payload(kind, data[position + head_size:end]))
+        position = end
+
+def read_index(path: str) -> list[tuple[int, int, int, int]]:
+    """Записи индекса сегмента: (user_id, fight_id, ts_ms, смещение)."""
+    index_path = path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, "rb") as f:
+        data = f.read()
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return [INDEX_ENTRY.unpack_from(data, pos) for pos in range(0, usable, INDEX_ENTRY.size)]
+
+def find_fights(directory: str, user_id: int, since_ms: int = 0, until_ms: int | None = None) -> list[tuple[str, int, int, int]]:
+    """Бои игрока, начатые в [since_ms, until_ms]: (путь сегмента, смещение START, fight_id, ts_ms) по индексам."""
+    found = []
+    for segment_ts, _, path in list_segments(directory):
+        if until_ms is not None and segment_ts > until_ms:
+            break # Сегмент открыт позже конца периода - дальше только более новые
+        for entry_user, fight_id, ts_ms, offset in read_index(path):
+            if entry_user == user_id and ts_ms >= since_ms and (until_ms is None or ts_ms <= until_ms):
+                found.append((path, offset, fight_id, ts_ms))
+    found.sort(key=lambda item: item[3])
+    return found
+
+def load_fight(directory: str, segment_path: str, offset: int, user_id: int, fight_id: int) -> list[CombatEvent]:
+    """События боя от START до END (бой может продолжаться в следующих сегментах того же процесса)."""
+    segments = list_segments(directory)
+    pid = next((p for _, p, path in segments if path == segment_path), None)
+    paths = [path for _, p, path in segments if p == pid]
+    events = []
+    for i, path in enumerate(paths[paths.index(segment_path):] if segment_path in paths else [segment_path]):
+        for _, event in read_records(path, offset if i == 0 else 0):
+            if event.user_id != user_id or event.fight_id != fight_id:
+                continue
+            events.append(event)
+            if event.kind == EVENT_END:
+                return events
+    return events
+
+def load_all_fights(directory: str) -> dict[tuple[int, int], list[CombatEvent]]:
+    """Все бои журнала (всех игроков, без индексов): (user_id, fight_id) -> события по порядку записи."""
+    fights: dict[tuple[int, int], list[CombatEvent]] = {}
+    for _, _, path in list_segments(directory):
+        for _, event in read_records(path):
+            fights.setdefault((event.user_id, event.fight_id), []).append(event)
+    return fights
+
+
+# --- Переигровка ---
+def replay_fight(events: list[CombatEvent]) -> dict:
+    """
+    Переигрывает бой по правилам combat_engine с сидом из START и сверяет каждый ход с журналом.
+    Возвращает {'ok', 'turns', 'mismatch' (None или описание первого расхождения), 'outcome'}.
+    """
+    if not events or events[0].kind != EVENT_START:
+        return {'ok': False, 'turns': 0, 'mismatch': "no START event", 'outcome': None}
+    start = events[0].data
+    rng = random.Random(start['seed'])
+    player = dict(start['player'])
+    player['active_effects'] = player.get('active_effects') or {}
+    combat = CombatState.decode(start['combat'])
+    effects = combat.effects
+    hp, mana, es, enemy_hp = player['current_hp'], player['current_mana'], player['energy_shield'], combat.enemy_hp
+    turns = 0
+    outcome = None
+
+    def mismatch(event_no: int, expected: dict, actual: dict) -> dict:
+        diff = {key: (expected[key], actual[key]) for key in actual if expected.get(key) != actual[key]}
+        return {'ok': False, 'turns': turns, 'mismatch': f"event #{event_no}: logged vs replayed {diff}", 'outcome': outcome}
+
+    for event_no, event in enumerate(events[1:], start=1):
+        data = event.data
+        if event.kind == EVENT_TURN:
+            turns += 1
+            result = resolve_turn(player, {'hp': hp, 'mana': mana, 'es': es}, enemy_hp, combat.enemy_damage,
+                                  effects, data['action'], rng=rng)
+            if result['error']:
+                return {'ok': False, 'turns': turns, 'mismatch': f"event #{event_no}: action {data['action']!r} -> {result['error']}", 'outcome': outcome}
+            turn, tick = result['turn'], result['tick']
+            attack = result['attack'] or {'dodged': False, 'damage': 0}
+            hp, mana, es, enemy_hp = result['hp'], result['mana'], result['es'], result['enemy_hp']
+            actual = {'damage': turn['damage'], 'is_crit': turn['is_crit'], 'effect_damage': tick.enemy_damage,
+                      'healed': turn['healed'], 'effect_healed': result['effect_healed'], 'mana_cost': turn['mana_cost'],
+                      'dodged': attack['dodged'], 'damage_taken': attack['damage'],
+                      'hp': hp, 'mana': mana, 'es': es, 'enemy_hp': enemy_hp}
+            if any(data[key] != value for key, value in actual.items()):
+                return mismatch(event_no, data, actual)
+        elif event.kind == EVENT_AUTO:
+            player_now = dict(player, current_hp=hp, current_mana=mana)
+            result = simulate_fight(player_now, {'key': combat.enemy_key, 'hp': enemy_hp, 'damage': combat.enemy_damage},
+                                    data['policy'], spell_ids=start['spells'], rng=rng, es=es, effects=effects)
+            turns += result['turns']
+            hp, mana, es, enemy_hp = result['hp'], result['mana'], result['es'], result['enemy_hp']
+            actual = {'won': result['won'], 'turns': result['turns'], 'hp': hp, 'mana': mana, 'es': es, 'enemy_hp': enemy_hp}
+            if any(data[key] != value for key, value in actual.items()):
+                return mismatch(event_no, data, actual)
+        elif event.kind == EVENT_END:
+            outcome = data['outcome']
+            # Исход END пишется после хода: виталы обязаны совпасть (кроме прерванных боев)
+            if data['outcome'] in ("won", "died") and (data['hp'], data['enemy_hp']) != (hp, enemy_hp):
+                return mismatch(event_no, data, {'hp': hp, 'enemy_hp': enemy_hp})
+    return {'ok': True, 'turns': turns, 'mismatch': None, 'outcome': outcome}
+
+
+# Общий журнал процесса (каталог - из config; None выключает журнал)
+combat_events = CombatEventLog(COMBAT_LOG_DIR)
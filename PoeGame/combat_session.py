@@ -0,0 +1,196 @@
+# combat_session.py
+"""
+Реестр живых боевых сессий в памяти.
+Сессия хранит все, что нужно для хода: эффективные статы игрока (снимок на начало боя; смена
+экипировки, прокачка и новые заклинания переснимают его через refresh),
+изученные заклинания, текущие HP/ману/ES и CombatState. Ход не читает БД вообще;
+в БД (виталы) и FSM (CombatState) сессия сбрасывается контрольной точкой раз в N ходов,
+в конце боя и при истечении TTL. После рестарта сессия восстанавливается из БД + FSM.
+"""
+import time
+import random
+import asyncio
+import logging
+
+from aiogram.fsm.context import FSMContext
+
+from combat_state import CombatState, load_combat_state, save_combat_state
+from combat_log import combat_events, OUTCOME_ABORTED, OUTCOME_SUSPENDED
+from database.db_manager import get_player_effective_stats, get_learned_spells, update_player_vitals
+
+SESSION_TTL_SECONDS = 15 * 60 # Бездействующая сессия сбрасывается в БД и выгружается
+CHECKPOINT_EVERY_TURNS = 5 # Контрольная точка каждые N ходов
+EXPIRY_CHECK_INTERVAL = 60 # Период фоновой проверки TTL
+
+
+class CombatSession:
+    """Живой бой одного игрока. Все броски хода - из rng (сид пишется в журнал боя для переигровки)."""
+    __slots__ = ('user_id', 'fsm', 'player', 'learned_spells', 'combat', 'hp', 'mana', 'es',
+                 'turns', 'checkpointed_turn', 'last_active', 'fight_id', 'seed', 'rng')
+
+    def __init__(self, user_id: int, fsm: FSMContext, player: dict, learned_spells: list[dict], combat: CombatState):
+        self.user_id = user_id
+        self.fsm = fsm
+        self.player = player
+        self.learned_spells = learned_spells
+        self.combat = combat
+        self.hp = player['current_hp']
+        self.mana = player['current_mana']
+        self.es = player['energy_shield']
+        self.turns = 0
+        self.checkpointed_turn = 0
+        self.last_active = time.monotonic()
+        self.reseed()
+
+    def reseed(self):
+        """Новые fight_id и сид RNG: следующий отрезок боя пишется в журнал с новым START."""
+        self.fight_id = random.getrandbits(32)
+        self.seed = random.getrandbits(63)
+        self.rng = random.Random(self.seed)
+
+    def snapshot_player(self) -> dict:
+        """Статы игрока с текущими виталами сессии (в том же формате, что get_player_effective_stats)."""
+        player = dict(self.player)
+        player['current_hp'], player['current_mana'], player['energy_shield'] = self.hp, self.mana, self.es
+        return player
+
+    def change_vitals(self, hp_change: int = 0, mana_change: int = 0):
+        """Хил/трата маны в памяти (нижняя граница 0, как update_player_vitals)."""
+        self.hp = max(0, self.hp + hp_change)
+        self.mana = max(0, self.mana + mana_change)
+
+
+class CombatSessionRegistry:
+    def __init__(self, ttl: int = SESSION_TTL_SECONDS, checkpoint_every: int = CHECKPOINT_EVERY_TURNS):
+        self.ttl = ttl
+        self.checkpoint_every = checkpoint_every
+        self._sessions: dict[int, CombatSession] = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def start(self, user_id: int, fsm: FSMContext, player: dict, combat: CombatState) -> CombatSession:
+        """Начало боя: player - свежие эффективные статы. Сразу пишет CombatState в FSM."""
+        learned_spells = await get_learned_spells(user_id)
+        session = CombatSession(user_id, fsm, player, learned_spells, combat)
+        self._sessions[user_id] = session
+        combat_events.fight_start(session)
+        await save_combat_state(fsm, combat)
+        return session
+
+    async def get(self, user_id: int, fsm: FSMContext) -> CombatSession | None:
+        """Сессия игрока; если ее нет в памяти (рестарт/TTL) - восстанавливает из БД и FSM."""
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = await self._restore(user_id, fsm)
+            if session is None:
+                return None
+        session.fsm = fsm
+        session.last_active = time.monotonic()
+        return session
+
+    async def _restore(self, user_id: int, fsm: FSMContext) -> CombatSession | None:
+        combat = await load_combat_state(fsm)
+        if combat is None:
+            return None
+        player = await get_player_effective_stats(user_id)
+        if not player:
+            return None
+        learned_spells = await get_learned_spells(user_id)
+        session = CombatSession(user_id, fsm, player, learned_spells, combat)
+        self._sessions[user_id] = session
+        combat_events.fight_start(session, resumed=True) # Новый сид: переигровка начинается отсюда
+        logging.info("Combat session restored for user %s: %s", user_id, combat)
+        return session
+
+    async def after_turn(self, session: CombatSession):
+        """Ход завершен, бой продолжается: контрольная точка раз в checkpoint_every ходов."""
+        session.turns += 1
+        if session.turns - session.checkpointed_turn >= self.checkpoint_every:
+            await self.checkpoint(session)
+
+    async def checkpoint(self, session: CombatSession):
+        """Сбрасывает виталы в БД и CombatState в FSM."""
+        await update_player_vitals(session.user_id, set_hp=session.hp, set_mana=session.mana, set_es=session.es)
+        await save_combat_state(session.fsm, session.combat)
+        session.checkpointed_turn = session.turns
+        logging.debug("Combat session checkpoint for user %s at turn %s", session.user_id, session.turns)
+
+    async def refresh(self, user_id: int):
+        """
+        Пересъемка статов и заклинаний живой сессии после изменения вне боя (экипировка, прокачка,
+        изучение спелла). Виталы сессии остаются, но не выше новых максимумов, и сразу пишутся в БД -
+        поверх якоря, который смена экипировки записала по устаревшим значениям из БД.
+        В журнале боя отрезок до пересъемки закрывается (SUSPENDED), дальше бой идет с новым сидом
+        и START с новыми статами - иначе переигровка считала бы ходы по старым. Нет сессии - ничего не делает.
+        """
+        session = self._sessions.get(user_id)
+        if session is None:
+            return
+        player = await get_player_effective_stats(user_id)
+        if not player:
+            return
+        learned_spells = await get_learned_spells(user_id)
+        combat_events.fight_end(session, OUTCOME_SUSPENDED)
+        session.player = player
+        session.learned_spells = learned_spells
+        session.hp = min(session.hp, player['max_hp'])
+        session.mana = min(session.mana, player['max_mana'])
+        session.es = min(session.es, player['max_energy_shield'])
+        session.reseed()
+        combat_events.fight_start(session, resumed=True)
+        await update_player_vitals(user_id, set_hp=session.hp, set_mana=session.mana, set_es=session.es)
+        logging.info("Combat session of user %s refreshed: max HP %s, HP %s", user_id, player['max_hp'], session.hp)
+
+    async def finish(self, session: CombatSession, save_vitals: bool = True, outcome: int = OUTCOME_ABORTED):
+        """
+        Конец боя: виталы в БД (если их не записал вызывающий) и выгрузка сессии. FSM чистит хендлер.
+        outcome - исход для журнала боя (combat_log.OUTCOME_*).
+        """
+        self._sessions.pop(session.user_id, None)
+        combat_events.fight_end(session, outcome)
+        if save_vitals:
+            await update_player_vitals(session.user_id, set_hp=session.hp, set_mana=session.mana, set_es=session.es)
+
+    def discard(self, user_id: int):
+        """Выгрузить сессию без записи (бой прерван ошибкой состояния)."""
+        session = self._sessions.pop(user_id, None)
+        if session is not None:
+            combat_events.fight_end(session, OUTCOME_ABORTED)
+
+    async def expire_idle(self, now: float | None = None) -> int:
+        """Сбрасывает и выгружает сессии, простаивающие дольше TTL. Возвращает их число."""
+        now = time.monotonic() if now is None else now
+        expired = [s for s in self._sessions.values() if now - s.last_active > self.ttl]
+        for session in expired:
+            self._sessions.pop(session.user_id, None)
+            combat_events.fight_end(session, OUTCOME_SUSPENDED)
+            try:
+                if await session.fsm.get_state() is None:
+                    continue # Бой уже сброшен (/start и т.п.) - виталы боя неактуальны
+                await self.checkpoint(session)
+            except Exception as e:
+                logging.error(f"Failed to checkpoint expired combat session of user {session.user_id}: {e}", exc_info=True)
+        if expired:
+            logging.info(f"Expired {len(expired)} idle combat sessions.")
+        return len(expired)
+
+    async def checkpoint_all(self):
+        """Контрольная точка всех живых сессий (например, перед остановкой бота)."""
+        for session in list(self._sessions.values()):
+            try:
+                if await session.fsm.get_state() is None:
+                    continue
+                await self.checkpoint(session)
+            except Exception as e:
+                logging.error(f"Failed to checkpoint combat session of user {session.user_id}: {e}", exc_info=True)
+
+    async def run_expiry_loop(self, interval: int = EXPIRY_CHECK_INTERVAL):
+        """Фоновая задача: периодически выгружает простаивающие сессии."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.expire_idle()
+
+
+# Общий реестр для хендлеров боя с монстрами и боссами
+combat_sessions = CombatSessionRegistry()
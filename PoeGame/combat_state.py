@@ -0,0 +1,105 @@
+# combat_state.py
+"""
+Компактное состояние боя для FSM-хранилища.
+Вместо россыпи ключей (monster_hp, monster_damage, ..., player_buffs) в данных FSM лежит
+одна версионированная запись-список под ключом COMBAT_STATE_KEY, которая пишется один раз за ход.
+Бои, начатые до деплоя (старый формат или прошлая версия), читаются через decode/from_legacy_data.
+"""
+import logging
+
+from aiogram.fsm.context import FSMContext
+
+from combat_effects import EffectScheduler
+
+COMBAT_STATE_KEY = "combat"
+COMBAT_STATE_VERSION = 2 # v2: баффы -> планировщик эффектов (combat_effects)
+
+# Баффы в записи v1: (ключ, значение, длительность); длительность 0 - бафф без таймера (buff_next_attack)
+NO_DURATION = 0
+
+
+class CombatState:
+    """Состояние одного боя (монстр или босс). enemy_key - ключ монстра или индекс босса строкой."""
+    __slots__ = ('enemy_key', 'enemy_name', 'enemy_hp', 'enemy_max_hp', 'enemy_damage',
+                 'xp_reward', 'gold_reward', 'fragment_item_id', 'effects')
+
+    def __init__(self, enemy_key: str, enemy_name: str, enemy_hp: int, enemy_max_hp: int, enemy_damage: int,
+                 xp_reward: int, gold_reward: int, fragment_item_id: str | None = None, effects: EffectScheduler | None = None):
+        self.enemy_key = enemy_key
+        self.enemy_name = enemy_name
+        self.enemy_hp = enemy_hp
+        self.enemy_max_hp = enemy_max_hp
+        self.enemy_damage = enemy_damage
+        self.xp_reward = xp_reward
+        self.gold_reward = gold_reward
+        self.fragment_item_id = fragment_item_id
+        self.effects = effects if effects is not None else EffectScheduler() # Баффы, HoT/DoT, призывы
+
+    def __repr__(self):
+        return f"CombatState({self.enemy_key!r}, hp={self.enemy_hp}/{self.enemy_max_hp}, effects={self.effects.describe()})"
+
+    # --- Кодирование ---
+    def encode(self) -> list:
+        """Версионированная запись: [версия, ключ, имя, hp, max_hp, урон, xp, золото, фрагмент, эффекты]."""
+        # Список, а не кортеж: JSON-хранилища все равно вернут список
+        return [COMBAT_STATE_VERSION, self.enemy_key, self.enemy_name, self.enemy_hp, self.enemy_max_hp,
+                self.enemy_damage, self.xp_reward, self.gold_reward, self.fragment_item_id, self.effects.encode()]
+
+    @classmethod
+    def decode(cls, record) -> "CombatState":
+        """Обратно из encode(). ValueError - неизвестная версия или битая запись."""
+        if not isinstance(record, (list, tuple)) or not record:
+            raise ValueError(f"Bad combat state record: {record!r}")
+        version = record[0]
+        if version not in (1, COMBAT_STATE_VERSION):
+            raise ValueError(f"Unsupported combat state version: {version}")
+        (_, enemy_key, enemy_name, enemy_hp, enemy_max_hp, enemy_damage,
+         xp_reward, gold_reward, fragment_item_id, encoded_effects) = record
+        if version == 1:
+            buffs = {}
+            for buff_key, value, duration in encoded_effects:
+                buffs[buff_key] = {'value': value, 'duration': duration} if duration != NO_DURATION else value
+            effects = EffectScheduler.from_legacy_buffs(buffs)
+        else:
+            effects = EffectScheduler.decode(encoded_effects)
+        return cls(enemy_key, enemy_name, enemy_hp, enemy_max_hp, enemy_damage,
+                   xp_reward, gold_reward, fragment_item_id, effects)
+
+    @classmethod
+    def from_legacy_data(cls, state_data: dict) -> "CombatState | None":
+        """Бой, начатый до перехода на запись (россыпь ключей в FSM). None - данных не хватает."""
+        effects = EffectScheduler.from_legacy_buffs(state_data.get("player_buffs") or {})
+        if state_data.get("monster_key") is not None:
+            keys = ("monster_key", "monster_hp", "monster_max_hp", "monster_damage", "monster_xp_reward", "monster_gold_reward")
+            if any(state_data.get(k) is None for k in keys):
+                return None
+            return cls(state_data["monster_key"], state_data["monster_key"], state_data["monster_hp"],
+                       state_data["monster_max_hp"], state_data["monster_damage"],
+                       state_data["monster_xp_reward"], state_data["monster_gold_reward"], effects=effects)
+        if state_data.get("boss_id") is not None:
+            keys = ("boss_id", "boss_name", "boss_hp", "boss_max_hp", "boss_damage", "boss_xp_reward",
+                    "boss_gold_reward", "fragment_item_id")
+            if any(state_data.get(k) is None for k in keys):
+                return None
+            return cls(state_data["boss_id"], state_data["boss_name"], state_data["boss_hp"],
+                       state_data["boss_max_hp"], state_data["boss_damage"], state_data["boss_xp_reward"],
+                       state_data["boss_gold_reward"], state_data["fragment_item_id"], effects)
+        return None
+
+
+# --- Чтение/запись через FSMContext ---
+async def load_combat_state(state: FSMContext) -> CombatState | None:
+    """Читает состояние боя из FSM. None - боя нет или запись не читается."""
+    state_data = await state.get_data()
+    record = state_data.get(COMBAT_STATE_KEY)
+    if record is None:
+        return CombatState.from_legacy_data(state_data)
+    try:
+        return CombatState.decode(record)
+    except (ValueError, TypeError) as e:
+        logging.error(f"Failed to decode combat state: {e}")
+        return None
+
+async def save_combat_state(state: FSMContext, combat: CombatState):
+    """Одна запись в хранилище за ход: данные FSM целиком заменяются записью боя."""
+    await state.set_data({COMBAT_STATE_KEY: combat.encode()})
@@ -6,5 +6,62 @@ import os
 # Лучше использовать переменные окружения для реальных проектов.
 BOT_TOKEN = "7909967646:AAF-eumDtD46VSVbOya8FHcRdJWd63Xb_1I"
 
+# Адрес Bot API; пусто - api.telegram.org. Для нагрузочных тестов без сети -
+# локальный заменитель: python -m tools.fake_bot_api, BOT_TELEGRAM_API_URL=http://127.0.0.1:8081
+TELEGRAM_API_URL = os.getenv("BOT_TELEGRAM_API_URL", "")
+
 # Имя файла базы данных
 DB_NAME = "poe_bot.db"
+
+# Логи (log_setup.py): уровень ("DEBUG" - подробные трассы боя) и файл (пусто - только консоль)
+LOG_LEVEL = os.getenv("BOT_LOG_LEVEL", "INFO")
+LOG_FILE = os.getenv("BOT_LOG_FILE", "") or None
+
+# Файл FSM-хранилища (fsm_storage.py): состояния диалогов и боев переживают рестарт
+FSM_DB_NAME = "fsm_state.db"
+
+# Каталог бинарного журнала боев (combat_log.py); None - журнал выключен
+COMBAT_LOG_DIR = "combat_log"
+
+# --- Режим запуска ---
+# "polling" - getUpdates (по умолчанию), "webhook" - aiohttp-сервер (webhook_server.py)
+RUN_MODE = os.getenv("BOT_RUN_MODE", "polling")
+# Сколько апдейтов обрабатывается одновременно (оба режима); None/0 - без лимита
+UPDATE_CONCURRENCY_LIMIT = int(os.getenv("BOT_UPDATE_CONCURRENCY", "64")) or None
+# Апдейты, накопившиеся за время рестарта: по умолчанию обрабатываются (FSM и бои переживают рестарт)
+DROP_PENDING_UPDATES = os.getenv("BOT_DROP_PENDING_UPDATES", "0") != "0"
+# Бюджет холодного старта, сек до приема апдейтов (startup.py; замер - python -m benchmarks.startup_bench)
+STARTUP_BUDGET = float(os.getenv("BOT_STARTUP_BUDGET", "8"))
+# Остановка (SIGTERM/SIGINT, shutdown.py): сек на дообработку принятых апдейтов, потом они отменяются.
+# Вместе с остальными фазами должно укладываться в паузу до SIGKILL (docker stop - 10 с, sharding.STOP_TIMEOUT - 20 с)
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("BOT_SHUTDOWN_DRAIN_TIMEOUT", "5"))
+
+# Бюджет работы с БД на один апдейт (middlewares/query_budget.py): превышение - WARNING с цепочкой
+# вызовов db_manager (N+1 видно как "get_inventory_items x2"); 0 - без ограничения
+DB_QUERY_BUDGET = int(os.getenv("BOT_DB_QUERY_BUDGET", "15")) # Операторов SQLite (вместе с BEGIN/COMMIT)
+DB_CONNECTION_BUDGET = int(os.getenv("BOT_DB_CONNECTION_BUDGET", "6")) # Соединений (каждая функция db_manager - свое)
+DB_ROW_BUDGET = int(os.getenv("BOT_DB_ROW_BUDGET", "500")) # Прочитанных строк
+
+# Вебхук: публичный адрес (за reverse proxy с TLS) и локальный адрес сервера
+WEBHOOK_BASE_URL = os.getenv("BOT_WEBHOOK_BASE_URL", "") # Например https://bot.example.com
+WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "") # Секрет для X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("BOT_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", "8080"))
+WEBHOOK_HANDLE_IN_BACKGROUND = os.getenv("BOT_WEBHOOK_BACKGROUND", "1") != "0" # 200 сразу, обработка в фоне
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("BOT_WEBHOOK_MAX_CONNECTIONS", "40")) # Параллельных соединений от Telegram
+
+# --- Шардирование (sharding.py) ---
+# BOT_SHARD_WORKERS > 0: этот процесс - супервизор и фронт вебхука на WEBHOOK_PORT,
+# апдейты по хешу user_id уходят N воркерам на портах SHARD_BASE_PORT..SHARD_BASE_PORT+N-1
+SHARD_WORKERS = int(os.getenv("BOT_SHARD_WORKERS", "0"))
+SHARD_BASE_PORT = int(os.getenv("BOT_SHARD_BASE_PORT", str(WEBHOOK_PORT + 1)))
+# Задаются супервизором воркеру: номер шарда и их число (FSM-файл и доля лимита исходящих - свои)
+SHARD_INDEX = int(os.getenv("BOT_SHARD_INDEX", "-1")) # -1 - не воркер
+SHARD_COUNT = int(os.getenv("BOT_SHARD_COUNT", "1"))
+
+# --- Метрики (metrics.py) ---
+# Prometheus: GET http://METRICS_HOST:METRICS_PORT/metrics; 0 - сервер метрик выключен.
+# Воркер шарда слушает METRICS_PORT + SHARD_INDEX (супервизор апдейты не обрабатывает - своих метрик нет)
+METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("BOT_METRICS_HOST", "127.0.0.1")
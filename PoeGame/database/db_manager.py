@@ -2,8 +2,10 @@
 import aiosqlite
 import logging
 import time
-import math
+from collections import OrderedDict
 from config import DB_NAME
+from database.query_stats import connect, instrument_module # Соединения с учетом запросов (метрики)
+from metrics import CACHE_REQUESTS
 # Добавляем импорт данных, включая BOSSES и эффекты
 from game_data import (
     BASE_STATS, ALL_ITEMS, ALL_SLOTS, ITEM_SLOTS, ITEM_TYPE_RING,
@@ -15,15 +17,17 @@ from game_data import (
     ITEM_TYPE_FRAGMENT # Нужен для кузнеца
 )
 import json # Для хранения списков ID в БД
-
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
+from combat_engine import (
+    calculate_effective_stats, calculate_level_progress, calculate_base_max_vitals, calculate_death_penalty,
+    calculate_regen_vitals, simulate_farm_run, POLICY_BEST_SPELL, MAX_LEVEL
+)
 
 # --- Инициализация/Обновление БД ---
 async def init_db():
     """Инициализирует БД, создает/обновляет все таблицы."""
     # Отступ 0 - Начало функции
     # Отступ 4 - Начало блока async with
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         # Отступ 8 - Начало работы с таблицей players
         # --- Таблица players ---
         cursor = await db.execute("PRAGMA table_info(players)")
@@ -192,15 +196,28 @@ async def init_db():
         # Отступ 8
         await db.commit()
 
+        # WAL (режим сохраняется в файле БД): читатели не блокируют писателя - при нескольких
+        # процессах-шардах (sharding.py) иначе запись одного останавливает чтение всех
+        await db.execute("PRAGMA journal_mode=WAL")
+
     # --- !!! ЕДИНСТВЕННЫЙ ЛОГ ПОСЛЕ ЗАВЕРШЕНИЯ РАБОТЫ С БД !!! ---
     # Отступ 4 - СНАРУЖИ блока async with
     logging.info("Database initialized/updated (players, player_spells, inventory, shop_state, blacksmith_state, boss_cooldowns).")
 
+async def checkpoint_wal():
+    """Переносит WAL в основной файл и обрезает его (остановка бота: на диске остается один файл БД)."""
+    async with connect(DB_NAME) as db:
+        async with db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cursor:
+            busy, log_pages, checkpointed = await cursor.fetchone()
+    if busy:
+        # Файл читает другой процесс (шард) - остаток перенесет следующий checkpoint
+        logging.info(f"WAL checkpoint of {DB_NAME} incomplete: {checkpointed}/{log_pages} pages.")
+
 # --- Получение Базовых Данных Игрока ---
 async def get_player(user_id: int):
     """Получает RAW данные игрока из таблицы players."""
     # ... (это начало следующей функции, дальше код как был) ...
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         db.row_factory = aiosqlite.Row
         async with db.execute("SELECT * FROM players WHERE user_id = ?", (user_id,)) as cursor:
             player_data = await cursor.fetchone()
@@ -208,7 +225,7 @@ async def get_player(user_id: int):
 
 async def delete_item_from_inventory(inventory_id: int) -> bool:
     """Удаляет предмет из инвентаря по его inventory_id."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         try:
             cursor = await db.execute("DELETE FROM inventory WHERE inventory_id = ?", (inventory_id,))
             # Проверяем, была ли удалена ровно одна строка
@@ -230,7 +247,7 @@ async def add_item_to_inventory(player_id: int, item_id: str):
     if item_id not in ALL_ITEMS:
         logging.error(f"Attempted to add non-existent item_id '{item_id}' to inventory for player {player_id}.")
         return False
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         try:
             await db.execute(
                 "INSERT INTO inventory (player_id, item_id) VALUES (?, ?)",
@@ -243,6 +260,31 @@ async def add_item_to_inventory(player_id: int, item_id: str):
             logging.error(f"Failed to add item to inventory for player {player_id}, item {item_id}: {e}", exc_info=True)
             return False
 
+async def add_items_to_inventory(player_id: int, item_ids: list[str], db: aiosqlite.Connection | None = None) -> int:
+    """
+    Добавляет пачку предметов одним executemany. Несуществующие ID пропускаются.
+    Если передано соединение db - пишет в его транзакцию без commit (коммитит вызывающий).
+    Возвращает число добавленных предметов.
+    """
+    rows = [(player_id, item_id) for item_id in item_ids if item_id in ALL_ITEMS]
+    if len(rows) != len(item_ids):
+        logging.error(f"Skipped non-existent item_ids for player {player_id}: {[i for i in item_ids if i not in ALL_ITEMS]}")
+    if not rows:
+        return 0
+    sql = "INSERT INTO inventory (player_id, item_id) VALUES (?, ?)"
+    if db is not None:
+        await db.executemany(sql, rows)
+        return len(rows)
+    async with connect(DB_NAME) as own_db:
+        try:
+            await own_db.executemany(sql, rows)
+            await own_db.commit()
+        except Exception as e:
+            logging.error(f"Failed to add {len(rows)} items to inventory for player {player_id}: {e}", exc_info=True)
+            return 0
+    logging.info(f"Added {len(rows)} items to inventory for player {player_id}.")
+    return len(rows)
+
 async def get_inventory_items(player_id: int, equipped: bool | None = None) -> list[dict]:
     """
     Получает список предметов в инвентаре игрока.
@@ -256,7 +298,7 @@ async def get_inventory_items(player_id: int, equipped: bool | None = None) -> l
         sql += " AND is_equipped = ?"
         params.append(equipped)
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         db.row_factory = aiosqlite.Row # Получаем как объекты Row
         async with db.execute(sql, params) as cursor:
             inventory_rows = await cursor.fetchall()
@@ -273,7 +315,7 @@ async def get_inventory_items(player_id: int, equipped: bool | None = None) -> l
 
 async def get_item_from_inventory(inventory_id: int) -> dict | None:
      """Получает данные одного конкретного предмета из инвентаря по его inventory_id."""
-     async with aiosqlite.connect(DB_NAME) as db:
+     async with connect(DB_NAME) as db:
          db.row_factory = aiosqlite.Row
          async with db.execute("SELECT * FROM inventory WHERE inventory_id = ?", (inventory_id,)) as cursor:
              row = await cursor.fetchone()
@@ -310,7 +352,8 @@ async def equip_item(player_id: int, inventory_id: int, target_slot: str) -> tup
     if target_slot not in allowed_slots:
         return False, f"Предмет '{item_to_equip['name']}' ({item_type}) нельзя надеть в слот '{target_slot}'."
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    await anchor_regen_vitals(player_id) # Реген до смены экипировки - по старым эффектам
+    async with connect(DB_NAME) as db:
         try:
             # --- Сначала снимаем предмет, который УЖЕ в целевом слоте ---
             cursor = await db.execute(
@@ -350,7 +393,8 @@ async def unequip_item(player_id: int, inventory_id: int) -> tuple[bool, str]:
 
      slot = item_to_unequip['equipped_slot']
 
-     async with aiosqlite.connect(DB_NAME) as db:
+     await anchor_regen_vitals(player_id) # Реген до смены экипировки - по старым эффектам
+     async with connect(DB_NAME) as db:
          try:
              await db.execute(
                  "UPDATE inventory SET is_equipped = FALSE, equipped_slot = NULL WHERE inventory_id = ?",
@@ -369,94 +413,21 @@ async def get_player_effective_stats(user_id: int) -> dict | None:
     """
     Рассчитывает и возвращает ПОЛНЫЕ статы игрока и активные эффекты,
     учитывая базу, уровень, прокачку статов и НАДЕТЫЕ предметы (включая легендарки).
+    current_hp/current_mana - с пассивной регенерацией на текущий момент (в БД не пишется).
     """
     player_base = await get_player(user_id)
     if not player_base: return None
 
-    effective_stats = dict(player_base)
-    active_effects = {}
-
-    # Шаг 1: База + Уровень + Прокачка
-    base_class_stats = BASE_STATS.get(player_base['class'], BASE_STATS['Scion'])
-    level = player_base['level']
-    hp_gain_per_level = 10
-    mana_gain_per_level = 5
-    effective_stats['max_hp'] = base_class_stats['hp'] + int(effective_stats['strength'] * 0.5) + (level * hp_gain_per_level)
-    effective_stats['max_mana'] = base_class_stats['mana'] + effective_stats['intelligence'] + (level * mana_gain_per_level)
-    effective_stats['armor'] = 0
-    effective_stats['max_energy_shield'] = 0
-    # Сбрасываем криты до базовых перед добавлением бонусов
-    effective_stats['crit_chance'] = 5.0
-    effective_stats['crit_damage'] = 150.0
-
-    # Шаг 2: Добавляем статы и ЭФФЕКТЫ от экипированных предметов
+    # Надетые предметы; сам расчет - в combat_engine (общий с симулятором)
     equipped_items = await get_inventory_items(user_id, equipped=True)
-    logging.debug(f"Calculating effective stats for {user_id}. Found {len(equipped_items)} items.")
-
-    for item in equipped_items:
-        item_data = ALL_ITEMS.get(item['item_id'], {})
-        item_stats = item_data.get('stats', {})
-        for stat_name, value in item_stats.items():
-            if stat_name in effective_stats:
-                # Проверяем, что стат числовой перед сложением
-                if isinstance(effective_stats[stat_name], (int, float)) and isinstance(value, (int, float)):
-                    effective_stats[stat_name] += value
-                    logging.debug(f"  + {value} {stat_name} from '{item_data.get('name', 'Unknown Item')}'")
-                else:
-                    logging.warning(f"Non-numeric stat addition skipped: {stat_name} (item: {item_data.get('name', '?')})")
-            # else: игнорируем неизвестные статы
-
-        item_effect = item_data.get('effect')
-        if item_effect and isinstance(item_effect, dict):
-            effect_type = item_effect.get('type')
-            effect_value = item_effect.get('value')
-            if effect_type:
-                # TODO: Продумать стакание (суммировать? брать макс/мин?) Пока перезапись.
-                if effect_type in active_effects:
-                     logging.warning(f"Effect '{effect_type}' overwritten by item '{item_data.get('name', '?')}'. Stacking logic needed.")
-                active_effects[effect_type] = effect_value
-                logging.debug(f"  + EFFECT {effect_type}={effect_value} from '{item_data.get('name', 'Unknown Item')}'")
-
-    # Шаг 3: Применение некоторых эффектов к статам
-    logging.debug(f"Applying effects to stats for {user_id}. Active effects: {active_effects}")
-
-    # Конвертация маны в ES ('mana_to_es')
-    if 'mana_to_es' in active_effects:
-        try:
-            conversion_rate = float(active_effects['mana_to_es'])
-            # Конвертируем от МАКСИМАЛЬНОЙ маны, рассчитанной на Шаге 1
-            mana_for_conversion = base_class_stats['mana'] + effective_stats['intelligence'] + (level * mana_gain_per_level)
-            mana_converted_to_es = int(mana_for_conversion * conversion_rate)
-            # Добавляем к ES, рассчитанному от шмота
-            effective_stats['max_energy_shield'] += mana_converted_to_es
-            logging.info(f"  Applied 'mana_to_es' ({conversion_rate * 100}%): +{mana_converted_to_es} MaxES. New MaxES: {effective_stats['max_energy_shield']}")
-            # Решаем, уменьшать ли ману. Допустим, НЕТ, это просто бонус ES на основе маны.
-            # effective_stats['max_mana'] = max(0, effective_stats['max_mana'] - mana_converted_to_es)
-        except (ValueError, TypeError) as e:
-             logging.error(f"Error applying 'mana_to_es' effect: {e}")
-
-    # Бонус к множителю крита ('crit_multiplier_bonus')
-    if 'crit_multiplier_bonus' in active_effects:
-         try:
-             bonus = float(active_effects['crit_multiplier_bonus'])
-             # Добавляем к базовому множителю крита
-             effective_stats['crit_damage'] += bonus
-             logging.info(f"  Applied 'crit_multiplier_bonus': +{bonus}%. New CritDamage: {effective_stats['crit_damage']}%")
-         except (ValueError, TypeError) as e:
-              logging.error(f"Error applying 'crit_multiplier_bonus' effect: {e}")
-
-    # --- Другие эффекты, модифицирующие статы напрямую ---
-    # (Добавлять сюда по мере необходимости)
-
-    # Шаг 4: Коррекция текущих значений
-    effective_stats['current_hp'] = min(effective_stats['current_hp'], effective_stats['max_hp'])
-    effective_stats['current_mana'] = min(effective_stats['current_mana'], effective_stats['max_mana'])
-    effective_stats['energy_shield'] = min(effective_stats['energy_shield'], effective_stats['max_energy_shield'])
-
-    # Добавляем активные эффекты (которые не были применены напрямую к статам) в словарь
-    effective_stats['active_effects'] = active_effects
-
-    logging.info(f"Effective stats calculated for {user_id}. Final MaxHP: {effective_stats['max_hp']}, Final MaxES: {effective_stats['max_energy_shield']}, Effects dictionary: {active_effects}")
+    logging.debug("Calculating effective stats for %s. Found %d items.", user_id, len(equipped_items))
+    effective_stats = calculate_effective_stats(dict(player_base), [item['item_id'] for item in equipped_items])
+    active_effects = effective_stats['active_effects']
+    effective_stats['current_hp'], effective_stats['current_mana'] = calculate_regen_vitals(effective_stats, int(time.time()))
+
+    # Считается на каждом апдейте (player_context) - трасса только на DEBUG, аргументы форматируются лениво
+    logging.debug("Effective stats calculated for %s. Final MaxHP: %s, Final MaxES: %s, Effects dictionary: %s",
+                  user_id, effective_stats['max_hp'], effective_stats['max_energy_shield'], active_effects)
     return effective_stats
 
 
@@ -477,7 +448,7 @@ async def get_top_players(by: str = 'level_xp', limit: int = 10) -> list[dict]:
 
     sql = f"SELECT user_id, username, level, xp, gold FROM players {order_by_clause} LIMIT ?"
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         db.row_factory = aiosqlite.Row
         async with db.execute(sql, (limit,)) as cursor:
             rows = await cursor.fetchall()
@@ -500,7 +471,7 @@ async def update_player_boss_progression(user_id: int, defeated_boss_index: int)
     # и если это не последний босс
     if defeated_boss_index == current_max_boss and current_max_boss < num_bosses - 1:
         next_boss_index = current_max_boss + 1
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with connect(DB_NAME) as db:
             await db.execute("UPDATE players SET highest_unlocked_boss_index = ? WHERE user_id = ?", (next_boss_index, user_id))
             await db.commit()
         logging.info(f"Player {user_id} unlocked next boss (index: {next_boss_index}).")
@@ -510,7 +481,7 @@ async def update_player_boss_progression(user_id: int, defeated_boss_index: int)
 
 async def get_boss_cooldown(player_id: int, boss_id: str) -> int:
     """Возвращает время ПОСЛЕДНЕГО УБИЙСТВА босса (timestamp) или 0, если не убивал/нет записи."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         async with db.execute(
             "SELECT last_kill_time FROM boss_cooldowns WHERE player_id = ? AND boss_id = ?",
             (player_id, boss_id)
@@ -521,7 +492,7 @@ async def get_boss_cooldown(player_id: int, boss_id: str) -> int:
 async def set_boss_cooldown(player_id: int, boss_id: str):
     """Записывает ТЕКУЩЕЕ время как время последнего убийства босса."""
     current_time = int(time.time())
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         # INSERT OR REPLACE обновит запись, если она есть, или вставит новую
         await db.execute(
             """INSERT OR REPLACE INTO boss_cooldowns (player_id, boss_id, last_kill_time)
@@ -534,7 +505,7 @@ async def set_boss_cooldown(player_id: int, boss_id: str):
 # --- Получение/Добавление Игрока ---
 async def get_player(user_id: int):
     """Получает данные игрока по его user_id."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         # Устанавливаем row_factory для получения результата в виде объекта sqlite3.Row
         db.row_factory = aiosqlite.Row
         async with db.execute("SELECT * FROM players WHERE user_id = ?", (user_id,)) as cursor:
@@ -554,7 +525,7 @@ async def add_player(user_id: int, username: str, chosen_class: str = 'Scion'):
     start_crit_damage = 150.0
     current_time = int(time.time())
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         # Используем явную транзакцию с try/except/finally
         transaction_successful = False
         try:
@@ -591,6 +562,7 @@ async def add_player(user_id: int, username: str, chosen_class: str = 'Scion'):
 
             # --- !!! ВОЗВРАЩАЕМ ЯВНЫЙ COMMIT ВНУТРИ TRY !!! ---
             await db.commit()
+            invalidate_learned_spells(user_id) # Пустой список мог закэшироваться до создания персонажа
             transaction_successful = True # Ставим флаг, что коммит прошел
             # --- КОНЕЦ ИЗМЕНЕНИЯ ---
             logging.info(f"Transaction committed for player {user_id}.")
@@ -606,10 +578,27 @@ async def add_player(user_id: int, username: str, chosen_class: str = 'Scion'):
             return False # Ошибка добавления
 
 # --- Функции для Заклинаний ---
+# Кэш изученных спеллов: player_id -> кортеж данных спеллов. Меняются они только через
+# learn_spell/add_player, которые сбрасывают запись, поэтому ход боя не ходит в БД за спеллами.
+LEARNED_SPELLS_CACHE_SIZE = 10000
+_learned_spells_cache = OrderedDict()
+_learned_spells_hit = CACHE_REQUESTS.labels("learned_spells", "hit")
+_learned_spells_miss = CACHE_REQUESTS.labels("learned_spells", "miss")
+
+def invalidate_learned_spells(player_id: int):
+    """Сбрасывает кэш изученных спеллов игрока."""
+    _learned_spells_cache.pop(player_id, None)
+
 async def get_learned_spells(player_id: int) -> list[dict]:
-    """Получает список ID и данных изученных заклинаний игрока."""
+    """Получает список ID и данных изученных заклинаний игрока (из кэша, если есть). Данные спеллов менять нельзя."""
+    cached = _learned_spells_cache.get(player_id)
+    if cached is not None:
+        _learned_spells_cache.move_to_end(player_id)
+        _learned_spells_hit.inc()
+        return list(cached)
+    _learned_spells_miss.inc()
     learned = []
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         db.row_factory = aiosqlite.Row
         async with db.execute("SELECT spell_id FROM player_spells WHERE player_id = ?", (player_id,)) as cursor:
             rows = await cursor.fetchall()
@@ -625,6 +614,9 @@ async def get_learned_spells(player_id: int) -> list[dict]:
                     logging.warning(f"Learned spell '{spell_id}' for player {player_id} not found in SPELLS data.")
     # Сортируем по уровню требования
     learned.sort(key=lambda s: s.get('level_req', 999))
+    _learned_spells_cache[player_id] = tuple(learned)
+    while len(_learned_spells_cache) > LEARNED_SPELLS_CACHE_SIZE:
+        _learned_spells_cache.popitem(last=False)
     return learned
 
 async def learn_spell(player_id: int, spell_id: str) -> bool:
@@ -632,13 +624,14 @@ async def learn_spell(player_id: int, spell_id: str) -> bool:
     if spell_id not in SPELLS:
         logging.error(f"Attempted to learn non-existent spell_id '{spell_id}' for player {player_id}.")
         return False
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         try:
             await db.execute(
                 "INSERT INTO player_spells (player_id, spell_id) VALUES (?, ?)",
                 (player_id, spell_id)
             )
             await db.commit()
+            invalidate_learned_spells(player_id) # Следующее чтение возьмет новый список из БД
             logging.info(f"Player {player_id} learned spell '{spell_id}' ({SPELLS[spell_id]['name']}).")
             return True
         except aiosqlite.IntegrityError: # Если уже изучено (UNIQUE constraint)
@@ -655,9 +648,11 @@ async def update_player_vitals(user_id: int, hp_change: int = 0, mana_change: in
     Урон (hp_change<0) сначала вычитается из текущего ES.
     !!! НЕ ПРОВЕРЯЕТ ВЕРХНИЕ ГРАНИЦЫ (MaxHP/MaxMana/MaxES) - это должен делать вызывающий код !!!
     Проверяет только нижнюю границу (0).
-    Возвращает кортеж фактических записанных в БД значений (current_hp, current_mana, current_es) или None.
+    HP/мана считаются от текущих значений с учетом ленивого регена; измененный ресурс получает
+    новый якорь (значение + время), неизмененный не пишется.
+    Возвращает кортеж фактических значений (current_hp, current_mana, current_es) или None.
     """
-    player = await get_player(user_id)
+    player = await get_player_effective_stats(user_id)
     if not player:
         logging.warning(f"Attempted to update vitals for non-existent player {user_id}")
         return None
@@ -674,9 +669,9 @@ async def update_player_vitals(user_id: int, hp_change: int = 0, mana_change: in
 
     # --- Обработка set_* (имеет приоритет) ---
     hp_was_set = False; mana_was_set = False; es_was_set = False
-    if set_hp is not None: final_hp = set_hp; hp_was_set = True; logging.info(f"[update_vitals SET_HP] Setting HP to {set_hp}")
-    if set_mana is not None: final_mana = set_mana; mana_was_set = True; logging.info(f"[update_vitals SET_MANA] Setting Mana to {set_mana}")
-    if set_es is not None: final_es = set_es; es_was_set = True; logging.info(f"[update_vitals SET_ES] Setting ES to {set_es}")
+    if set_hp is not None: final_hp = set_hp; hp_was_set = True; logging.debug("[update_vitals SET_HP] Setting HP to %s", set_hp)
+    if set_mana is not None: final_mana = set_mana; mana_was_set = True; logging.debug("[update_vitals SET_MANA] Setting Mana to %s", set_mana)
+    if set_es is not None: final_es = set_es; es_was_set = True; logging.debug("[update_vitals SET_ES] Setting ES to %s", set_es)
 
     # --- Обработка *_change (только если set_* не использовался для этого ресурса) ---
     # Обработка урона
@@ -685,22 +680,22 @@ async def update_player_vitals(user_id: int, hp_change: int = 0, mana_change: in
         es_damage = min(final_es, damage_taken) # Вычитаем из ТЕКУЩЕГО (final_es)
         hp_damage = damage_taken - es_damage
 
-        logging.info(f"[update_vitals DAMAGE] Taken={damage_taken}, CurrentES={final_es}, ES_absorb={es_damage}, HP_dmg={hp_damage}")
+        logging.debug("[update_vitals DAMAGE] Taken=%s, CurrentES=%s, ES_absorb=%s, HP_dmg=%s", damage_taken, final_es, es_damage, hp_damage)
         final_es -= es_damage
         final_hp -= hp_damage
-        logging.info(f"[update_vitals AFTER_DMG] NewES={final_es}, NewHP={final_hp}")
+        logging.debug("[update_vitals AFTER_DMG] NewES=%s, NewHP=%s", final_es, final_hp)
     elif hp_change > 0 and not hp_was_set: # Исцеление HP
-        logging.info(f"[update_vitals HEAL_HP] Adding {hp_change} HP. Initial HP: {current_hp}")
+        logging.debug("[update_vitals HEAL_HP] Adding %s HP. Initial HP: %s", hp_change, current_hp)
         final_hp += hp_change
 
     # Изменение маны
     if mana_change != 0 and not mana_was_set:
-        logging.info(f"[update_vitals MANA_CHG] Change: {mana_change}. Initial Mana: {current_mana}")
+        logging.debug("[update_vitals MANA_CHG] Change: %s. Initial Mana: %s", mana_change, current_mana)
         final_mana += mana_change
 
     # Изменение ES (если не урон и не было set_es)
     if hp_change >= 0 and es_change != 0 and not es_was_set:
-        logging.info(f"[update_vitals ES_CHG] Change: {es_change}. Initial ES: {current_es}")
+        logging.debug("[update_vitals ES_CHG] Change: %s. Initial ES: %s", es_change, current_es)
         final_es += es_change
 
     # --- Ограничение СНИЗУ (0) ---
@@ -709,36 +704,46 @@ async def update_player_vitals(user_id: int, hp_change: int = 0, mana_change: in
     final_es = max(0, final_es)
     # --- ВЕРХНЕЕ ОГРАНИЧЕНИЕ УБРАНО ---
 
-    # --- Логируем финальные значения ПЕРЕД записью ---
-    logging.info(f"[update_vitals FINAL_VALS to write] HP={final_hp}, Mana={final_mana}, ES={final_es}")
-
-    # Обновляем данные в БД
+    # --- Логируем финальные значения ПЕРЕД записью (трассы update_vitals - DEBUG, лениво) ---
+    logging.debug("[update_vitals FINAL_VALS to write] HP=%s, Mana=%s, ES=%s", final_hp, final_mana, final_es)
+
+    # Обновляем в БД только изменившиеся ресурсы; HP/мана - вместе с новым якорем регена
+    now = int(time.time())
+    assignments, params = [], []
+    if final_hp != current_hp:
+        assignments.append("current_hp = ?, last_hp_regen_time = ?"); params += [final_hp, now]
+    if final_mana != current_mana:
+        assignments.append("current_mana = ?, last_mana_regen_time = ?"); params += [final_mana, now]
+    if final_es != current_es:
+        assignments.append("energy_shield = ?"); params.append(final_es)
+    if not assignments:
+        return final_hp, final_mana, final_es
     try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute(
-                "UPDATE players SET current_hp = ?, current_mana = ?, energy_shield = ? WHERE user_id = ?",
-                (final_hp, final_mana, final_es, user_id)
-            )
+        async with connect(DB_NAME) as db:
+            await db.execute(f"UPDATE players SET {', '.join(assignments)} WHERE user_id = ?", (*params, user_id))
             await db.commit()
-        logging.info(f"[update_vitals END] DB updated successfully. Returning: HP={final_hp}, Mana={final_mana}, ES={final_es}")
+        logging.debug("[update_vitals END] DB updated successfully. Returning: HP=%s, Mana=%s, ES=%s", final_hp, final_mana, final_es)
         return final_hp, final_mana, final_es
     except Exception as e:
          logging.error(f"Failed to update vitals in DB for user {user_id}: {e}", exc_info=True)
          return None # Возвращаем None при ошибке записи
 
-
-    # Обновляем данные в БД
-    # Обновляем данные в БД
-    async with aiosqlite.connect(DB_NAME) as db:
+async def anchor_regen_vitals(user_id: int):
+    """
+    Записывает накопленный ленивый реген как новый якорь HP/маны.
+    Нужно перед изменением того, от чего зависит скорость регена (экипировка с regen_multiplier и т.п.).
+    """
+    player = await get_player_effective_stats(user_id)
+    if not player:
+        return
+    now = int(time.time())
+    async with connect(DB_NAME) as db:
         await db.execute(
-            "UPDATE players SET current_hp = ?, current_mana = ?, energy_shield = ? WHERE user_id = ?",
-            (final_hp, final_mana, final_es, user_id) # Используем final_ переменные
+            "UPDATE players SET current_hp = ?, last_hp_regen_time = ?, current_mana = ?, last_mana_regen_time = ? WHERE user_id = ?",
+            (player['current_hp'], now, player['current_mana'], now, user_id)
         )
         await db.commit()
 
-    logging.info(f"[update_vitals END] DB updated. Returning: HP={final_hp}, Mana={final_mana}, ES={final_es}")
-    return final_hp, final_mana, final_es
-
 
 # --- Обновление Опыта, Золота, Уровня ---
 async def update_player_xp(user_id: int, gained_xp: int = 0, gained_gold: int = 0):
@@ -753,14 +758,12 @@ async def update_player_xp(user_id: int, gained_xp: int = 0, gained_gold: int =
         logging.warning(f"Attempted to update XP/Gold for non-existent player {user_id}")
         return None, False # Возвращаем None и False (не апнулся)
 
-    MAX_LEVEL = 100 # Определяем максимальный уровень
-
     # --- Обработка Штрафов (отрицательные значения) ---
     if gained_xp < 0 or gained_gold < 0:
         # Не позволяем опыту/золоту уйти ниже 0
         new_xp = max(0, player['xp'] + gained_xp)
         new_gold = max(0, player['gold'] + gained_gold)
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with connect(DB_NAME) as db:
             await db.execute("UPDATE players SET xp = ?, gold = ? WHERE user_id = ?", (new_xp, new_gold, user_id))
             await db.commit()
         logging.info(f"Player {user_id} penalized: XP change {gained_xp} -> {new_xp}, Gold change {gained_gold} -> {new_gold}")
@@ -776,47 +779,22 @@ async def update_player_xp(user_id: int, gained_xp: int = 0, gained_gold: int =
     if gained_xp <= 0 and gained_gold <= 0:
         return None, False
 
-    # Получаем текущие значения для расчета
-    new_xp = player['xp'] + gained_xp
-    xp_needed = player['xp_to_next_level']
-    current_level = player['level']
-    new_level = current_level
-    leveled_up = False
-    gained_stat_points = 0 # Очки, полученные за этот вызов функции
-
-    # Базовые статы класса для пересчета HP/Mana
-    base_class_stats = BASE_STATS.get(player['class'], BASE_STATS['Scion'])
-    # Текущие статы (они НЕ меняются при левел-апе здесь, только очки даются)
-    current_strength = player['strength']
-    current_dexterity = player['dexterity']
-    current_intelligence = player['intelligence']
-    # Текущие Max HP/Mana (будут пересчитаны, если уровень повысится)
+    # --- Повышение Уровня (формулы - в combat_engine) ---
+    new_level, new_xp, xp_needed, gained_stat_points = calculate_level_progress(
+        player['level'], player['xp'], player['xp_to_next_level'], gained_xp
+    )
+    leveled_up = new_level > player['level']
+    # Текущие Max HP/Mana (пересчитываются на основе базы класса, статов и НОВОГО уровня)
     current_max_hp = player['max_hp']
     current_max_mana = player['max_mana']
-
-    # --- Цикл Повышения Уровня ---
-    # Повышаем уровень, пока хватает опыта и не достигнут максимум
-    while new_xp >= xp_needed and new_level < MAX_LEVEL:
-        new_xp -= xp_needed       # Вычитаем опыт, потраченный на уровень
-        new_level += 1            # Увеличиваем уровень
-        leveled_up = True         # Ставим флаг, что уровень был повышен
-        gained_stat_points += 2   # Начисляем +2 очка характеристик
-        xp_needed = int(xp_needed * 1.5) # Увеличиваем требуемый опыт для СЛЕДУЮЩЕГО уровня (примерная формула)
-
+    if leveled_up:
         logging.info(f"Player {user_id} leveled up to {new_level}! Gained {gained_stat_points} stat points (total in this update).")
-
-        # --- Пересчет Макс. HP/Mana при повышении уровня ---
-        hp_gain_per_level = 10 # Фиксированный бонус HP за уровень
-        mana_gain_per_level = 5 # Фиксированный бонус Mana за уровень
-
-        # Пересчитываем на основе БАЗЫ класса, ТЕКУЩИХ статов и НОВОГО уровня
-        current_max_hp = base_class_stats['hp'] + int(current_strength * 0.5) + (new_level * hp_gain_per_level)
-        current_max_mana = base_class_stats['mana'] + current_intelligence + (new_level * mana_gain_per_level)
+        current_max_hp, current_max_mana = calculate_base_max_vitals(player['class'], player['strength'], player['intelligence'], new_level)
 
     # --- Обновление Базы Данных ---
     new_gold = player['gold'] + gained_gold
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         # Обновляем уровень, опыт, золото, ОЧКИ СТАТОВ, макс. HP/Mana
         await db.execute(
             """UPDATE players SET
@@ -838,9 +816,10 @@ async def update_player_xp(user_id: int, gained_xp: int = 0, gained_gold: int =
 
         # Если был левел-ап, восстанавливаем HP и Mana до новых максимумов
         if leveled_up:
+             now = int(time.time())
              await db.execute(
-                 "UPDATE players SET current_hp = max_hp, current_mana = max_mana WHERE user_id = ?",
-                 (user_id,)
+                 "UPDATE players SET current_hp = max_hp, current_mana = max_mana, last_hp_regen_time = ?, last_mana_regen_time = ? WHERE user_id = ?",
+                 (now, now, user_id)
              )
              logging.info(f"Player {user_id} HP/Mana restored after level up.")
 
@@ -871,11 +850,8 @@ async def apply_death_penalty(user_id: int):
     if not player or player['level'] <= 1: # Не штрафуем на 1 уровне
         return 0, 0 # Возвращаем нулевой штраф
 
-    # Штраф опыта: 10% от ТЕКУЩЕГО накопленного опыта на уровне
-    xp_penalty = math.floor(player['xp'] * 0.10)
-
-    # Штраф золота: 5% от текущего золота
-    gold_penalty = math.floor(player['gold'] * 0.05)
+    # Штраф: 10% текущего опыта на уровне и 5% золота (формула в combat_engine)
+    xp_penalty, gold_penalty = calculate_death_penalty(player['level'], player['xp'], player['gold'])
 
     logging.info(f"Applying death penalty to player {user_id} (Level {player['level']}): -{xp_penalty} XP, -{gold_penalty} Gold")
 
@@ -887,106 +863,152 @@ async def apply_death_penalty(user_id: int):
     return xp_penalty, gold_penalty
 
 
-# --- Регенерация ---
-async def record_regen_time(user_id: int, regen_type: str):
-    """Обновляет время последней регенерации (hp или mana)."""
-    current_time = int(time.time())
-    # Определяем поле для обновления в зависимости от типа регенерации
-    field_to_update = "last_hp_regen_time" if regen_type == "hp" else "last_mana_regen_time"
-
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(f"UPDATE players SET {field_to_update} = ? WHERE user_id = ?", (current_time, user_id))
-        await db.commit()
-
-async def check_and_apply_regen(user_id: int, current_state_str: str | None):
+# --- Итог боя одной транзакцией (авто-бой) ---
+async def apply_fight_outcome(user_id: int, final_hp: int, final_mana: int, final_es: int, won: bool,
+                              xp_gain: int = 0, gold_gain: int = 0, loot_item_ids: list[str] | None = None,
+                              killed_monster_key: str | None = None) -> dict | None:
     """
-    Проверяет и применяет пассивную регенерацию HP/Mana, если игрок не в бою.
-    Учитывает эффекты 'regen_multiplier' и 'cannot_regen_mana'.
-    Возвращает кортеж (hp_regened, mana_regened).
+    Записывает результат целого боя за одно соединение и одну транзакцию:
+    виталы, опыт/золото/левел-ап, прогресс квеста (с наградой), лут или штраф за смерть.
+    Возвращает словарь для итогового сообщения или None, если игрок не найден/ошибка.
     """
-    # Проверяем состояния боя
-    is_fighting = (current_state_str == CombatStates.fighting.state or
-                   (current_state_str and current_state_str.startswith("BossCombatStates:")))
+    loot_item_ids = [item_id for item_id in (loot_item_ids or []) if item_id in ALL_ITEMS]
+    async with connect(DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        try:
+            await db.execute("BEGIN IMMEDIATE") # Сразу берем блокировку записи - читаем и пишем атомарно
+            async with db.execute("SELECT * FROM players WHERE user_id = ?", (user_id,)) as cursor:
+                player = await cursor.fetchone()
+            if not player:
+                await db.rollback()
+                return None
+
+            outcome = {'won': won, 'leveled_up': False, 'level': player['level'], 'gained_stat_points': 0,
+                       'xp_gain': 0, 'gold_gain': 0, 'quest': None, 'xp_penalty': 0, 'gold_penalty': 0,
+                       'loot_item_ids': loot_item_ids if won else []}
+            quest_fields = (player['quest_monster_key'], player['quest_target_count'], player['quest_current_count'],
+                            player['quest_gold_reward'], player['quest_xp_reward'])
+            xp, gold = player['xp'], player['gold']
+            level, xp_needed = player['level'], player['xp_to_next_level']
+            max_hp, max_mana = player['max_hp'], player['max_mana']
+            gained_stat_points = 0
+
+            if won:
+                # Квест: как update_quest_progress + clear_daily_quest
+                quest_key, target, current, quest_gold, quest_xp = quest_fields
+                if quest_key and quest_key == killed_monster_key and current < target:
+                    current += 1
+                    if current >= target:
+                        outcome['quest'] = {'completed': True, 'gold_reward': quest_gold, 'xp_reward': quest_xp}
+                        xp_gain += quest_xp
+                        gold_gain += quest_gold
+                        quest_fields = (None, 0, 0, 0, 0)
+                    else:
+                        outcome['quest'] = {'completed': False, 'current_count': current, 'target_count': target}
+                        quest_fields = (quest_key, target, current, quest_gold, quest_xp)
+
+                level, xp, xp_needed, gained_stat_points = calculate_level_progress(level, xp, xp_needed, xp_gain)
+                gold += max(0, gold_gain)
+                outcome['xp_gain'], outcome['gold_gain'] = xp_gain, gold_gain
+                if level > player['level']:
+                    # Левел-ап восстанавливает HP/ману до новых максимумов (как update_player_xp)
+                    max_hp, max_mana = calculate_base_max_vitals(player['class'], player['strength'], player['intelligence'], level)
+                    final_hp, final_mana = max_hp, max_mana
+                    outcome.update(leveled_up=True, level=level, gained_stat_points=gained_stat_points)
+            else:
+                xp_penalty, gold_penalty = calculate_death_penalty(level, xp, gold)
+                xp, gold = max(0, xp - xp_penalty), max(0, gold - gold_penalty)
+                outcome['xp_penalty'], outcome['gold_penalty'] = xp_penalty, gold_penalty
 
-    if is_fighting:
-         logging.debug(f"Player {user_id} is fighting, skipping passive regen check.")
-         return 0, 0
+            await db.execute(
+                """UPDATE players SET
+                   level = ?, xp = ?, xp_to_next_level = ?, gold = ?, stat_points = stat_points + ?,
+                   max_hp = ?, max_mana = ?, current_hp = ?, current_mana = ?, energy_shield = ?,
+                   last_hp_regen_time = ?, last_mana_regen_time = ?,
+                   quest_monster_key = ?, quest_target_count = ?, quest_current_count = ?,
+                   quest_gold_reward = ?, quest_xp_reward = ?
+                   WHERE user_id = ?""",
+                (level, xp, xp_needed, gold, gained_stat_points,
+                 max_hp, max_mana, max(0, final_hp), max(0, final_mana), max(0, final_es),
+                 int(time.time()), int(time.time()), # Новые якоря регена
+                 *quest_fields, user_id)
+            )
+            await add_items_to_inventory(user_id, outcome['loot_item_ids'], db=db)
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logging.error(f"Failed to apply fight outcome for user {user_id}: {e}", exc_info=True)
+            return None
 
-    # Получаем ЭФФЕКТИВНЫЕ статы, чтобы иметь доступ к active_effects
-    player = await get_player_effective_stats(user_id)
-    if not player:
-        logging.warning(f"Regen check failed: Player {user_id} not found.")
-        return 0, 0
+    logging.info("Fight outcome applied for user %s: won=%s, xp+%s, gold+%s, loot=%s, level=%s",
+                 user_id, won, outcome['xp_gain'], outcome['gold_gain'], outcome['loot_item_ids'], outcome['level'])
+    return outcome
 
-    current_time = int(time.time())
-    hp_regen_interval = 30
-    mana_regen_interval = 60
-    hp_regened = 0
-    mana_regened = 0
 
-    # Получаем активные эффекты
-    active_effects = player.get('active_effects', {})
+# --- Фарм-забег одной транзакцией ---
+async def apply_farm_run(user_id: int, fights: int, policy: str = POLICY_BEST_SPELL) -> dict | None:
+    """
+    Проводит фарм-забег (simulate_farm_run) и записывает его итог за одно соединение:
+    чтение игрока/экипировки/заклинаний, симуляция, один UPDATE players и пачка лута в inventory.
+    Возвращает итоги забега или None, если игрок не найден/ошибка.
+    """
+    async with connect(DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        try:
+            # Блокировка записи на время забега - параллельные апдейты игрока не потеряются
+            await db.execute("BEGIN IMMEDIATE")
+            async with db.execute("SELECT * FROM players WHERE user_id = ?", (user_id,)) as cursor:
+                player = await cursor.fetchone()
+            if not player:
+                await db.rollback()
+                return None
+            async with db.execute("SELECT item_id FROM inventory WHERE player_id = ? AND is_equipped = 1", (user_id,)) as cursor:
+                equipped_item_ids = [row['item_id'] for row in await cursor.fetchall()]
+            async with db.execute("SELECT spell_id FROM player_spells WHERE player_id = ?", (user_id,)) as cursor:
+                spell_ids = [row['spell_id'] for row in await cursor.fetchall()]
+
+            # Забег начинается с HP/маной с учетом ленивого регена
+            now = int(time.time())
+            player_row = dict(player)
+            player_row['current_hp'], player_row['current_mana'] = calculate_regen_vitals(
+                calculate_effective_stats(player_row, equipped_item_ids), now)
+            run = simulate_farm_run(player_row, equipped_item_ids, spell_ids, fights, policy)
+            final = run['final']
+            await db.execute(
+                """UPDATE players SET
+                   level = ?, xp = ?, xp_to_next_level = ?, gold = ?, stat_points = stat_points + ?,
+                   max_hp = ?, max_mana = ?, current_hp = ?, current_mana = ?, energy_shield = ?,
+                   last_hp_regen_time = ?, last_mana_regen_time = ?,
+                   quest_monster_key = ?, quest_target_count = ?, quest_current_count = ?,
+                   quest_gold_reward = ?, quest_xp_reward = ?
+                   WHERE user_id = ?""",
+                (final['level'], final['xp'], final['xp_to_next_level'], final['gold'], run['gained_stat_points'],
+                 final['max_hp'], final['max_mana'], final['current_hp'], final['current_mana'], final['energy_shield'],
+                 now, now,
+                 final['quest_monster_key'], final['quest_target_count'], final['quest_current_count'],
+                 final['quest_gold_reward'], final['quest_xp_reward'], user_id)
+            )
+            await add_items_to_inventory(user_id, run['loot_item_ids'], db=db)
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logging.error(f"Failed to apply farm run for user {user_id}: {e}", exc_info=True)
+            return None
 
-    # Получаем множитель регенерации
-    try:
-        regen_multiplier = float(active_effects.get('regen_multiplier', 1.0))
-        if regen_multiplier <= 0: # Предохранитель от отрицательного/нулевого регена
-            regen_multiplier = 0
-            logging.warning(f"Regen multiplier is <= 0 ({regen_multiplier}) for user {user_id}. Disabling regen.")
-    except (ValueError, TypeError):
-        regen_multiplier = 1.0
-        logging.error(f"Invalid 'regen_multiplier' value: {active_effects.get('regen_multiplier')}. Using 1.0.")
-
-    if regen_multiplier != 1.0 and regen_multiplier > 0:
-         logging.info(f"Applying regen multiplier {regen_multiplier} for user {user_id}")
-
-    # --- Регенерация HP ---
-    if regen_multiplier > 0 and player['current_hp'] < player['max_hp']:
-        hp_time_passed = current_time - player['last_hp_regen_time']
-        # Применяем множитель к расчетному количеству регена
-        hp_to_regen = math.floor(hp_time_passed / hp_regen_interval * regen_multiplier)
-
-        if hp_to_regen > 0:
-            new_hp = min(player['max_hp'], player['current_hp'] + hp_to_regen)
-            hp_regened = new_hp - player['current_hp']
-            if hp_regened > 0:
-                 await update_player_vitals(user_id, set_hp=new_hp)
-                 await record_regen_time(user_id, 'hp')
-                 logging.info(f"Player {user_id} regenerated {hp_regened} HP (multiplier: {regen_multiplier}).")
-
-    # --- Регенерация Mana ---
-    # Проверяем эффект 'cannot_regen_mana'
-    can_regen_mana = 'cannot_regen_mana' not in active_effects
-
-    if regen_multiplier > 0 and can_regen_mana and player['current_mana'] < player['max_mana']:
-        mana_time_passed = current_time - player['last_mana_regen_time']
-        # Применяем множитель
-        mana_to_regen = math.floor(mana_time_passed / mana_regen_interval * regen_multiplier)
-
-        if mana_to_regen > 0:
-            new_mana = min(player['max_mana'], player['current_mana'] + mana_to_regen)
-            mana_regened = new_mana - player['current_mana']
-            if mana_regened > 0:
-                await update_player_vitals(user_id, set_mana=new_mana)
-                await record_regen_time(user_id, 'mana')
-                logging.info(f"Player {user_id} regenerated {mana_regened} Mana (multiplier: {regen_multiplier}).")
-    elif not can_regen_mana:
-        logging.debug(f"Mana regeneration skipped for user {user_id} due to 'cannot_regen_mana' effect.")
-        # Можно принудительно обновить время регена маны, чтобы счетчик не накапливался
-        await record_regen_time(user_id, 'mana')
-
-    return hp_regened, mana_regened
+    logging.info("Farm run for user %s: %s/%s wins, died=%s, xp+%s, gold+%s, loot=%d, level=%s", user_id, run['wins'], run['fights'],
+                 run['died'], run['xp_gain'], run['gold_gain'], len(run['loot_item_ids']), run['end_level'])
+    return run
 
 
 # --- Прокачка Статов ---
 async def update_stat_points(user_id: int, points_change: int):
     """Изменяет количество свободных очков характеристик (может быть отрицательным для возврата)."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         # Используем `stat_points = stat_points + ?` для атомарного изменения
         # и `max(0, ...)` чтобы не уйти в отрицательные очки при возврате
         await db.execute("UPDATE players SET stat_points = max(0, stat_points + ?) WHERE user_id = ?", (points_change, user_id))
         await db.commit()
-    logging.debug(f"Player {user_id} stat points changed by {points_change}.")
+    logging.debug("Player %s stat points changed by %s.", user_id, points_change)
 
 
 async def increase_attribute(user_id: int, attribute: str, amount: int = 1):
@@ -1010,10 +1032,6 @@ async def increase_attribute(user_id: int, attribute: str, amount: int = 1):
     new_dexterity = player['dexterity']
     new_intelligence = player['intelligence']
     level = player['level']
-    # Получаем базовые статы класса
-    base_class_stats = BASE_STATS.get(player['class'], BASE_STATS['Scion'])
-    hp_gain_per_level = 10
-    mana_gain_per_level = 5
 
     # Применяем изменение к нужному атрибуту
     value_to_set = 0 # Переменная для хранения нового значения стата
@@ -1028,18 +1046,18 @@ async def increase_attribute(user_id: int, attribute: str, amount: int = 1):
         value_to_set = new_intelligence # Запоминаем значение для SQL
 
     # --- Пересчитываем Max HP/Mana на основе НОВЫХ статов и ТЕКУЩЕГО уровня ---
-    # Используем обновленные new_strength и new_intelligence для пересчета
-    new_max_hp = base_class_stats['hp'] + int(new_strength * 0.5) + (level * hp_gain_per_level)
-    new_max_mana = base_class_stats['mana'] + new_intelligence + (level * mana_gain_per_level)
+    new_max_hp, new_max_mana = calculate_base_max_vitals(player['class'], new_strength, new_intelligence, level)
 
+    # Реген до повышения максимумов: иначе старый якорь "дорегенится" до нового максимума задним числом
+    await anchor_regen_vitals(user_id)
     # Обновляем атрибут и Max HP/Mana в базе данных
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         try:
             # f-строка для имени столбца здесь безопасна, так как 'attribute' проверяется выше
             # Вместо getattr используем переменную value_to_set
             sql_query = f"UPDATE players SET {attribute} = ?, max_hp = ?, max_mana = ? WHERE user_id = ?"
             params = (value_to_set, new_max_hp, new_max_mana, user_id)
-            logging.debug(f"Executing SQL: {sql_query} with params {params}") # Логируем запрос
+            logging.debug("Executing SQL: %s with params %s", sql_query, params) # Логируем запрос
             await db.execute(sql_query, params)
 
             await db.commit()
@@ -1055,14 +1073,14 @@ async def increase_attribute(user_id: int, attribute: str, amount: int = 1):
 async def set_daily_reward_time(user_id: int):
     """Устанавливает время получения ежедневной награды на текущее."""
     current_time = int(time.time())
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         await db.execute("UPDATE players SET last_daily_reward_time = ? WHERE user_id = ?", (current_time, user_id))
         await db.commit()
 
 async def assign_daily_quest(user_id: int, monster_key: str, target_count: int, gold_reward: int, xp_reward: int):
     """Назначает игроку ежедневный квест."""
     current_time = int(time.time())
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         await db.execute("""
             UPDATE players SET
             quest_monster_key = ?, quest_target_count = ?, quest_current_count = 0,
@@ -1091,7 +1109,7 @@ async def update_quest_progress(user_id: int, killed_monster_key: str):
     # Проверяем, выполнен ли квест
     quest_complete = new_count >= player['quest_target_count']
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         await db.execute("UPDATE players SET quest_current_count = ? WHERE user_id = ?", (new_count, user_id))
         await db.commit()
 
@@ -1105,12 +1123,12 @@ async def update_quest_progress(user_id: int, killed_monster_key: str):
         }
     else:
         # Возвращаем информацию о прогрессе
-        logging.debug(f"Player {user_id} quest progress: {new_count}/{player['quest_target_count']} '{player['quest_monster_key']}' killed.")
+        logging.debug("Player %s quest progress: %s/%s '%s' killed.", user_id, new_count, player['quest_target_count'], player['quest_monster_key'])
         return {'completed': False, 'current_count': new_count, 'target_count': player['quest_target_count']}
 
 async def clear_daily_quest(user_id: int):
     """Сбрасывает данные квеста (после выполнения или провала)."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         await db.execute("""
             UPDATE players SET
             quest_monster_key = NULL, quest_target_count = 0, quest_current_count = 0,
@@ -1123,7 +1141,7 @@ async def clear_daily_quest(user_id: int):
 
 async def get_shop_items(shop_type: str) -> tuple[list[str], int]:
     """Получает список ID предметов и время последнего обновления для магазина."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         async with db.execute(
             "SELECT item_ids, last_refresh_time FROM shop_state WHERE shop_type = ?",
             (shop_type,)
@@ -1141,23 +1159,32 @@ async def get_shop_items(shop_type: str) -> tuple[list[str], int]:
                 logging.error(f"Shop state not found for type '{shop_type}'.")
                 return [], 0 # Возвращаем пустой список и 0 время
 
-async def update_shop_items(shop_type: str, new_item_ids: list[str]):
-    """Обновляет список предметов и время обновления для магазина."""
+async def update_shop_items(shop_type: str, new_item_ids: list[str], expected_refresh_time: int | None = None) -> bool:
+    """
+    Обновляет список предметов и время обновления для магазина.
+    expected_refresh_time - CAS: запись меняется, только если ее еще никто не обновил
+    (несколько процессов-шардов могут одновременно решить, что пора обновлять). False - опередили.
+    """
     current_time = int(time.time())
     item_ids_json = json.dumps(new_item_ids) # Кодируем список в JSON
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE shop_state SET item_ids = ?, last_refresh_time = ? WHERE shop_type = ?",
-            (item_ids_json, current_time, shop_type)
-        )
+    query = "UPDATE shop_state SET item_ids = ?, last_refresh_time = ? WHERE shop_type = ?"
+    params = [item_ids_json, current_time, shop_type]
+    if expected_refresh_time is not None:
+        query += " AND last_refresh_time = ?"
+        params.append(expected_refresh_time)
+    async with connect(DB_NAME) as db:
+        cursor = await db.execute(query, params)
         await db.commit()
-    logging.info(f"Shop '{shop_type}' refreshed. New items: {new_item_ids}")
+        updated = cursor.rowcount > 0
+    if updated:
+        logging.info(f"Shop '{shop_type}' refreshed. New items: {new_item_ids}")
+    return updated
 
 # --- Функции для Кузнеца ---
 
 async def get_blacksmith_items() -> tuple[list[str], int]:
     """Получает список ID легендарок и время последнего обновления у кузнеца."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
         async with db.execute(
             # state_id=1, так как запись всегда одна
             "SELECT legendary_ids, last_refresh_time FROM blacksmith_state WHERE state_id = 1"
@@ -1176,21 +1203,26 @@ async def get_blacksmith_items() -> tuple[list[str], int]:
                  logging.error("Blacksmith state not found (state_id=1).")
                  return [], 0
 
-async def update_blacksmith_items(new_legendary_ids: list[str]):
-    """Обновляет список легендарок и время у кузнеца."""
+async def update_blacksmith_items(new_legendary_ids: list[str], expected_refresh_time: int | None = None) -> bool:
+    """Обновляет список легендарок и время у кузнеца (CAS по expected_refresh_time, как update_shop_items)."""
     current_time = int(time.time())
     ids_json = json.dumps(new_legendary_ids)
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE blacksmith_state SET legendary_ids = ?, last_refresh_time = ? WHERE state_id = 1",
-            (ids_json, current_time)
-        )
+    query = "UPDATE blacksmith_state SET legendary_ids = ?, last_refresh_time = ? WHERE state_id = 1"
+    params = [ids_json, current_time]
+    if expected_refresh_time is not None:
+        query += " AND last_refresh_time = ?"
+        params.append(expected_refresh_time)
+    async with connect(DB_NAME) as db:
+        cursor = await db.execute(query, params)
         await db.commit()
-    logging.info(f"Blacksmith items refreshed. New legendaries: {new_legendary_ids}")
+        updated = cursor.rowcount > 0
+    if updated:
+        logging.info(f"Blacksmith items refreshed. New legendaries: {new_legendary_ids}")
+    return updated
 
 async def count_player_fragments(player_id: int, fragment_item_id: str) -> int:
      """Считает количество КОНКРЕТНЫХ фрагментов у игрока."""
-     async with aiosqlite.connect(DB_NAME) as db:
+     async with connect(DB_NAME) as db:
          async with db.execute(
              "SELECT COUNT(*) FROM inventory WHERE player_id = ? AND item_id = ? AND is_equipped = FALSE", # Считаем только не надетые
              (player_id, fragment_item_id)
@@ -1204,7 +1236,7 @@ async def remove_player_fragments(player_id: int, fragment_item_id: str, count:
 
     # Получаем ID записей инвентаря для удаления (с LIMIT)
     rows_to_delete_ids = []
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
          async with db.execute(
              "SELECT inventory_id FROM inventory WHERE player_id = ? AND item_id = ? AND is_equipped = FALSE LIMIT ?",
              (player_id, fragment_item_id, count)
@@ -1217,7 +1249,7 @@ async def remove_player_fragments(player_id: int, fragment_item_id: str, count:
          return False # Недостаточно фрагментов
 
     # Удаляем найденные записи
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with connect(DB_NAME) as db:
          try:
              # Создаем плейсхолдеры для запроса ('?, ?, ?')
              placeholders = ', '.join('?' * len(rows_to_delete_ids))
@@ -1229,12 +1261,7 @@ async def remove_player_fragments(player_id: int, fragment_item_id: str, count:
              logging.error(f"Failed to remove fragments for player {player_id}, fragment {fragment_item_id}: {e}", exc_info=True)
              return False
 
-# Добавляем импорт CombatStates для функции check_and_apply_regen
-# Это не очень хорошо с точки зрения архитектуры (db_manager зависит от handlers),
-# но для простоты MVP приемлемо. В идеале состояние боя нужно передавать параметром.
-try:
-    from handlers.combat import CombatStates
-except ImportError:
-    class CombatStates:
-        fighting = type("State", (), {"state": "CombatStates:fighting"})()
-    logging.debug("Using placeholder CombatStates in db_manager.")
+
+# --- Метрики ---
+# Последним: публичные корутины модуля получают учет времени, ошибок, соединений и запросов (query_stats.py)
+instrument_module(globals())
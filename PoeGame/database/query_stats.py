@@ -0,0 +1,162 @@
+# database/query_stats.py
+"""
+Учет работы с SQLite по функциям db_manager (метрики bot_db_*, metrics.py) и по апдейтам
+(бюджет запросов, middlewares/query_budget.py).
+- connect(path) вместо aiosqlite.connect: соединение создается фабрикой sqlite3 (_TracedConnection),
+  которая считает открытие, каждый выполненный оператор (trace callback) и каждую прочитанную строку
+  (обертка row_factory) - в потоке aiosqlite, на счетчики, захваченные при открытии.
+- instrument_module(globals()) в конце db_manager оборачивает его публичные корутины: время, ошибки
+  и "текущая функция" (ContextVar) - на нее и пишутся соединения, запросы и строки, открытые внутри.
+- update_scope(): счетчики одного апдейта (UpdateQueries) - тоже ContextVar; соединение, открытое
+  внутри апдейта, пишет и в них. Фоновые задачи, созданные хендлером, наследуют контекст и тоже считаются.
+Метки связываются при импорте, в рантайме - только inc()/observe().
+"""
+import time
+import sqlite3
+import inspect
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+from typing import Iterator
+
+import aiosqlite
+
+from metrics import DB_CALL_DURATION, DB_CALL_ERRORS, DB_QUERIES, DB_CONNECTIONS, DB_ROWS, Counter, Histogram
+
+OUTSIDE = "outside" # Соединения не из функций db_manager (прямой connect)
+
+
+class _FunctionStats:
+    __slots__ = ('name', 'duration', 'errors', 'queries', 'connections', 'rows')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.duration: Histogram = DB_CALL_DURATION.labels(name)
+        self.errors: Counter = DB_CALL_ERRORS.labels(name)
+        self.queries: Counter = DB_QUERIES.labels(name)
+        self.connections: Counter = DB_CONNECTIONS.labels(name)
+        self.rows: Counter = DB_ROWS.labels(name)
+
+
+class UpdateQueries:
+    """Работа с БД за один апдейт: хендлер (заполняет middleware), счетчики и вызовы db_manager по порядку."""
+    __slots__ = ('handler', 'queries', 'connections', 'rows', 'calls')
+
+    def __init__(self):
+        self.handler: str | None = None
+        self.queries = 0
+        self.connections = 0
+        self.rows = 0
+        self.calls: list[str] = [] # Включая вложенные (get_player внутри get_player_effective_stats)
+
+
+_outside = _FunctionStats(OUTSIDE)
+_current: ContextVar[_FunctionStats] = ContextVar("db_function", default=_outside)
+_current_update: ContextVar[UpdateQueries | None] = ContextVar("db_update", default=None)
+
+
+def _tracer(queries: Counter, update: UpdateQueries | None):
+    # Замыкание на счетчики, а не метод соединения: без цикла ссылок соединение освобождается сразу
+    if update is None:
+        def trace(_sql: str):
+            queries.value += 1
+    else:
+        def trace(_sql: str):
+            queries.value += 1
+            update.queries += 1
+    return trace
+
+def _row_counter(factory, rows: Counter, update: UpdateQueries | None):
+    """row_factory, который считает строки и отдает их исходной фабрике (None - кортеж как есть)."""
+    def counted(cursor, row):
+        rows.value += 1
+        if update is not None:
+            update.rows += 1
+        return row if factory is None else factory(cursor, row)
+    return counted
+
+
+class _TracedConnection(sqlite3.Connection):
+    """sqlite3-соединение, которое считает свои операторы и строки. Создается в потоке aiosqlite."""
+
+    def __init__(self, *args, stats: _FunctionStats, update: UpdateQueries | None, **kwargs):
+        super().__init__(*args, **kwargs)
+        stats.connections.inc()
+        if update is not None:
+            update.connections += 1
+        self._rows = stats.rows
+        self._update = update
+        self.set_trace_callback(_tracer(stats.queries, update))
+        self.row_factory = None
+
+    # db.row_factory = aiosqlite.Row в db_manager попадает сюда: sqlite3 получает считающую обертку
+    @property
+    def row_factory(self):
+        return self._row_factory
+
+    @row_factory.setter
+    def row_factory(self, factory):
+        self._row_factory = factory
+        sqlite3.Connection.row_factory.__set__(self, _row_counter(factory, self._rows, self._update))
+
+
+def connect(path: str, **kwargs) -> aiosqlite.Connection:
+    """aiosqlite.connect(path) с учетом соединения, запросов и строк на текущую функцию db_manager и апдейт."""
+    factory = partial(_TracedConnection, stats=_current.get(), update=_current_update.get())
+    return aiosqlite.connect(path, factory=factory, **kwargs)
+
+
+# --- Апдейт ---
+def current_update() -> UpdateQueries | None:
+    return _current_update.get()
+
+@contextmanager
+def update_scope() -> Iterator[UpdateQueries]:
+    """Счетчики апдейта; внутри уже открытого scope - тот же объект (tools/load_gen.py открывает его снаружи)."""
+    scope = _current_update.get()
+    if scope is not None:
+        yield scope
+        return
+    scope = UpdateQueries()
+    token = _current_update.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_update.reset(token)
+
+
+# --- Функции db_manager ---
+def _instrument(fn):
+    stats = _FunctionStats(fn.__name__)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        update = _current_update.get()
+        if update is not None:
+            update.calls.append(stats.name)
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            stats.errors.inc()
+            raise
+        finally:
+            stats.duration.observe(time.perf_counter() - started)
+            _current.reset(token)
+
+    return wrapper
+
+
+def instrument_module(namespace: dict):
+    """
+    Оборачивает публичные корутины, определенные в модуле namespace. Вызывать в конце модуля:
+    `from database.db_manager import ...` в хендлерах получает уже обернутые функции,
+    вызовы внутри модуля (get_player из get_player_effective_stats) - тоже.
+    """
+    module = namespace['__name__']
+    for name, value in list(namespace.items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(value) or value.__module__ != module:
+            continue
+        namespace[name] = _instrument(value)
@@ -0,0 +1,247 @@
+# fsm_storage.py
+"""
+FSM-хранилище aiogram поверх SQLite (отдельный файл, не poe_bot.db).
+Чтение и запись идут в LRU-кэш в памяти; в SQLite изменения уходят пачкой раз в FLUSH_INTERVAL,
+причем для каждого ключа пишется только последнее состояние за период (запись коалесцируется).
+Пустые записи (нет состояния и данных) из файла удаляются, брошенные диалоги - по TTL.
+При старте restore() одним запросом поднимает в кэш все живые записи:
+бои, выбор босса и диалог лекаря переживают рестарт бота.
+"""
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Mapping
+
+import aiosqlite
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+FSM_CACHE_SIZE = 50_000 # Записей в памяти; вытесненные дочитываются из файла
+FLUSH_INTERVAL = 1.0 # Сек между пачками записи
+STATE_TTL = 3 * 24 * 60 * 60 # Запись без изменений дольше TTL считается брошенной
+EVICT_INTERVAL = 10 * 60 # Сек между чистками по TTL
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'updated_at')
+
+    def __init__(self, state: str | None = None, data: dict | None = None, updated_at: int = 0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.updated_at = updated_at or int(time.time())
+
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+def _row_key(key: StorageKey) -> tuple:
+    """Ключ строки в SQLite: NULL в составном ключе не уникален, поэтому None -> 0/''."""
+    return (key.bot_id, key.chat_id, key.user_id, key.thread_id or 0, key.business_connection_id or "", key.destiny)
+
+def _storage_key(row) -> StorageKey:
+    return StorageKey(bot_id=row[0], chat_id=row[1], user_id=row[2], thread_id=row[3] or None,
+                      business_connection_id=row[4] or None, destiny=row[5])
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str, cache_size: int = FSM_CACHE_SIZE, ttl: int = STATE_TTL):
+        self.path = path
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._records: OrderedDict[StorageKey, _Record] = OrderedDict() # LRU
+        self._dirty: dict[StorageKey, _Record] = {} # Изменено с последней пачки (последнее значение)
+        self._fully_cached = False # В кэше все записи файла - промах можно не дочитывать
+        self._flush_lock = asyncio.Lock()
+        self._ready = False # Таблица создана
+        self.flushed_writes = 0 # Для бенчмарков: строк записано / изменений принято
+        self.accepted_writes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0 # Записи не было в LRU (дочитана из файла или новая)
+
+    async def _init_db(self, db: aiosqlite.Connection):
+        if self._ready:
+            return
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_state (
+                bot_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                thread_id INTEGER NOT NULL DEFAULT 0,
+                business_connection_id TEXT NOT NULL DEFAULT '',
+                destiny TEXT NOT NULL,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at INTEGER NOT NULL,
+                PRIMARY KEY (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny)
+            )
+        ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state (updated_at)")
+        self._ready = True
+
+    # --- Старт ---
+    async def restore(self) -> int:
+        """Создает таблицу, удаляет просроченное и поднимает живые записи в кэш. Возвращает их число."""
+        cutoff = int(time.time()) - self.ttl
+        async with aiosqlite.connect(self.path) as db:
+            await self._init_db(db)
+            await db.execute("DELETE FROM fsm_state WHERE updated_at < ?", (cutoff,))
+            await db.commit()
+            async with db.execute(
+                "SELECT bot_id, chat_id, user_id, thread_id, business_connection_id, destiny, state, data, updated_at "
+                "FROM fsm_state ORDER BY updated_at DESC LIMIT ?", (self.cache_size + 1,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        self._fully_cached = len(rows) <= self.cache_size
+        # Свежие - в хвост LRU: вставляем от старых к новым
+        for row in reversed(rows[:self.cache_size]):
+            self._records[_storage_key(row)] = _Record(row[6], json.loads(row[7]), row[8])
+        logging.info(f"FSM storage restored {len(self._records)} records from {self.path} (fully cached: {self._fully_cached}).")
+        return len(self._records)
+
+    # --- Кэш ---
+    async def _get_record(self, key: StorageKey) -> _Record:
+        record = self._records.get(key)
+        if record is not None:
+            self._records.move_to_end(key)
+            self.cache_hits += 1
+            return record
+        self.cache_misses += 1
+        record = self._dirty.get(key) # Вытеснена из LRU, но еще не записана
+        if record is None and not self._fully_cached:
+            record = await self._load(key)
+        if record is None:
+            record = _Record()
+        # Пока читали файл, ключ мог быть записан - побеждает запись из памяти
+        record = self._records.setdefault(key, record)
+        self._records.move_to_end(key)
+        self._trim()
+        return record
+
+    async def _load(self, key: StorageKey) -> _Record | None:
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute(
+                "SELECT state, data, updated_at FROM fsm_state WHERE bot_id = ? AND chat_id = ? AND user_id = ? "
+                "AND thread_id = ? AND business_connection_id = ? AND destiny = ?", _row_key(key)
+            ) as cursor:
+                row = await cursor.fetchone()
+        return _Record(row[0], json.loads(row[1]), row[2]) if row else None
+
+    def _trim(self):
+        while len(self._records) > self.cache_size:
+            _, evicted = self._records.popitem(last=False)
+            if not evicted.is_empty():
+                self._fully_cached = False # Грязная останется в _dirty до пачки, чистая - в файле
+
+    def _touch(self, key: StorageKey, record: _Record):
+        record.updated_at = int(time.time())
+        self._dirty[key] = record
+        self.accepted_writes += 1
+
+    # --- BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._touch(key, record)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._get_record(key)).data.copy()
+
+    # --- Запись ---
+    async def flush(self):
+        """Пишет накопленные изменения одной транзакцией: upsert живых, delete пустых."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, {}
+            upserts, deletes = [], []
+            for key, record in batch.items():
+                if record.is_empty():
+                    deletes.append(_row_key(key))
+                else:
+                    upserts.append(_row_key(key) + (record.state, json.dumps(record.data, ensure_ascii=False), record.updated_at))
+            try:
+                async with aiosqlite.connect(self.path) as db:
+                    await self._init_db(db)
+                    if upserts:
+                        await db.executemany('''
+                            INSERT INTO fsm_state (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny, state, data, updated_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny)
+                            DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+                        ''', upserts)
+                    if deletes:
+                        await db.executemany(
+                            "DELETE FROM fsm_state WHERE bot_id = ? AND chat_id = ? AND user_id = ? "
+                            "AND thread_id = ? AND business_connection_id = ? AND destiny = ?", deletes
+                        )
+                    await db.commit()
+                self.flushed_writes += len(batch)
+            except Exception as e:
+                # Не теряем изменения: вернуть в очередь, если ключ с тех пор не менялся
+                for key, record in batch.items():
+                    self._dirty.setdefault(key, record)
+                logging.error(f"Failed to flush {len(batch)} FSM records: {e}", exc_info=True)
+
+    async def evict_expired(self, now: int | None = None) -> int:
+        """Убирает брошенные записи (старше TTL) из кэша и файла. Возвращает число убранных из кэша."""
+        cutoff = (int(time.time()) if now is None else now) - self.ttl
+        expired = [key for key, record in self._records.items() if record.updated_at < cutoff and key not in self._dirty]
+        for key in expired:
+            del self._records[key]
+        async with aiosqlite.connect(self.path) as db:
+            await self._init_db(db)
+            await db.execute("DELETE FROM fsm_state WHERE updated_at < ?", (cutoff,))
+            await db.commit()
+        if expired:
+            logging.info(f"FSM storage evicted {len(expired)} abandoned records.")
+        return len(expired)
+
+    async def run_flush_loop(self, interval: float = FLUSH_INTERVAL, evict_interval: int = EVICT_INTERVAL):
+        """Фоновая задача: пачка записи раз в interval, чистка по TTL раз в evict_interval."""
+        last_evict = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+            if time.monotonic() - last_evict >= evict_interval:
+                last_evict = time.monotonic()
+                try:
+                    await self.evict_expired()
+                except Exception as e:
+                    logging.error(f"FSM storage TTL eviction failed: {e}", exc_info=True)
+
+    # --- Метрики ---
+    def state_counts(self) -> dict[str | None, int]:
+        """Записи в памяти по состоянию (None - только данные, без состояния)."""
+        counts: dict[str | None, int] = {}
+        for record in list(self._records.values()):
+            counts[record.state] = counts.get(record.state, 0) + 1
+        return counts
+
+    def stats(self) -> dict:
+        return {'records': len(self._records), 'dirty': len(self._dirty), 'accepted_writes': self.accepted_writes,
+                'flushed_writes': self.flushed_writes} # Попадания в кэш - bot_cache_requests_total{cache="fsm"}
+
+    async def checkpoint_wal(self):
+        """Переносит WAL в основной файл (после последней пачки при остановке)."""
+        async with aiosqlite.connect(self.path) as db:
+            await self._init_db(db)
+            await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    async def close(self) -> None:
+        # Диспетчер зовет close() при остановке поллинга, но контрольные точки боев пишутся после -
+        # поэтому close() только сбрасывает буфер, хранилище остается рабочим
+        await self.flush()
@@ -108,6 +108,11 @@ SPELLS = {
     # "Ледяной шип": ...
     # "Стрела хаоса": ...
 }
+# --- Призываемые союзники (effect_type "summon") ---
+# damage - базовый урон в ход (скейлится от интеллекта как заклинания), duration - сколько ходов живет
+SUMMONS = {
+    "stone_golem": {"name": "Каменный голем", "damage": 8, "duration": 5},
+}
 SPELL_DAMAGE_INTELLIGENCE_SCALING = 0.01 # +1% урона за 1 интеллект (или 10% за 10 инт)
 # --- БОССЫ ---
 # Список боссов по порядку. Индекс в списке = ID босса (0-9)
@@ -310,10 +315,15 @@ BLACKSMITH_ITEMS_COUNT = 3 # Количество легендарок у куз
 BLACKSMITH_REFRESH_INTERVAL = 24 * 60 * 60 # 24 часа
 BLACKSMITH_CRAFT_COST = 5 # Сколько фрагментов нужно для крафта
 
+# --- Фарм-забег (N боев одной командой) ---
+FARM_DEFAULT_FIGHTS = 10
+FARM_MAX_FIGHTS = 50
+FARM_REGEN_SECONDS_PER_FIGHT = 60 # Условное время между боями для пассивного регена
+
 # --- Функция дропа ---
-def get_random_loot_item_id() -> str | None:
+def get_random_loot_item_id(rng=random) -> str | None:
     # ... (остается без изменений, она выбирает из ALL_ITEMS) ...
-    if random.random() > 0.5:
+    if rng.random() > 0.5:
         return None
     items_list = list(ALL_ITEMS.items())
     # Исключаем фрагменты и легендарки из ОБЫЧНОГО дропа
@@ -323,9 +333,16 @@ def get_random_loot_item_id() -> str | None:
     chances = [item_data["drop_chance"] for _, item_data in eligible_items]
     item_ids = [item_id for item_id, _ in eligible_items]
 
-    chosen_id_list = random.choices(item_ids, weights=chances, k=1)
+    chosen_id_list = rng.choices(item_ids, weights=chances, k=1)
     return chosen_id_list[0] if chosen_id_list else None
 
+def get_spell_intelligence_requirement(level_req: int) -> int:
+    """Рассчитывает требование интеллекта на основе уровня заклинания."""
+    # Формула: 20 + (уровень_спелла - 1) * 5
+    # Например: Ур.1 -> 20, Ур.2 -> 25, Ур.3 -> 30, ...
+    if level_req <= 0: return 0 # На всякий случай
+    return 20 + (level_req - 1) * 5
+
 def calculate_final_spell_damage(base_damage: int, intelligence: int) -> int:
     """Рассчитывает финальный урон заклинания с учетом интеллекта (БЕЗ КРИТА)."""
     multiplier = 1 + intelligence * SPELL_DAMAGE_INTELLIGENCE_SCALING
@@ -334,12 +351,13 @@ def calculate_final_spell_damage(base_damage: int, intelligence: int) -> int:
     return final_base_damage
 # --- Функция дропа Легендарки (для боссов) ---
 # --- !!! НОВАЯ ФУНКЦИЯ ДЛЯ КРИТА !!! ---
-def calculate_damage_with_crit(base_damage: int, crit_chance: float, crit_multiplier: float) -> tuple[int, bool]:
+def calculate_damage_with_crit(base_damage: int, crit_chance: float, crit_multiplier: float, rng=random) -> tuple[int, bool]:
     """
     Рассчитывает финальный урон, учитывая шанс и множитель крита.
     Возвращает кортеж (финальный_урон, был_ли_крит).
+    rng - источник случайности (модуль random или random.Random для воспроизводимых симуляций).
     """
-    is_crit = random.uniform(0, 100) < crit_chance
+    is_crit = rng.uniform(0, 100) < crit_chance
     if is_crit:
         # Применяем множитель (например, 150.0 -> 1.5)
         final_damage = math.ceil(base_damage * (crit_multiplier / 100.0))
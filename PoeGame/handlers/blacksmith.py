@@ -12,12 +12,13 @@ from aiogram.exceptions import TelegramBadRequest # Для обработки о
 # Импортируем все необходимое из БД
 from database.db_manager import (
     get_blacksmith_items, update_blacksmith_items,
-    get_player_effective_stats, check_and_apply_regen,
+    get_player_effective_stats,
     # count_player_fragments, # Эта функция больше не нужна, считаем по инвентарю
     get_inventory_items, # Нужна для подсчета фрагментов
     remove_player_fragments, add_item_to_inventory,
     update_player_xp # Нужен для возврата фрагментов (хотя это сложно)
 )
+from middlewares.player_context import PlayerContext
 # Импортируем данные игры
 from game_data import (
     ALL_ITEMS, BLACKSMITH_ITEMS_COUNT, BLACKSMITH_REFRESH_INTERVAL,
@@ -34,7 +35,6 @@ except ImportError:
     logging.error("Could not import format_item_stats or ITEM_TYPE_EMOJI")
 
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
 router = Router()
 
 # --- Вспомогательные функции ---
@@ -52,14 +52,17 @@ async def refresh_blacksmith_if_needed() -> list[str]:
         ]
         if not possible_legendaries:
              logging.error("No equipable legendary items found for blacksmith.")
-             await update_blacksmith_items([]) # Очищаем ассортимент, если лег нет
+             await update_blacksmith_items([], expected_refresh_time=last_refresh) # Очищаем ассортимент, если лег нет
              return []
 
         new_legendary_ids = random.sample(
             possible_legendaries,
             min(len(possible_legendaries), BLACKSMITH_ITEMS_COUNT)
         )
-        await update_blacksmith_items(new_legendary_ids)
+        if not await update_blacksmith_items(new_legendary_ids, expected_refresh_time=last_refresh):
+            # Другой процесс обновил кузнеца раньше - показываем его ассортимент
+            current_legendary_ids, _ = await get_blacksmith_items()
+            return current_legendary_ids
         logging.info(f"Blacksmith items refreshed: {new_legendary_ids}")
         return new_legendary_ids
     else:
@@ -141,13 +144,11 @@ def format_blacksmith_message_text(legendary_ids: list[str], player_fragments_co
 
 # --- Обработчик входа к кузнецу ---
 @router.message(F.text.lower() == "🔨 кузнец")
-async def blacksmith_start(message: types.Message, state: FSMContext):
+async def blacksmith_start(message: types.Message, player_ctx: PlayerContext):
     user_id = message.from_user.id
     logging.info(f"User {user_id} visited the blacksmith.")
-    try: await check_and_apply_regen(user_id, await state.get_state())
-    except Exception as e: logging.error(f"Regen check error in blacksmith: {e}")
 
-    player = await get_player_effective_stats(user_id)
+    player = await player_ctx.stats()
     if not player:
         await message.answer("Сначала создайте персонажа: /start")
         return
@@ -182,7 +183,7 @@ async def blacksmith_start(message: types.Message, state: FSMContext):
 
 # --- Обработчик нажатий кнопок кузнеца ---
 @router.callback_query(F.data.startswith("smith:"))
-async def handle_blacksmith_action(callback: types.CallbackQuery, state: FSMContext):
+async def handle_blacksmith_action(callback: types.CallbackQuery, state: FSMContext, player_ctx: PlayerContext):
     user_id = callback.from_user.id
     data_parts = callback.data.split(":") # smith:action:item_id
 
@@ -215,7 +216,7 @@ async def handle_blacksmith_action(callback: types.CallbackQuery, state: FSMCont
         return
     if action == "back": # Кнопка Назад из инфо
         # Перегенерируем основное меню кузнеца
-        player = await get_player_effective_stats(user_id) # Нужен для проверки? Нет.
+        player = await player_ctx.stats()
         legendary_ids_after, _ = await get_blacksmith_items()
         inventory_items_after = await get_inventory_items(user_id)
         player_fragments_count_after = {}
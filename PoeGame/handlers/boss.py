@@ -2,7 +2,6 @@
 import logging
 import time
 import random
-import math
 from aiogram import F, Router, types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -15,39 +14,36 @@ from database.db_manager import (
     get_player_effective_stats, update_player_vitals, update_player_xp,
     # update_quest_progress, clear_daily_quest, # Убрал, т.к. квесты не влияют на боссов
     apply_death_penalty,
-    check_and_apply_regen, add_item_to_inventory,
+    add_item_to_inventory,
     get_player_boss_progression, update_player_boss_progression,
     get_boss_cooldown, set_boss_cooldown,
     get_learned_spells # Добавляем для получения спеллов
 )
+from middlewares.player_context import PlayerContext
 # Импортируем данные игры
 from game_data import (
-    BOSSES, SPELLS, ALL_ITEMS, ITEM_TYPE_FRAGMENT, ITEM_TYPE_LEGENDARY,
-    get_random_legendary_item_id,
-    calculate_final_spell_damage, # Используем новую функцию для урона спеллов
-    calculate_damage_with_crit # Используем новую функцию для крита
+    BOSSES, ALL_ITEMS, ITEM_TYPE_FRAGMENT, ITEM_TYPE_LEGENDARY,
+    get_random_legendary_item_id
 )
-# Импортируем остальные функции расчета (лучше вынести в utils)
+from combat_engine import scale_boss, resolve_turn # Правила боя - общие с монстрами и симулятором
+from combat_state import CombatState # Компактное состояние боя в FSM
+from combat_session import combat_sessions # Живые сессии боя в памяти
+from log_setup import hot_log
+from keyboard_cache import combat_keyboards, spell_rows_key # Кэш клавиатур боя
+from combat_log import combat_events, OUTCOME_WON, OUTCOME_DIED # Журнал боевых событий
+# Тексты эффектов и состояние боя - из хендлера боя с монстрами
 try:
-    from handlers.combat import (
-        calculate_player_attack_damage, # Используем обновленную функцию
-        # calculate_spell_damage, # Старая не нужна
-        calculate_dodge_chance,
-        calculate_damage_reduction
-    )
+    from handlers.combat import describe_new_effects, format_effect_tick # Тексты временных эффектов
     # Импортируем CombatStates для проверки регена
     from handlers.combat import CombatStates
 except ImportError as e:
     logging.error(f"Could not import helpers from handlers.combat in boss.py: {e}")
     # Заглушки
-    def calculate_player_attack_damage(s, cc, cd): return calculate_damage_with_crit(max(1,s//2), cc, cd) # Используем новую крит функцию
-    # def calculate_spell_damage(d, cc, cd): return calculate_damage_with_crit(d.get('damage', 1), cc, cd) # Старая не нужна
-    def calculate_dodge_chance(d): return 0
-    def calculate_damage_reduction(a): return 0
+    def describe_new_effects(e): return "."
+    def format_effect_tick(t, h): return ""
     class CombatStates: fighting = type("State", (), {"state": "CombatStates:fighting"})()
 
 # Настройка логгера
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
 router = Router()
 
 # Константы
@@ -75,40 +71,45 @@ def get_boss_selection_keyboard(unlocked_index: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 # --- ИСПРАВЛЕНО: async def ---
-async def get_boss_combat_action_keyboard(user_id: int, boss_id: str, player_mana: int, active_effects: dict) -> InlineKeyboardMarkup:
-    """Генерирует кнопки действий в бою с боссом, включая изученные спеллы."""
-    buttons = [
-        [InlineKeyboardButton(text="🗡️ Атаковать", callback_data=f"boss_action:attack:{boss_id}")],
-    ]
-    learned_spells = await get_learned_spells(user_id) # Получаем изученные спеллы
+async def get_boss_combat_action_keyboard(user_id: int, boss_id: str, player_mana: int, active_effects: dict,
+                                          learned_spells: list[dict] | None = None) -> InlineKeyboardMarkup:
+    """Кнопки действий в бою с боссом (из кэша клавиатур, см. get_combat_action_keyboard)."""
+    if learned_spells is None:
+        learned_spells = await get_learned_spells(user_id) # Получаем изученные спеллы
     try: # Безопасно получаем множитель маны
          mana_multiplier = float(active_effects.get('mana_cost_multiplier', 1.0))
          if mana_multiplier <= 0: mana_multiplier = 1.0 # Защита от неверных значений
     except (ValueError, TypeError): mana_multiplier = 1.0
+    spell_rows = spell_rows_key(learned_spells, mana_multiplier, player_mana)
+    return combat_keyboards.get_or_build(
+        ("boss", boss_id, spell_rows),
+        lambda: build_boss_combat_action_keyboard(boss_id, spell_rows, learned_spells)
+    )
 
-    for spell_data in learned_spells:
-        spell_id = spell_data['id']
-        spell_name = spell_data['name']
-        try: # Безопасно получаем стоимость
-             base_mana_cost = int(spell_data['mana_cost'])
-             actual_mana_cost = math.ceil(base_mana_cost * mana_multiplier)
-        except (ValueError, TypeError, KeyError):
+def build_boss_combat_action_keyboard(boss_id: str, spell_rows: tuple, learned_spells: list[dict]) -> InlineKeyboardMarkup:
+    """Собирает клавиатуру боя с боссом. spell_rows - из keyboard_cache.spell_rows_key."""
+    spell_names = {spell_data['id']: spell_data['name'] for spell_data in learned_spells}
+    buttons = [
+        [InlineKeyboardButton(text="🗡️ Атаковать", callback_data=f"boss_action:attack:{boss_id}")],
+    ]
+    for spell_id, actual_mana_cost, affordable in spell_rows:
+        if actual_mana_cost is None:
              logging.warning(f"Invalid mana cost for spell {spell_id}. Skipping.")
              continue # Пропускаем спелл с неверной стоимостью
 
         cost_text = f" ({actual_mana_cost} Маны)"
 
-        if player_mana >= actual_mana_cost:
+        if affordable:
             buttons.append([
                 InlineKeyboardButton(
-                    text=f"✨ {hd.quote(spell_name)}{cost_text}",
+                    text=f"✨ {hd.quote(spell_names[spell_id])}{cost_text}",
                     callback_data=f"boss_action:{spell_id}:{boss_id}" # Используем ID спелла
                 )
             ])
         else:
              buttons.append([
                 InlineKeyboardButton(
-                    text=f"❌ {hd.quote(spell_name)}{cost_text}",
+                    text=f"❌ {hd.quote(spell_names[spell_id])}{cost_text}",
                     callback_data=f"boss_action:no_mana"
                 )
             ])
@@ -122,9 +123,6 @@ async def get_boss_combat_action_keyboard(user_id: int, boss_id: str, player_man
 async def select_boss_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     logging.info(f"User {user_id} requested boss fight selection.")
-    try: await check_and_apply_regen(user_id, await state.get_state())
-    except Exception as e: logging.error(f"Regen check error for boss selection {user_id}: {e}")
-
     unlocked_index = await get_player_boss_progression(user_id)
     keyboard = get_boss_selection_keyboard(unlocked_index)
     await message.answer("Выберите босса для сражения:", reply_markup=keyboard)
@@ -149,7 +147,7 @@ async def handle_cancel_boss_selection(callback: types.CallbackQuery, state: FSM
 
 # Обработчик выбора КОНКРЕТНОГО босса
 @router.callback_query(BossCombatStates.selecting_boss, F.data.startswith("boss_select:"))
-async def start_boss_fight(callback: types.CallbackQuery, state: FSMContext):
+async def start_boss_fight(callback: types.CallbackQuery, state: FSMContext, player_ctx: PlayerContext):
     user_id = callback.from_user.id
     try:
         boss_index = int(callback.data.split(":")[1])
@@ -180,7 +178,7 @@ async def start_boss_fight(callback: types.CallbackQuery, state: FSMContext):
         return # Не сбрасываем состояние
 
     # 2. Проверка HP и восстановление ES
-    player = await get_player_effective_stats(user_id)
+    player = await player_ctx.stats()
     if not player:
         await callback.answer("Ошибка получения данных игрока.", show_alert=True)
         await state.clear();
@@ -194,36 +192,30 @@ async def start_boss_fight(callback: types.CallbackQuery, state: FSMContext):
         return
 
     if player['energy_shield'] < player['max_energy_shield']:
-        logging.info(f"Restoring ES for player {user_id} before boss fight.")
+        hot_log.info("Restoring ES for player %s before boss fight.", user_id)
         await update_player_vitals(user_id, set_es=player['max_energy_shield'])
         player = await get_player_effective_stats(user_id)
         if not player: await callback.answer("Ошибка восстановления энергощита.", show_alert=True); return
 
     # 3. Скалирование босса
-    scale_factor = 2 ** boss_index
-    scaled_hp = math.ceil(boss_data['base_hp'] * scale_factor)
-    scaled_damage = math.ceil(boss_data['base_damage'] * scale_factor)
-    scaled_xp = math.ceil(100 * (scale_factor * 1.5))
-    scaled_gold = math.ceil(50 * scale_factor)
+    scaled_boss = scale_boss(boss_index) # Формулы - в combat_engine
+    scaled_hp = scaled_boss['hp']
+    scaled_damage = scaled_boss['damage']
+    scaled_xp = scaled_boss['xp_reward']
+    scaled_gold = scaled_boss['gold_reward']
 
-    logging.info(f"Player {user_id} starting fight with BOSS {boss_id_str} ('{boss_name}'). Scaled HP: {scaled_hp}, Dmg: {scaled_damage}, XP: {scaled_xp}, Gold: {scaled_gold}")
+    logging.info("Player %s starting fight with BOSS %s ('%s'). Scaled HP: %s, Dmg: %s, XP: %s, Gold: %s",
+                 user_id, boss_id_str, boss_name, scaled_hp, scaled_damage, scaled_xp, scaled_gold)
 
     # 4. Установка состояния боя
     await state.set_state(BossCombatStates.fighting)
-    await state.update_data(
-        boss_id=boss_id_str,
-        boss_name=boss_name,
-        boss_hp=scaled_hp,
-        boss_max_hp=scaled_hp,
-        boss_damage=scaled_damage,
-        boss_xp_reward=scaled_xp,
-        boss_gold_reward=scaled_gold,
-        fragment_item_id=boss_data['fragment_item_id'],
-        player_buffs={} # Инициализация баффов
-    )
+    session = await combat_sessions.start(user_id, state, player, CombatState(
+        boss_id_str, boss_name, scaled_hp, scaled_hp, scaled_damage, scaled_xp, scaled_gold,
+        fragment_item_id=boss_data['fragment_item_id'] # Баффы пустые в начале боя
+    ))
 
     # 5. Отправка сообщения о начале боя
-    keyboard = await get_boss_combat_action_keyboard(user_id, boss_id_str, player['current_mana'], player.get('active_effects',{}))
+    keyboard = await get_boss_combat_action_keyboard(user_id, boss_id_str, player['current_mana'], player.get('active_effects',{}), session.learned_spells)
     try:
         await callback.message.edit_text( # Редактируем сообщение выбора босса
             f"Вы вступаете в бой с <b>{hd.quote(boss_name)}</b>!\n"
@@ -252,113 +244,64 @@ async def handle_boss_combat_action(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
     user_id = callback.from_user.id
 
-    player = await get_player_effective_stats(user_id)
-    state_data = await state.get_data()
-
-    # Получение данных боя из состояния
-    boss_id = state_data.get("boss_id")
-    boss_name = state_data.get("boss_name")
-    current_boss_hp = state_data.get("boss_hp")
-    boss_max_hp = state_data.get("boss_max_hp")
-    boss_damage = state_data.get("boss_damage")
-    boss_xp_reward = state_data.get("boss_xp_reward")
-    boss_gold_reward = state_data.get("boss_gold_reward")
-    fragment_item_id = state_data.get("fragment_item_id")
-    current_buffs = state_data.get("player_buffs", {}) # Баффы с прошлого хода
-
-    if (not player or boss_id is None or boss_name is None or current_boss_hp is None or
-            boss_max_hp is None or boss_damage is None or boss_xp_reward is None or
-            boss_gold_reward is None or fragment_item_id is None):
-        logging.error(f"Incomplete boss combat state for user {user_id}. Data: {state_data}")
+    # Статы, заклинания, виталы и состояние боя - из сессии в памяти (без чтения БД)
+    session = await combat_sessions.get(user_id, state)
+
+    if not session or session.combat.fragment_item_id is None:
+        logging.error(f"Incomplete boss combat state for user {user_id}. State: {session.combat if session else None}")
         try: await callback.message.edit_text("Ошибка состояния боя с боссом. Бой прерван.")
         except Exception: pass
+        combat_sessions.discard(user_id)
         await state.clear(); return
 
+    player = session.snapshot_player(); combat = session.combat
+
+    boss_id = combat.enemy_key; boss_name = combat.enemy_name
+    current_boss_hp = combat.enemy_hp; boss_max_hp = combat.enemy_max_hp; boss_damage = combat.enemy_damage
+    boss_xp_reward = combat.xp_reward; boss_gold_reward = combat.gold_reward; fragment_item_id = combat.fragment_item_id
+    effects = combat.effects # Баффы/HoT/призывы с прошлых ходов
+
     action_data = callback.data.split(":")
     action_type = action_data[1]
 
     if action_type == "no_mana": return
 
-    # --- Переменные для хода игрока ---
-    player_damage_dealt = 0; mana_cost = 0; action_log = ""; is_crit = False; healed_amount = 0; applied_buffs = {}
-
-    # --- Эффекты и Баффы ---
-    active_effects = player.get('active_effects', {});
-    try: mana_multiplier = float(active_effects.get('mana_cost_multiplier', 1.0)); mana_multiplier = max(0, mana_multiplier)
-    except (ValueError, TypeError): mana_multiplier = 1.0
-    try: crit_mult_bonus = float(active_effects.get('crit_multiplier_bonus', 0))
-    except (ValueError, TypeError): crit_mult_bonus = 0
-
-    # --- Логика действия игрока ---
-    if action_type == "attack":
-        attack_multiplier = current_buffs.get("buff_next_attack", 1.0)
-        # Используем функцию из combat (или utils)
-        player_damage_dealt, is_crit = calculate_player_attack_damage(player['strength'], player['crit_chance'], player['crit_damage'] + crit_mult_bonus)
-        player_damage_dealt = math.ceil(player_damage_dealt * attack_multiplier) # Применяем бафф
-        crit_text = "💥<b>КРИТ!</b> " if is_crit else ""; buff_text = f"(x{attack_multiplier:.1f}!) " if attack_multiplier > 1.0 else ""
-        action_log = f"Вы атаковали 🗡️ {buff_text}{crit_text}и нанесли {player_damage_dealt} урона."
-        if "buff_next_attack" in current_buffs: del current_buffs["buff_next_attack"] # Удаляем бафф
-
-    else: # Заклинание
-        spell_id = action_type
-        spell_data = SPELLS.get(spell_id)
-        if not spell_data: await callback.answer("Ошибка: заклинание не найдено.", show_alert=True); return
-
-        try: base_mana_cost = int(spell_data['mana_cost']); actual_mana_cost = math.ceil(base_mana_cost * mana_multiplier)
-        except Exception: actual_mana_cost = 99999
-
-        if player['current_mana'] >= actual_mana_cost:
-            mana_cost = actual_mana_cost; spell_name = spell_data['name']; cost_text = f" ({mana_cost} М)"
-            effect_type = spell_data.get('effect_type'); effect_value = spell_data.get('effect_value'); duration = spell_data.get('duration', 0)
-            action_log = f"Вы использовали ✨ {hd.quote(spell_name)}{cost_text}"
-
-            if effect_type == "damage":
-                base_damage = effect_value; final_base_damage = calculate_final_spell_damage(base_damage, player['intelligence'])
-                # Используем calculate_damage_with_crit для крита
-                player_damage_dealt, is_crit = calculate_damage_with_crit(final_base_damage, player['crit_chance'], player['crit_damage'] + crit_mult_bonus)
-                crit_text = "💥<b>КРИТ!</b> " if is_crit else ""; action_log += f", {crit_text}нанеся {player_damage_dealt} урона."
-            elif effect_type == "heal_percent":
-                percent = effect_value; heal_calc = math.ceil(player['max_hp'] * (percent / 100.0))
-                heal_actual = min(heal_calc, player['max_hp'] - player['current_hp']); healed_amount = heal_actual
-                action_log += f", восстановив {healed_amount} здоровья."
-            elif effect_type == "buff_next_attack":
-                applied_buffs["buff_next_attack"] = effect_value; action_log += f", усилив след. атаку (x{effect_value:.1f})."
-            elif effect_type == "temp_buff":
-                if isinstance(effect_value, dict) and duration > 0:
-                     buff_log_parts = []
-                     for stat_name, buff_val in effect_value.items():
-                         applied_buffs[f"temp_{stat_name}"] = {'value': buff_val, 'duration': duration}
-                         buff_log_parts.append(f"+{buff_val} {stat_name}")
-                     if buff_log_parts: action_log += f", усилив {', '.join(buff_log_parts)} на {duration} хода."
-                     else: action_log += ", но бафф не сработал (ошибка данных)."
-                else: action_log += ", но бафф не сработал (неверные данные)."
-            else: action_log += ", но ничего не произошло (неизвестный эффект)."
-        else: await callback.answer("Недостаточно маны!", show_alert=True); return
-
-    # --- Применяем изменения HP/Mana игрока ---
-    await update_player_vitals(user_id, hp_change=healed_amount, mana_change=-mana_cost)
-
-    # --- Обновляем баффы в состоянии FSM ---
-    next_turn_buffs = {} # Баффы для СЛЕДУЮЩЕГО хода
-    buffs_expired_log = []
-    for buff_key, buff_data in current_buffs.items(): # Обходим баффы с ПРОШЛОГО хода
-        if isinstance(buff_data, dict) and 'duration' in buff_data:
-            remaining_duration = buff_data['duration'] - 1
-            if remaining_duration > 0: next_turn_buffs[buff_key] = {'value': buff_data['value'], 'duration': remaining_duration}
-            else: buffs_expired_log.append(buff_key.replace('temp_', ''))
-    if buffs_expired_log: logging.info(f"Buffs expired for user {user_id}: {', '.join(buffs_expired_log)}")
-    next_turn_buffs.update(applied_buffs) # Добавляем/обновляем новыми баффами
-    await state.update_data(player_buffs=next_turn_buffs) # Сохраняем для следующего хода
-    logging.debug(f"Player {user_id} buffs for next turn: {next_turn_buffs}")
-
-    # --- Обновление HP босса и проверка победы ---
-    new_boss_hp = current_boss_hp
-    if player_damage_dealt > 0:
-        new_boss_hp = max(0, current_boss_hp - player_damage_dealt)
-        await state.update_data(boss_hp=new_boss_hp)
+    # --- Ход по правилам combat_engine (общим с монстрами, симулятором и переигровкой журнала) ---
+    active_effects = player.get('active_effects', {})
+    result = resolve_turn(player, {'hp': session.hp, 'mana': session.mana, 'es': session.es},
+                          current_boss_hp, boss_damage, effects, action_type, rng=session.rng)
+    if result['error'] == "no_spell": await callback.answer("Ошибка: заклинание не найдено.", show_alert=True); return
+    if result['error'] == "no_mana": await callback.answer("Недостаточно маны!", show_alert=True); return
+    turn, tick, attack = result['turn'], result['tick'], result['attack']; effect_heal = result['effect_healed']
+
+    # --- Текст действия игрока ---
+    crit_text = "💥<b>КРИТ!</b> " if turn['is_crit'] else ""; spell_data = turn['spell']
+    if spell_data is None: # Атака
+        attack_multiplier = turn['attack_multiplier']; buff_text = f"(x{attack_multiplier:.1f}!) " if attack_multiplier > 1.0 else ""
+        action_log = f"Вы атаковали 🗡️ {buff_text}{crit_text}и нанесли {turn['damage']} урона."
+    else:
+        effect_type = spell_data.get('effect_type')
+        action_log = f"Вы использовали ✨ {hd.quote(spell_data['name'])} ({turn['mana_cost']} М)"
+        if effect_type == "damage": action_log += f", {crit_text}нанеся {turn['damage']} урона."
+        elif effect_type == "heal_percent": action_log += f", восстановив {turn['healed']} здоровья."
+        elif effect_type == "buff_next_attack": action_log += f", усилив след. атаку (x{turn['attack_buff']:.1f})."
+        elif effect_type in ("temp_buff", "heal_over_time", "damage_over_time", "summon"):
+            action_log += describe_new_effects(turn['new_effects']) if turn['new_effects'] else ", но эффект не сработал (ошибка данных)."
+        else: action_log += ", но ничего не произошло (неизвестный эффект)."
+    action_log += format_effect_tick(tick, effect_heal) # HoT, призывы, истечение баффов
+    if tick.expired: hot_log.info("Effects expired for user %s: %s", user_id, ', '.join(tick.expired))
+
+    # --- Итог хода - в сессию (в памяти) и журнал боя ---
+    session.hp, session.mana, session.es = result['hp'], result['mana'], result['es']
+    new_boss_hp = combat.enemy_hp = result['enemy_hp']
+    dodged, player_hp_loss = (attack['dodged'], attack['damage']) if attack else (False, 0)
+    combat_events.turn(session, action_type, turn['damage'], turn['is_crit'], tick.enemy_damage, turn['healed'],
+                       effect_heal, turn['mana_cost'], dodged, player_hp_loss)
+    logging.debug("[handle_boss_combat_action] User %s: HP=%s, Mana=%s, ES=%s, boss HP=%s", user_id, session.hp, session.mana, session.es, new_boss_hp)
 
     if new_boss_hp <= 0: # Победа
-        logging.info(f"Player {user_id} DEFEATED BOSS {boss_id} ('{boss_name}')!")
+        hot_log.info("Player %s DEFEATED BOSS %s ('%s')!", user_id, boss_id, boss_name)
+        await combat_sessions.finish(session, outcome=OUTCOME_WON) # Виталы боя - в БД до начисления опыта
         xp_gain = boss_xp_reward; gold_gain = boss_gold_reward
         # Эффект золота
         try: triple_gold_chance = float(active_effects.get('triple_gold_chance', 0))
@@ -384,8 +327,8 @@ async def handle_boss_combat_action(callback: types.CallbackQuery, state: FSMCon
         player_after_boss = await get_player_effective_stats(user_id)
         if player_after_boss and player_after_boss['energy_shield'] < player_after_boss['max_energy_shield']:
              await update_player_vitals(user_id, set_es=player_after_boss['max_energy_shield'])
-        # Завершаем бой и реген
-        await state.clear(); await check_and_apply_regen(user_id, None)
+        # Завершаем бой
+        await state.clear()
         # Сообщение
         level_up_log = ""
         if leveled_up and xp_update_result: level_up_log = (f"🎉<b>УРОВЕНЬ {xp_update_result['level']}!</b> (+{xp_update_result['gained_stat_points']} очка)🎉\n")
@@ -397,35 +340,24 @@ async def handle_boss_combat_action(callback: types.CallbackQuery, state: FSMCon
         except Exception as e: await callback.message.answer(result_text, parse_mode="HTML")
         return
 
-    # --- Ход Босса ---
-    boss_raw_damage = boss_damage; dodge_chance = calculate_dodge_chance(player['dexterity'])
-    # Учитываем временные баффы брони игрока, сохраненные для этого хода
-    current_turn_buffs = next_turn_buffs
-    player_armor = player['armor'] + current_turn_buffs.get('temp_armor', {}).get('value', 0)
-    player_damage_reduction = calculate_damage_reduction(player_armor)
-    player_hp_loss = 0; boss_action_log = ""
-    if random.uniform(0, 100) < dodge_chance:
+    # --- Текст хода босса ---
+    if dodged:
         boss_action_log = f"<b>{hd.quote(boss_name)}</b> атаковал, но вы увернулись! 💨"
     else:
-        actual_damage = max(1, boss_raw_damage - player_damage_reduction)
-        player_hp_loss = actual_damage
-        reduction_text = f" (-{player_damage_reduction} броня{'🛡️' if current_turn_buffs.get('temp_armor') else ''})" if player_damage_reduction > 0 else ""
-        boss_action_log = f"<b>{hd.quote(boss_name)}</b> атаковал 👹 и нанес вам <b>{actual_damage}</b> урона{reduction_text}."
-
-    # --- Обновляем виталы игрока ПОСЛЕ хода босса ---
-    logging.info(f"[handle_boss_combat_action CALLING_VITALS for boss attack] User {user_id}: hp_change={-player_hp_loss}")
-    new_hp, new_mana, new_es = await update_player_vitals(user_id, hp_change=-player_hp_loss)
-    logging.info(f"[handle_boss_combat_action VITALS_RETURNED after boss] User {user_id}: NewHP={new_hp}, NewMana={new_mana}, NewES={new_es}")
+        reduction = attack['reduction']; armor_bonus = effects.stat_bonus('armor') # Временная броня действовала на эту атаку
+        reduction_text = f" (-{reduction} броня{'🛡️' if armor_bonus > 0 else ''})" if reduction > 0 else ""
+        boss_action_log = f"<b>{hd.quote(boss_name)}</b> атаковал 👹 и нанес вам <b>{player_hp_loss}</b> урона{reduction_text}."
 
     # --- Проверка поражения игрока ---
-    if new_hp <= 0: # Поражение
-        logging.info(f"Player {user_id} was defeated by BOSS {boss_id} ('{boss_name}').")
+    if session.hp <= 0: # Поражение
+        hot_log.info("Player %s was defeated by BOSS %s ('%s').", user_id, boss_id, boss_name)
+        await combat_sessions.finish(session, outcome=OUTCOME_DIED)
         xp_penalty, gold_penalty = await apply_death_penalty(user_id); penalty_log = f"☠️ Потеряно: {xp_penalty} XP, {gold_penalty} 💰."
         # Восстанавливаем ES
         player_after_death_b = await get_player_effective_stats(user_id)
         if player_after_death_b: await update_player_vitals(user_id, set_es=player_after_death_b['max_energy_shield'])
-        # Завершаем бой и реген
-        await state.clear(); await check_and_apply_regen(user_id, None)
+        # Завершаем бой
+        await state.clear()
         # Сообщение
         result_text = (f"{action_log}\n{boss_action_log}\n\n"
                        f"<b>Вы повержены: {hd.quote(boss_name)}...</b> 💀\n{penalty_log}")
@@ -434,15 +366,11 @@ async def handle_boss_combat_action(callback: types.CallbackQuery, state: FSMCon
         return
 
     # --- Бой продолжается ---
-    updated_player = await get_player_effective_stats(user_id)
-    if not updated_player: await callback.message.edit_text("Ошибка данных. Бой прерван."); await state.clear(); return
-    keyboard = await get_boss_combat_action_keyboard(user_id, boss_id, updated_player['current_mana'], updated_player.get('active_effects', {}))
+    await combat_sessions.after_turn(session) # Контрольная точка в БД/FSM раз в N ходов
+    updated_player = session.snapshot_player()
+    keyboard = await get_boss_combat_action_keyboard(user_id, boss_id, updated_player['current_mana'], updated_player.get('active_effects', {}), session.learned_spells)
     # Отображение баффов
-    active_buff_texts = []
-    for buff_key, buff_data in next_turn_buffs.items():
-         if isinstance(buff_data, dict) and 'duration' in buff_data: active_buff_texts.append(f"{buff_key.replace('temp_', '').capitalize()} (+{buff_data['value']}) [{buff_data['duration']} х.]")
-         elif buff_key == "buff_next_attack": active_buff_texts.append(f"Усиление атаки (x{buff_data:.1f})")
-    buff_display = " / ".join(active_buff_texts); buff_line = f"\n<i>Эффекты: {buff_display}</i>" if buff_display else ""
+    buff_display = " / ".join(effects.describe()); buff_line = f"\n<i>Эффекты: {buff_display}</i>" if buff_display else ""
     # Сообщение
     result_text = (f"{action_log}\n{boss_action_log}\n\n"
                    f"<b>{hd.quote(boss_name)}</b>\n❤️ HP: {new_boss_hp}/{boss_max_hp}\n\n"
@@ -452,7 +380,7 @@ async def handle_boss_combat_action(callback: types.CallbackQuery, state: FSMCon
         await callback.message.edit_text(result_text, reply_markup=keyboard, parse_mode="HTML")
     except Exception as e:
         logging.error(f"Error editing boss combat message: {e}")
-        await callback.message.answer("Ошибка отображения боя. Бой прерван."); await state.clear()
+        await callback.message.answer("Ошибка отображения боя. Бой прерван."); await combat_sessions.finish(session); await state.clear()
 
 
 # --- Обработчики нажатий кнопок босса ВНЕ состояния ---
@@ -8,7 +8,8 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.text_decorations import html_decoration as hd
 
 # Импортируем необходимые функции из базы данных
-from database.db_manager import get_player, update_player_vitals, update_player_xp, check_and_apply_regen
+from database.db_manager import update_player_vitals, update_player_xp
+from middlewares.player_context import PlayerContext
 
 # Настройка логирования (если нужно для отладки)
 # logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
@@ -77,7 +78,7 @@ def get_healer_options_keyboard(player_level: int, current_hp: int, max_hp: int,
 
 # --- Обработчик Сообщения для кнопки "Лекарь" ---
 @router.message(F.text.lower() == "⚕️ лекарь")
-async def healer_start(message: types.Message, state: FSMContext):
+async def healer_start(message: types.Message, state: FSMContext, player_ctx: PlayerContext):
     """
     Обрабатывает нажатие кнопки "Лекарь" в меню города.
     Показывает приветствие лекаря и кнопки с опциями лечения.
@@ -85,12 +86,7 @@ async def healer_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     logging.info(f"User {user_id} accessed the healer.")
 
-    # Проверяем и применяем регенерацию перед отображением опций
-    current_state_str = await state.get_state()
-    await check_and_apply_regen(user_id, current_state_str)
-
-    # Получаем обновленные данные игрока ПОСЛЕ регенерации
-    player = await get_player(user_id)
+    player = await player_ctx.stats() # HP/мана с учетом ленивого регена
 
     if not player:
         logging.warning(f"Non-player {user_id} tried to access the healer.")
@@ -117,7 +113,7 @@ async def healer_start(message: types.Message, state: FSMContext):
 
 # --- Обработчик Callback'ов от кнопок Лекаря ---
 @router.callback_query(HealerStates.choosing_heal_option, F.data.startswith("heal:"))
-async def process_healer_option(callback: types.CallbackQuery, state: FSMContext):
+async def process_healer_option(callback: types.CallbackQuery, state: FSMContext, player_ctx: PlayerContext):
     """
     Обрабатывает нажатия на инлайн-кнопки в меню лекаря.
     Работает только если пользователь находится в состоянии choosing_heal_option.
@@ -174,7 +170,7 @@ async def process_healer_option(callback: types.CallbackQuery, state: FSMContext
         return
 
     # Получаем актуальные данные игрока для проверки и расчета
-    player = await get_player(user_id)
+    player = await player_ctx.stats()
     if not player:
         logging.error(f"Could not retrieve player data for {user_id} during healing purchase.")
         await callback.message.edit_text("Не удалось найти данные вашего персонажа.")
@@ -2,81 +2,124 @@
 import random
 import logging
 import time
-import math
 from aiogram import Router, F, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.text_decorations import html_decoration as hd
+from aiogram.exceptions import TelegramBadRequest # Для обработки ошибок API
 
 from database.db_manager import (
     get_player_effective_stats, update_player_vitals, update_player_xp,
     update_quest_progress, clear_daily_quest, apply_death_penalty,
-    check_and_apply_regen, add_item_to_inventory, get_learned_spells
-)
-from game_data import (
-    MONSTERS, SPELLS, ALL_ITEMS, get_random_loot_item_id,
-    calculate_final_spell_damage, # Импорт функции скейлинга от инты
-    calculate_damage_with_crit # <-- НОВЫЙ ИМПОРТ для крита
+    add_item_to_inventory, get_learned_spells,
+    apply_fight_outcome, apply_farm_run
 )
+from middlewares.player_context import PlayerContext
+from game_data import MONSTERS, ALL_ITEMS, get_random_loot_item_id, FARM_DEFAULT_FIGHTS, FARM_MAX_FIGHTS
 # Убедись, что эта строка удалена или закомментирована:
 # from handlers.combat import ...
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
-
 router = Router()
 
 class CombatStates(StatesGroup):
     fighting = State()
 
 # --- Вспомогательные функции ---
-
-# --- ИСПРАВЛЕНИЕ: Убираем лишний else ---
-def calculate_player_attack_damage(strength: int, crit_chance: float, crit_damage: float) -> tuple[int, bool]:
-    """Рассчитывает базовый урон атаки, а затем применяет крит."""
-    base_damage = max(1, strength // 2)
-    # Вызываем общую функцию для крита
-    final_damage, is_crit = calculate_damage_with_crit(base_damage, crit_chance, crit_damage)
-    return final_damage, is_crit
-
-def calculate_dodge_chance(dexterity: int) -> float:
-    return min(75.0, dexterity / 5.0)
-def calculate_damage_reduction(armor: int) -> int:
-    return armor // 20
+# Правила боя живут в combat_engine (общие с boss.py, симулятором и переигровкой журнала),
+# здесь - только тексты и интерфейс.
+from combat_engine import resolve_turn, scale_monster, simulate_fight, POLICY_ATTACK, POLICY_BEST_SPELL
+from combat_effects import EffectTick, EFFECT_HOT, EFFECT_STAT, EFFECT_SUMMON
+from combat_state import CombatState
+from combat_session import combat_sessions, CombatSession
+from log_setup import hot_log # Строки на каждый бой/ход - с сэмплингом
+from keyboard_cache import combat_keyboards, spell_rows_key # Кэш клавиатур боя
+from combat_log import combat_events, OUTCOME_WON, OUTCOME_DIED # Журнал боевых событий
+
+# Авто-бой: действие в callback_data -> политика выбора действий
+AUTO_FIGHT_POLICIES = {
+    "auto_attack": POLICY_ATTACK,
+    "auto_spell": POLICY_BEST_SPELL,
+}
+
+
+# --- Тексты временных эффектов (общие с boss.py) ---
+def describe_new_effects(new_effects: list) -> str:
+    """Хвост строки действия для наложенных эффектов."""
+    parts = []
+    for effect in new_effects:
+        if effect.kind == EFFECT_HOT:
+            parts.append(f"восстанавливая {effect.value} HP в ход ({effect.remaining} ход.)")
+        elif effect.kind == EFFECT_SUMMON:
+            parts.append(f"призвав {hd.quote(effect.name)} ({effect.value} урона в ход, {effect.remaining} ход.)")
+        elif effect.kind == EFFECT_STAT:
+            parts.append(f"временно усилив +{effect.value} {effect.key} на {effect.remaining} хода")
+        else:
+            parts.append(f"нанося {effect.value} урона в ход ({effect.remaining} ход.)")
+    return ", " + ", ".join(parts) + "."
+
+def format_effect_tick(tick: EffectTick, healed: int) -> str:
+    """Строки срабатывания эффектов за ход (пусто, если ничего не сработало)."""
+    lines = []
+    hot_names = [hd.quote(effect.name) for effect, _ in tick.events if effect.kind == EFFECT_HOT]
+    if hot_names:
+        lines.append(f"💚 {', '.join(hot_names)}: +{healed} HP.") # Уже с учетом максимума HP
+    for effect, amount in tick.events:
+        if effect.kind == EFFECT_HOT:
+            continue
+        elif effect.kind == EFFECT_SUMMON:
+            lines.append(f"🗿 {hd.quote(effect.name)} атакует и наносит {amount} урона.")
+        else:
+            lines.append(f"☠️ {hd.quote(effect.name)}: {amount} урона.")
+    return "".join(f"\n{line}" for line in lines)
 
 
 # --- Клавиатура действий (Обновленная) ---
-async def get_combat_action_keyboard(user_id: int, monster_key: str, player_mana: int, active_effects: dict) -> InlineKeyboardMarkup:
-    """Создает клавиатуру с действиями в бою, включая изученные спеллы."""
-    buttons = [
-        [InlineKeyboardButton(text="🗡️ Атаковать", callback_data=f"fight_action:attack:{monster_key}")],
-    ]
+async def get_combat_action_keyboard(user_id: int, monster_key: str, player_mana: int, active_effects: dict,
+                                     learned_spells: list[dict] | None = None) -> InlineKeyboardMarkup:
+    """
+    Клавиатура с действиями в бою, включая изученные спеллы (из сессии боя или из БД).
+    Берется из кэша по (спеллы, стоимость, по карману, монстр); собирается только при промахе.
+    """
     # Получаем изученные спеллы
-    learned_spells = await get_learned_spells(user_id)
+    if learned_spells is None:
+        learned_spells = await get_learned_spells(user_id)
     mana_multiplier = float(active_effects.get('mana_cost_multiplier', 1.0))
+    spell_rows = spell_rows_key(learned_spells, mana_multiplier, player_mana)
+    return combat_keyboards.get_or_build(
+        ("fight", monster_key, spell_rows),
+        lambda: build_combat_action_keyboard(monster_key, spell_rows, learned_spells)
+    )
 
-    for spell_data in learned_spells:
-        spell_id = spell_data['id']
-        spell_name = spell_data['name']
-        base_mana_cost = spell_data['mana_cost']
-        actual_mana_cost = math.ceil(base_mana_cost * mana_multiplier)
-
+def build_combat_action_keyboard(monster_key: str, spell_rows: tuple, learned_spells: list[dict]) -> InlineKeyboardMarkup:
+    """Собирает клавиатуру боя. spell_rows - из keyboard_cache.spell_rows_key."""
+    spell_names = {spell_data['id']: spell_data['name'] for spell_data in learned_spells}
+    buttons = [
+        [InlineKeyboardButton(text="🗡️ Атаковать", callback_data=f"fight_action:attack:{monster_key}")],
+        [
+            InlineKeyboardButton(text="⚡ Авто-бой (атака)", callback_data=f"fight_action:auto_attack:{monster_key}"),
+            InlineKeyboardButton(text="⚡ Авто-бой (магия)", callback_data=f"fight_action:auto_spell:{monster_key}"),
+        ],
+    ]
+    for spell_id, actual_mana_cost, affordable in spell_rows:
+        if actual_mana_cost is None:
+            logging.warning(f"Invalid mana cost for spell {spell_id}. Skipping.")
+            continue
         # Показываем актуальную стоимость маны
         cost_text = f" ({actual_mana_cost} М)"
 
-        if player_mana >= actual_mana_cost:
+        if affordable:
             buttons.append([
                 InlineKeyboardButton(
-                    text=f"✨ {hd.quote(spell_name)}{cost_text}",
+                    text=f"✨ {hd.quote(spell_names[spell_id])}{cost_text}",
                     callback_data=f"fight_action:{spell_id}:{monster_key}" # Используем ID спелла
                 )
             ])
         else:
              buttons.append([
                 InlineKeyboardButton(
-                    text=f"❌ {hd.quote(spell_name)}{cost_text}",
+                    text=f"❌ {hd.quote(spell_names[spell_id])}{cost_text}",
                     callback_data=f"fight_action:no_mana"
                 )
             ])
@@ -86,12 +129,11 @@ async def get_combat_action_keyboard(user_id: int, monster_key: str, player_mana
 
 # --- Обработчики ---
 @router.message(F.text.lower() == "⚔️ бой с монстром")
-async def start_fight_button(message: types.Message, state: FSMContext):
+async def start_fight_button(message: types.Message, state: FSMContext, player_ctx: PlayerContext):
     user_id = message.from_user.id
     current_state_str = await state.get_state()
-    await check_and_apply_regen(user_id, current_state_str)
 
-    player = await get_player_effective_stats(user_id)
+    player = await player_ctx.stats()
 
     # --- ИСПРАВЛЕНИЕ: Убираем псевдокомментарии ---
     if not player:
@@ -101,16 +143,16 @@ async def start_fight_button(message: types.Message, state: FSMContext):
         await message.answer("Вы без сознания! Найдите способ исцелиться (⚕️ Лекарь).")
         return
     if current_state_str == CombatStates.fighting.state:
-        state_data = await state.get_data()
-        monster_key = state_data.get("monster_key")
-        monster_hp = state_data.get("monster_hp")
-        if monster_key and monster_hp is not None:
-             base_monster_hp = MONSTERS.get(monster_key, {}).get('hp', '?') # Получаем базовое ХП для показа
+        session = await combat_sessions.get(user_id, state)
+        if session:
+             combat = session.combat
+             monster_key = combat.enemy_key
+             player = session.snapshot_player() # Виталы в БД могут отставать до контрольной точки
              # --- ИСПРАВЛЕНИЕ: Передаем все 4 аргумента при повторном показе клавиатуры ---
-             keyboard = await get_combat_action_keyboard(user_id, monster_key, player['current_mana'], player.get('active_effects',{}))
+             keyboard = await get_combat_action_keyboard(user_id, monster_key, player['current_mana'], player.get('active_effects',{}), session.learned_spells)
              await message.answer(
                  f"Вы уже сражаетесь с <b>{hd.quote(monster_key)}</b>!\n"
-                 f"❤️ HP Монстра: {monster_hp}/{base_monster_hp}\n\n" # Можно показывать текущее/макс. скейленное, если сохраняли
+                 f"❤️ HP Монстра: {combat.enemy_hp}/{combat.enemy_max_hp}\n\n"
                  f"Ваши статы:\n"
                  f"❤️ HP: {player['current_hp']}/{player['max_hp']} | 🛡️ ES: {player['energy_shield']}/{player['max_energy_shield']} | 💧 Mana: {player['current_mana']}/{player['max_mana']}\n\n"
                  f"Выберите действие:",
@@ -123,7 +165,7 @@ async def start_fight_button(message: types.Message, state: FSMContext):
         return
         # --- Восстановление ES перед боем ---
     if player['energy_shield'] < player['max_energy_shield']:
-        logging.info(f"Restoring ES for player {user_id} before combat.")
+        hot_log.info("Restoring ES for player %s before combat.", user_id)
         await update_player_vitals(user_id, set_es=player['max_energy_shield'])
         player = await get_player_effective_stats(user_id)
         if not player:
@@ -133,35 +175,26 @@ async def start_fight_button(message: types.Message, state: FSMContext):
 
      # --- Выбор и Скалирование Монстра ---
     monster_key = random.choice(list(MONSTERS.keys()))
-    base_monster = MONSTERS[monster_key]
     player_level = player['level']
 
-    # Формулы скалирования (можно настраивать)
-    hp_multiplier = 1 + (player_level - 1) * 0.15
-    damage_multiplier = 1 + (player_level - 1) * 0.10
-    xp_multiplier = 1 + (player_level - 1) * 0.08
-    gold_multiplier = 1 + (player_level - 1) * 0.05
-    scaled_hp = math.ceil(base_monster['hp'] * hp_multiplier)
-    scaled_damage = math.ceil(base_monster['damage'] * damage_multiplier)
-    scaled_xp = math.ceil(base_monster['xp_reward'] * xp_multiplier)
-    base_gold_drop = random.randint(1, 5) + (base_monster['xp_reward'] // 3)
-    scaled_gold = math.ceil(base_gold_drop * gold_multiplier)
-
-    logging.info(f"Player {user_id} (Lvl {player_level}) starting fight with {monster_key}. Scaled HP:{scaled_hp}, Dmg:{scaled_damage}, XP:{scaled_xp}, Gold:{scaled_gold}")
-
-    await state.update_data(
-        monster_key=monster_key,
-        monster_hp=scaled_hp,
-        monster_max_hp=scaled_hp, # Сохраняем макс ХП для отображения
-        monster_damage=scaled_damage,
-        monster_xp_reward=scaled_xp,
-        monster_gold_reward=scaled_gold,
-        player_buffs={} # Инициализируем пустой словарь баффов в начале боя
+    # Формулы скалирования - в combat_engine.scale_monster
+    scaled_monster = scale_monster(monster_key, player_level)
+    scaled_hp = scaled_monster['hp']
+    scaled_damage = scaled_monster['damage']
+    scaled_xp = scaled_monster['xp_reward']
+    scaled_gold = scaled_monster['gold_reward']
+
+    hot_log.info("Player %s (Lvl %s) starting fight with %s. Scaled HP:%s, Dmg:%s, XP:%s, Gold:%s",
+                 user_id, player_level, monster_key, scaled_hp, scaled_damage, scaled_xp, scaled_gold)
+
+    # Живая сессия боя в памяти + компактная запись состояния в FSM, баффы пустые в начале боя
+    session = await combat_sessions.start(
+        user_id, state, player, CombatState(monster_key, monster_key, scaled_hp, scaled_hp, scaled_damage, scaled_xp, scaled_gold)
     )
     await state.set_state(CombatStates.fighting)
 
 
-    keyboard = await get_combat_action_keyboard(user_id, monster_key, player['current_mana'], player.get('active_effects',{}))
+    keyboard = await get_combat_action_keyboard(user_id, monster_key, player['current_mana'], player.get('active_effects',{}), session.learned_spells)
     await message.answer(
         f"На вашем пути встает <b>{hd.quote(monster_key)}</b> (Ур. {player['level']})!\n"
         f"❤️ HP: {scaled_hp} | ⚔️ Урон: {scaled_damage}\n\n"
@@ -173,29 +206,171 @@ async def start_fight_button(message: types.Message, state: FSMContext):
     )
 
 
+# --- Авто-бой ---
+async def run_auto_fight(callback: types.CallbackQuery, state: FSMContext, session: CombatSession, policy: str):
+    """
+    Доигрывает бой на сервере по политике (combat_engine.simulate_fight),
+    записывает итог одной транзакцией и отправляет одно итоговое сообщение.
+    """
+    user_id = callback.from_user.id
+    player = session.snapshot_player()
+    combat = session.combat
+    monster_key = combat.enemy_key
+    enemy = {'key': monster_key, 'hp': combat.enemy_hp, 'damage': combat.enemy_damage}
+    result = simulate_fight(
+        player, enemy, policy, spell_ids=[s['id'] for s in session.learned_spells],
+        rng=session.rng, es=session.es, effects=combat.effects
+    )
+    combat_events.auto(session, policy, result)
+    spells_cast = sum(count for action, count in result['actions'].items() if action != "attack")
+    fight_log = (f"⚡ <b>Авто-бой</b> с <b>{hd.quote(monster_key)}</b>: {result['turns']} ход(ов)\n"
+                 f"🗡️ Атак: {result['actions'].get('attack', 0)} | ✨ Заклинаний: {spells_cast} | 💥 Критов: {result['crits']}\n"
+                 f"Нанесено урона: {result['damage_dealt']} | Получено урона: {result['damage_taken']}\n\n")
+
+    session.hp, session.mana, session.es = result['hp'], result['mana'], result['es']
+    combat.enemy_hp = result['enemy_hp'] # Эффекты уже продвинуты симуляцией
+    if not result['won'] and result['hp'] > 0:
+        # Лимит ходов: сохраняем прогресс и возвращаем ручное управление
+        await combat_sessions.checkpoint(session)
+        keyboard = await get_combat_action_keyboard(user_id, monster_key, result['mana'], player.get('active_effects', {}), session.learned_spells)
+        text = (f"{fight_log}Авто-бой остановлен: {hd.quote(monster_key)} все еще жив "
+                f"(❤️ {result['enemy_hp']}/{combat.enemy_max_hp}).\n"
+                f"❤️ HP: {result['hp']}/{player['max_hp']} | 💧 Mana: {result['mana']}/{player['max_mana']}\n\nВыберите действие:")
+        try: await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+        except Exception: await callback.message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+        return
+
+    loot_item_ids = []
+    gold_gain = combat.gold_reward
+    loot_log = ""
+    if result['won']:
+        try: triple_gold_chance = float(player.get('active_effects', {}).get('triple_gold_chance', 0))
+        except (ValueError, TypeError): triple_gold_chance = 0
+        if random.uniform(0, 100) < triple_gold_chance:
+            gold_gain *= 3
+            loot_log = f"💰 Вы получаете <b>УТРОЕННОЕ</b> золото: {gold_gain}!\n"
+        else:
+            loot_log = f"💰 Получено {gold_gain} золота.\n"
+        dropped_item_id = get_random_loot_item_id()
+        if dropped_item_id:
+            loot_item_ids.append(dropped_item_id)
+
+    # ES восстанавливается после боя (и после победы, и после поражения); виталы пишет apply_fight_outcome
+    await combat_sessions.finish(session, save_vitals=False, outcome=OUTCOME_WON if result['won'] else OUTCOME_DIED)
+    outcome = await apply_fight_outcome(
+        user_id, result['hp'], result['mana'], player['max_energy_shield'], result['won'],
+        xp_gain=combat.xp_reward if result['won'] else 0,
+        gold_gain=gold_gain if result['won'] else 0,
+        loot_item_ids=loot_item_ids, killed_monster_key=monster_key if result['won'] else None
+    )
+    await state.clear()
+    if outcome is None:
+        try: await callback.message.edit_text("Ошибка сохранения результата боя. Бой прерван.")
+        except Exception: pass
+        return
+
+    if result['won']:
+        hot_log.info("Player %s auto-defeated monster %s in %s turns.", user_id, monster_key, result['turns'])
+        item_drop_log = "".join(f"🎁 Вы нашли: <b>{hd.quote(ALL_ITEMS[item_id]['name'])}</b>!\n" for item_id in outcome['loot_item_ids'])
+        quest_log = ""
+        quest = outcome['quest']
+        if quest and quest['completed']:
+            quest_log = f"📜 <b>Задание выполнено!</b> (+{quest['gold_reward']}💰, +{quest['xp_reward']} XP)\n"
+        elif quest:
+            quest_log = f"📜 Прогресс: {quest['current_count']}/{quest['target_count']} {hd.quote(monster_key)}.\n"
+        level_up_log = f"🎉 <b>УРОВЕНЬ {outcome['level']}!</b> (+{outcome['gained_stat_points']} очка) 🎉\n" if outcome['leveled_up'] else ""
+        result_text = (f"{fight_log}<b>Победа над {hd.quote(monster_key)}!</b> 💪\n"
+                       f"✨ +{combat.xp_reward} опыта.\n"
+                       f"{loot_log}{item_drop_log}{quest_log}{level_up_log}")
+    else:
+        hot_log.info("Player %s was defeated by %s in auto-fight.", user_id, monster_key)
+        result_text = (f"{fight_log}<b>Вы были повержены {hd.quote(monster_key)}...</b> 💀\n"
+                       f"☠️ Вы теряете {outcome['xp_penalty']} опыта и {outcome['gold_penalty']} золота.\nВы потеряли сознание.")
+    try: await callback.message.edit_text(result_text, parse_mode="HTML")
+    except Exception: await callback.message.answer(result_text, parse_mode="HTML")
+
+
+# --- Фарм-забег: N боев одной командой ---
+@router.message(Command("farm"))
+@router.message(F.text.lower() == "🔁 фарм-забег")
+async def handle_farm_run(message: types.Message, state: FSMContext, player_ctx: PlayerContext):
+    """
+    /farm [N] [attack|spell] - проводит до N боев с монстрами без кнопок.
+    Между боями - пассивный реген, смерть останавливает забег. Итог пишется одной транзакцией.
+    """
+    user_id = message.from_user.id
+    current_state_str = await state.get_state()
+    if current_state_str is not None:
+        await message.answer("Сначала завершите текущее действие (бой, выбор и т.п.).")
+        return
+
+    # Аргументы: число боев и политика (по умолчанию - лучшие заклинания)
+    args = (message.text or "").split()[1:] if (message.text or "").startswith("/") else []
+    fights = FARM_DEFAULT_FIGHTS
+    policy = POLICY_BEST_SPELL
+    for arg in args:
+        if arg.isdigit():
+            fights = max(1, min(int(arg), FARM_MAX_FIGHTS))
+        elif arg.lower() in ("attack", "атака"):
+            policy = POLICY_ATTACK
+
+    player = await player_ctx.stats()
+    if not player:
+        await message.answer("Сначала создайте персонажа командой /start")
+        return
+    if player['current_hp'] <= 0:
+        await message.answer("Вы без сознания! Найдите способ исцелиться (⚕️ Лекарь).")
+        return
+
+    run = await apply_farm_run(user_id, fights, policy)
+    if run is None:
+        await message.answer("Ошибка при проведении фарм-забега. Попробуйте позже.")
+        return
+
+    kills_log = ", ".join(f"{hd.quote(key)} x{count}" for key, count in sorted(run['kills'].items(), key=lambda kv: -kv[1]))
+    loot_counts = {}
+    for item_id in run['loot_item_ids']:
+        loot_counts[item_id] = loot_counts.get(item_id, 0) + 1
+    loot_log = "".join(f"🎁 <b>{hd.quote(ALL_ITEMS[item_id]['name'])}</b> x{count}\n" for item_id, count in loot_counts.items())
+    quest = run['quest']
+    quest_log = ""
+    if quest and quest['completed']:
+        quest_log = f"📜 <b>Задание выполнено!</b> (+{quest['gold_reward']}💰, +{quest['xp_reward']} XP)\n"
+    elif quest:
+        quest_log = f"📜 Прогресс задания: {quest['current_count']}/{quest['target_count']}.\n"
+    level_log = ""
+    if run['end_level'] > run['start_level']:
+        level_log = f"🎉 <b>УРОВЕНЬ {run['end_level']}!</b> (+{run['gained_stat_points']} очков) 🎉\n"
+    final = run['final']
+    if run['died']:
+        end_log = (f"💀 <b>Вы пали в бою №{run['fights']}.</b> Забег окончен.\n"
+                   f"☠️ Вы теряете {run['xp_penalty']} опыта и {run['gold_penalty']} золота.\n")
+    elif run['stopped'] == "turn_limit":
+        end_log = "⏸️ Бой затянулся - забег остановлен.\n"
+    else:
+        end_log = ""
+
+    await message.answer(
+        f"🔁 <b>Фарм-забег</b>: {run['wins']}/{run['fights']} побед за {run['turns']} ход(ов)\n"
+        f"⚔️ {kills_log or 'никого'}\n"
+        f"✨ +{run['xp_gain']} опыта | 💰 +{run['gold_gain']} золота\n"
+        f"{loot_log}{quest_log}{level_log}{end_log}"
+        f"❤️ HP: {final['current_hp']} | 💧 Mana: {final['current_mana']}",
+        parse_mode="HTML"
+    )
+
+
 # --- Боевой цикл (handle_combat_action) ---
 @router.callback_query(CombatStates.fighting, F.data.startswith("fight_action:"))
 async def handle_combat_action(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer() # Сразу отвечаем на коллбэк
     user_id = callback.from_user.id
 
-    # Получаем эффективные статы и состояние боя
-    player = await get_player_effective_stats(user_id)
-    state_data = await state.get_data()
-
-    # Получаем данные монстра ИЗ СОСТОЯНИЯ (скейленные)
-    monster_key = state_data.get("monster_key")
-    current_monster_hp = state_data.get("monster_hp")
-    monster_max_hp = state_data.get("monster_max_hp")
-    monster_damage = state_data.get("monster_damage")
-    monster_xp_reward = state_data.get("monster_xp_reward")
-    monster_gold_reward = state_data.get("monster_gold_reward")
-
-    # Проверка полноты данных из состояния
-    if (not player or not monster_key or current_monster_hp is None or
-            monster_max_hp is None or monster_damage is None or
-            monster_xp_reward is None or monster_gold_reward is None):
-        logging.error(f"Incomplete combat state for user {user_id}. Data: {state_data}")
+    # Статы, заклинания, виталы и состояние боя - из сессии в памяти (без чтения БД)
+    session = await combat_sessions.get(user_id, state)
+
+    if not session:
+        logging.error(f"No combat session/state for user {user_id}.")
         try:
             await callback.message.edit_text("Ошибка состояния боя. Бой прерван.")
         except Exception: pass # Игнорируем ошибки редактирования старого сообщения
@@ -211,166 +386,76 @@ async def handle_combat_action(callback: types.CallbackQuery, state: FSMContext)
         # await callback.answer("Недостаточно маны!")
         return
 
-    # --- Переменные для хода игрока ---
-    player_damage_dealt = 0
-    mana_cost = 0
-    action_log = ""
-    is_crit = False
-    healed_amount = 0
-    applied_buffs = {} # Баффы, примененные В ЭТОМ ХОДЕ
-
-    # Получаем активные эффекты от предметов
-    active_effects = player.get('active_effects', {})
-    try: mana_multiplier = float(active_effects.get('mana_cost_multiplier', 1.0)); mana_multiplier = max(0, mana_multiplier)
-    except (ValueError, TypeError): mana_multiplier = 1.0
-    try: crit_mult_bonus = float(active_effects.get('crit_multiplier_bonus', 0))
-    except (ValueError, TypeError): crit_mult_bonus = 0
-
-    # --- Логика действия игрока ---
-    if action_type == "attack":
-        # Получаем бафф атаки из состояния FSM (если он есть)
-        current_buffs = state_data.get("player_buffs", {}) # Получаем баффы С ПРОШЛОГО ХОДА
-        attack_multiplier = current_buffs.get("buff_next_attack", 1.0)
-        # Считаем урон атаки
-        base_attack_damage, is_crit = calculate_player_attack_damage(
-            player['strength'], player['crit_chance'], player['crit_damage'] + crit_mult_bonus
-        )
-        player_damage_dealt, is_crit = calculate_player_attack_damage(
-            player['strength'], player['crit_chance'], player['crit_damage'] + crit_mult_bonus
-        )
-        # Формируем лог
-        crit_text = "💥 <b>КРИТ!</b> " if is_crit else ""
-        buff_text = f"(x{attack_multiplier:.1f}!) " if attack_multiplier > 1.0 else ""
-        action_log = f"Вы атаковали 🗡️ {buff_text}{crit_text}и нанесли {player_damage_dealt} урона."
-        # Сбрасываем бафф атаки, так как он использован
-        if "buff_next_attack" in current_buffs:
-             del current_buffs["buff_next_attack"]
-             # Сразу обновляем баффы в состоянии, чтобы бафф не применился снова, если бой закончится на этом ходу
-             await state.update_data(player_buffs=current_buffs)
-             logging.debug(f"Buff 'buff_next_attack' consumed for user {user_id}")
-
-
-    else: # Заклинание (action_type = spell_id)
-        spell_id = action_type
-        spell_data = SPELLS.get(spell_id)
-
-        if not spell_data:
-             logging.warning(f"Spell NOT FOUND for action '{action_type}' by user {user_id}.")
-             await callback.answer("Ошибка: заклинание не найдено.", show_alert=True)
-             return
-
-        # Расчет стоимости маны
-        try:
-            base_mana_cost = int(spell_data['mana_cost'])
-            actual_mana_cost = math.ceil(base_mana_cost * mana_multiplier)
-        except Exception as e:
-            logging.error(f"Error calculating mana cost for spell '{spell_name}': {e}")
-            actual_mana_cost = 99999
-
-        # Проверка маны
-        if player['current_mana'] >= actual_mana_cost:
-            mana_cost = actual_mana_cost # Запоминаем затраты маны
-            spell_name = spell_data['name']
-            spell_target = spell_data.get('target', 'enemy')
-            effect_type = spell_data.get('effect_type')
-            effect_value = spell_data.get('effect_value')
-            duration = spell_data.get('duration', 0)
-            cost_text = f" ({mana_cost} М)"
-            action_log = f"Вы использовали ✨ {hd.quote(spell_name)}{cost_text}"
-            
-        if spell_data and player['current_mana'] >= actual_mana_cost:
-            # Обработка эффектов заклинания
-            if effect_type == "damage":
-                base_damage = effect_value
-                final_base_damage = calculate_final_spell_damage(base_damage, player['intelligence'])
-                # Расчет крита для спелла (используем заглушку calculate_spell_damage, так как она берет словарь)
-                damage_dict_for_calc = {'damage': final_base_damage} # Оборачиваем в словарь
-                player_damage_dealt, is_crit = calculate_damage_with_crit(
-                    final_base_damage, # Передаем урон С УЧЕТОМ ИНТЕЛЛЕКТА
-                    player['crit_chance'],
-                    player['crit_damage'] + crit_mult_bonus
-                )# Передаем множитель крита С УЧЕТОМ БОНУСОВ
-                crit_text = "💥 <b>КРИТ!</b> " if is_crit else ""
-                action_log += f", {crit_text}нанеся {player_damage_dealt} урона {spell_target}."
-
-            elif effect_type == "heal_percent":
-                percent = effect_value
-                heal_calc = math.ceil(player['max_hp'] * (percent / 100.0))
-                heal_actual = min(heal_calc, player['max_hp'] - player['current_hp'])
-                healed_amount = heal_actual
-                action_log += f", восстановив {healed_amount} здоровья."
-
-            elif effect_type == "buff_next_attack":
-                # Сохраняем бафф для СЛЕДУЮЩЕГО хода
-                applied_buffs["buff_next_attack"] = effect_value
-                action_log += f", усилив следующую атаку (x{effect_value:.1f})."
-
-            elif effect_type == "temp_buff":
-                 if isinstance(effect_value, dict) and duration > 0:
-                     buff_log_parts = []
-                     for stat_name, buff_val in effect_value.items():
-                         # Добавляем временный бафф в словарь applied_buffs
-                         applied_buffs[f"temp_{stat_name}"] = {'value': buff_val, 'duration': duration}
-                         buff_log_parts.append(f"+{buff_val} {stat_name}")
-                     if buff_log_parts:
-                          action_log += f", временно усилив {', '.join(buff_log_parts)} на {duration} хода."
-                          logging.info(f"Applied temp_buff for {duration} turns: {effect_value}")
-                     else:
-                          action_log += ", но бафф не сработал (ошибка данных)."
-                 else:
-                      action_log += ", но бафф не сработал (неверные данные)."
-
-            # TODO: Добавить обработку "heal_over_time", "summon"
-            else:
-                 logging.warning(f"Unknown spell effect type: {effect_type} for spell {spell_id}")
-                 action_log += ", но ничего не произошло (неизвестный эффект)."
-
-        else: # Не хватает маны
-            await callback.answer("Недостаточно маны!", show_alert=True)
-            return # Выход из обработчика, ход не состоялся
-
-    # --- Применяем изменения HP/Mana игрока (включая хил) ---
-    logging.debug(f"[handle_combat_action] Before player vitals update: HP change={healed_amount}, Mana change={-mana_cost}")
-    # Вызываем update_player_vitals ТОЛЬКО для изменения маны/хила игрока, НЕ для урона монстра
-    # Урон монстра будет применен позже отдельным вызовом
-    await update_player_vitals(user_id, hp_change=healed_amount, mana_change=-mana_cost)
-    logging.debug(f"[handle_combat_action] After player vitals update.")
-
-    # --- Обновляем баффы в состоянии FSM ---
-    current_buffs = state_data.get("player_buffs", {}) # Получаем баффы с прошлого хода (могли измениться после атаки)
-    next_turn_buffs = {}
-    buffs_expired_log = []
-    # Уменьшаем длительность старых баффов
-    for buff_key, buff_data in current_buffs.items():
-        if isinstance(buff_data, dict) and 'duration' in buff_data:
-            remaining_duration = buff_data['duration'] - 1
-            if remaining_duration > 0:
-                next_turn_buffs[buff_key] = {'value': buff_data['value'], 'duration': remaining_duration}
-            else:
-                buffs_expired_log.append(buff_key.replace('temp_', ''))
-        # else: баффы без длительности (например, buff_next_attack, если не был потрачен) переносим как есть? Или он уже удален? Лучше не переносить то, что не имеет duration.
-
-    if buffs_expired_log:
-         logging.info(f"Buffs expired for user {user_id}: {', '.join(buffs_expired_log)}")
-         # action_log += f"\n<i>(Истек срок: {', '.join(buffs_expired_log)})</i>" # Можно добавить в лог боя
-
-    # Добавляем/обновляем баффы, примененные В ЭТОМ ХОДЕ
-    next_turn_buffs.update(applied_buffs)
-    await state.update_data(player_buffs=next_turn_buffs) # Сохраняем баффы для следующего хода
-    logging.debug(f"Player {user_id} buffs updated in state for next turn: {next_turn_buffs}")
-
+    if action_type in AUTO_FIGHT_POLICIES:
+        await run_auto_fight(callback, state, session, AUTO_FIGHT_POLICIES[action_type])
+        return
 
-    # --- Обновление HP монстра (если был урон) ---
-    new_monster_hp = current_monster_hp
-    if player_damage_dealt > 0:
-        new_monster_hp = max(0, current_monster_hp - player_damage_dealt) # Не уходим в минус
-        await state.update_data(monster_hp=new_monster_hp)
-        logging.debug(f"Monster HP updated: {new_monster_hp}/{monster_max_hp}")
+    player = session.snapshot_player()
+    combat = session.combat
+    monster_key = combat.enemy_key
+    current_monster_hp = combat.enemy_hp
+    monster_max_hp = combat.enemy_max_hp
+    monster_damage = combat.enemy_damage
+    monster_xp_reward = combat.xp_reward
+    monster_gold_reward = combat.gold_reward
+    effects = combat.effects # Баффы/HoT/призывы с прошлых ходов
+    active_effects = player.get('active_effects', {}) # Эффекты предметов
+
+    # --- Ход по правилам combat_engine (общим с боссами, авто-боем и переигровкой журнала) ---
+    result = resolve_turn(player, {'hp': session.hp, 'mana': session.mana, 'es': session.es},
+                          current_monster_hp, monster_damage, effects, action_type, rng=session.rng)
+    if result['error'] == "no_spell":
+        logging.warning(f"Spell NOT FOUND for action '{action_type}' by user {user_id}.")
+        await callback.answer("Ошибка: заклинание не найдено.", show_alert=True)
+        return
+    if result['error'] == "no_mana":
+        await callback.answer("Недостаточно маны!", show_alert=True)
+        return # Выход из обработчика, ход не состоялся
+    turn, tick, attack = result['turn'], result['tick'], result['attack']
+    effect_heal = result['effect_healed']
+
+    # --- Текст действия игрока ---
+    crit_text = "💥 <b>КРИТ!</b> " if turn['is_crit'] else ""
+    spell_data = turn['spell']
+    if spell_data is None: # Атака
+        attack_multiplier = turn['attack_multiplier']
+        buff_text = f"(x{attack_multiplier:.1f}!) " if attack_multiplier > 1.0 else ""
+        action_log = f"Вы атаковали 🗡️ {buff_text}{crit_text}и нанесли {turn['damage']} урона."
+    else:
+        effect_type = spell_data.get('effect_type')
+        action_log = f"Вы использовали ✨ {hd.quote(spell_data['name'])} ({turn['mana_cost']} М)"
+        if effect_type == "damage":
+            action_log += f", {crit_text}нанеся {turn['damage']} урона {spell_data.get('target', 'enemy')}."
+        elif effect_type == "heal_percent":
+            action_log += f", восстановив {turn['healed']} здоровья."
+        elif effect_type == "buff_next_attack":
+            action_log += f", усилив следующую атаку (x{turn['attack_buff']:.1f})."
+        elif effect_type in ("temp_buff", "heal_over_time", "damage_over_time", "summon"):
+            new_effects = turn['new_effects']
+            action_log += describe_new_effects(new_effects) if new_effects else ", но эффект не сработал (ошибка данных)."
+            hot_log.info("Applied %s for user %s: %s", effect_type, user_id, new_effects)
+        else:
+            logging.warning(f"Unknown spell effect type: {effect_type} for spell {action_type}")
+            action_log += ", но ничего не произошло (неизвестный эффект)."
+    # HoT, призывы, истечение баффов этого хода
+    action_log += format_effect_tick(tick, effect_heal)
+    if tick.expired:
+         hot_log.info("Effects expired for user %s: %s", user_id, ', '.join(tick.expired))
+
+    # --- Итог хода - в сессию (в памяти) и журнал боя ---
+    session.hp, session.mana, session.es = result['hp'], result['mana'], result['es']
+    new_monster_hp = combat.enemy_hp = result['enemy_hp']
+    dodged, player_hp_loss = (attack['dodged'], attack['damage']) if attack else (False, 0)
+    combat_events.turn(session, action_type, turn['damage'], turn['is_crit'], tick.enemy_damage, turn['healed'],
+                       effect_heal, turn['mana_cost'], dodged, player_hp_loss)
+    logging.debug("[handle_combat_action] User %s: HP=%s, Mana=%s, ES=%s, monster HP=%s/%s",
+                  user_id, session.hp, session.mana, session.es, new_monster_hp, monster_max_hp)
 
     # --- Проверка победы игрока ---
     # Проверяем ПОСЛЕ обновления баффов, но ДО хода монстра
     if new_monster_hp <= 0:
-        logging.info(f"Player {user_id} defeated monster {monster_key}.")
+        hot_log.info("Player %s defeated monster %s.", user_id, monster_key)
+        await combat_sessions.finish(session, outcome=OUTCOME_WON) # Виталы боя - в БД до начисления опыта (левел-ап их перезапишет)
         xp_gain = monster_xp_reward
         gold_gain = monster_gold_reward
         # Применяем эффект утроения золота
@@ -378,7 +463,7 @@ async def handle_combat_action(callback: types.CallbackQuery, state: FSMContext)
         except (ValueError, TypeError): triple_gold_chance = 0
         if random.uniform(0, 100) < triple_gold_chance:
              gold_gain *= 3
-             logging.info(f"Triple gold proc! Gold: {gold_gain}")
+             hot_log.info("Triple gold proc! Gold: %s", gold_gain)
              loot_log = f"💰 Вы получаете <b>УТРОЕННОЕ</b> золото: {gold_gain}!\n"
         else:
              loot_log = f"💰 Получено {gold_gain} золота.\n"
@@ -416,11 +501,10 @@ async def handle_combat_action(callback: types.CallbackQuery, state: FSMContext)
         player_after_fight = await get_player_effective_stats(user_id)
         if player_after_fight and player_after_fight['energy_shield'] < player_after_fight['max_energy_shield']:
              await update_player_vitals(user_id, set_es=player_after_fight['max_energy_shield'])
-             logging.info(f"Player {user_id} ES restored after victory.")
+             hot_log.info("Player %s ES restored after victory.", user_id)
 
-        # Завершаем бой и регеним HP/Mana
+        # Завершаем бой (реген ленивый - от якоря, записанного combat_sessions.finish через update_player_vitals)
         await state.clear()
-        await check_and_apply_regen(user_id, None)
 
         result_text = (f"{action_log}\n\n"
                        f"<b>Победа над {hd.quote(monster_key)}!</b> 💪\n"
@@ -430,45 +514,28 @@ async def handle_combat_action(callback: types.CallbackQuery, state: FSMContext)
         except Exception as e: await callback.message.answer(result_text, parse_mode="HTML")
         return # <<< ВАЖНО: Выход после победы
 
-    # --- Логика хода монстра ---
-    monster_raw_damage = monster_damage
-    dodge_chance = calculate_dodge_chance(player['dexterity'])
-    # Получаем баффы для ЭТОГО хода (которые действуют СЕЙЧАС)
-    current_turn_buffs = next_turn_buffs # Баффы, сохраненные после хода игрока
-    player_armor = player['armor'] + current_turn_buffs.get('temp_armor', {}).get('value', 0)
-    player_damage_reduction = calculate_damage_reduction(player_armor)
-
-    # !!! ИНИЦИАЛИЗИРУЕМ player_hp_loss ЗДЕСЬ !!!
-    player_hp_loss = 0
-    monster_action_log = ""
-
-    if random.uniform(0, 100) < dodge_chance:
+    # --- Текст хода монстра ---
+    if dodged:
         monster_action_log = f"{hd.quote(monster_key)} атаковал, но вы увернулись! 💨"
     else:
-        actual_damage = max(1, monster_raw_damage - player_damage_reduction)
-        player_hp_loss = actual_damage # Устанавливаем урон, который получит игрок
-        reduction_text = f" (-{player_damage_reduction} броня{'🛡️' if current_turn_buffs.get('temp_armor') else ''})" if player_damage_reduction > 0 else "" # Эмодзи, если есть бафф брони
-        monster_action_log = f"{hd.quote(monster_key)} атаковал 👹 и нанес вам <b>{actual_damage}</b> урона{reduction_text}."
-
-    # --- Обновляем виталы игрока ПОСЛЕ хода монстра ---
-    # Передаем только урон от монстра (hp_change будет < 0)
-    logging.info(f"[handle_combat_action CALLING_VITALS for monster attack] User {user_id}: hp_change={-player_hp_loss}")
-    new_hp, new_mana, new_es = await update_player_vitals(user_id, hp_change=-player_hp_loss) # Ману и ES не меняем здесь
-    logging.info(f"[handle_combat_action VITALS_RETURNED after monster] User {user_id}: NewHP={new_hp}, NewMana={new_mana}, NewES={new_es}")
+        reduction = attack['reduction']
+        armor_bonus = effects.stat_bonus('armor') # Временная броня действовала на эту атаку
+        reduction_text = f" (-{reduction} броня{'🛡️' if armor_bonus > 0 else ''})" if reduction > 0 else "" # Эмодзи, если есть бафф брони
+        monster_action_log = f"{hd.quote(monster_key)} атаковал 👹 и нанес вам <b>{player_hp_loss}</b> урона{reduction_text}."
 
     # --- Проверка поражения игрока ---
-    if new_hp <= 0:
-        logging.info(f"Player {user_id} was defeated by {monster_key}.")
+    if session.hp <= 0:
+        hot_log.info("Player %s was defeated by %s.", user_id, monster_key)
+        await combat_sessions.finish(session, outcome=OUTCOME_DIED)
         xp_penalty, gold_penalty = await apply_death_penalty(user_id)
         penalty_log = f"☠️ Вы теряете {xp_penalty} опыта и {gold_penalty} золота."
         # Восстанавливаем ES после поражения
         player_after_death = await get_player_effective_stats(user_id)
         if player_after_death:
              await update_player_vitals(user_id, set_es=player_after_death['max_energy_shield'])
-             logging.info(f"Player {user_id} ES restored after defeat.")
+             hot_log.info("Player %s ES restored after defeat.", user_id)
 
         await state.clear()
-        await check_and_apply_regen(user_id, None)
 
         result_text = (f"{action_log}\n{monster_action_log}\n\n"
                        f"<b>Вы были повержены {hd.quote(monster_key)}...</b> 💀\n"
@@ -478,24 +545,14 @@ async def handle_combat_action(callback: types.CallbackQuery, state: FSMContext)
         return # <<< ВАЖНО: Выход после поражения
 
     # --- Бой продолжается ---
-    updated_player = await get_player_effective_stats(user_id) # Получаем актуальные статы
-    if not updated_player: # Проверка
-         await callback.message.edit_text("Ошибка получения данных игрока. Бой прерван.")
-         await state.clear()
-         return
+    await combat_sessions.after_turn(session) # Контрольная точка в БД/FSM раз в N ходов
+    updated_player = session.snapshot_player()
 
     # Генерируем клавиатуру для СЛЕДУЮЩЕГО хода игрока
-    keyboard = await get_combat_action_keyboard(user_id, monster_key, updated_player['current_mana'], updated_player.get('active_effects', {}))
-
-    # Собираем информацию о действующих баффах для отображения
-    active_buff_texts = []
-    for buff_key, buff_data in next_turn_buffs.items(): # Используем баффы, сохраненные для следующего хода
-         if isinstance(buff_data, dict) and 'duration' in buff_data:
-              stat_name = buff_key.replace('temp_', '')
-              active_buff_texts.append(f"{stat_name.capitalize()} (+{buff_data['value']}) [{buff_data['duration']} ход]")
-         elif buff_key == "buff_next_attack":
-              active_buff_texts.append(f"Усиление атаки (x{buff_data:.1f})")
-    buff_display = " / ".join(active_buff_texts)
+    keyboard = await get_combat_action_keyboard(user_id, monster_key, updated_player['current_mana'], updated_player.get('active_effects', {}), session.learned_spells)
+
+    # Действующие эффекты для отображения
+    buff_display = " / ".join(effects.describe())
     buff_line = f"\n<i>Активные эффекты: {buff_display}</i>" if buff_display else ""
 
 
@@ -515,10 +572,12 @@ async def handle_combat_action(callback: types.CallbackQuery, state: FSMContext)
          else:
              logging.error(f"Error editing combat message: {e}")
              await callback.message.answer("Произошла ошибка отображения боя. Бой прерван.")
+             await combat_sessions.finish(session)
              await state.clear()
     except Exception as e:
         logging.error(f"Error editing combat message: {e}")
         await callback.message.answer("Произошла ошибка отображения боя. Бой прерван.")
+        await combat_sessions.finish(session)
         await state.clear()
         
 # Обработчик для случая, если игрок нажал кнопку действия вне состояния боя
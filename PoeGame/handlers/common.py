@@ -4,29 +4,17 @@ import time
 from aiogram import Router, F
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton # Нужные типы для клавиатуры
 from aiogram.filters import CommandStart, Command
-from aiogram.fsm.context import FSMContext # Нужен для получения состояния во всех хендлерах
 
 # Импортируем данные и функции БД
 from game_data import BASE_STATS
-from database.db_manager import add_player, get_player, check_and_apply_regen
+from database.db_manager import add_player
+from middlewares.player_context import PlayerContext
 
 # Настройка логирования (можно удалить, если настроено глобально в bot.py)
 # logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
 
 router = Router()
 
-# --- Вспомогательная функция для вызова регенерации ---
-# Вынесена для удобства повторного использования
-async def trigger_regen_check(user_id: int, state: FSMContext):
-     """Проверяет и применяет регенерацию, если игрок не в бою."""
-     try:
-        current_state_str = await state.get_state()
-        await check_and_apply_regen(user_id, current_state_str)
-     except Exception as e:
-         # Логируем ошибку, но не прерываем основной процесс
-         logging.error(f"Error during regen check for user {user_id}: {e}", exc_info=False) # exc_info=False, чтобы не засорять лог трейсбеком регена
-
-
 # --- Клавиатуры Меню ---
 def get_main_menu_keyboard() -> ReplyKeyboardMarkup:
     """Создает и возвращает клавиатуру главного меню."""
@@ -53,7 +41,7 @@ def get_fight_menu_keyboard() -> ReplyKeyboardMarkup:
     """Создает и возвращает клавиатуру подменю 'Бой'."""
     buttons = [
         [KeyboardButton(text="⚔️ Бой с монстром"), KeyboardButton(text="💀 Бой с боссом")],
-        [KeyboardButton(text="🤺 Бой с игроком (скоро)")],
+        [KeyboardButton(text="🔁 Фарм-забег"), KeyboardButton(text="🤺 Бой с игроком (скоро)")],
         # Кнопка для возврата в главное меню
         [KeyboardButton(text="⬅️ Назад в меню")]
     ]
@@ -83,19 +71,16 @@ def get_city_menu_keyboard() -> ReplyKeyboardMarkup:
 # --- Обработчики Команд и Кнопок ---
 
 @router.message(CommandStart())
-async def handle_start(message: Message, state: FSMContext): # Добавляем state
+async def handle_start(message: Message, player_ctx: PlayerContext):
     """
     Обрабатывает команду /start.
     Регистрирует нового игрока (если его нет) и показывает главное меню.
-    Вызывает проверку регенерации.
     """
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     logging.info(f"User {user_id} ({username}) initiated /start.")
 
-    # Проверяем реген ДО получения данных игрока
-    await trigger_regen_check(user_id, state)
-    player = await get_player(user_id) # Получаем базовые данные
+    player = await player_ctx.row() # Получаем базовые данные
 
     if player:
         logging.info(f"Existing player {user_id} found. Sending main menu.")
@@ -128,55 +113,44 @@ async def handle_start(message: Message, state: FSMContext): # Добавляе
 
 # Обработчик для кнопки "Назад в меню"
 @router.message(F.text.lower() == "⬅️ назад в меню")
-async def handle_back_to_main_menu(message: Message, state: FSMContext): # Добавляем state
+async def handle_back_to_main_menu(message: Message):
     """Обрабатывает нажатие кнопки 'Назад в меню', возвращая основную клавиатуру."""
     logging.debug(f"User {message.from_user.id} pressed 'Back to menu'.")
-    await trigger_regen_check(message.from_user.id, state) # Проверяем реген при возврате
     await message.answer("Главное меню:", reply_markup=get_main_menu_keyboard())
 
 # Обработчики для кнопок, открывающих подменю
 @router.message(F.text.lower() == "⚔️ бой")
-async def handle_fight_menu(message: Message, state: FSMContext): # Добавляем state
+async def handle_fight_menu(message: Message):
     """Обрабатывает нажатие кнопки 'Бой', показывая подменю боя."""
     logging.debug(f"User {message.from_user.id} pressed 'Fight' button.")
-    await trigger_regen_check(message.from_user.id, state) # Реген перед входом в меню боя
     await message.answer("Выберите тип боя:", reply_markup=get_fight_menu_keyboard())
 
 @router.message(F.text.lower() == "🏘️ город")
-async def handle_city_menu(message: Message, state: FSMContext): # Добавляем state
+async def handle_city_menu(message: Message):
     """Обрабатывает нажатие кнопки 'Город', показывая подменю города."""
     logging.debug(f"User {message.from_user.id} pressed 'City' button.")
-    await trigger_regen_check(message.from_user.id, state) # Реген перед входом в город
     await message.answer("Добро пожаловать в город! Что вас интересует?", reply_markup=get_city_menu_keyboard())
 
 # Обработчик для всех кнопок с текстом "(скоро)"
 @router.message(F.text.lower().contains("(скоро)"))
-async def handle_coming_soon(message: Message, state: FSMContext): # Добавляем state
+async def handle_coming_soon(message: Message):
     """Обрабатывает нажатия на любые кнопки, содержащие '(скоро)'."""
     logging.debug(f"User {message.from_user.id} clicked a 'coming soon' button: {message.text}")
-    await trigger_regen_check(message.from_user.id, state) # Реген даже при нажатии на неактивные
     await message.answer("Этот раздел еще находится в разработке! 🚧 Скоро здесь что-то появится.")
 
 # Оставляем команду /menu как запасной вариант для вызова главного меню
 @router.message(Command("menu"))
-async def handle_menu_command(message: Message, state: FSMContext): # Добавляем state
+async def handle_menu_command(message: Message):
     """Обрабатывает команду /menu для отображения главного меню."""
-    logging.debug(f"User {message.from_user.id} used /menu command.")
     user_id = message.from_user.id
-    # Проверяем реген перед показом меню
-    await trigger_regen_check(user_id, state)
-    player = await get_player(user_id) # Достаточно базовых данных для проверки существования
-    if player:
-        await message.answer("Главное меню:", reply_markup=get_main_menu_keyboard())
-    else:
-        await message.answer("Сначала начните игру командой /start")
+    # Незарегистрированных отсекает PlayerContextMiddleware
+    await message.answer("Главное меню:", reply_markup=get_main_menu_keyboard())
 
 # Команда /help
 @router.message(Command("help"))
-async def handle_help_command(message: Message, state: FSMContext): # Добавляем state
+async def handle_help_command(message: Message):
      """Обрабатывает команду /help, выводя базовую информацию."""
      logging.debug(f"User {message.from_user.id} used /help command.")
-     await trigger_regen_check(message.from_user.id, state) # Реген при запросе помощи
      await message.answer(
          "👋 <b>Добро пожаловать в ПоЕ-Бот!</b>\n\n"
          "Это текстовая игра по мотивам Path of Exile прямо в Telegram.\n\n"
@@ -201,6 +175,5 @@ async def handle_help_command(message: Message, state: FSMContext): # Добав
 # @router.message()
 # async def handle_unknown_text(message: Message, state: FSMContext):
 #     logging.debug(f"Received unhandled text from {message.from_user.id}: {message.text}")
-#     await trigger_regen_check(message.from_user.id, state)
 #     await message.reply("Не совсем понимаю, что ты имеешь в виду 🤔\n"
 #                         "Попробуй использовать кнопки меню или команду /help.")
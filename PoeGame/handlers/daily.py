@@ -5,15 +5,14 @@ import random
 import logging
 from aiogram import Router, F, types
 from aiogram.filters import Command # Оставляем Command, если вдруг понадобится
-from aiogram.fsm.context import FSMContext # Импортируем FSMContext
 from datetime import datetime, timedelta # Не используется, но может пригодиться
 from aiogram.utils.text_decorations import html_decoration as hd # Для экранирования имен монстров
 
 # Импортируем нужные функции из db_manager
 from database.db_manager import (
-    get_player, set_daily_reward_time, assign_daily_quest, clear_daily_quest,
-    update_player_xp, check_and_apply_regen # Добавляем check_and_apply_regen
+    set_daily_reward_time, assign_daily_quest, clear_daily_quest, update_player_xp
 )
+from middlewares.player_context import PlayerContext
 # Импортируем данные о монстрах для квестов
 from game_data import MONSTERS
 
@@ -27,22 +26,13 @@ DAILY_REWARD_COOLDOWN = 24 * 60 * 60 # 24 часа в секундах
 DAILY_QUEST_COOLDOWN = 24 * 60 * 60  # 24 часа в секундах
 DAILY_REWARD_GOLD = 50 # Базовая награда
 
-async def trigger_regen_check(user_id: int, state: FSMContext):
-     """Вспомогательная функция для вызова регенерации."""
-     current_state_str = await state.get_state()
-     await check_and_apply_regen(user_id, current_state_str)
-
 # Обработчик кнопки "Ежедневная награда"
 @router.message(F.text.lower() == "🎁 ежедневная награда")
-async def handle_daily_reward(message: types.Message, state: FSMContext): # Добавляем state
+async def handle_daily_reward(message: types.Message, player_ctx: PlayerContext):
     user_id = message.from_user.id
     logging.debug(f"User {user_id} requested daily reward.")
 
-    # --- Вызов регенерации ---
-    await trigger_regen_check(user_id, state)
-
-    # Получаем данные игрока ПОСЛЕ регена
-    player = await get_player(user_id)
+    player = await player_ctx.row()
 
     if not player:
         logging.warning(f"Non-player {user_id} tried to get daily reward.")
@@ -82,15 +72,11 @@ async def handle_daily_reward(message: types.Message, state: FSMContext): # До
 
 # Обработчик кнопки "Задания"
 @router.message(F.text.lower() == "🗺️ задания")
-async def handle_daily_quest_menu(message: types.Message, state: FSMContext): # Добавляем state
+async def handle_daily_quest_menu(message: types.Message, player_ctx: PlayerContext):
     user_id = message.from_user.id
     logging.debug(f"User {user_id} requested daily quests menu.")
 
-    # --- Вызов регенерации ---
-    await trigger_regen_check(user_id, state)
-
-    # Получаем данные игрока ПОСЛЕ регена
-    player = await get_player(user_id)
+    player = await player_ctx.row()
 
     if not player:
         logging.warning(f"Non-player {user_id} tried to access quests.")
@@ -8,15 +8,14 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.text_decorations import html_decoration as hd
 
 from database.db_manager import (
-    get_player_effective_stats, update_player_xp, add_item_to_inventory,
-    check_and_apply_regen
+    get_player_effective_stats, update_player_xp, add_item_to_inventory
 )
+from middlewares.player_context import PlayerContext
 from game_data import (
     GAMBLER_BOX_COSTS, GAMBLER_REWARD_CHANCES, GAMBLER_ITEM_CHANCES,
     ALL_ITEMS, ITEM_TYPE_FRAGMENT, get_random_legendary_item_id
 )
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
 router = Router()
 
 # Клавиатура для Гемблера
@@ -35,13 +34,11 @@ def get_gambler_keyboard(player_gold: int) -> InlineKeyboardMarkup:
 
 # Обработчик для кнопки Гемблер
 @router.message(F.text.lower() == "🎲 гемблер")
-async def gambler_start(message: types.Message, state: FSMContext):
+async def gambler_start(message: types.Message, player_ctx: PlayerContext):
     user_id = message.from_user.id
     logging.info(f"User {user_id} approached the gambler.")
-    try: await check_and_apply_regen(user_id, await state.get_state())
-    except Exception as e: logging.error(f"Regen check error in gambler: {e}")
 
-    player = await get_player_effective_stats(user_id)
+    player = await player_ctx.stats()
     if not player:
         await message.answer("Сначала создайте персонажа: /start")
         return
@@ -56,7 +53,7 @@ async def gambler_start(message: types.Message, state: FSMContext):
 
 # Обработчик нажатий кнопок у Гемблера
 @router.callback_query(F.data.startswith("gamble:"))
-async def handle_gamble_action(callback: types.CallbackQuery, state: FSMContext):
+async def handle_gamble_action(callback: types.CallbackQuery, state: FSMContext, player_ctx: PlayerContext):
     user_id = callback.from_user.id
     data_parts = callback.data.split(":") # gamble:action/box_size:cost/box_size
 
@@ -83,7 +80,7 @@ async def handle_gamble_action(callback: types.CallbackQuery, state: FSMContext)
         return
 
     await callback.answer(f"Открываем {box_size} ящик...") # Временный ответ
-    player = await get_player_effective_stats(user_id)
+    player = await player_ctx.stats()
     if not player:
          await callback.answer("Ошибка получения данных игрока.", show_alert=True)
          return
@@ -11,7 +11,6 @@ from aiogram.utils.text_decorations import html_decoration as hd
 # --- ИСПРАВЛЕНИЕ: Добавляем delete_item_from_inventory в импорт ---
 from database.db_manager import (
     get_inventory_items, get_item_from_inventory, equip_item, unequip_item,
-    get_player_effective_stats, check_and_apply_regen,
     delete_item_from_inventory, # <--- ДОБАВЛЕНО ЗДЕСЬ
     update_player_xp # Нужен для начисления золота при продаже
 )
@@ -21,9 +20,9 @@ from game_data import (
     SLOT_HELMET, SLOT_CHEST, SLOT_GLOVES, SLOT_BOOTS, SLOT_AMULET, SLOT_BELT,
     ITEM_TYPE_FRAGMENT # Нужен для подсчета в кузнеце, но здесь тоже не помешает
 )
+from combat_session import combat_sessions
 
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
 router = Router()
 
 # --- Состояния для Экипировки ---
@@ -126,23 +125,12 @@ def get_slot_selection_keyboard(item_type: str, inventory_id: int) -> InlineKeyb
 
 # Обработчик для кнопки "Инвентарь"
 @router.message(F.text.lower() == "🎒 инвентарь")
-async def show_inventory(message: types.Message, state: FSMContext):
+async def show_inventory(message: types.Message):
     user_id = message.from_user.id
     logging.info(f"User {user_id} requested inventory.")
-    # --- Вызов проверки регенерации ---
-    try:
-        current_state_str = await state.get_state()
-        await check_and_apply_regen(user_id, current_state_str) # <-- Теперь функция должна быть найдена
-    except Exception as e:
-        logging.error(f"Error during regen check in show_inventory for user {user_id}: {e}", exc_info=False)
-
 
+    # Существование игрока уже проверил PlayerContextMiddleware
     inventory_items = await get_inventory_items(user_id)
-    player_exists = await get_player_effective_stats(user_id) # Проверяем существование игрока
-
-    if not player_exists:
-         await message.answer("Сначала создайте персонажа: /start")
-         return
 
     keyboard = get_inventory_keyboard(inventory_items)
     text = "🎒 <b>Ваш инвентарь:</b>\n\n"
@@ -215,6 +203,7 @@ async def handle_inventory_action(callback: types.CallbackQuery, state: FSMConte
         await callback.answer("Снимаем предмет...") # Временный ответ
         success, message_text = await unequip_item(user_id, inventory_id)
         if success:
+            await combat_sessions.refresh(user_id) # Снятый предмет перестает действовать и в идущем бою
             logging.info(f"Item inv_id:{inventory_id} unequipped by user {user_id}.")
             # Обновляем сообщение с инвентарем
             inventory_items = await get_inventory_items(user_id)
@@ -272,6 +261,7 @@ async def handle_inventory_action(callback: types.CallbackQuery, state: FSMConte
                 logging.info(f"Auto-equipping item inv_id:{inventory_id} to single slot '{target_slot}' for user {user_id}.")
                 success, message_text = await equip_item(user_id, inventory_id, target_slot)
                 if success:
+                    await combat_sessions.refresh(user_id)
                     logging.info(f"Item inv_id:{inventory_id} equipped by user {user_id} to slot '{target_slot}'.")
                     inventory_items = await get_inventory_items(user_id)
                     keyboard = get_inventory_keyboard(inventory_items)
@@ -413,6 +403,7 @@ async def handle_slot_selection(callback: types.CallbackQuery, state: FSMContext
 
     if success:
         logging.info(f"Item inv_id:{inventory_id} equipped successfully to slot '{target_slot}' by user {user_id}.")
+        await combat_sessions.refresh(user_id)
         # Обновляем клавиатуру инвентаря
         inventory_items = await get_inventory_items(user_id)
         keyboard = get_inventory_keyboard(inventory_items)
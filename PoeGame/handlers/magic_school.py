@@ -9,22 +9,14 @@ from aiogram.exceptions import TelegramBadRequest
 
 # Импортируем нужные функции и данные
 from database.db_manager import (
-    get_player_effective_stats, check_and_apply_regen,
     get_learned_spells, learn_spell
 )
-from game_data import SPELLS
+from middlewares.player_context import PlayerContext
+from combat_session import combat_sessions
+from game_data import SPELLS, get_spell_intelligence_requirement
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
 router = Router()
 
-# --- Вспомогательная функция для расчета требования интеллекта ---
-def get_spell_intelligence_requirement(level_req: int) -> int:
-    """Рассчитывает требование интеллекта на основе уровня заклинания."""
-    # Формула: 20 + (уровень_спелла - 1) * 5
-    # Например: Ур.1 -> 20, Ур.2 -> 25, Ур.3 -> 30, ...
-    if level_req <= 0: return 0 # На всякий случай
-    return 20 + (level_req - 1) * 5
-
 # --- Клавиатура для Школы Магов (Обновленная) ---
 def get_magic_school_keyboard(player_level: int, player_intelligence: int, learned_spell_ids: list[str]) -> InlineKeyboardMarkup:
     """
@@ -95,13 +87,11 @@ def get_magic_school_keyboard(player_level: int, player_intelligence: int, learn
 
 # Обработчик для кнопки "Школа магов"
 @router.message(F.text.lower() == "🔮 школа магов")
-async def magic_school_start(message: types.Message, state: FSMContext):
+async def magic_school_start(message: types.Message, player_ctx: PlayerContext):
     user_id = message.from_user.id
     logging.info(f"User {user_id} entered the Magic School.")
-    try: await check_and_apply_regen(user_id, await state.get_state())
-    except Exception as e: logging.error(f"Regen check error in magic school: {e}")
 
-    player = await get_player_effective_stats(user_id) # Нужен уровень и ИНТЕЛЛЕКТ
+    player = await player_ctx.stats() # Нужен уровень и ИНТЕЛЛЕКТ
     if not player:
         await message.answer("Сначала создайте персонажа: /start")
         return
@@ -138,7 +128,7 @@ async def magic_school_start(message: types.Message, state: FSMContext):
 
 # Обработчик нажатий кнопок в Школе Магов
 @router.callback_query(F.data.startswith("magic:"))
-async def handle_magic_school_action(callback: types.CallbackQuery, state: FSMContext):
+async def handle_magic_school_action(callback: types.CallbackQuery, state: FSMContext, player_ctx: PlayerContext):
     user_id = callback.from_user.id
     data_parts = callback.data.split(":") # magic:action:spell_id
 
@@ -184,7 +174,7 @@ async def handle_magic_school_action(callback: types.CallbackQuery, state: FSMCo
         await callback.answer(f"Изучаем '{spell_data['name']}'...")
 
         # Получаем АКТУАЛЬНЫЕ данные игрока перед изучением
-        player = await get_player_effective_stats(user_id)
+        player = await player_ctx.stats()
         level_req = spell_data.get('level_req', 999)
         int_req = get_spell_intelligence_requirement(level_req)
 
@@ -204,6 +194,7 @@ async def handle_magic_school_action(callback: types.CallbackQuery, state: FSMCo
 
         if learned_success:
              logging.info(f"User {user_id} successfully learned spell '{spell_id}'.")
+             await combat_sessions.refresh(user_id) # Новое заклинание - и в клавиатуре идущего боя
              await callback.answer(f"Заклинание '{spell_data['name']}' изучено!", show_alert=False)
              # Обновляем сообщение Школы Магов
              learned_spells_after = await get_learned_spells(user_id)
@@ -1,43 +1,40 @@
 # handlers/profile.py
+import asyncio
 import logging
 import math
 from aiogram import Router, F
 from aiogram.types import Message
-from aiogram.fsm.context import FSMContext
 from aiogram.utils.text_decorations import html_decoration as hd
 
-# --- ИСПРАВЛЕНИЕ: Импортируем get_player_effective_stats вместо/в дополнение get_player ---
-from database.db_manager import get_player_effective_stats, check_and_apply_regen
-# --- КОНЕЦ ИСПРАВЛЕНИЯ ---
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
+from database.db_manager import get_learned_spells
+from middlewares.player_context import PlayerContext
+from game_data import BOSSES
+from sim.boss_ladder import get_boss_readiness # Индикатор готовности (симуляция с кэшем по билду)
 
 router = Router()
 
-# Вспомогательная функция регена (может быть и в common.py)
-async def trigger_regen_check(user_id: int, state: FSMContext):
-     try:
-        current_state_str = await state.get_state()
-        await check_and_apply_regen(user_id, current_state_str)
-     except Exception as e:
-         logging.error(f"Error during regen check in profile for user {user_id}: {e}", exc_info=False)
+async def format_boss_readiness(player: dict) -> str:
+    """Строка с оценкой шанса победы над самым высоким открытым боссом."""
+    boss_index = min(player.get('highest_unlocked_boss_index', 0) or 0, len(BOSSES) - 1)
+    try:
+        learned_spells = await get_learned_spells(player['user_id'])
+        # Симуляция CPU-bound - уводим из event loop; повторные открытия профиля берутся из кэша
+        readiness = await asyncio.to_thread(get_boss_readiness, player, [s['id'] for s in learned_spells], boss_index)
+    except Exception as e:
+        logging.error(f"Boss readiness estimation failed for user {player.get('user_id')}: {e}")
+        return ""
+    return f"💀 Готовность к боссу {hd.quote(BOSSES[boss_index]['name'])}: ~{readiness['win_prob']:.0%} побед\n\n"
 
 # Обработчик для кнопки "Профиль"
 @router.message(F.text.lower() == "👤 профиль")
-async def handle_profile_button(message: Message, state: FSMContext):
+async def handle_profile_button(message: Message, player_ctx: PlayerContext):
     user_id = message.from_user.id
     logging.info(f"User {user_id} requested profile.")
 
-    # Проверяем реген
-    await trigger_regen_check(user_id, state)
-
-    # --- ИСПРАВЛЕНИЕ: Используем get_player_effective_stats ---
-    player = await get_player_effective_stats(user_id)
-    # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
+    player = await player_ctx.stats() # Эффективные статы, HP/мана с регеном
 
     if player:
-        logging.debug(f"Displaying profile for user {user_id}. Effective stats: {dict(player)}")
+        logging.debug("Displaying profile for user %s. Effective stats: %s", user_id, player)
         # Экранируем переменные данные
         username_escaped = hd.quote(player.get('username', f"User_{user_id}")) # Используем .get для безопасности
         class_escaped = hd.quote(player.get('class', 'Неизвестный'))
@@ -72,6 +69,8 @@ async def handle_profile_button(message: Message, state: FSMContext):
 
             f"💰 Золото: {player.get('gold', 0)}\n\n"
 
+            f"{await format_boss_readiness(player)}"
+
             f"📜 <b>Ежедневное задание:</b>\n"
         )
         if player.get('quest_monster_key'):
@@ -1,13 +1,11 @@
 # handlers/ranking.py
 import logging
 from aiogram import F, Router, types
-from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.text_decorations import html_decoration as hd
 
-from database.db_manager import get_top_players, check_and_apply_regen
+from database.db_manager import get_top_players
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
 router = Router()
 
 RANKING_LIMIT = 10 # Сколько игроков показывать в топе
@@ -24,16 +22,9 @@ def get_ranking_type_keyboard() -> InlineKeyboardMarkup:
 # Обработчик кнопки/команды Рейтинг
 @router.message(F.text.lower() == "🏆 рейтинг")
 # @router.message(Command("ranking")) # Можно добавить и команду
-async def show_ranking_options(message: types.Message, state: FSMContext):
+async def show_ranking_options(message: types.Message):
     user_id = message.from_user.id
     logging.info(f"User {user_id} requested ranking.")
-    # Проверяем реген
-    try:
-        current_state_str = await state.get_state()
-        await check_and_apply_regen(user_id, current_state_str)
-    except Exception as e:
-        logging.error(f"Error during regen check in ranking for user {user_id}: {e}", exc_info=False)
-
     await message.answer("Выберите тип рейтинга:", reply_markup=get_ranking_type_keyboard())
 
 # Обработчик выбора типа рейтинга
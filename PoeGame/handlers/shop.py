@@ -11,8 +11,9 @@ from aiogram.exceptions import TelegramBadRequest # Импортируем дл
 
 from database.db_manager import (
     get_shop_items, update_shop_items, get_player_effective_stats,
-    add_item_to_inventory, update_player_xp, check_and_apply_regen
+    add_item_to_inventory, update_player_xp
 )
+from middlewares.player_context import PlayerContext
 from game_data import (
     ALL_ITEMS, SHOP_REFRESH_INTERVAL, SHOP_WEAPON_ITEMS, SHOP_ARMOR_ITEMS,
     SHOP_LEGENDARY_CHANCE, ITEM_TYPE_WEAPON, ITEM_TYPE_HELMET, ITEM_TYPE_CHEST,
@@ -27,7 +28,6 @@ except ImportError:
     def format_item_stats(stats: dict) -> str: return "Ошибка: format_item_stats не найдена"
     logging.error("Could not import format_item_stats from handlers.inventory in shop.py")
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
 router = Router()
 
 # Словарь эмодзи для типов предметов
@@ -94,7 +94,10 @@ async def refresh_shop_if_needed(shop_type: str) -> list[str]:
         elif items_needed > 0:
              logging.warning(f"Not enough non-legendary items of types {allowed_types} to fill the shop '{shop_type}'.")
 
-        await update_shop_items(shop_type, new_item_ids)
+        if not await update_shop_items(shop_type, new_item_ids, expected_refresh_time=last_refresh):
+            # Другой процесс обновил магазин раньше - показываем его ассортимент
+            current_item_ids, _ = await get_shop_items(shop_type)
+            return current_item_ids
         return new_item_ids
     else:
         return current_item_ids
@@ -164,13 +167,11 @@ def format_shop_message_text(shop_title: str, item_ids: list[str], player_gold:
     return shop_text
 
 # --- Обработчики входа в магазин ---
-async def show_shop(message: types.Message, state: FSMContext, shop_type: str, shop_title: str):
+async def show_shop(message: types.Message, player_ctx: PlayerContext, shop_type: str, shop_title: str):
     user_id = message.from_user.id
     logging.info(f"User {user_id} entered {shop_type}.")
-    try: await check_and_apply_regen(user_id, await state.get_state())
-    except Exception as e: logging.error(f"Regen check error in {shop_type}: {e}")
 
-    player = await get_player_effective_stats(user_id)
+    player = await player_ctx.stats()
     if not player:
         await message.answer("Сначала создайте персонажа: /start")
         return
@@ -192,17 +193,17 @@ async def show_shop(message: types.Message, state: FSMContext, shop_type: str, s
 
 
 @router.message(F.text.lower() == "🛒 магазин оружия")
-async def weapon_shop_start(message: types.Message, state: FSMContext):
-    await show_shop(message, state, 'weapon_shop', '🛒 Магазин Оружия')
+async def weapon_shop_start(message: types.Message, player_ctx: PlayerContext):
+    await show_shop(message, player_ctx, 'weapon_shop', '🛒 Магазин Оружия')
 
 @router.message(F.text.lower() == "🛡️ магазин брони")
-async def armor_shop_start(message: types.Message, state: FSMContext):
-    await show_shop(message, state, 'armor_shop', '🛡️ Магазин Брони')
+async def armor_shop_start(message: types.Message, player_ctx: PlayerContext):
+    await show_shop(message, player_ctx, 'armor_shop', '🛡️ Магазин Брони')
 
 
 # --- Обработчик нажатий на кнопки магазина ---
 @router.callback_query(F.data.startswith("shop:"))
-async def handle_shop_action(callback: types.CallbackQuery, state: FSMContext):
+async def handle_shop_action(callback: types.CallbackQuery, state: FSMContext, player_ctx: PlayerContext):
     user_id = callback.from_user.id
     data_parts = callback.data.split(":") # shop:shop_type:action:item_id[:price]
 
@@ -256,7 +257,7 @@ async def handle_shop_action(callback: types.CallbackQuery, state: FSMContext):
 
     # --- Кнопка Назад к магазину ---
     if action == "back":
-        player = await get_player_effective_stats(user_id)
+        player = await player_ctx.stats()
         if not player: return
         item_ids = await get_shop_items(shop_type)
         keyboard = get_shop_action_keyboard(shop_type, item_ids, player['gold'])
@@ -309,7 +310,7 @@ async def handle_shop_action(callback: types.CallbackQuery, state: FSMContext):
         if not item_data: return # Проверка
         await callback.answer("Покупаем...")
         logging.info(f"Attempting purchase: User {user_id}, Item {item_id}, Price {price}, Shop {shop_type}")
-        player = await get_player_effective_stats(user_id)
+        player = await player_ctx.stats()
         # --- ИСПРАВЛЕНО: Заменяем псевдокод на return ---
         if not player:
              await callback.answer("Ошибка получения данных игрока.", show_alert=True)
@@ -8,10 +8,9 @@ from aiogram.utils.text_decorations import html_decoration as hd
 from aiogram.exceptions import TelegramBadRequest # Для обработки ошибок API
 
 # Импортируем нужные функции из базы данных
-from database.db_manager import get_player, update_stat_points, increase_attribute, check_and_apply_regen
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s")
+from database.db_manager import get_player, update_stat_points, increase_attribute
+from middlewares.player_context import PlayerContext
+from combat_session import combat_sessions
 
 router = Router()
 
@@ -26,16 +25,6 @@ ATTRIBUTE_NAMES = {
     'intelligence': '🧠 Интеллект'
 }
 
-# --- Вспомогательная функция для вызова регенерации ---
-# (Дублируется из common.py, можно вынести в utils)
-async def trigger_regen_check(user_id: int, state: FSMContext):
-     try:
-        current_state_str = await state.get_state()
-        await check_and_apply_regen(user_id, current_state_str)
-     except Exception as e:
-         logging.error(f"Error during regen check in stats handler for user {user_id}: {e}", exc_info=False)
-
-
 # --- Клавиатура для распределения очков ---
 def get_stat_allocation_keyboard(player_stats: types.User) -> InlineKeyboardMarkup: # player_stats - это sqlite3.Row
     """
@@ -100,16 +89,14 @@ def get_stat_allocation_keyboard(player_stats: types.User) -> InlineKeyboardMark
 
 # Обработчик для кнопки "Прокачка" из главного меню
 @router.message(F.text.lower() == "💪 прокачка")
-async def stats_allocation_start(message: types.Message, state: FSMContext):
+async def stats_allocation_start(message: types.Message, state: FSMContext, player_ctx: PlayerContext):
     """
     Начинает процесс распределения очков характеристик.
     Вызывается при нажатии кнопки 'Прокачка'.
     """
     user_id = message.from_user.id
     logging.info(f"User {user_id} initiated stat allocation via button.")
-    # Проверяем реген перед показом
-    await trigger_regen_check(user_id, state)
-    player = await get_player(user_id) # Используем get_player, т.к. нужны базовые статы и очки
+    player = await player_ctx.row() # Базовые статы и очки (строка уже загружена middleware)
 
     if not player:
         logging.warning(f"Non-player {user_id} tried to access stat allocation.")
@@ -158,7 +145,7 @@ async def stats_allocation_start(message: types.Message, state: FSMContext):
 
 # Обработчик нажатий кнопок в меню распределения очков
 @router.callback_query(StatAllocationStates.choosing_attribute, F.data.startswith("allocate:"))
-async def process_stat_allocation(callback: types.CallbackQuery, state: FSMContext):
+async def process_stat_allocation(callback: types.CallbackQuery, state: FSMContext, player_ctx: PlayerContext):
     """
     Обрабатывает нажатие кнопки с выбором атрибута или кнопки 'Завершить'.
     Работает только когда пользователь в состоянии choosing_attribute.
@@ -201,7 +188,7 @@ async def process_stat_allocation(callback: types.CallbackQuery, state: FSMConte
          return
 
     # Логика траты очка и увеличения стата
-    player_before = await get_player(user_id) # Снова получаем базовые данные
+    player_before = await player_ctx.row() # Базовые данные (строка уже загружена middleware)
     if not player_before:
         logging.error(f"Could not retrieve player data for {user_id} during stat allocation processing.")
         try: await callback.message.edit_text("Ошибка: Не удалось получить данные вашего персонажа.", reply_markup=None)
@@ -232,6 +219,7 @@ async def process_stat_allocation(callback: types.CallbackQuery, state: FSMConte
         return
 
     # Успешное распределение очка
+    await combat_sessions.refresh(user_id)
     player_after = await get_player(user_id) # Получаем обновленные базовые данные
     if not player_after:
          logging.error(f"Could not retrieve updated player data for {user_id} after successful stat allocation.")
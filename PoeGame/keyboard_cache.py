@@ -0,0 +1,64 @@
+# keyboard_cache.py
+"""
+LRU-кэш готовых inline-клавиатур боя.
+Клавиатура действий зависит только от набора изученных спеллов, множителя стоимости маны,
+того, какие спеллы сейчас по карману, и ключа противника. Все это и есть ключ кэша,
+поэтому ход, где ничего из этого не поменялось, отдает уже собранный InlineKeyboardMarkup.
+Закэшированные клавиатуры общие для всех игроков - их нельзя менять на месте.
+"""
+import math
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from aiogram.types import InlineKeyboardMarkup
+
+KEYBOARD_CACHE_SIZE = 4096
+
+
+def spell_rows_key(learned_spells: list[dict], mana_multiplier: float, player_mana: int) -> tuple:
+    """
+    Часть ключа, зависящая от спеллов: ((id, стоимость, по карману), ...).
+    Спелл с битой стоимостью маны получает стоимость None (хендлер его пропускает).
+    """
+    rows = []
+    for spell_data in learned_spells:
+        try:
+            cost = math.ceil(int(spell_data['mana_cost']) * mana_multiplier)
+        except (ValueError, TypeError, KeyError):
+            rows.append((spell_data['id'], None, False))
+            continue
+        rows.append((spell_data['id'], cost, player_mana >= cost))
+    return tuple(rows)
+
+
+class KeyboardCache:
+    """LRU ключ -> InlineKeyboardMarkup. Вызывается только из event loop, блокировка не нужна."""
+    def __init__(self, max_size: int = KEYBOARD_CACHE_SIZE):
+        self.max_size = max_size
+        self._keyboards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._keyboards)
+
+    def get_or_build(self, key: Hashable, build: Callable[[], InlineKeyboardMarkup]) -> InlineKeyboardMarkup:
+        keyboard = self._keyboards.get(key)
+        if keyboard is not None:
+            self._keyboards.move_to_end(key)
+            self.hits += 1
+            return keyboard
+        self.misses += 1
+        keyboard = build()
+        self._keyboards[key] = keyboard
+        while len(self._keyboards) > self.max_size:
+            self._keyboards.popitem(last=False)
+        return keyboard
+
+    def clear(self):
+        self._keyboards.clear()
+        self.hits = self.misses = 0
+
+
+# Общий кэш клавиатур боя с монстрами и боссами (ключи различаются префиксом)
+combat_keyboards = KeyboardCache()
@@ -0,0 +1,115 @@
+# log_setup.py
+"""
+Единая настройка логов (вызывается точкой входа: bot.py, sim, tools), модули только пишут в logging.
+Бот: на корневом логгере QueueHandler, вывод - QueueListener в отдельном потоке. На цикле событий
+остается создание записи и подстановка %-аргументов (значения - на момент вызова); время, шаблон
+и запись в поток/файл - в потоке слушателя.
+Сэмплинг - только для логгера горячих мест hot_log ("poegame.hot": строки на каждый ход/бой): с одним
+ключом сообщения (шаблон %-строки) проходит не больше SAMPLE_BURST записей уровня INFO и ниже за
+SAMPLE_WINDOW сек, остальные отбрасываются до форматирования; первая запись следующего окна сообщает,
+сколько было пропущено. WARNING и выше проходят всегда. Остальные логгеры (экономика, аудит) не сэмплируются.
+Горячие места пишут %-стилем (logging.debug("HP=%s", hp)) - при выключенном уровне ничего не форматируется;
+дорогие аргументы - под logging.getLogger().isEnabledFor(...).
+"""
+import sys
+import time
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - [%(filename)s:%(lineno)d] - %(message)s"
+SAMPLE_WINDOW = 10.0 # Сек
+SAMPLE_BURST = 20 # Записей с одним ключом за окно
+HOT_LOGGER = "poegame.hot"
+
+hot_log = logging.getLogger(HOT_LOGGER) # Горячие места: logging.info(...) -> hot_log.info(...)
+
+_listener: QueueListener | None = None
+sampling: "SamplingFilter | None" = None # Фильтр текущей настройки (счетчик suppressed - в метрики)
+
+
+class SamplingFilter(logging.Filter):
+    """Ограничивает частоту записей (уровень <= max_level) с одним ключом сообщения (шаблоном)."""
+
+    def __init__(self, window: float = SAMPLE_WINDOW, burst: int = SAMPLE_BURST, max_level: int = logging.INFO):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.max_level = max_level
+        self._keys: dict[str, list] = {} # Шаблон -> [начало окна, прошло, пропущено]
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level:
+            return True
+        key = str(record.msg)
+        now = time.monotonic()
+        entry = self._keys.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            if entry is not None and entry[2]:
+                record.msg = f"{record.msg} [+{entry[2]} similar suppressed]"
+            self._keys[key] = [now, 1, 0]
+            return True
+        if entry[1] < self.burst:
+            entry[1] += 1
+            return True
+        entry[2] += 1
+        self.suppressed += 1
+        return False
+
+
+class _LazyQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Только подстановка аргументов: изменяемые объекты могут поменяться до потока слушателя.
+        # Formatter (время, шаблон, traceback) - уже там
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level: int | str = logging.INFO, filename: str | None = None, queued: bool = True) -> SamplingFilter:
+    """
+    Настраивает корневой логгер и сэмплинг hot_log (повторный вызов заменяет прежнюю настройку).
+    queued=False - вывод прямо в вызывающем потоке (CLI-утилиты, форк процессов пула).
+    """
+    global _listener, sampling
+    if sampling is not None:
+        hot_log.removeFilter(sampling)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(level)
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    outputs: list[logging.Handler] = [logging.StreamHandler(sys.stderr)]
+    if filename:
+        outputs.append(logging.FileHandler(filename, encoding="utf-8"))
+    for output in outputs:
+        output.setFormatter(formatter)
+
+    sampling = SamplingFilter()
+    hot_log.addFilter(sampling) # Фильтр логгера: записи остальных логгеров его не проходят
+    if queued:
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        root.addHandler(_LazyQueueHandler(log_queue))
+        _listener = QueueListener(log_queue, *outputs)
+        _listener.start()
+    else:
+        for output in outputs:
+            root.addHandler(output)
+    return sampling
+
+def stop_logging():
+    """Дописать очередь и остановить поток слушателя (при выходе вызывается сама)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
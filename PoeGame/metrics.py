@@ -0,0 +1,340 @@
+# metrics.py
+"""
+Метрики процесса в текстовом формате Prometheus на локальном HTTP: GET /metrics (config.METRICS_PORT).
+Без prometheus_client: счетчики, gauge и гистограммы - объекты со __slots__. Метки связываются
+заранее (family.labels(...) -> дочерний объект, его и держит код), на горячем пути - только
+inc()/observe() (~0.1-0.3 мкс): без словаря меток и без блокировок - почти все вызовы из event loop,
+счетчики запросов БД из потоков aiosqlite - под GIL, как счетчики stats() в остальных модулях.
+Готовые stats() модулей (замки игроков, исходящие, FSM, нажатия, сэмплинг логов) читаются только
+при сборе (register_stats/register_collector) - на обработку апдейтов это не влияет.
+"""
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Iterable
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Границы гистограмм, сек: от запроса SQLite (~0.5 мс) до апдейта, ждущего лимитов Telegram
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 0.5 # Сек между замерами задержки event loop
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+# --- Дочерние объекты (одна комбинация меток) ---
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # По корзинам (не накопительно), последняя - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1 # Граница le включительна
+        self.sum += value
+        self.count += 1
+
+
+class _Tracked:
+    """Значение читается при сборе (готовый счетчик модуля, например KeyboardCache.hits)."""
+    __slots__ = ('fn',)
+
+    def __init__(self, fn: Callable[[], float]):
+        self.fn = fn
+
+    @property
+    def value(self) -> float:
+        return self.fn()
+
+
+# --- Семейства и реестр ---
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Family:
+    def __init__(self, kind: str, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self._children: dict[tuple, Any] = {}
+
+    def labels(self, *values) -> Any:
+        """Дочерний объект для значений меток; вызывать один раз и хранить (не на каждом событии)."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if self.kind == "histogram":
+                child = Histogram(self.buckets)
+            elif self.kind == "counter":
+                child = Counter()
+            else:
+                child = Gauge()
+            self._children[key] = child
+        return child
+
+    def track(self, fn: Callable[[], float], *values):
+        """Значение для этих меток берется из fn() при сборе."""
+        self._children[tuple(str(v) for v in values)] = _Tracked(fn)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, values)} {child.sum!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, values)} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._families: dict[str, Family] = {}
+        self._collectors: list[Callable[[], Iterable[Family]]] = []
+
+    def _family(self, kind: str, name: str, documentation: str, labelnames: tuple[str, ...], **kwargs) -> Family:
+        if name in self._families:
+            raise ValueError(f"Metric {name} is already registered.")
+        family = self._families[name] = Family(kind, name, documentation, labelnames, **kwargs)
+        return family
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Family:
+        return self._family("counter", name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Family:
+        return self._family("gauge", name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Family:
+        return self._family("histogram", name, documentation, labelnames, buckets=buckets)
+
+    def register_collector(self, collect: Callable[[], Iterable[Family]]):
+        """collect() при каждом сборе отдает готовые семейства (набор меток заранее неизвестен)."""
+        self._collectors.append(collect)
+
+    def register_stats(self, prefix: str, stats: Callable[[], dict], counters: Iterable[str] = ()):
+        """
+        Числовые поля stats() модуля -> {prefix}_{поле}; поля из counters - счетчики ({prefix}_{поле}_total),
+        остальные - gauge.
+        """
+        counters = set(counters)
+
+        def collect():
+            for key, value in stats().items():
+                if not isinstance(value, (int, float)):
+                    continue
+                kind = "counter" if key in counters else "gauge"
+                family = Family(kind, f"{prefix}_{key}_total" if key in counters else f"{prefix}_{key}", f"{prefix} stats: {key}")
+                family.track(lambda value=value: value)
+                yield family
+
+        self.register_collector(collect)
+
+    def render(self) -> str:
+        lines = []
+        for family in list(self._families.values()):
+            lines += family.render()
+        for collect in self._collectors:
+            try:
+                for family in collect():
+                    lines += family.render()
+            except Exception as e: # Сломанный сборщик не должен ронять весь /metrics
+                logging.error(f"Metrics collector {collect!r} failed: {e}", exc_info=True)
+        return "\n".join(lines) + "\n"
+
+
+# --- Метрики бота ---
+registry = Registry()
+
+HANDLER_DURATION = registry.histogram(
+    "bot_handler_duration_seconds", "Handler run time (after middleware and filters).", ("router", "handler"))
+HANDLER_ERRORS = registry.counter("bot_handler_errors_total", "Handler exceptions.", ("router", "handler"))
+DB_CALL_DURATION = registry.histogram(
+    "bot_db_call_duration_seconds", "db_manager function run time (with nested calls).", ("function",))
+DB_CALL_ERRORS = registry.counter("bot_db_call_errors_total", "db_manager function exceptions.", ("function",))
+DB_QUERIES = registry.counter("bot_db_queries_total", "SQLite statements by db_manager function.", ("function",))
+DB_CONNECTIONS = registry.counter("bot_db_connections_total", "SQLite connections opened by db_manager function.", ("function",))
+DB_ROWS = registry.counter("bot_db_rows_total", "Rows fetched by db_manager function.", ("function",))
+TELEGRAM_DURATION = registry.histogram(
+    "bot_telegram_request_duration_seconds", "Bot API request time (without outbound queue wait).", ("method",))
+TELEGRAM_ERRORS = registry.counter("bot_telegram_errors_total", "Bot API request errors.", ("method", "error"))
+CACHE_REQUESTS = registry.counter("bot_cache_requests_total", "In-memory cache lookups.", ("cache", "result"))
+LOOP_LAG = registry.histogram("bot_event_loop_lag_seconds", "Event loop scheduling delay.", buckets=LOOP_LAG_BUCKETS)
+LOOP_LAG_LAST = registry.gauge("bot_event_loop_lag_last_seconds", "Last measured event loop delay.")
+
+
+def track_cache(name: str, hits: Callable[[], int], misses: Callable[[], int]):
+    """Кэш со своими счетчиками попаданий -> bot_cache_requests_total{cache=name}."""
+    CACHE_REQUESTS.track(hits, name, "hit")
+    CACHE_REQUESTS.track(misses, name, "miss")
+
+
+# --- Хендлеры ---
+class HandlerMetricsMiddleware:
+    """
+    Inner-middleware на dp.message/dp.callback_query: время и ошибки хендлера. Роутер - модуль хендлера
+    (один роутер на файл handlers/), дочерние метрики связываются при первом вызове хендлера.
+    """
+
+    def __init__(self):
+        self._bound: dict[Callable, tuple[Histogram, Counter]] = {}
+
+    def _bind(self, callback: Callable) -> tuple[Histogram, Counter]:
+        router = callback.__module__.rsplit(".", 1)[-1]
+        bound = self._bound[callback] = (HANDLER_DURATION.labels(router, callback.__name__),
+                                         HANDLER_ERRORS.labels(router, callback.__name__))
+        return bound
+
+    async def __call__(self, handler: Callable[[Any, dict[str, Any]], Awaitable[Any]], event: Any, data: dict[str, Any]) -> Any:
+        callback = data['handler'].callback
+        duration, errors = self._bound.get(callback) or self._bind(callback)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            duration.observe(time.perf_counter() - started)
+
+
+# --- Bot API ---
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """
+    Request-middleware сессии бота, после outbound: время каждой попытки запроса (без ожидания
+    в очереди лимитов) и ошибки по методу и классу исключения (429 - TelegramRetryAfter).
+    """
+
+    def __init__(self):
+        self._bound: dict[type, Histogram] = {}
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot, method: TelegramMethod):
+        duration = self._bound.get(type(method))
+        if duration is None:
+            duration = self._bound[type(method)] = TELEGRAM_DURATION.labels(method.__api_method__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.labels(method.__api_method__, type(e).__name__).inc() # Редко - без связывания заранее
+            raise
+        finally:
+            duration.observe(time.perf_counter() - started)
+
+
+handler_metrics = HandlerMetricsMiddleware()
+telegram_metrics = TelegramMetricsMiddleware()
+
+
+# --- Event loop ---
+async def run_loop_lag_monitor(interval: float = LOOP_LAG_INTERVAL):
+    """Насколько позже заказанного просыпается sleep: долгие синхронные участки в хендлерах и middleware."""
+    loop = asyncio.get_running_loop()
+    lag = LOOP_LAG.labels()
+    last = LOOP_LAG_LAST.labels()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        delay = max(0.0, loop.time() - started - interval)
+        lag.observe(delay)
+        last.set(delay)
+
+
+# --- Готовые счетчики модулей ---
+def register_module_stats(storage):
+    """stats() модулей бота и FSM-хранилища storage -> /metrics (читаются только при сборе)."""
+    import log_setup
+    from outbound import outbound
+    from combat_session import combat_sessions
+    from keyboard_cache import combat_keyboards
+    from middlewares.user_lock import user_locks
+    from middlewares.callback_guard import callback_guard
+    from shutdown import in_flight
+    from middlewares.query_budget import query_budget
+
+    registry.register_stats("bot_user_locks", user_locks.table.stats, counters=("acquired", "contended"))
+    registry.register_stats("bot_outbound", outbound.stats, counters=("sent", "coalesced", "retried"))
+    registry.register_stats("bot_fsm", storage.stats, counters=("accepted_writes", "flushed_writes"))
+    registry.register_stats("bot_callback_guard", callback_guard.stats,
+                            counters=("passed", "dropped", "dropped_duplicate", "dropped_overflow", "dropped_stale"))
+    registry.register_stats("bot_updates", lambda: {'in_flight': len(in_flight), 'handled': in_flight.handled,
+                                                     'cancelled': in_flight.cancelled}, counters=("handled", "cancelled"))
+    registry.register_stats("bot_db_budget", query_budget.stats, counters=("updates", "over_budget"))
+    registry.register_stats("bot_combat_sessions", lambda: {'active': len(combat_sessions)})
+    registry.register_stats("bot_log", lambda: {'suppressed': log_setup.sampling.suppressed if log_setup.sampling else 0},
+                            counters=("suppressed",))
+    track_cache("combat_keyboards", lambda: combat_keyboards.hits, lambda: combat_keyboards.misses)
+    track_cache("fsm", lambda: storage.cache_hits, lambda: storage.cache_misses)
+
+    def fsm_states():
+        family = Family("gauge", "bot_fsm_states", "FSM records in memory by state.", ("state",))
+        for state, count in storage.state_counts().items():
+            family.track(lambda count=count: count, state or "none")
+        yield family
+
+    registry.register_collector(fsm_states)
+
+
+# --- HTTP ---
+async def start_metrics_server(host: str, port: int):
+    """GET /metrics на host:port (по умолчанию только localhost: метки содержат имена хендлеров). Возвращает runner."""
+    from aiohttp import web # aiohttp.web тянется только при включенных метриках
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    logging.info(f"Metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,2 @@
+# middlewares/__init__.py
+"""Outer-middleware диспетчера: общая подготовка апдейта до хендлеров."""
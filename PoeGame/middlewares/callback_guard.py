@@ -0,0 +1,94 @@
+# middlewares/callback_guard.py
+"""
+Защита от спама кнопками ("🗡️ Атаковать", ящики гемблера).
+Outer-middleware на dp.update, до замка пользователя (user_lock.py): иначе каждое лишнее нажатие
+ждет замка и потом проходит весь хендлер.
+- Дубль: то же callback_data на том же сообщении, пока предыдущее нажатие еще обрабатывается
+  (или ждет очереди) - склеивается с ним: хендлер не вызывается, крутилка на кнопке гасится пустым ответом.
+- Очередь чата ограничена: больше CHAT_QUEUE_LIMIT нажатий в работе на чат - новые отбрасываются с подсказкой.
+- Устаревшее сообщение (Telegram отдает его как InaccessibleMessage) - ответ без хендлера.
+Ответ на отброшенное нажатие - только answerCallbackQuery, без запросов к БД.
+Записи удаляются, как только нажатий в работе нет: память - по числу активных чатов.
+"""
+import logging
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, CallbackQuery, InaccessibleMessage
+
+CHAT_QUEUE_LIMIT = 3 # Нажатий в работе на чат (одно обрабатывается, остальные ждут замка)
+BUSY_TEXT = "⏳ Подождите, предыдущее действие еще выполняется."
+STALE_TEXT = "Это сообщение устарело."
+
+
+def _press_key(callback: CallbackQuery) -> tuple[object, tuple]:
+    """(чат, (сообщение, callback_data)) нажатия."""
+    message = callback.message
+    if message is not None:
+        return message.chat.id, (message.message_id, callback.data)
+    return callback.from_user.id, (callback.inline_message_id, callback.data) # Кнопка inline-режима
+
+
+class CallbackGuardMiddleware(BaseMiddleware):
+    def __init__(self, chat_limit: int = CHAT_QUEUE_LIMIT):
+        self.chat_limit = chat_limit
+        self._chats: dict[object, set[tuple]] = {} # чат -> нажатия в работе (сообщение, data)
+        # Метрики
+        self.passed = 0
+        self.dropped_duplicate = 0
+        self.dropped_overflow = 0
+        self.dropped_stale = 0
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        callback = event.callback_query if isinstance(event, Update) else None
+        if callback is None:
+            return await handler(event, data)
+
+        if isinstance(callback.message, InaccessibleMessage):
+            self.dropped_stale += 1
+            return await self._answer(callback, STALE_TEXT)
+
+        chat_id, press = _press_key(callback)
+        presses = self._chats.get(chat_id)
+        if presses is not None:
+            if press in presses:
+                self.dropped_duplicate += 1
+                logging.debug("Duplicate press %r in chat %s merged into the running one.", callback.data, chat_id)
+                return await self._answer(callback)
+            if len(presses) >= self.chat_limit:
+                self.dropped_overflow += 1
+                logging.debug("Chat %s has %d presses in progress, dropping %r.", chat_id, self.chat_limit, callback.data)
+                return await self._answer(callback, BUSY_TEXT)
+        else:
+            presses = self._chats[chat_id] = set()
+
+        presses.add(press)
+        self.passed += 1
+        try:
+            return await handler(event, data)
+        finally:
+            presses.discard(press)
+            if not presses:
+                self._chats.pop(chat_id, None)
+
+    @staticmethod
+    async def _answer(callback: CallbackQuery, text: str | None = None):
+        try:
+            await callback.answer(text)
+        except Exception as e: # Ответ уже не нужен (query is too old) - нажатие все равно отброшено
+            logging.debug("Failed to answer dropped callback %s: %s", callback.id, e)
+
+    @property
+    def dropped(self) -> int:
+        return self.dropped_duplicate + self.dropped_overflow + self.dropped_stale
+
+    def stats(self) -> dict:
+        return {
+            'chats': len(self._chats), 'passed': self.passed, 'dropped': self.dropped,
+            'dropped_duplicate': self.dropped_duplicate, 'dropped_overflow': self.dropped_overflow,
+            'dropped_stale': self.dropped_stale,
+        }
+
+
+callback_guard = CallbackGuardMiddleware()
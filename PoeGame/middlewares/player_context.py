@@ -0,0 +1,124 @@
+# middlewares/player_context.py
+"""
+Контекст игрока на один апдейт.
+Outer-middleware проверяет, что игрок зарегистрирован, и кладет в kwargs хендлера
+player_ctx: PlayerContext. Строка игрока и эффективные статы грузятся из БД по требованию
+и не больше одного раза за апдейт. Реген отдельно применять не нужно - он ленивый
+и уже учтен в PlayerContext.stats() (get_player_effective_stats).
+Известные игроки и незарегистрированные пользователи кэшируются в памяти,
+поэтому проверка существования обычно не делает запросов.
+"""
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Message, CallbackQuery
+
+from database.db_manager import get_player, get_player_effective_stats
+
+KNOWN_PLAYERS_CACHE_SIZE = 100_000 # Игроки не удаляются, поэтому "существует" можно помнить долго
+UNREGISTERED_CACHE_SIZE = 10_000
+UNREGISTERED_TTL = 60 # Сек; /start сбрасывает запись сразу
+OPEN_COMMANDS = ("/start", "/help") # Доступны без персонажа
+NOT_REGISTERED_TEXT = "Сначала создайте персонажа: /start"
+
+
+class PlayerContext:
+    """Ленивые данные игрока в пределах одного апдейта."""
+    __slots__ = ('user_id', '_row', '_stats')
+
+    def __init__(self, user_id: int, row=None):
+        self.user_id = user_id
+        self._row = row
+        self._stats = None
+
+    async def row(self):
+        """RAW строка players (как get_player)."""
+        if self._row is None:
+            self._row = await get_player(self.user_id)
+        return self._row
+
+    async def stats(self) -> dict | None:
+        """Эффективные статы с регеном на текущий момент (как get_player_effective_stats)."""
+        if self._stats is None:
+            self._stats = await get_player_effective_stats(self.user_id)
+        return self._stats
+
+    def invalidate(self):
+        """Сбросить загруженное - после записи в БД внутри хендлера."""
+        self._row = None
+        self._stats = None
+
+
+class PlayerContextMiddleware(BaseMiddleware):
+    """Проверка регистрации + player_ctx в kwargs. Вешается outer-middleware на message и callback_query."""
+
+    def __init__(self):
+        self.known = OrderedDict() # user_id -> None (LRU)
+        self.unregistered = OrderedDict() # user_id -> истекает (monotonic)
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        user_id = user.id
+
+        if _is_open_command(event):
+            # /start может создать игрока - после него негативная запись неактуальна
+            data['player_ctx'] = PlayerContext(user_id)
+            try:
+                return await handler(event, data)
+            finally:
+                self.unregistered.pop(user_id, None)
+
+        ctx = await self._resolve(user_id)
+        if ctx is None:
+            logging.debug("Update from unregistered user %s short-circuited.", user_id)
+            await _answer_not_registered(event)
+            return None
+        data['player_ctx'] = ctx
+        return await handler(event, data)
+
+    async def _resolve(self, user_id: int) -> PlayerContext | None:
+        """PlayerContext для зарегистрированного игрока, иначе None (с кэшем в обе стороны)."""
+        if user_id in self.known:
+            self.known.move_to_end(user_id)
+            return PlayerContext(user_id)
+        expires = self.unregistered.get(user_id)
+        if expires is not None:
+            if expires > time.monotonic():
+                return None
+            del self.unregistered[user_id]
+
+        row = await get_player(user_id)
+        if row is None:
+            self.unregistered[user_id] = time.monotonic() + UNREGISTERED_TTL
+            if len(self.unregistered) > UNREGISTERED_CACHE_SIZE:
+                self.unregistered.popitem(last=False)
+            return None
+        self.known[user_id] = None
+        if len(self.known) > KNOWN_PLAYERS_CACHE_SIZE:
+            self.known.popitem(last=False)
+        return PlayerContext(user_id, row) # Строка уже загружена - хендлеру второй запрос не нужен
+
+
+def _is_open_command(event: TelegramObject) -> bool:
+    if not isinstance(event, Message) or not event.text:
+        return False
+    command = event.text.split(maxsplit=1)[0].split('@', 1)[0].lower()
+    return command in OPEN_COMMANDS
+
+async def _answer_not_registered(event: TelegramObject):
+    try:
+        if isinstance(event, CallbackQuery):
+            await event.answer(NOT_REGISTERED_TEXT, show_alert=True)
+        elif isinstance(event, Message):
+            await event.answer(NOT_REGISTERED_TEXT)
+    except Exception as e:
+        logging.warning(f"Failed to answer unregistered user: {e}")
+
+
+player_context = PlayerContextMiddleware()
@@ -0,0 +1,117 @@
+# middlewares/query_budget.py
+"""
+Бюджет работы с БД на апдейт: сколько операторов SQLite, соединений и строк стоил апдейт
+(database/query_stats.py) и какой хендлер его обработал. Ищет N+1: продажа предмета из инвентаря -
+get_item_from_inventory, get_inventory_items, delete_item_from_inventory, update_player_xp и снова
+get_inventory_items, каждая функция - свое соединение.
+- Outer-middleware на dp.update (после замка игрока, до player_context - его запросы тоже в счет апдейта).
+- probe - inner-middleware на dp.message/dp.callback_query: записывает хендлер в счетчики апдейта.
+Превышение бюджета (config.DB_*_BUDGET) - WARNING с цепочкой вызовов, не чаще LOG_INTERVAL на хендлер.
+Итоги по хендлерам - report(): "самые дорогие хендлеры" для отчета нагрузочного теста (tools/load_gen.py).
+"""
+import time
+import logging
+from typing import Any, Awaitable, Callable
+
+from config import DB_QUERY_BUDGET, DB_CONNECTION_BUDGET, DB_ROW_BUDGET
+from database.query_stats import UpdateQueries, current_update, update_scope
+
+LOG_INTERVAL = 60.0 # Сек между предупреждениями об одном хендлере
+UNHANDLED = "(unhandled)" # Апдейт не дошел до хендлера (фильтры, отказ player_context)
+
+
+def call_chain(calls: list[str]) -> str:
+    """Вызовы db_manager по порядку; подряд идущие одинаковые - "имя xN"."""
+    chain = []
+    for name in calls:
+        if chain and chain[-1][0] == name:
+            chain[-1][1] += 1
+        else:
+            chain.append([name, 1])
+    return ", ".join(name if count == 1 else f"{name} x{count}" for name, count in chain)
+
+
+class _HandlerTotals:
+    __slots__ = ('updates', 'queries', 'connections', 'rows', 'max_queries', 'over_budget', 'worst_calls')
+
+    def __init__(self):
+        self.updates = 0
+        self.queries = 0
+        self.connections = 0
+        self.rows = 0
+        self.max_queries = 0
+        self.over_budget = 0
+        self.worst_calls: list[str] = [] # Цепочка самого дорогого апдейта
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, queries: int = DB_QUERY_BUDGET, connections: int = DB_CONNECTION_BUDGET, rows: int = DB_ROW_BUDGET):
+        self.queries = queries
+        self.connections = connections
+        self.rows = rows
+        self.handlers: dict[str, _HandlerTotals] = {}
+        self._logged_at: dict[str, float] = {}
+        # Метрики
+        self.updates = 0
+        self.over_budget = 0
+
+    async def __call__(self, handler: Callable[[Any, dict[str, Any]], Awaitable[Any]], event: Any, data: dict[str, Any]) -> Any:
+        with update_scope() as scope:
+            try:
+                return await handler(event, data)
+            finally:
+                self._finish(scope)
+
+    async def probe(self, handler: Callable[[Any, dict[str, Any]], Awaitable[Any]], event: Any, data: dict[str, Any]) -> Any:
+        scope = current_update()
+        if scope is not None:
+            callback = data['handler'].callback
+            scope.handler = f"{callback.__module__.rsplit('.', 1)[-1]}.{callback.__name__}"
+        return await handler(event, data)
+
+    def exceeded(self, scope: UpdateQueries) -> bool:
+        return ((self.queries and scope.queries > self.queries) or (self.connections and scope.connections > self.connections)
+                or (self.rows and scope.rows > self.rows))
+
+    def _finish(self, scope: UpdateQueries):
+        name = scope.handler or UNHANDLED
+        totals = self.handlers.get(name)
+        if totals is None:
+            totals = self.handlers[name] = _HandlerTotals()
+        totals.updates += 1
+        totals.queries += scope.queries
+        totals.connections += scope.connections
+        totals.rows += scope.rows
+        if scope.queries > totals.max_queries:
+            totals.max_queries = scope.queries
+            totals.worst_calls = scope.calls
+        self.updates += 1
+        if not self.exceeded(scope):
+            return
+        totals.over_budget += 1
+        self.over_budget += 1
+        now = time.monotonic()
+        if now - self._logged_at.get(name, -LOG_INTERVAL) < LOG_INTERVAL:
+            return
+        self._logged_at[name] = now
+        logging.warning("DB budget exceeded by %s: %d queries (budget %d), %d connections (%d), %d rows (%d); "
+                        "calls: %s; over budget %d of %d updates of this handler.",
+                        name, scope.queries, self.queries, scope.connections, self.connections, scope.rows, self.rows,
+                        call_chain(scope.calls), totals.over_budget, totals.updates)
+
+    def report(self, top: int = 10) -> list[dict]:
+        """Самые дорогие хендлеры: по числу апдейтов сверх бюджета, затем по запросам на апдейт."""
+        rows = [{
+            'handler': name, 'updates': t.updates, 'over_budget': t.over_budget,
+            'queries_avg': t.queries / t.updates, 'queries_max': t.max_queries,
+            'connections_avg': t.connections / t.updates, 'rows_avg': t.rows / t.updates,
+            'worst_calls': call_chain(t.worst_calls),
+        } for name, t in self.handlers.items() if t.updates]
+        rows.sort(key=lambda r: (-r['over_budget'], -r['queries_avg']))
+        return rows[:top]
+
+    def stats(self) -> dict:
+        return {'updates': self.updates, 'over_budget': self.over_budget, 'handlers': len(self.handlers)}
+
+
+query_budget = QueryBudgetMiddleware()
@@ -0,0 +1,116 @@
+# middlewares/user_lock.py
+"""
+Последовательная обработка апдейтов одного пользователя.
+Два быстрых нажатия "купить"/"открыть ящик"/"атака" иначе идут параллельно, и
+read-check-write по золоту или HP дает двойную трату. Outer-middleware на уровне update
+берет замок пользователя на все время обработки; разные пользователи не ждут друг друга.
+Замки лежат в шардированной таблице и удаляются, как только их никто не держит и не ждет,
+поэтому память пропорциональна числу пользователей с апдейтом "в работе", а не всем игрокам.
+"""
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+LOCK_SHARDS = 64
+SLOW_WAIT_WARNING = 2.0 # Сек ожидания замка, после которых пишем предупреждение
+
+
+class _UserLock:
+    __slots__ = ('lock', 'users') # users - держит + ждут; 0 -> запись удаляется
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class UserLockTable:
+    """Таблица замков по user_id: шард = user_id % shards, запись живет, пока есть держатель/ожидающие."""
+
+    def __init__(self, shards: int = LOCK_SHARDS):
+        self._shards: list[dict[int, _UserLock]] = [{} for _ in range(shards)]
+        # Метрики
+        self.acquired = 0
+        self.contended = 0 # Сколько раз пришлось ждать
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.queue_depth = 0 # Апдейтов ждут замка сейчас
+        self.queue_depth_max = 0
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    async def acquire(self, user_id: int) -> float:
+        """Берет замок пользователя; возвращает время ожидания в секундах."""
+        shard = self._shards[user_id % len(self._shards)]
+        entry = shard.get(user_id)
+        if entry is None:
+            entry = shard[user_id] = _UserLock()
+        entry.users += 1
+        if entry.users == 1:
+            await entry.lock.acquire() # Никто не держит и не ждет - без переключения контекста
+            self.acquired += 1
+            return 0.0
+
+        self.contended += 1
+        self.queue_depth += 1
+        self.queue_depth_max = max(self.queue_depth_max, self.queue_depth)
+        started = time.perf_counter()
+        try:
+            await entry.lock.acquire()
+        except BaseException:
+            self._release_entry(user_id, shard, entry) # Отмена во время ожидания
+            raise
+        finally:
+            self.queue_depth -= 1
+        waited = time.perf_counter() - started
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return waited
+
+    def release(self, user_id: int):
+        shard = self._shards[user_id % len(self._shards)]
+        entry = shard[user_id]
+        entry.lock.release()
+        self._release_entry(user_id, shard, entry)
+
+    @staticmethod
+    def _release_entry(user_id: int, shard: dict, entry: _UserLock):
+        entry.users -= 1
+        if entry.users == 0:
+            del shard[user_id] # Простаивающий замок не хранится
+
+    def stats(self) -> dict:
+        return {
+            'locks': len(self), 'acquired': self.acquired, 'contended': self.contended,
+            'wait_avg_ms': self.wait_total / self.contended * 1000 if self.contended else 0.0,
+            'wait_max_ms': self.wait_max * 1000,
+            'queue_depth': self.queue_depth, 'queue_depth_max': self.queue_depth_max,
+        }
+
+
+class UserLockMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: обработка апдейтов одного пользователя строго по очереди."""
+
+    def __init__(self, table: UserLockTable | None = None):
+        self.table = table or UserLockTable()
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        waited = await self.table.acquire(user.id)
+        if waited > SLOW_WAIT_WARNING:
+            logging.warning(f"User {user.id} update waited {waited:.2f}s for the previous one (queue depth {self.table.queue_depth}).")
+        try:
+            return await handler(event, data)
+        finally:
+            self.table.release(user.id)
+
+
+user_locks = UserLockMiddleware()
@@ -0,0 +1,289 @@
+# outbound.py
+"""
+Планировщик исходящих запросов к Telegram (request-middleware сессии бота).
+Хендлеры по-прежнему просто await message.answer()/edit_text(), но отправка и правки
+проходят через очередь с приоритетами и два вида token bucket: общий (~30 сообщений/с на бота)
+и на чат (~1/с с небольшим запасом на всплеск). Ждущая правка того же сообщения тем же методом
+заменяется новой - уходит только последняя, все вызывающие получают ее результат.
+На 429 запрос возвращается в очередь после retry_after, чат (или весь бот) на это время на паузе.
+Остальные методы (getUpdates, answerCallbackQuery, ...) идут напрямую.
+"""
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+GLOBAL_RATE = 30.0 # Сообщений в секунду на бота
+GLOBAL_BURST = 30
+CHAT_RATE = 1.0 # Сообщений в секунду в один чат
+CHAT_BURST = 3
+MAX_RETRIES = 3 # Повторов после 429
+IDLE_BUCKET_TTL = 60 # Сек: полный и неиспользуемый bucket чата удаляется
+
+PRIORITY_EDIT = 0 # Правки (ответ на нажатие) - раньше новых сообщений
+PRIORITY_SEND = 1
+RATE_LIMITED_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.paused_until = 0.0 # 429 от Telegram
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд будет токен (0 - есть сейчас)."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, until: float):
+        self.paused_until = max(self.paused_until, until)
+        self.tokens = 0
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+
+class _Job:
+    __slots__ = ('bot', 'method', 'make_request', 'chat_id', 'coalesce_key', 'priority', 'waiters', 'retries', 'enqueued')
+
+    def __init__(self, bot, method, make_request, chat_id, coalesce_key, priority):
+        self.bot = bot
+        self.method = method
+        self.make_request = make_request
+        self.chat_id = chat_id
+        self.coalesce_key = coalesce_key
+        self.priority = priority
+        self.waiters: list[asyncio.Future] = []
+        self.retries = 0
+        self.enqueued = time.monotonic()
+
+
+def classify(method: TelegramMethod) -> tuple[bool, object, tuple | None, int]:
+    """(лимитируется, chat_id, ключ склейки правок, приоритет)."""
+    name = type(method).__name__
+    if not name.startswith(RATE_LIMITED_PREFIXES):
+        return False, None, None, PRIORITY_SEND
+    chat_id = getattr(method, 'chat_id', None)
+    if name.startswith("Edit"):
+        message_id = getattr(method, 'message_id', None)
+        inline_id = getattr(method, 'inline_message_id', None)
+        key = (name, chat_id, message_id, inline_id) if (message_id or inline_id) else None
+        return True, chat_id, key, PRIORITY_EDIT
+    return True, chat_id, None, PRIORITY_SEND
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = GLOBAL_RATE, global_burst: float = GLOBAL_BURST,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_burst, time.monotonic())
+        self._chats: dict[object, TokenBucket] = {}
+        self._ready: list = [] # (приоритет, seq, job) - можно отправлять, как только есть общий токен
+        self._delayed: list = [] # (когда, seq, job) - ждут токен чата / retry_after
+        self._pending_edits: dict[tuple, _Job] = {} # Правка ждет отправки - новые склеиваются в нее
+        self._sending_keys: set[tuple] = set() # Правка этого сообщения сейчас в полете
+        self._blocked: dict[tuple, _Job] = {} # Следующая правка ждет ответа на предыдущую (порядок правок)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._worker: asyncio.Task | None = None
+        self._in_flight: set[asyncio.Task] = set()
+        self._last_cleanup = time.monotonic()
+        # Метрики
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.queue_wait_max = 0.0
+
+    def set_global_rate(self, rate: float, burst: float):
+        """Общий лимит бота (шард получает свою долю: лимит Telegram один на всех воркеров)."""
+        self._global = TokenBucket(rate, burst, time.monotonic())
+
+    @property
+    def queued(self) -> int:
+        return len(self._ready) + len(self._delayed)
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot, method: TelegramMethod):
+        limited, chat_id, coalesce_key, priority = classify(method)
+        if not limited:
+            return await make_request(bot, method)
+
+        future = asyncio.get_running_loop().create_future()
+        job = self._pending_edits.get(coalesce_key) if coalesce_key else None
+        if job is not None:
+            # Правка еще не ушла - заменяем ее новой, старый вызывающий получит результат новой
+            job.method = method
+            job.make_request = make_request
+            job.waiters.append(future)
+            self.coalesced += 1
+            return await future
+
+        job = _Job(bot, method, make_request, chat_id, coalesce_key, priority)
+        job.waiters.append(future)
+        if coalesce_key:
+            self._pending_edits[coalesce_key] = job
+        self._push_ready(job)
+        self._ensure_worker()
+        return await future
+
+    # --- Очереди ---
+    def _push_ready(self, job: _Job):
+        heapq.heappush(self._ready, (job.priority, next(self._seq), job))
+        self._wakeup.set()
+
+    def _push_delayed(self, job: _Job, when: float):
+        heapq.heappush(self._delayed, (when, next(self._seq), job))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    # --- Отправка ---
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, job = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (job.priority, next(self._seq), job))
+
+            if not self._ready:
+                self._cleanup(now)
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                if timeout is None and not self._in_flight:
+                    self._worker = None # Очередь пуста - выходим, следующий запрос перезапустит
+                    return
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            _, _, job = heapq.heappop(self._ready)
+            if job.coalesce_key in self._sending_keys:
+                self._blocked[job.coalesce_key] = job # Уйдет после ответа на предыдущую правку
+                continue
+            if job.chat_id is not None:
+                bucket = self._chat_bucket(job.chat_id, now)
+                chat_wait = bucket.wait_time(now)
+                if chat_wait > 0:
+                    self._push_delayed(job, now + chat_wait) # Другие чаты не ждут этот
+                    continue
+                bucket.take(now)
+            self._global.take(now)
+            if job.coalesce_key:
+                self._pending_edits.pop(job.coalesce_key, None) # Дальше правки - уже новой задачей
+                self._sending_keys.add(job.coalesce_key)
+            self.queue_wait_max = max(self.queue_wait_max, now - job.enqueued)
+            task = asyncio.create_task(self._send(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, job: _Job):
+        try:
+            response = await job.make_request(job.bot, job.method)
+        except TelegramRetryAfter as e:
+            now = time.monotonic()
+            until = now + e.retry_after
+            if job.chat_id is not None:
+                self._chat_bucket(job.chat_id, now).pause(until)
+            else:
+                self._global.pause(until)
+            if job.retries < MAX_RETRIES:
+                self.retried += 1
+                logging.warning(f"Telegram 429 for {type(job.method).__name__} (chat {job.chat_id}), retry in {e.retry_after}s.")
+                self._retry(job, until)
+            else:
+                self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            for future in job.waiters:
+                if not future.done():
+                    future.set_result(response)
+        finally:
+            if job.coalesce_key:
+                self._sending_keys.discard(job.coalesce_key)
+                blocked = self._blocked.pop(job.coalesce_key, None)
+                if blocked is not None:
+                    self._push_ready(blocked)
+                    self._ensure_worker()
+
+    def _retry(self, job: _Job, until: float):
+        key = job.coalesce_key
+        newer = self._pending_edits.get(key) if key else None
+        if newer is not None:
+            # Пока ждали ответа, пришла более новая правка - повторять старую незачем
+            newer.waiters.extend(job.waiters)
+            self.coalesced += 1
+            return
+        job.retries += 1
+        if key:
+            self._pending_edits[key] = job # Новые правки снова склеиваются в нее
+        self._push_delayed(job, until)
+        self._ensure_worker()
+
+    @staticmethod
+    def _fail(job: _Job, error: Exception):
+        for future in job.waiters:
+            if not future.done():
+                future.set_exception(error)
+
+    def _cleanup(self, now: float):
+        """Удаляет bucket'ы чатов, которые давно полны (память не растет с числом чатов)."""
+        if now - self._last_cleanup < IDLE_BUCKET_TTL:
+            return
+        self._last_cleanup = now
+        for chat_id in [c for c, b in self._chats.items() if b.is_idle(now)]:
+            del self._chats[chat_id]
+
+    async def close(self, timeout: float = 10.0):
+        """Дождаться отправки очереди (остановка бота)."""
+        deadline = time.monotonic() + timeout
+        while (self.queued or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.queued:
+            logging.warning(f"Outbound scheduler closed with {self.queued} unsent requests.")
+
+    def stats(self) -> dict:
+        return {'queued': self.queued, 'in_flight': len(self._in_flight), 'sent': self.sent,
+                'coalesced': self.coalesced, 'retried': self.retried, 'chats': len(self._chats),
+                'queue_wait_max_ms': self.queue_wait_max * 1000}
+
+
+# Общий планировщик бота
+outbound = OutboundScheduler()
@@ -0,0 +1,247 @@
+# sharding.py
+"""
+Многопроцессный режим: супервизор + N воркеров, шардирование по user_id.
+Фронт (этот процесс) принимает вебхук Telegram, достает из апдейта user_id и пересылает
+апдейт своему воркеру: shard_for(user_id) всегда дает один и тот же процесс, поэтому FSM,
+боевые сессии, замки и кэши игрока остаются локальными для шарда и не требуют синхронизации.
+Каждый воркер - обычный bot.py в режиме вебхука на локальном порту (BOT_SHARD_INDEX задан).
+Общее для всех шардов (магазины, кузнец, игроки) живет только в SQLite (WAL), обновляется CAS-ом.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+import secrets
+
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+
+SHARD_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token" # Воркер проверяет внутренний секрет (не телеграмный) тем же заголовком
+FORWARD_TIMEOUT = 30 # Сек на ответ воркера
+RESTART_BACKOFF = (1, 2, 5, 10) # Пауза перед перезапуском упавшего воркера (по числу падений подряд)
+STABLE_UPTIME = 60 # Сек работы воркера, после которых падения перестают считаться "подряд"
+STOP_TIMEOUT = 20 # Сек на корректную остановку воркера, потом kill
+HEALTH_PATH = "/healthz"
+
+
+def shard_for(user_id: int, shards: int) -> int:
+    """Номер шарда игрока. Мультипликативный хеш - соседние id расходятся по разным шардам."""
+    return ((user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) % shards
+
+def extract_user_id(update: dict) -> int | None:
+    """user_id отправителя апдейта любого типа (message.from, callback_query.from, poll_answer.user, ...)."""
+    for key, payload in update.items():
+        if key == 'update_id' or not isinstance(payload, dict):
+            continue
+        user = payload.get('from') or payload.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        chat = payload.get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return None
+
+def _base_url(url: str) -> str:
+    """http://host:port/path -> http://host:port"""
+    return "/".join(url.split("/", 3)[:3])
+
+def shard_path(path: str, index: int) -> str:
+    """Файл шарда: fsm_state.db -> fsm_state.shard2.db."""
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard{index}{ext}"
+
+
+# --- Фронт ---
+class ShardRouter:
+    """Принимает апдейты Telegram и пересылает их воркеру по user_id."""
+
+    def __init__(self, worker_urls: list[str], telegram_secret: str | None, internal_secret: str):
+        self.worker_urls = worker_urls
+        self.telegram_secret = telegram_secret
+        self.internal_secret = internal_secret
+        self._http: ClientSession | None = None
+        self.forwarded = [0] * len(worker_urls)
+        self.failed = 0
+
+    async def start(self):
+        self._http = ClientSession(timeout=ClientTimeout(total=FORWARD_TIMEOUT))
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+
+    def route(self, update: dict) -> int:
+        user_id = extract_user_id(update)
+        key = user_id if user_id is not None else update.get('update_id', 0)
+        return shard_for(key, len(self.worker_urls))
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.telegram_secret and not secrets.compare_digest(
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.telegram_secret):
+            return web.Response(body="Unauthorized", status=401)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        index = self.route(update)
+        try:
+            async with self._http.post(self.worker_urls[index], data=body, headers={
+                "Content-Type": "application/json", SHARD_SECRET_HEADER: self.internal_secret,
+            }) as response:
+                payload = await response.read()
+                if response.status >= 300:
+                    raise ClientError(f"worker {index} answered {response.status}")
+        except (ClientError, asyncio.TimeoutError) as e:
+            # 5xx - Telegram повторит доставку (воркер мог перезапускаться)
+            self.failed += 1
+            logging.error(f"Failed to forward update {update.get('update_id')} to shard {index}: {e}")
+            return web.Response(status=503)
+        self.forwarded[index] += 1
+        return web.Response(body=payload, content_type="application/json")
+
+    async def health(self, request: web.Request) -> web.Response:
+        workers = []
+        for index, url in enumerate(self.worker_urls):
+            try:
+                async with self._http.get(_base_url(url) + HEALTH_PATH, timeout=ClientTimeout(total=2)) as response:
+                    workers.append({"shard": index, "forwarded": self.forwarded[index], **(await response.json())})
+            except Exception as e:
+                workers.append({"shard": index, "forwarded": self.forwarded[index], "status": f"down: {e}"})
+        status = "ok" if all(w.get("status") == "ok" for w in workers) else "degraded"
+        return web.json_response({"status": status, "failed_forwards": self.failed, "workers": workers},
+                                 status=200 if status == "ok" else 503)
+
+    def build_app(self, path: str) -> web.Application:
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        app.router.add_get(HEALTH_PATH, self.health)
+        return app
+
+
+# --- Воркеры ---
+class Supervisor:
+    """Запускает воркеры подпроцессами, перезапускает упавшие, останавливает по SIGINT (как Ctrl+C)."""
+
+    def __init__(self, count: int, command: list[str], env_for):
+        self.count = count
+        self.command = command
+        self.env_for = env_for # index -> dict переменных окружения воркера
+        self._procs: list[asyncio.subprocess.Process | None] = [None] * count
+        self._crashes = [0] * count
+        self._started = [0.0] * count # monotonic запуска воркера
+        self._restarts: dict[int, asyncio.Task] = {} # index -> отложенный перезапуск
+        self._stopping = False
+
+    async def _spawn(self, index: int):
+        env = {**os.environ, **self.env_for(index)}
+        self._procs[index] = await asyncio.create_subprocess_exec(*self.command, env=env)
+        self._started[index] = time.monotonic()
+        logging.info(f"Shard worker {index} started (pid {self._procs[index].pid}).")
+
+    async def _restart(self, index: int, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            if not self._stopping:
+                await self._spawn(index)
+        finally:
+            self._restarts.pop(index, None)
+
+    async def start(self):
+        for index in range(self.count):
+            await self._spawn(index)
+
+    async def watch(self):
+        """
+        Фоновая задача: перезапуск упавших воркеров с нарастающей паузой. Пауза растет только
+        с падениями подряд (воркер проработал меньше STABLE_UPTIME); каждый перезапуск - своя задача,
+        пауза одного воркера не задерживает остальные.
+        """
+        while not self._stopping:
+            for index, proc in enumerate(self._procs):
+                if proc is None or proc.returncode is None:
+                    continue
+                if time.monotonic() - self._started[index] >= STABLE_UPTIME:
+                    self._crashes[index] = 0
+                delay = RESTART_BACKOFF[min(self._crashes[index], len(RESTART_BACKOFF) - 1)]
+                self._crashes[index] += 1
+                logging.error(f"Shard worker {index} exited with code {proc.returncode}; restarting in {delay}s.")
+                self._procs[index] = None
+                self._restarts[index] = asyncio.create_task(self._restart(index, delay))
+            await asyncio.sleep(0.5)
+
+    async def stop(self, timeout: float = STOP_TIMEOUT):
+        self._stopping = True
+        for task in list(self._restarts.values()):
+            task.cancel()
+        procs = [p for p in self._procs if p is not None and p.returncode is None]
+        for proc in procs:
+            proc.send_signal(signal.SIGINT) # Воркер доводит контрольные точки и сбрасывает буферы
+        deadline = time.monotonic() + timeout
+        for proc in procs:
+            try:
+                await asyncio.wait_for(proc.wait(), max(0.1, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                logging.error(f"Shard worker pid {proc.pid} did not stop in time; killing.")
+                proc.kill()
+                await proc.wait()
+
+
+async def wait_ready(urls: list[str], timeout: float = 30.0):
+    """Ждет, пока /healthz всех воркеров ответит."""
+    deadline = time.monotonic() + timeout
+    async with ClientSession(timeout=ClientTimeout(total=1)) as http:
+        for url in urls:
+            base = _base_url(url)
+            while True:
+                try:
+                    async with http.get(base + HEALTH_PATH) as response:
+                        if response.status == 200:
+                            break
+                except (ClientError, asyncio.TimeoutError):
+                    pass
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Shard worker {base} is not ready")
+                await asyncio.sleep(0.2)
+
+
+async def run_supervisor(count: int, *, command: list[str] | None = None, base_port: int, path: str,
+                         host: str, port: int, telegram_secret: str | None, on_ready=None,
+                         stop: asyncio.Event | None = None):
+    """
+    Фронт + воркеры до отмены задачи или stop. Воркеры - тот же bot.py с BOT_SHARD_INDEX/BOT_SHARD_COUNT.
+    on_ready - корутина после старта фронта (bot.py регистрирует вебхук в Telegram).
+    """
+    internal_secret = secrets.token_urlsafe(24)
+    worker_urls = [f"http://127.0.0.1:{base_port + i}{path}" for i in range(count)]
+    supervisor = Supervisor(count, command or [sys.executable, os.path.abspath(sys.argv[0])], lambda i: {
+        "BOT_SHARD_INDEX": str(i), "BOT_SHARD_COUNT": str(count), "BOT_SHARD_WORKERS": "0",
+        "BOT_RUN_MODE": "webhook", "BOT_WEBHOOK_HOST": "127.0.0.1", "BOT_WEBHOOK_PORT": str(base_port + i),
+        "BOT_WEBHOOK_PATH": path, "BOT_WEBHOOK_SECRET": internal_secret,
+    })
+    router = ShardRouter(worker_urls, telegram_secret, internal_secret)
+    await supervisor.start()
+    watcher = None
+    runner = None
+    try:
+        await wait_ready(worker_urls)
+        await router.start()
+        runner = web.AppRunner(router.build_app(path), handle_signals=False)
+        await runner.setup()
+        site = web.TCPSite(runner, host=host, port=port)
+        await site.start()
+        logging.info(f"Shard front listening on {host}:{port}{path}, {count} workers on ports {base_port}..{base_port + count - 1}.")
+        watcher = asyncio.create_task(supervisor.watch())
+        if on_ready is not None:
+            await on_ready()
+        await (stop or asyncio.Event()).wait()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if runner is not None:
+            await runner.cleanup() # Сначала перестаем принимать апдейты
+        await router.close()
+        await supervisor.stop()
+        logging.info("Shard supervisor stopped.")
@@ -0,0 +1,126 @@
+# shutdown.py
+"""
+Упорядоченная остановка бота по SIGTERM/SIGINT (порядок фаз - в bot.py):
+перестать принимать апдейты -> дождаться обрабатываемых (с дедлайном, оставшиеся отменяются) ->
+контрольные точки боев -> FSM -> журнал боев -> исходящие -> WAL checkpoint -> закрытие соединений.
+Каждая фаза замеряется и ограничена по времени; ошибка или таймаут фазы не отменяет следующие.
+Отчет по фазам пишется в лог, как профиль старта (startup.py).
+"""
+import time
+import signal
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+PHASE_TIMEOUT = 10.0 # Сек на фазу по умолчанию
+CANCEL_GRACE = 1.0 # Сек на выход отмененных после дедлайна обработок (откат транзакций)
+
+
+class ShutdownSequence:
+    def __init__(self):
+        self.requested = asyncio.Event()
+        self.reason: str | None = None
+        self.started: float | None = None
+        self.phases: list[tuple[str, float, str]] = [] # (фаза, сек, ok/timeout/error)
+
+    def install_signal_handlers(self):
+        """SIGTERM/SIGINT -> request() (вместо KeyboardInterrupt посреди хендлера / мгновенного выхода)."""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request, sig.name)
+            except NotImplementedError: # Windows: остается KeyboardInterrupt
+                pass
+
+    def request(self, reason: str = "manual"):
+        if self.requested.is_set():
+            logging.warning(f"Received {reason} again, shutdown is already in progress.")
+            return
+        logging.warning(f"Received {reason}, shutting down...")
+        self.reason = reason
+        self.requested.set()
+
+    async def phase(self, name: str, action: Awaitable, timeout: float | None = PHASE_TIMEOUT):
+        """Выполнить фазу с дедлайном; исключение и таймаут логируются, остановка продолжается."""
+        if self.started is None:
+            self.started = time.perf_counter()
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            await asyncio.wait_for(action, timeout)
+        except asyncio.TimeoutError:
+            status = "timeout"
+            logging.warning(f"Shutdown phase '{name}' did not finish in {timeout:.1f}s, moving on.")
+        except Exception as e:
+            status = "error"
+            logging.error(f"Shutdown phase '{name}' failed: {e}", exc_info=True)
+        self.phases.append((name, time.perf_counter() - started, status))
+
+    def report(self) -> str:
+        lines = [f"  {name:<24} {seconds * 1000:>9.1f} ms  {status}" for name, seconds, status in self.phases]
+        if self.started is not None:
+            lines.append(f"  {'total':<24} {(time.perf_counter() - self.started) * 1000:>9.1f} ms")
+        return "\n".join(lines)
+
+
+class InFlightTracker:
+    """
+    Outer-middleware на dp.update (первым): помнит задачи, которые сейчас обрабатывают апдейт,
+    чтобы при остановке их дождаться, и ограничивает число одновременных обработок (set_limit) -
+    в любом режиме приема (polling, вебхук в фоне и без). Ждущие лимита тоже учтены: drain дождется
+    или отменит и их. Без BaseMiddleware - как FirstUpdateMiddleware в startup.py.
+    """
+
+    def __init__(self, limit: int | None = None):
+        self._tasks: set[asyncio.Task] = set()
+        self._semaphore: asyncio.Semaphore | None = None
+        self.set_limit(limit)
+        self.accepted = 0
+        self.handled = 0
+        self.cancelled = 0
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def set_limit(self, limit: int | None):
+        """Лимит одновременных обработок (None - без лимита). Задавать до приема апдейтов."""
+        self._semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def __call__(self, handler: Callable[[Any, dict[str, Any]], Awaitable[Any]], event: Any, data: dict[str, Any]) -> Any:
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.accepted += 1
+        try:
+            if self._semaphore is None:
+                return await handler(event, data)
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self._tasks.discard(task)
+            self.handled += 1
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Ждет обрабатываемые апдейты (и ждущие лимита) до дедлайна; не успевшие отменяются:
+        незакоммиченная транзакция откатится, а не оборвется на середине. Возвращает число отмененных.
+        """
+        await asyncio.sleep(0) # Задачи, только что созданные приемом апдейтов, доходят до middleware
+        tasks = set(self._tasks)
+        tasks.discard(asyncio.current_task())
+        if not tasks:
+            return 0
+        logging.info(f"Waiting for {len(tasks)} in-flight updates (up to {timeout:.1f}s)...")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if not pending:
+            return 0
+        logging.warning(f"{len(pending)} updates still running after {timeout:.1f}s, cancelling them.")
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending, timeout=CANCEL_GRACE)
+        self.cancelled += len(pending)
+        return len(pending)
+
+
+# Остановка текущего процесса и учет обрабатываемых апдейтов
+shutdown = ShutdownSequence()
+in_flight = InFlightTracker()
@@ -0,0 +1,5 @@
+# sim/__init__.py
+"""
+Офлайн-симуляторы баланса. Не зависят от aiogram и БД: используют combat_engine.
+Запуск из папки PoeGame: python -m sim --help
+"""
@@ -0,0 +1,72 @@
+# sim/__main__.py
+"""
+CLI симулятора баланса.
+Пример (из папки PoeGame):
+    python -m sim --fights 100000 --levels 1,5,10,20 --gear none,rare --workers 4 --out sim_results.csv
+"""
+import os
+import time
+import argparse
+import logging
+
+from log_setup import setup_logging
+from game_data import BASE_STATS
+from combat_engine import POLICIES, DEFAULT_MAX_TURNS
+from sim.presets import GEAR_PRESETS, validate_gear_presets
+from sim.monte_carlo import (
+    ENGINE_AUTO, ENGINE_NUMPY, ENGINE_PYTHON, np,
+    make_cells, run_sweep, write_csv, format_summary
+)
+
+
+def _split(value: str, allowed) -> list[str]:
+    items = list(allowed) if value == "all" else [v.strip() for v in value.split(",") if v.strip()]
+    unknown = [v for v in items if v not in allowed]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown values {unknown}; allowed: {', '.join(allowed)}")
+    return items
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim", description="Monte Carlo balance simulator for monster fights.")
+    parser.add_argument("--classes", default="all", help="comma-separated classes or 'all'")
+    parser.add_argument("--levels", default="1,5,10,20,30", help="comma-separated player levels")
+    parser.add_argument("--gear", default="all", help=f"gear presets: {', '.join(GEAR_PRESETS)} or 'all'")
+    parser.add_argument("--policies", default="all", help=f"spell policies: {', '.join(POLICIES)} or 'all'")
+    parser.add_argument("--fights", type=int, default=20000, help="fights per grid cell")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--engine", choices=[ENGINE_AUTO, ENGINE_NUMPY, ENGINE_PYTHON], default=ENGINE_AUTO)
+    parser.add_argument("--max-turns", type=int, default=DEFAULT_MAX_TURNS)
+    parser.add_argument("--batch-size", type=int, default=50000, help="fights per NumPy batch")
+    parser.add_argument("--seconds-per-turn", type=float, default=3.0, help="player think time per turn")
+    parser.add_argument("--seconds-between-fights", type=float, default=5.0, help="menu overhead per fight")
+    parser.add_argument("--out", default="sim_results.csv", help="CSV output path")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(logging.WARNING, queued=False) # Симулятору не нужны INFO-логи движка
+    validate_gear_presets()
+    classes = _split(args.classes, list(BASE_STATS))
+    gears = _split(args.gear, list(GEAR_PRESETS))
+    policies = _split(args.policies, list(POLICIES))
+    levels = [int(v) for v in args.levels.split(",") if v.strip()]
+    cells = make_cells(classes, levels, gears, policies)
+
+    engine_name = args.engine if args.engine != ENGINE_AUTO else (ENGINE_NUMPY if np is not None else ENGINE_PYTHON)
+    print(f"Simulating {len(cells)} cells x {args.fights} fights (engine={engine_name}, workers={args.workers})...")
+    started = time.perf_counter()
+    rows = run_sweep(
+        cells, args.fights, seed=args.seed, workers=args.workers, engine=args.engine,
+        max_turns=args.max_turns, batch_size=args.batch_size,
+        seconds_per_turn=args.seconds_per_turn, seconds_between_fights=args.seconds_between_fights
+    )
+    elapsed = time.perf_counter() - started
+    write_csv(rows, args.out)
+    print(format_summary(rows))
+    total_fights = len(cells) * args.fights
+    print(f"\n{total_fights} fights in {elapsed:.2f}s ({total_fights / max(elapsed, 1e-9):,.0f} fights/s). CSV: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
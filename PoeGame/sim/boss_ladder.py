@@ -0,0 +1,194 @@
+# sim/boss_ladder.py
+"""
+Симулятор прохождения лестницы из 10 боссов для конкретного билда.
+Для каждого босса оценивает шанс победы и ожидаемое число попыток (геометрическое распределение).
+Бои режутся на пачки и считаются в пуле процессов; сид пачки = f(сид, босс, номер пачки).
+
+Запуск из папки PoeGame:
+    python -m sim.boss_ladder --class Marauder --level 20 --gear rare --fights 2000
+    python -m sim.boss_ladder --user-id 123456789   # билд живого игрока из БД
+"""
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from log_setup import setup_logging
+from game_data import BASE_STATS, BOSSES, SPELLS
+from combat_engine import (
+    POLICIES, POLICY_BEST_SPELL, DEFAULT_MAX_TURNS,
+    scale_boss, simulate_fight, get_damage_spells_by_power
+)
+from sim.presets import (
+    GEAR_PRESETS, allocate_stat_points, build_player_from_spec, get_available_spell_ids
+)
+
+CHUNK_SIZE = 500 # Боев в одной задаче пула
+READINESS_FIGHTS = 200 # Боев для индикатора готовности в профиле
+READINESS_CACHE_SIZE = 2048
+
+
+def _chunk_seed(seed: int, boss_index: int, chunk_index: int) -> int:
+    return random.Random(f"{seed}:{boss_index}:{chunk_index}").getrandbits(63)
+
+def prepare_player(player: dict) -> dict:
+    """Копия статов игрока с полными HP/маной - к боссу идут подготовленными."""
+    prepared = dict(player)
+    prepared['current_hp'] = prepared['max_hp']
+    prepared['current_mana'] = prepared['max_mana']
+    return prepared
+
+def _run_chunk(task: tuple) -> tuple[int, int, int, int]:
+    """task = (boss_index, player, ranked_spells, policy, fights, seed, max_turns) -> (boss_index, fights, wins, turns_sum)."""
+    boss_index, player, ranked_spells, policy, fights, seed, max_turns = task
+    rng = random.Random(seed)
+    enemy = scale_boss(boss_index)
+    wins = 0
+    turns_sum = 0
+    for _ in range(fights):
+        result = simulate_fight(player, enemy, policy, rng=rng, max_turns=max_turns, ranked_spells=ranked_spells)
+        wins += result['won']
+        turns_sum += result['turns']
+    return boss_index, fights, wins, turns_sum
+
+def simulate_ladder(player: dict, spell_ids: list[str], policy: str = POLICY_BEST_SPELL, fights: int = 1000,
+                    seed: int = 1, workers: int = 1, max_turns: int = DEFAULT_MAX_TURNS,
+                    boss_indexes: list[int] | None = None) -> list[dict]:
+    """Считает шанс победы над каждым боссом. Возвращает список строк по боссам."""
+    player = prepare_player(player)
+    ranked_spells = get_damage_spells_by_power(spell_ids, player['intelligence'])
+    if boss_indexes is None:
+        boss_indexes = list(range(len(BOSSES)))
+
+    tasks = []
+    for boss_index in boss_indexes:
+        remaining = fights
+        chunk_index = 0
+        while remaining > 0:
+            chunk = min(CHUNK_SIZE, remaining)
+            tasks.append((boss_index, player, ranked_spells, policy, chunk, _chunk_seed(seed, boss_index, chunk_index), max_turns))
+            remaining -= chunk
+            chunk_index += 1
+
+    if workers <= 1:
+        chunk_results = [_run_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunk_results = list(pool.map(_run_chunk, tasks))
+
+    totals = {i: [0, 0, 0] for i in boss_indexes} # fights, wins, turns
+    for boss_index, chunk_fights, wins, turns_sum in chunk_results:
+        totals[boss_index][0] += chunk_fights
+        totals[boss_index][1] += wins
+        totals[boss_index][2] += turns_sum
+
+    rows = []
+    for boss_index in boss_indexes:
+        total_fights, wins, turns_sum = totals[boss_index]
+        win_prob = wins / total_fights if total_fights else 0.0
+        rows.append({
+            'boss_index': boss_index,
+            'boss_name': BOSSES[boss_index]['name'],
+            'fights': total_fights,
+            'win_prob': round(win_prob, 4),
+            # Ожидаемое число попыток до первой победы; None - победа не встретилась ни разу
+            'expected_attempts': round(1 / win_prob, 2) if win_prob > 0 else None,
+            'mean_turns': round(turns_sum / total_fights, 2) if total_fights else 0.0,
+        })
+    return rows
+
+
+# --- Кэш для индикатора готовности ---
+_readiness_cache = OrderedDict()
+_readiness_lock = threading.Lock() # Вызывается из asyncio.to_thread
+
+def build_signature(player: dict, spell_ids: list[str], policy: str) -> tuple:
+    """Ключ билда: все, что влияет на исход боя с боссом."""
+    effects = tuple(sorted((k, str(v)) for k, v in player.get('active_effects', {}).items()))
+    return (
+        player['class'], player['level'], player['strength'], player['dexterity'], player['intelligence'],
+        player['armor'], player['max_hp'], player['max_mana'], player['max_energy_shield'],
+        player['crit_chance'], player['crit_damage'], effects, tuple(sorted(spell_ids)), policy
+    )
+
+def get_boss_readiness(player: dict, spell_ids: list[str], boss_index: int, policy: str = POLICY_BEST_SPELL,
+                       fights: int = READINESS_FIGHTS) -> dict:
+    """
+    Шанс победы над боссом для билда с кэшированием по сигнатуре билда.
+    Синхронная и CPU-bound: из хендлеров вызывать через asyncio.to_thread.
+    """
+    key = (build_signature(player, spell_ids, policy), boss_index, fights)
+    with _readiness_lock:
+        cached = _readiness_cache.get(key)
+        if cached is not None:
+            _readiness_cache.move_to_end(key)
+            return cached
+    # Сид из сигнатуры - один и тот же билд всегда получает одну и ту же оценку
+    seed = random.Random(repr(key)).getrandbits(31)
+    result = simulate_ladder(player, spell_ids, policy, fights=fights, seed=seed, workers=1, boss_indexes=[boss_index])[0]
+    with _readiness_lock:
+        _readiness_cache[key] = result
+        while len(_readiness_cache) > READINESS_CACHE_SIZE:
+            _readiness_cache.popitem(last=False)
+    return result
+
+
+# --- CLI ---
+async def _load_build_from_db(user_id: int) -> tuple[dict, list[str]]:
+    from database.db_manager import get_player_effective_stats, get_learned_spells # Только для режима --user-id
+    player = await get_player_effective_stats(user_id)
+    if not player:
+        raise SystemExit(f"Player {user_id} not found in DB")
+    spells = await get_learned_spells(user_id)
+    return player, [s['id'] for s in spells]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.boss_ladder", description="Boss ladder win-probability simulator.")
+    parser.add_argument("--user-id", type=int, help="load build (stats, items, spells) of a player from the DB")
+    parser.add_argument("--class", dest="class_name", default="Scion", choices=list(BASE_STATS))
+    parser.add_argument("--level", type=int, default=10)
+    parser.add_argument("--str", dest="strength", type=int, help="strength (default: class base + points into primary stat)")
+    parser.add_argument("--dex", dest="dexterity", type=int)
+    parser.add_argument("--int", dest="intelligence", type=int)
+    parser.add_argument("--gear", default="none", choices=list(GEAR_PRESETS), help="gear preset (ignored if --items is given)")
+    parser.add_argument("--items", help="comma-separated item ids to equip")
+    parser.add_argument("--spells", help="comma-separated learned spell ids (default: all learnable)")
+    parser.add_argument("--policy", default=POLICY_BEST_SPELL, choices=list(POLICIES))
+    parser.add_argument("--fights", type=int, default=2000, help="fights per boss")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-turns", type=int, default=DEFAULT_MAX_TURNS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(logging.WARNING, queued=False)
+    if args.user_id is not None:
+        player, spell_ids = asyncio.run(_load_build_from_db(args.user_id))
+    else:
+        attributes = allocate_stat_points(args.class_name, args.level)
+        for key in ('strength', 'dexterity', 'intelligence'):
+            if getattr(args, key) is not None:
+                attributes[key] = getattr(args, key)
+        item_ids = [i.strip() for i in args.items.split(",")] if args.items else GEAR_PRESETS[args.gear]
+        player = build_player_from_spec(args.class_name, args.level, attributes, item_ids)
+        if args.spells:
+            spell_ids = [s.strip() for s in args.spells.split(",") if s.strip() in SPELLS]
+        else:
+            spell_ids = get_available_spell_ids(args.level, player['intelligence'])
+
+    rows = simulate_ladder(player, spell_ids, args.policy, fights=args.fights, seed=args.seed,
+                           workers=args.workers, max_turns=args.max_turns)
+    print(f"Build: {player['class']} lvl {player['level']} | STR {player['strength']} DEX {player['dexterity']} INT {player['intelligence']} "
+          f"| HP {player['max_hp']} ES {player['max_energy_shield']} Armor {player['armor']} | spells: {', '.join(spell_ids)}")
+    print(f"{'#':>2} {'boss':<28} {'win_prob':>8} {'attempts':>9} {'turns':>7}")
+    for row in rows:
+        attempts = f"{row['expected_attempts']:.2f}" if row['expected_attempts'] is not None else "inf"
+        print(f"{row['boss_index']:>2} {row['boss_name']:<28} {row['win_prob']:>8.2%} {attempts:>9} {row['mean_turns']:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
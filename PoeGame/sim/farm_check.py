@@ -0,0 +1,218 @@
+# sim/farm_check.py
+"""
+Сверка фарм-забега (/farm N, combat_engine.simulate_farm_run) с N одиночными боями подряд -
+так, как их проводят хендлеры: бой по правилам движка, награда монстра одним update_player_xp,
+награда квеста - вторым, штраф за смерть, пассивный реген только за время между боями.
+Сравниваются средние опыт, золото, лут и доля серий, закончившихся смертью.
+
+Намеренные отличия фарма:
+- реген между боями - фиксированные FARM_REGEN_SECONDS_PER_FIGHT (60 с), а у одиночных боев -
+  время игрока в меню (--menu-seconds): забег восстанавливает больше HP/маны и реже умирает;
+- опыт квеста начисляется тем же шагом левел-апа, что и опыт монстра (у одиночного боя - два шага).
+Режим "same regen" прогоняет одиночные бои с регеном фарма и тем же сидом: итог обязан совпасть
+с забегом точно (свертка опыта квеста на итог не влияет - calculate_level_progress аддитивна).
+
+Запуск из папки PoeGame:
+    python -m sim.farm_check --fights 20 --trials 1000 --levels 1,5,10 --gear none,rare
+"""
+import math
+import random
+import logging
+import argparse
+
+from log_setup import setup_logging
+from game_data import BASE_STATS, MONSTERS, FARM_REGEN_SECONDS_PER_FIGHT, get_random_loot_item_id
+from combat_engine import (
+    POLICIES, POLICY_BEST_SPELL, HP_REGEN_INTERVAL, MANA_REGEN_INTERVAL, XP_TO_NEXT_LEVEL_GROWTH,
+    calculate_effective_stats, calculate_base_max_vitals, calculate_level_progress, calculate_death_penalty,
+    get_damage_spells_by_power, get_regen_multiplier, scale_monster, simulate_fight, simulate_farm_run
+)
+from sim.presets import GEAR_PRESETS, allocate_stat_points, get_available_spell_ids
+
+MENU_SECONDS_BETWEEN_FIGHTS = 5.0 # Как --seconds-between-fights в python -m sim
+QUEST_REWARD_MULTIPLIER = 1.2 # Как в handlers/daily.py
+COMPARED_KEYS = ('fights', 'wins', 'died', 'xp_gain', 'gold_gain', 'loot_item_ids', 'gained_stat_points', 'end_level')
+
+
+# --- Игрок ---
+def make_daily_quest(rng) -> dict:
+    """Ежедневный квест, как его выдает handlers/daily.py (поля таблицы players)."""
+    monster_key = rng.choice(list(MONSTERS))
+    target_count = rng.randint(3, 10)
+    xp_reward = MONSTERS[monster_key]['xp_reward']
+    return {
+        'quest_monster_key': monster_key, 'quest_target_count': target_count, 'quest_current_count': 0,
+        'quest_gold_reward': math.ceil(target_count * (xp_reward // 2 + 2) * QUEST_REWARD_MULTIPLIER),
+        'quest_xp_reward': math.ceil(target_count * xp_reward * QUEST_REWARD_MULTIPLIER + 10),
+    }
+
+def build_player_row(class_name: str, level: int, quest: dict | None = None) -> dict:
+    """Запись players для пресета: очки прокачки в основной атрибут, 0 опыта на уровне, полные HP/мана."""
+    attributes = allocate_stat_points(class_name, level)
+    max_hp, max_mana = calculate_base_max_vitals(class_name, attributes['strength'], attributes['intelligence'], level)
+    xp_needed = 100 # Как у нового игрока (add_player)
+    for _ in range(level - 1):
+        xp_needed = int(xp_needed * XP_TO_NEXT_LEVEL_GROWTH)
+    row = {
+        'user_id': 0, 'class': class_name, 'level': level, 'xp': 0, 'xp_to_next_level': xp_needed, 'gold': 0,
+        'max_hp': max_hp, 'current_hp': 10 ** 9, 'max_mana': max_mana, 'current_mana': 10 ** 9, # Обрежутся до максимума
+        'armor': 0, 'max_energy_shield': 0, 'energy_shield': 0, 'crit_chance': 5.0, 'crit_damage': 150.0,
+        'quest_monster_key': None, 'quest_target_count': 0, 'quest_current_count': 0,
+        'quest_gold_reward': 0, 'quest_xp_reward': 0,
+    }
+    row.update(attributes)
+    if quest:
+        row.update(quest)
+    return row
+
+
+# --- N одиночных боев ---
+def simulate_single_fights(player_row: dict, equipped_item_ids: list[str], spell_ids: list[str], fights: int,
+                           policy: str = POLICY_BEST_SPELL, rng=random,
+                           regen_seconds: float = MENU_SECONDS_BETWEEN_FIGHTS) -> dict:
+    """
+    До fights отдельных боев подряд, как в хендлерах боя: после победы update_player_xp с наградой
+    монстра, затем (если квест выполнен) отдельный update_player_xp с наградой квеста; смерть
+    останавливает серию (apply_death_penalty). Броски - в том же порядке, что у simulate_farm_run.
+    Возвращает итоги с ключами simulate_farm_run из COMPARED_KEYS.
+    """
+    raw = dict(player_row)
+    player = calculate_effective_stats(raw, equipped_item_ids)
+    active_effects = player['active_effects']
+    ranked_spells = get_damage_spells_by_power(spell_ids, player['intelligence'])
+    regen_multiplier = get_regen_multiplier(active_effects)
+    can_regen_mana = 'cannot_regen_mana' not in active_effects
+    try: triple_gold_chance = float(active_effects.get('triple_gold_chance', 0))
+    except (ValueError, TypeError): triple_gold_chance = 0.0
+    monster_keys = list(MONSTERS)
+    hp, mana = player['current_hp'], player['current_mana']
+    run = {'fights': 0, 'wins': 0, 'died': False, 'xp_gain': 0, 'gold_gain': 0, 'loot_item_ids': [],
+           'gained_stat_points': 0}
+
+    for _ in range(fights):
+        if hp <= 0:
+            break
+        player['current_hp'], player['current_mana'] = hp, mana
+        monster = scale_monster(rng.choice(monster_keys), raw['level'], rng=rng)
+        result = simulate_fight(player, monster, policy, rng=rng, ranked_spells=ranked_spells)
+        run['fights'] += 1
+        hp, mana = result['hp'], result['mana']
+        if not result['won']:
+            if hp <= 0:
+                run['died'] = True
+                xp_penalty, gold_penalty = calculate_death_penalty(raw['level'], raw['xp'], raw['gold'])
+                raw['xp'], raw['gold'] = max(0, raw['xp'] - xp_penalty), max(0, raw['gold'] - gold_penalty)
+            break
+
+        run['wins'] += 1
+        gold_gain = monster['gold_reward'] * 3 if rng.uniform(0, 100) < triple_gold_chance else monster['gold_reward']
+        loot_item_id = get_random_loot_item_id(rng=rng)
+        if loot_item_id:
+            run['loot_item_ids'].append(loot_item_id)
+        rewards = [(monster['xp_reward'], gold_gain)]
+        # update_quest_progress: при выполнении награда квеста - отдельным update_player_xp
+        if raw['quest_monster_key'] == monster['key'] and raw['quest_current_count'] < raw['quest_target_count']:
+            raw['quest_current_count'] += 1
+            if raw['quest_current_count'] >= raw['quest_target_count']:
+                rewards.append((raw['quest_xp_reward'], raw['quest_gold_reward']))
+                raw.update(quest_monster_key=None, quest_target_count=0, quest_current_count=0,
+                           quest_gold_reward=0, quest_xp_reward=0)
+
+        for xp_gain, gold_step in rewards: # Каждая награда - свой шаг левел-апа (update_player_xp)
+            run['xp_gain'] += xp_gain
+            run['gold_gain'] += gold_step
+            raw['gold'] += gold_step
+            old_level = raw['level']
+            raw['level'], raw['xp'], raw['xp_to_next_level'], stat_points = calculate_level_progress(
+                raw['level'], raw['xp'], raw['xp_to_next_level'], xp_gain
+            )
+            run['gained_stat_points'] += stat_points
+            if raw['level'] > old_level:
+                raw['max_hp'], raw['max_mana'] = calculate_base_max_vitals(raw['class'], raw['strength'], raw['intelligence'], raw['level'])
+                raw['current_hp'], raw['current_mana'] = raw['max_hp'], raw['max_mana']
+                player = calculate_effective_stats(raw, equipped_item_ids)
+                hp, mana = player['current_hp'], player['current_mana']
+
+        # Ленивый реген - только за время в меню до следующего боя
+        if regen_multiplier > 0:
+            hp = min(player['max_hp'], hp + math.floor(regen_seconds / HP_REGEN_INTERVAL * regen_multiplier))
+            if can_regen_mana:
+                mana = min(player['max_mana'], mana + math.floor(regen_seconds / MANA_REGEN_INTERVAL * regen_multiplier))
+
+    run['end_level'] = raw['level']
+    return run
+
+
+# --- Сверка ---
+def _summary(runs: list[dict]) -> dict:
+    n = len(runs)
+    return {'xp': sum(r['xp_gain'] for r in runs) / n, 'gold': sum(r['gold_gain'] for r in runs) / n,
+            'loot': sum(len(r['loot_item_ids']) for r in runs) / n, 'wins': sum(r['wins'] for r in runs) / n,
+            'death_rate': sum(r['died'] for r in runs) / n}
+
+def compare_cell(class_name: str, level: int, gear: str, fights: int, trials: int, policy: str = POLICY_BEST_SPELL,
+                 seed: int = 1, menu_seconds: float = MENU_SECONDS_BETWEEN_FIGHTS, with_quest: bool = True) -> dict:
+    """Сверка одной ячейки: trials серий по fights боев; у каждой серии свой сид, общий для всех трех прогонов."""
+    item_ids = GEAR_PRESETS[gear]
+    farm_runs, single_runs, exact = [], [], 0
+    for trial in range(trials):
+        trial_seed = random.Random(f"{seed}:{class_name}:{level}:{gear}:{trial}").getrandbits(63)
+        setup_rng = random.Random(trial_seed)
+        row = build_player_row(class_name, level, make_daily_quest(setup_rng) if with_quest else None)
+        spell_ids = get_available_spell_ids(level, calculate_effective_stats(row, item_ids)['intelligence'])
+        farm = simulate_farm_run(row, item_ids, spell_ids, fights, policy, rng=random.Random(trial_seed))
+        same_regen = simulate_single_fights(row, item_ids, spell_ids, fights, policy, rng=random.Random(trial_seed),
+                                            regen_seconds=FARM_REGEN_SECONDS_PER_FIGHT)
+        exact += all(farm[key] == same_regen[key] for key in COMPARED_KEYS)
+        farm_runs.append(farm)
+        single_runs.append(simulate_single_fights(row, item_ids, spell_ids, fights, policy, rng=random.Random(trial_seed),
+                                                  regen_seconds=menu_seconds))
+    return {'class': class_name, 'level': level, 'gear': gear, 'trials': trials, 'exact_matches': exact,
+            'farm': _summary(farm_runs), 'single': _summary(single_runs)}
+
+
+def _split(value: str, allowed) -> list[str]:
+    return list(allowed) if value == "all" else [v.strip() for v in value.split(",") if v.strip()]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.farm_check", description="Compare /farm N with N single fights.")
+    parser.add_argument("--classes", default="Marauder,Witch,Ranger", help="comma-separated classes or 'all'")
+    parser.add_argument("--levels", default="1,5,10", help="comma-separated player levels")
+    parser.add_argument("--gear", default="none,rare", help=f"gear presets: {', '.join(GEAR_PRESETS)} or 'all'")
+    parser.add_argument("--policy", default=POLICY_BEST_SPELL, choices=list(POLICIES))
+    parser.add_argument("--fights", type=int, default=20, help="fights per farm run / single-fight series")
+    parser.add_argument("--trials", type=int, default=500, help="series per grid cell")
+    parser.add_argument("--menu-seconds", type=float, default=MENU_SECONDS_BETWEEN_FIGHTS,
+                        help="regen time between single fights (player in menus)")
+    parser.add_argument("--no-quest", action="store_true", help="no active daily quest")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(logging.WARNING, queued=False)
+    classes = _split(args.classes, list(BASE_STATS))
+    gears = _split(args.gear, list(GEAR_PRESETS))
+    levels = [int(v) for v in args.levels.split(",") if v.strip()]
+    print(f"{args.fights} fights x {args.trials} series per cell; farm regen {FARM_REGEN_SECONDS_PER_FIGHT}s, "
+          f"single-fight regen {args.menu_seconds}s between fights; quest {'off' if args.no_quest else 'on'}")
+    print(f"{'class':<10} {'lvl':>3} {'gear':<9} | {'farm xp':>8} {'gold':>7} {'loot':>5} {'died':>6} | "
+          f"{'single xp':>9} {'gold':>7} {'loot':>5} {'died':>6} | {'same regen':>10}")
+    mismatched_cells = 0
+    for class_name in classes:
+        for level in levels:
+            for gear in gears:
+                row = compare_cell(class_name, level, gear, args.fights, args.trials, args.policy, args.seed,
+                                   args.menu_seconds, not args.no_quest)
+                farm, single = row['farm'], row['single']
+                mismatched_cells += row['exact_matches'] != row['trials']
+                print(f"{class_name:<10} {level:>3} {gear:<9} | {farm['xp']:>8.0f} {farm['gold']:>7.0f} {farm['loot']:>5.1f} "
+                      f"{farm['death_rate']:>6.1%} | {single['xp']:>9.0f} {single['gold']:>7.0f} {single['loot']:>5.1f} "
+                      f"{single['death_rate']:>6.1%} | {row['exact_matches']:>5}/{row['trials']}")
+    if mismatched_cells:
+        print(f"\n{mismatched_cells} cell(s): farm run differs from single fights with the same regen and seed")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+# sim/monte_carlo.py
+"""
+Монте-Карло симуляция боев с монстрами по сетке класс x уровень x экипировка x политика.
+Каждая ячейка сетки считается независимо (в отдельном процессе), сид ячейки выводится
+из общего сида и индекса ячейки - результат не зависит от числа воркеров.
+"""
+import csv
+import math
+import random
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError: # NumPy необязателен: без него работает чистый Python на combat_engine
+    np = None
+
+from game_data import MONSTERS, SPELLS, calculate_final_spell_damage
+from combat_engine import (
+    POLICY_BEST_SPELL, DEFAULT_MAX_TURNS, HP_REGEN_INTERVAL, MANA_REGEN_INTERVAL,
+    calculate_dodge_chance, calculate_damage_reduction, get_effect_modifiers, get_regen_multiplier,
+    get_spell_mana_cost, get_damage_spells_by_power, scale_monster, simulate_fight
+)
+from sim.presets import build_player, get_available_spell_ids
+
+ENGINE_AUTO = "auto"
+ENGINE_NUMPY = "numpy"
+ENGINE_PYTHON = "python"
+
+# Колонки CSV в порядке вывода
+RESULT_FIELDS = [
+    "class", "level", "gear", "policy", "fights",
+    "win_rate", "death_rate", "timeout_rate",
+    "mean_turns", "p95_turns", "mean_damage_taken", "mean_hp_lost", "mean_mana_spent",
+    "mean_xp_per_win", "mean_gold_per_win", "seconds_per_fight", "xp_per_hour", "gold_per_hour",
+]
+
+
+# --- Параметры ячейки ---
+def make_cells(classes: list[str], levels: list[int], gears: list[str], policies: list[str]) -> list[dict]:
+    """Разворачивает сетку в список ячеек."""
+    return [
+        {'class': c, 'level': lvl, 'gear': g, 'policy': p}
+        for c, lvl, g, p in itertools.product(classes, levels, gears, policies)
+    ]
+
+def _cell_seed(seed: int, cell_index: int) -> int:
+    """Детерминированный сид ячейки (не зависит от PYTHONHASHSEED и числа процессов)."""
+    return random.Random(f"{seed}:{cell_index}").getrandbits(63)
+
+
+# --- Движок NumPy: все бои ячейки шагают одновременно ---
+def _run_fights_numpy(player: dict, policy: str, spell_ids: list[str], fights: int, seed: int, max_turns: int) -> dict:
+    rng = np.random.default_rng(seed)
+    level = player['level']
+    monster_keys = list(MONSTERS)
+    mana_multiplier, crit_mult_bonus = get_effect_modifiers(player['active_effects'])
+    crit_chance = player['crit_chance']
+    crit_damage = player['crit_damage'] + crit_mult_bonus
+    try: triple_gold_chance = float(player['active_effects'].get('triple_gold_chance', 0))
+    except (ValueError, TypeError): triple_gold_chance = 0.0
+
+    # Таблицы скалированных монстров (детерминированные части scale_monster)
+    scaled = [scale_monster(k, level, rng=random.Random(0)) for k in monster_keys]
+    monster_hp_table = np.array([m['hp'] for m in scaled], dtype=np.int64)
+    monster_dmg_table = np.array([m['damage'] for m in scaled], dtype=np.int64)
+    monster_xp_table = np.array([m['xp_reward'] for m in scaled], dtype=np.int64)
+    monster_gold_base = np.array([MONSTERS[k]['xp_reward'] // 3 for k in monster_keys], dtype=np.int64)
+    gold_multiplier = 1 + (level - 1) * 0.05
+
+    monster_idx = rng.integers(0, len(monster_keys), fights)
+    enemy_hp = monster_hp_table[monster_idx].copy()
+    enemy_dmg = monster_dmg_table[monster_idx]
+
+    hp = np.full(fights, player['current_hp'], dtype=np.int64)
+    mana = np.full(fights, player['current_mana'], dtype=np.int64)
+    es = np.full(fights, player['max_energy_shield'], dtype=np.int64)
+    turns = np.zeros(fights, dtype=np.int64)
+    damage_taken = np.zeros(fights, dtype=np.int64)
+    mana_spent = np.zeros(fights, dtype=np.int64)
+    won = np.zeros(fights, dtype=bool)
+    done = np.zeros(fights, dtype=bool)
+
+    attack_damage = max(1, player['strength'] // 2)
+    spell_table = [] # (урон без крита, стоимость) - только спеллы сильнее атаки, как в choose_action
+    if policy == POLICY_BEST_SPELL:
+        for spell_id in get_damage_spells_by_power(spell_ids, player['intelligence']):
+            spell_damage = calculate_final_spell_damage(SPELLS[spell_id]['effect_value'], player['intelligence'])
+            if spell_damage <= attack_damage:
+                break
+            spell_table.append((spell_damage, get_spell_mana_cost(SPELLS[spell_id], mana_multiplier)))
+
+    dodge_chance = calculate_dodge_chance(player['dexterity'])
+    reduction = calculate_damage_reduction(player['armor'])
+
+    for _ in range(max_turns):
+        idx = np.flatnonzero(~done)
+        if idx.size == 0:
+            break
+        # Ход игрока: выбор действия по мане
+        base = np.full(idx.size, attack_damage, dtype=np.int64)
+        cost = np.zeros(idx.size, dtype=np.int64)
+        chosen = np.zeros(idx.size, dtype=bool)
+        for spell_damage, spell_cost in spell_table:
+            pick = ~chosen & (mana[idx] >= spell_cost)
+            base[pick] = spell_damage
+            cost[pick] = spell_cost
+            chosen |= pick
+        crit = rng.random(idx.size) * 100 < crit_chance
+        dealt = np.where(crit, np.ceil(base * (crit_damage / 100.0)).astype(np.int64), base)
+        mana[idx] -= cost
+        mana_spent[idx] += cost
+        turns[idx] += 1
+        enemy_hp[idx] -= dealt
+
+        killed = enemy_hp[idx] <= 0
+        won[idx[killed]] = True
+        done[idx[killed]] = True
+
+        # Ход монстра
+        alive = idx[~killed]
+        dodged = rng.random(alive.size) * 100 < dodge_chance
+        incoming = np.where(dodged, 0, np.maximum(1, enemy_dmg[alive] - reduction))
+        es_absorb = np.minimum(es[alive], incoming)
+        es[alive] -= es_absorb
+        hp[alive] -= incoming - es_absorb
+        damage_taken[alive] += incoming
+        done[alive[hp[alive] <= 0]] = True
+
+    died = done & ~won
+    timed_out = ~done
+    gold_roll = rng.integers(1, 6, fights) # randint(1, 5)
+    gold = np.ceil((gold_roll + monster_gold_base[monster_idx]) * gold_multiplier).astype(np.int64)
+    if triple_gold_chance > 0:
+        gold = np.where(rng.random(fights) * 100 < triple_gold_chance, gold * 3, gold)
+
+    return {
+        'won': won, 'died': died, 'timed_out': timed_out, 'turns': turns,
+        'damage_taken': damage_taken, 'hp_lost': player['current_hp'] - np.maximum(hp, 0),
+        'mana_spent': mana_spent, 'xp': np.where(won, monster_xp_table[monster_idx], 0),
+        'gold': np.where(won, gold, 0),
+    }
+
+
+# --- Движок на чистом Python (combat_engine.simulate_fight) ---
+def _run_fights_python(player: dict, policy: str, spell_ids: list[str], fights: int, seed: int, max_turns: int) -> dict:
+    rng = random.Random(seed)
+    monster_keys = list(MONSTERS)
+    ranked_spells = get_damage_spells_by_power(spell_ids, player['intelligence'])
+    try: triple_gold_chance = float(player['active_effects'].get('triple_gold_chance', 0))
+    except (ValueError, TypeError): triple_gold_chance = 0.0
+
+    columns = {k: [] for k in ('won', 'died', 'timed_out', 'turns', 'damage_taken', 'hp_lost', 'mana_spent', 'xp', 'gold')}
+    for _ in range(fights):
+        enemy = scale_monster(rng.choice(monster_keys), player['level'], rng=rng)
+        result = simulate_fight(player, enemy, policy, rng=rng, max_turns=max_turns, ranked_spells=ranked_spells)
+        won = result['won']
+        gold = enemy['gold_reward']
+        if won and rng.uniform(0, 100) < triple_gold_chance:
+            gold *= 3
+        columns['won'].append(won)
+        columns['died'].append(not won and result['hp'] <= 0)
+        columns['timed_out'].append(not won and result['hp'] > 0)
+        columns['turns'].append(result['turns'])
+        columns['damage_taken'].append(result['damage_taken'])
+        columns['hp_lost'].append(player['current_hp'] - result['hp'])
+        columns['mana_spent'].append(result['mana_spent'])
+        columns['xp'].append(enemy['xp_reward'] if won else 0)
+        columns['gold'].append(gold if won else 0)
+    return columns
+
+
+# --- Агрегация ---
+def _mean(values) -> float:
+    return float(sum(values)) / len(values) if len(values) else 0.0
+
+def _percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return float(ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)])
+
+def summarize_cell(cell: dict, player: dict, columns: dict, seconds_per_turn: float, seconds_between_fights: float) -> dict:
+    """
+    Сводит бои ячейки в строку результата.
+    Время боя = ходы * seconds_per_turn + пауза + простой на пассивный реген потерянных HP/маны
+    (HP и мана регенерируют параллельно, поэтому берется максимум).
+    """
+    fights = len(columns['won'])
+    wins = int(sum(columns['won']))
+    regen_multiplier = get_regen_multiplier(player['active_effects'])
+    can_regen_mana = 'cannot_regen_mana' not in player['active_effects']
+
+    total_seconds = 0.0
+    for turns, hp_lost, mana_spent in zip(columns['turns'], columns['hp_lost'], columns['mana_spent']):
+        downtime = 0.0
+        if regen_multiplier > 0:
+            downtime = hp_lost * HP_REGEN_INTERVAL / regen_multiplier
+            if can_regen_mana:
+                downtime = max(downtime, mana_spent * MANA_REGEN_INTERVAL / regen_multiplier)
+        total_seconds += int(turns) * seconds_per_turn + seconds_between_fights + downtime
+    seconds_per_fight = total_seconds / fights if fights else 0.0
+    hours = total_seconds / 3600.0 if total_seconds else 1.0
+    total_xp = int(sum(columns['xp']))
+    total_gold = int(sum(columns['gold']))
+
+    return {
+        **cell,
+        "fights": fights,
+        "win_rate": round(wins / fights, 4) if fights else 0.0,
+        "death_rate": round(int(sum(columns['died'])) / fights, 4) if fights else 0.0,
+        "timeout_rate": round(int(sum(columns['timed_out'])) / fights, 4) if fights else 0.0,
+        "mean_turns": round(_mean(columns['turns']), 2),
+        "p95_turns": _percentile(columns['turns'], 0.95),
+        "mean_damage_taken": round(_mean(columns['damage_taken']), 2),
+        "mean_hp_lost": round(_mean(columns['hp_lost']), 2),
+        "mean_mana_spent": round(_mean(columns['mana_spent']), 2),
+        "mean_xp_per_win": round(total_xp / wins, 2) if wins else 0.0,
+        "mean_gold_per_win": round(total_gold / wins, 2) if wins else 0.0,
+        "seconds_per_fight": round(seconds_per_fight, 1),
+        "xp_per_hour": round(total_xp / hours, 1),
+        "gold_per_hour": round(total_gold / hours, 1),
+    }
+
+def run_cell(task: tuple) -> dict:
+    """Считает одну ячейку сетки. task = (индекс, ячейка, параметры) - удобно для pool.map."""
+    cell_index, cell, params = task
+    player = build_player(cell['class'], cell['level'], cell['gear'])
+    spell_ids = get_available_spell_ids(cell['level'], player['intelligence'])
+    seed = _cell_seed(params['seed'], cell_index)
+    engine = params['engine']
+    if engine == ENGINE_NUMPY or (engine == ENGINE_AUTO and np is not None):
+        columns = {k: [] for k in ('won', 'died', 'timed_out', 'turns', 'damage_taken', 'hp_lost', 'mana_spent', 'xp', 'gold')}
+        remaining = params['fights']
+        batch_index = 0
+        while remaining > 0: # Пачки ограничивают память на больших прогонах
+            batch = min(remaining, params['batch_size'])
+            result = _run_fights_numpy(player, cell['policy'], spell_ids, batch, seed + batch_index, params['max_turns'])
+            for key in columns:
+                columns[key].extend(result[key].tolist())
+            remaining -= batch
+            batch_index += 1
+    else:
+        columns = _run_fights_python(player, cell['policy'], spell_ids, params['fights'], seed, params['max_turns'])
+    return summarize_cell(cell, player, columns, params['seconds_per_turn'], params['seconds_between_fights'])
+
+def run_sweep(cells: list[dict], fights: int, seed: int = 1, workers: int = 1, engine: str = ENGINE_AUTO,
+              max_turns: int = DEFAULT_MAX_TURNS, batch_size: int = 50000,
+              seconds_per_turn: float = 3.0, seconds_between_fights: float = 5.0) -> list[dict]:
+    """Прогоняет всю сетку. workers > 1 - пул процессов (ячейки независимы)."""
+    if engine == ENGINE_NUMPY and np is None:
+        raise RuntimeError("NumPy is not installed; use --engine python")
+    params = {'fights': fights, 'seed': seed, 'engine': engine, 'max_turns': max_turns, 'batch_size': batch_size,
+              'seconds_per_turn': seconds_per_turn, 'seconds_between_fights': seconds_between_fights}
+    tasks = [(i, cell, params) for i, cell in enumerate(cells)]
+    if workers <= 1:
+        return [run_cell(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run_cell, tasks))
+
+
+# --- Вывод ---
+def write_csv(rows: list[dict], path: str):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def format_summary(rows: list[dict]) -> str:
+    """Текстовая таблица ключевых метрик для быстрого просмотра в консоли."""
+    columns = [("class", 8), ("level", 5), ("gear", 9), ("policy", 10), ("win_rate", 8),
+               ("death_rate", 10), ("mean_turns", 10), ("xp_per_hour", 11), ("gold_per_hour", 13)]
+    header = " ".join(name.rjust(width) for name, width in columns)
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        lines.append(" ".join(str(row[name]).rjust(width) for name, width in columns))
+    return "\n".join(lines)
@@ -0,0 +1,60 @@
+# sim/presets.py
+"""Пресеты билдов для симуляций: распределение статов, наборы экипировки, доступные заклинания."""
+from game_data import BASE_STATS, SPELLS, ALL_ITEMS, get_spell_intelligence_requirement
+from combat_engine import calculate_effective_stats
+
+STAT_POINTS_PER_LEVEL = 2 # Как в update_player_xp
+
+# --- Наборы экипировки ---
+# Один предмет на слот (два кольца), ID из ALL_ITEMS
+GEAR_PRESETS = {
+    "none": [],
+    "common": ["hlm003", "chs003", "glv002", "bts003", "rng001", "rng003", "amu002", "blt002", "wpn001"],
+    "magic": ["hlm005", "chs006", "glv004", "bts004", "rng006", "rng005", "amu007", "blt004", "wpn004"],
+    "rare": ["hlm010", "chs010", "glv010", "bts008", "rng009", "rng012", "amu010", "blt008", "wpn009"],
+    "legendary": ["hlm010", "leg_chs_002", "glv010", "bts008", "leg_rng_002", "rng012", "leg_amu_002", "leg_blt_001", "wpn009"],
+}
+
+STAT_KEYS = {'str': 'strength', 'dex': 'dexterity', 'int': 'intelligence'}
+
+
+def allocate_stat_points(class_name: str, level: int) -> dict:
+    """Базовые атрибуты класса + все очки прокачки в основной атрибут (при равенстве - по кругу)."""
+    base = BASE_STATS[class_name]
+    stats = {full_key: base[short_key] for short_key, full_key in STAT_KEYS.items()}
+    top_value = max(base[k] for k in STAT_KEYS)
+    primary = [STAT_KEYS[k] for k in STAT_KEYS if base[k] == top_value]
+    for i in range(STAT_POINTS_PER_LEVEL * (level - 1)):
+        stats[primary[i % len(primary)]] += 1
+    return stats
+
+def build_player_from_spec(class_name: str, level: int, attributes: dict, item_ids: list[str]) -> dict:
+    """Собирает эффективные статы (полные HP/мана) для явного билда: атрибуты + надетые предметы."""
+    player_base = {
+        'user_id': 0, 'class': class_name, 'level': level,
+        'current_hp': 10 ** 9, 'current_mana': 10 ** 9, 'energy_shield': 10 ** 9, # Обрежутся до максимума
+        'armor': 0, 'max_energy_shield': 0, 'crit_chance': 0.0, 'crit_damage': 0.0,
+        'max_hp': 0, 'max_mana': 0,
+    }
+    player_base.update(attributes)
+    return calculate_effective_stats(player_base, item_ids)
+
+def build_player(class_name: str, level: int, gear: str) -> dict:
+    """Собирает эффективные статы игрока (полные HP/мана) для пресета."""
+    return build_player_from_spec(class_name, level, allocate_stat_points(class_name, level), GEAR_PRESETS[gear])
+
+def get_available_spell_ids(level: int, intelligence: int) -> list[str]:
+    """Заклинания, которые игрок может выучить в Школе Магов на этом уровне/интеллекте (+ стартовое)."""
+    spell_ids = ["spell001"]
+    for spell_id, spell_data in SPELLS.items():
+        level_req = spell_data.get('level_req', 999)
+        if spell_id not in spell_ids and level >= level_req and intelligence >= get_spell_intelligence_requirement(level_req):
+            spell_ids.append(spell_id)
+    return spell_ids
+
+def validate_gear_presets():
+    """Проверяет, что все предметы пресетов существуют (ошибка в пресете = тихо неверная симуляция)."""
+    for gear, item_ids in GEAR_PRESETS.items():
+        for item_id in item_ids:
+            if item_id not in ALL_ITEMS:
+                raise ValueError(f"Gear preset '{gear}' references unknown item '{item_id}'")
@@ -0,0 +1,99 @@
+# startup.py
+"""
+Профиль холодного старта: время фаз (импорты, БД, FSM, диспетчер), время до готовности
+(диспетчер начал принимать апдейты) и до первого апдейта. Импортируется первым в bot.py -
+отсчет идет от этого момента (запуск интерпретатора ~0.05 с не учитывается).
+
+Бюджет - config.STARTUP_BUDGET (время до готовности; апдейты, пришедшие за время рестарта,
+забирает первый же getUpdates/вебхук). Замер (1 vCPU, Python 3.11, aiogram 3.x, python -m benchmarks.startup_bench):
+    импорт aiogram            ~4-6 с  (сборка pydantic-моделей aiogram.types; нужны диспетчеру - не ленивятся)
+    свои модули + хендлеры   ~0.06 с
+    init_db / restore FSM     ~3 мс / ~3 мс
+    диспетчер + роутеры       ~1 мс
+Дальше в пределах бюджета держат: webhook_server/sharding (aiohttp.web) импортируются только в своем
+режиме; на время прогрева сборщик мусора выключен (импорт aiogram ~5-7% быстрее), а после прогрева
+кучу замораживает gc.freeze() - ~200k долгоживущих объектов (модели aiogram, игровые данные)
+больше не обходятся полной сборкой (~120 мс паузы на каждую).
+"""
+import gc
+import time
+import logging
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable
+
+
+class StartupProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+        self.ready_after: float | None = None
+        self.first_update_after: float | None = None
+        self.frozen_objects = 0
+        self._gc_paused = False
+
+    @contextmanager
+    def phase(self, name: str):
+        """Замер фазы старта: with startup.phase("init_db"): ..."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def pause_gc(self):
+        """До импортов: сборщик не обходит растущую кучу на прогреве; включает обратно freeze_heap()."""
+        gc.disable()
+        self._gc_paused = True
+
+    def freeze_heap(self):
+        """После прогрева: все живые объекты - в постоянное поколение, полная сборка их не обходит."""
+        with self.phase("gc.freeze"):
+            if not self._gc_paused:
+                gc.collect() # Иначе циклический мусор прогрева (немного) остается замороженным
+            gc.freeze()
+            gc.enable()
+        self._gc_paused = False
+        self.frozen_objects = gc.get_freeze_count()
+
+    def mark_ready(self, budget: float | None = None) -> float:
+        """Диспетчер принимает апдейты: пишет отчет, предупреждает при превышении бюджета."""
+        self.ready_after = time.perf_counter() - self.started
+        logging.info(f"Startup profile:\n{self.report()}")
+        if budget and self.ready_after > budget:
+            logging.warning(f"Cold start took {self.ready_after:.2f}s, over the {budget:.2f}s budget.")
+        return self.ready_after
+
+    def mark_first_update(self):
+        if self.first_update_after is not None:
+            return
+        self.first_update_after = time.perf_counter() - self.started
+        logging.info(f"First update handled {self.first_update_after:.2f}s after start.")
+
+    def report(self) -> str:
+        lines = [f"  {name:<24} {seconds * 1000:>9.1f} ms" for name, seconds in self.phases]
+        if self.frozen_objects:
+            lines.append(f"  {'frozen objects':<24} {self.frozen_objects:>9}")
+        if self.ready_after is not None:
+            lines.append(f"  {'ready after':<24} {self.ready_after * 1000:>9.1f} ms")
+        return "\n".join(lines)
+
+
+class FirstUpdateMiddleware:
+    """
+    Outer-middleware на dp.update: отмечает время первого апдейта (дальше - одна проверка).
+    Без BaseMiddleware: модуль импортируется до aiogram, иначе его импорт не попал бы в замер.
+    """
+
+    def __init__(self, profile: StartupProfile):
+        self.profile = profile
+
+    async def __call__(self, handler: Callable[[Any, dict[str, Any]], Awaitable[Any]], event: Any, data: dict[str, Any]) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            if self.profile.first_update_after is None:
+                self.profile.mark_first_update()
+
+
+# Профиль текущего процесса
+startup = StartupProfile()
@@ -0,0 +1,2 @@
+# tools/__init__.py
+"""Служебные утилиты для разбора инцидентов и эксплуатации. Запуск из папки PoeGame: python -m tools.<модуль>"""
@@ -0,0 +1,69 @@
+# tools/combat_replay.py
+"""
+Поиск боев игрока в бинарном журнале (combat_log) и их переигровка по правилам combat_engine.
+Для каждого боя печатает исход и совпал ли пересчет с записанными бросками/уроном/виталами;
+с -v - все события боя.
+
+Запуск из папки PoeGame:
+    python -m tools.combat_replay --user-id 123456789
+    python -m tools.combat_replay --user-id 123456789 --since "2026-10-19 18:00" --until "2026-10-19 19:00" -v
+"""
+import logging
+import argparse
+from datetime import datetime
+
+from log_setup import setup_logging
+from config import COMBAT_LOG_DIR
+from combat_log import EVENT_NAMES, find_fights, load_fight, replay_fight
+
+
+def _parse_time(value: str | None) -> int | None:
+    """'YYYY-MM-DD[ HH:MM[:SS]]' (локальное время) -> мс."""
+    if value is None:
+        return None
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+def _format_ms(ts_ms: int) -> str:
+    return datetime.fromtimestamp(ts_ms / 1000).strftime("%Y-%m-%d %H:%M:%S")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tools.combat_replay", description="Find and replay logged fights of a player.")
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--since", help="start of period, e.g. '2026-10-19 18:00'")
+    parser.add_argument("--until", help="end of period")
+    parser.add_argument("--last", type=int, default=20, help="only the N most recent fights")
+    parser.add_argument("--dir", default=COMBAT_LOG_DIR, help="combat log directory")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every event of each fight")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(logging.WARNING, queued=False)
+    fights = find_fights(args.dir, args.user_id, _parse_time(args.since) or 0, _parse_time(args.until))[-args.last:]
+    if not fights:
+        print(f"No fights of user {args.user_id} found in {args.dir}")
+        return
+    mismatches = 0
+    for segment_path, offset, fight_id, ts_ms in fights:
+        events = load_fight(args.dir, segment_path, offset, args.user_id, fight_id)
+        start = events[0].data
+        combat = start['combat']
+        result = replay_fight(events)
+        mismatches += not result['ok']
+        status = "OK" if result['ok'] else "MISMATCH"
+        resumed = " (resumed)" if start.get('resumed') else ""
+        print(f"{_format_ms(ts_ms)} fight {fight_id:08x}{resumed}: {start['kind']} '{combat[2]}' "
+              f"hp {combat[3]}/{combat[4]} | player HP {start['player']['current_hp']}/{start['player']['max_hp']} "
+              f"| {result['turns']} turns, outcome {result['outcome'] or 'open'} | replay {status}")
+        if result['mismatch']:
+            print(f"    {result['mismatch']}")
+        if args.verbose:
+            for event in events[1:]:
+                print(f"    {_format_ms(event.ts_ms)} {EVENT_NAMES.get(event.kind, event.kind):<5} {event.data}")
+    print(f"{len(fights)} fight(s), {mismatches} mismatch(es)")
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
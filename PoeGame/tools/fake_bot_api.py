@@ -0,0 +1,382 @@
+# tools/fake_bot_api.py
+"""
+Локальный заменитель Telegram Bot API (aiohttp) для нагрузочных тестов и замеров задержек без сети.
+Методы: getMe, getUpdates (long polling), setWebhook/deleteWebhook/getWebhookInfo (апдейты POST-ятся
+на вебхук бота с секретом, как это делает Telegram), sendMessage, editMessageText,
+editMessageReplyMarkup, answerCallbackQuery, deleteMessage; остальные методы отвечают ok.
+Сообщения хранятся (чат -> message_id -> текст/клавиатура), правка без изменений дает
+400 "message is not modified", как у Telegram.
+Инъекции: задержка ответа (+ случайный разброс), доля 5xx и 429 (retry_after) на исходящих методах,
+лимиты частоты как у Telegram (скользящее окно 1 с на чат и на бота). Каждый вызов записывается.
+
+Бот направляется сюда через BOT_TELEGRAM_API_URL (config.py). Управление (для генератора нагрузки):
+    POST /fake/updates   - апдейт или список апдейтов (в очередь getUpdates или на вебхук)
+    GET  /fake/stats     - счетчики по методам, 429/5xx, доставка на вебхук
+    GET  /fake/calls?since=N - записанные вызовы с номера N
+
+Запуск из папки PoeGame:
+    python -m tools.fake_bot_api --port 8081 --latency-ms 40 --jitter-ms 20 --error-rate 0.01 --flood-rate 0.01
+    BOT_TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+"""
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web, ClientSession, ClientTimeout
+
+from log_setup import setup_logging
+
+GET_UPDATES_LIMIT = 100
+INJECTED_METHODS = frozenset({"sendMessage", "editMessageText", "editMessageReplyMarkup", "answerCallbackQuery", "deleteMessage"})
+WEBHOOK_TIMEOUT = 60 # Сек на ответ вебхука бота
+
+
+class ApiCall:
+    __slots__ = ('at', 'method', 'params', 'status', 'elapsed')
+
+    def __init__(self, at: float, method: str, params: dict, status: int, elapsed: float):
+        self.at = at # Сек от старта сервера
+        self.method = method
+        self.params = params
+        self.status = status
+        self.elapsed = elapsed # Сек на ответ (с инъекцией задержки)
+
+    def as_dict(self) -> dict:
+        return {'at': self.at, 'method': self.method, 'params': self.params, 'status': self.status, 'elapsed': self.elapsed}
+
+
+def _error(code: int, description: str, retry_after: int | None = None) -> web.Response:
+    payload = {"ok": False, "error_code": code, "description": description}
+    if retry_after is not None:
+        payload["parameters"] = {"retry_after": retry_after}
+    return web.json_response(payload, status=code)
+
+def _ok(result) -> web.Response:
+    return web.json_response({"ok": True, "result": result})
+
+def _json_param(params: dict, name: str):
+    value = params.get(name)
+    return json.loads(value) if isinstance(value, str) and value else value
+
+
+# --- Готовые апдейты (генератор нагрузки, бенчмарки) ---
+def make_message_update(update_id: int, user_id: int, text: str, message_id: int | None = None) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id or update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"load{user_id}"},
+        },
+    }
+
+def make_callback_update(update_id: int, user_id: int, message_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "chat_instance": str(user_id), "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"load{user_id}"},
+            "message": {"message_id": message_id, "date": int(time.time()), "text": "",
+                        "chat": {"id": user_id, "type": "private"}},
+        },
+    }
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, chat_limit: int | None = None, global_limit: int | None = None,
+                 record_params: bool = True, seed: int | None = None):
+        self.latency = latency # Сек
+        self.jitter = jitter # Сек, равномерно 0..jitter сверху
+        self.error_rate = error_rate # Доля 500 на INJECTED_METHODS
+        self.flood_rate = flood_rate # Доля 429 на INJECTED_METHODS
+        self.retry_after = retry_after
+        self.chat_limit = chat_limit # Запросов в чат за 1 с (None - без лимита)
+        self.global_limit = global_limit # Запросов на бота за 1 с
+        self.record_params = record_params
+        self._random = random.Random(seed)
+        self._started = time.monotonic()
+        self.bot_id = 0 # Из токена последнего запроса
+        # Апдейты
+        self._updates: deque[dict] = deque()
+        self._arrived = asyncio.Event()
+        self.webhook: dict | None = None # url, secret_token, max_connections
+        self._webhook_session: ClientSession | None = None
+        self._webhook_slots: asyncio.Semaphore | None = None
+        self._deliveries: set[asyncio.Task] = set()
+        # Сообщения: чат -> message_id -> {"text", "reply_markup"}
+        self.messages: dict[str, dict[int, dict]] = defaultdict(dict)
+        self._next_message_id: dict[str, int] = defaultdict(lambda: 1_000_000)
+        # Лимиты частоты
+        self._chat_hits: dict[str, deque] = defaultdict(deque)
+        self._global_hits: deque = deque()
+        # Запись вызовов и метрики
+        self.calls: list[ApiCall] = []
+        self.by_method: Counter = Counter()
+        self.flood_errors = 0
+        self.server_errors = 0
+        self.delivered = 0
+        self.delivery_failed = 0
+
+    # --- Апдейты ---
+    def push(self, update: dict):
+        """Новый апдейт: в очередь getUpdates или (вебхук задан) POST на сервер бота."""
+        if self.webhook is None:
+            self._updates.append(update)
+            self._arrived.set()
+            return
+        task = asyncio.create_task(self._deliver(update))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, update: dict):
+        webhook = self.webhook
+        headers = {"X-Telegram-Bot-Api-Secret-Token": webhook['secret_token']} if webhook['secret_token'] else {}
+        async with self._webhook_slots: # Как Telegram: не больше max_connections параллельно
+            try:
+                async with self._webhook_session.post(webhook['url'], json=update, headers=headers) as response:
+                    await response.read()
+                    ok = response.status == 200
+            except Exception as e:
+                logging.debug("Webhook delivery of update %s failed: %s", update.get('update_id'), e)
+                ok = False
+        if ok:
+            self.delivered += 1
+        else:
+            self.delivery_failed += 1
+
+    async def _get_updates(self, params: dict) -> web.Response:
+        if self.webhook is not None:
+            return _error(409, "Conflict: can't use getUpdates method while webhook is active; use deleteWebhook to delete the webhook first")
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or GET_UPDATES_LIMIT)
+        timeout = float(params.get('timeout') or 0)
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft() # Подтверждены offset'ом
+        if not self._updates and timeout:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return _ok([self._updates[i] for i in range(min(limit, len(self._updates)))])
+
+    async def _set_webhook(self, params: dict) -> web.Response:
+        if not params.get('url'):
+            return await self._delete_webhook(params)
+        self.webhook = {'url': params['url'], 'secret_token': params.get('secret_token'),
+                        'max_connections': int(params.get('max_connections') or 40)}
+        self._webhook_slots = asyncio.Semaphore(self.webhook['max_connections'])
+        if self._webhook_session is None:
+            self._webhook_session = ClientSession(timeout=ClientTimeout(total=WEBHOOK_TIMEOUT))
+        if params.get('drop_pending_updates') in ("true", "True", "1"):
+            self._updates.clear()
+        for update in list(self._updates): # Накопленное за время без вебхука уходит на вебхук
+            self.push(update)
+        self._updates.clear()
+        return _ok(True)
+
+    async def _delete_webhook(self, params: dict) -> web.Response:
+        self.webhook = None
+        if params.get('drop_pending_updates') in ("true", "True", "1"):
+            self._updates.clear()
+        return _ok(True)
+
+    # --- Сообщения ---
+    def _message(self, chat_id: str, message_id: int, text: str | None, reply_markup) -> dict:
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": int(chat_id or 0), "type": "private"},
+                   "from": {"id": self.bot_id, "is_bot": True, "first_name": "fake"}}
+        if text is not None:
+            message["text"] = text
+        if reply_markup and 'inline_keyboard' in reply_markup: # Обычную клавиатуру Telegram в Message не возвращает
+            message["reply_markup"] = reply_markup
+        return message
+
+    def _send_message(self, params: dict) -> web.Response:
+        chat_id = params.get('chat_id', '')
+        message_id = self._next_message_id[chat_id]
+        self._next_message_id[chat_id] += 1
+        reply_markup = _json_param(params, 'reply_markup')
+        self.messages[chat_id][message_id] = {"text": params.get('text', ''), "reply_markup": reply_markup}
+        return _ok(self._message(chat_id, message_id, params.get('text', ''), reply_markup))
+
+    def _edit_message(self, params: dict, text_changes: bool) -> web.Response:
+        if params.get('inline_message_id'):
+            return _ok(True)
+        chat_id = params.get('chat_id', '')
+        message_id = int(params.get('message_id') or 0)
+        stored = self.messages[chat_id].get(message_id)
+        if stored is None:
+            # Сообщение отправлено не через этот сервер (апдейты генератора) - заводим его с этой правки
+            stored = self.messages[chat_id][message_id] = {"text": None, "reply_markup": None}
+        new_text = params.get('text', '') if text_changes else stored['text']
+        new_markup = _json_param(params, 'reply_markup')
+        if new_text == stored['text'] and new_markup == stored['reply_markup']:
+            return _error(400, "Bad Request: message is not modified: specified new message content and reply markup "
+                               "are exactly the same as a current content and reply markup of the message")
+        stored['text'], stored['reply_markup'] = new_text, new_markup
+        return _ok(self._message(chat_id, message_id, new_text, new_markup))
+
+    def _delete_message(self, params: dict) -> web.Response:
+        chat_id = params.get('chat_id', '')
+        self.messages[chat_id].pop(int(params.get('message_id') or 0), None)
+        return _ok(True)
+
+    # --- Инъекции ---
+    def _rate_limited(self, chat_id: str) -> bool:
+        if self.chat_limit is None and self.global_limit is None:
+            return False
+        now = time.monotonic()
+        chat_hits = self._chat_hits[chat_id]
+        for hits in (chat_hits, self._global_hits):
+            while hits and hits[0] <= now - 1.0:
+                hits.popleft()
+        if (self.chat_limit is not None and len(chat_hits) >= self.chat_limit) or \
+                (self.global_limit is not None and len(self._global_hits) >= self.global_limit):
+            return True
+        chat_hits.append(now)
+        self._global_hits.append(now)
+        return False
+
+    def _injected_error(self, method: str, params: dict) -> web.Response | None:
+        if method not in INJECTED_METHODS:
+            return None
+        roll = self._random.random()
+        if roll < self.flood_rate or self._rate_limited(params.get('chat_id', '')):
+            self.flood_errors += 1
+            return _error(429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+        if roll < self.flood_rate + self.error_rate:
+            self.server_errors += 1
+            return _error(500, "Internal Server Error")
+        return None
+
+    # --- HTTP ---
+    async def handle(self, request: web.Request) -> web.Response:
+        started = time.monotonic()
+        method = request.match_info['method']
+        self.bot_id = int(request.match_info['token'].split(":")[0] or 0)
+        if request.content_type == "application/json":
+            params = await request.json() if request.can_read_body else {}
+        else:
+            params = dict(await request.post()) if request.can_read_body else {}
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._random.random() * self.jitter)
+        response = self._injected_error(method, params) or await self._dispatch(method, params)
+        self.by_method[method] += 1
+        self.calls.append(ApiCall(started - self._started, method, params if self.record_params else {},
+                                  response.status, time.monotonic() - started))
+        return response
+
+    async def _dispatch(self, method: str, params: dict) -> web.Response:
+        if method == "getMe":
+            return _ok({"id": self.bot_id, "is_bot": True, "first_name": "fake", "username": "fake_bot"})
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "setWebhook":
+            return await self._set_webhook(params)
+        if method == "deleteWebhook":
+            return await self._delete_webhook(params)
+        if method == "getWebhookInfo":
+            return _ok({"url": self.webhook['url'] if self.webhook else "", "has_custom_certificate": False,
+                        "pending_update_count": len(self._updates) + len(self._deliveries)})
+        if method == "sendMessage":
+            return self._send_message(params)
+        if method == "editMessageText":
+            return self._edit_message(params, text_changes=True)
+        if method == "editMessageReplyMarkup":
+            return self._edit_message(params, text_changes=False)
+        if method == "deleteMessage":
+            return self._delete_message(params)
+        return _ok(True) # answerCallbackQuery и прочие
+
+    async def handle_push(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        updates = payload if isinstance(payload, list) else [payload]
+        for update in updates:
+            self.push(update)
+        return web.json_response({"ok": True, "pushed": len(updates)})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    async def handle_calls(self, request: web.Request) -> web.Response:
+        since = int(request.query.get('since', 0))
+        return web.json_response({"next": len(self.calls), "calls": [c.as_dict() for c in self.calls[since:]]})
+
+    def stats(self) -> dict:
+        return {'calls': len(self.calls), 'by_method': dict(self.by_method), 'http_429': self.flood_errors,
+                'http_5xx': self.server_errors, 'queued_updates': len(self._updates),
+                'webhook': self.webhook['url'] if self.webhook else None,
+                'delivered': self.delivered, 'delivery_failed': self.delivery_failed,
+                'delivering': len(self._deliveries)}
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/bot{token}/{method}", self.handle)
+        app.router.add_post("/fake/updates", self.handle_push)
+        app.router.add_get("/fake/stats", self.handle_stats)
+        app.router.add_get("/fake/calls", self.handle_calls)
+        app.on_cleanup.append(lambda app: self.close())
+        return app
+
+    async def close(self):
+        for task in list(self._deliveries):
+            task.cancel()
+        if self._webhook_session is not None:
+            await self._webhook_session.close()
+            self._webhook_session = None
+
+
+async def start_fake_api(api: FakeBotAPI, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, str]:
+    """Поднимает сервер в текущем цикле; возвращает (runner, базовый URL для TelegramAPIServer.from_base)."""
+    runner = web.AppRunner(api.build_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tools.fake_bot_api", description="Local Telegram Bot API stand-in.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of 500 answers on outgoing methods")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Share of 429 answers on outgoing methods")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--chat-limit", type=int, default=None, help="Requests per chat per second before 429")
+    parser.add_argument("--global-limit", type=int, default=None, help="Requests per bot per second before 429")
+    parser.add_argument("--no-params", action="store_true", help="Record calls without parameters (long runs)")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+async def _serve(args):
+    api = FakeBotAPI(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, error_rate=args.error_rate,
+                     flood_rate=args.flood_rate, retry_after=args.retry_after, chat_limit=args.chat_limit,
+                     global_limit=args.global_limit, record_params=not args.no_params, seed=args.seed)
+    runner, url = await start_fake_api(api, args.host, args.port)
+    logging.warning(f"Fake Bot API listening on {url} (set BOT_TELEGRAM_API_URL={url}).")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        logging.warning(f"Fake Bot API stopped: {api.stats()}")
+        await runner.cleanup()
+
+def main(argv=None):
+    setup_logging(logging.WARNING, queued=False)
+    try:
+        asyncio.run(_serve(parse_args(argv)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
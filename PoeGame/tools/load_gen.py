@@ -0,0 +1,420 @@
+# tools/load_gen.py
+"""
+Нагрузочный тест: тысячи виртуальных игроков ходят по боту, как живые.
+Каждый игрок - /start, потом сценарии с весами и паузами "на подумать": профиль, бой с монстром
+(атаки до конца боя, иногда авто-бой или надеть предмет посреди боя), босс, покупки в магазинах, гемблер, инвентарь
+(надеть/продать), лекарь, ежедневная награда, рейтинг. Кнопки игрок берет из последней
+клавиатуры, которую бот прислал ему в чат (tools/fake_bot_api.py хранит сообщения), - как человек.
+
+Апдейты подаются в Dispatcher.feed_update в этом же процессе (диспетчер, middleware и роутеры
+бота - настоящие, build_dispatcher из bot.py); ответы бота уходят в поддельный Bot API.
+БД, FSM и журнал боев - во временном каталоге (--db - стартовать с копии существующей БД).
+
+Отчет: пропускная способность, p50/p95/p99 задержки апдейта (от подачи до конца обработки,
+включая ожидание замка игрока и очереди исходящих) по роутерам и хендлерам, SQL-запросов,
+соединений и строк на апдейт (database/query_stats.py), самые дорогие по БД хендлеры
+(middlewares/query_budget.py), лаг цикла событий, переигровка всех боев по журналу
+(совпали ли ходы с правилами combat_engine). Результат сохраняется в JSON (--out), --compare - сравнение
+с прошлым прогоном.
+Исходящие по умолчанию идут через outbound.py с лимитами Telegram (30 сообщений/с на бота, 1/с в чат):
+при сотнях активных игроков задержка упирается в них, а не в бота; --no-outbound - задержка самого бота.
+
+Запуск из папки PoeGame:
+    python -m tools.load_gen --players 1000 --duration 60 --out load.json
+    python -m tools.load_gen --players 1000 --duration 60 --out load2.json --compare load.json
+"""
+import os
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import statistics
+from collections import defaultdict
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.types import Update
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from log_setup import setup_logging
+from database.query_stats import UpdateQueries, update_scope
+from middlewares.query_budget import query_budget, UNHANDLED
+from tools.fake_bot_api import FakeBotAPI, start_fake_api, make_message_update, make_callback_update
+
+TOKEN = "42:LOAD"
+FIRST_USER_ID = 7_000_000
+MAX_FIGHT_TURNS = 40
+MID_FIGHT_EQUIP_CHANCE = 0.15 # Доля боев, где игрок посреди боя надевает предмет (пересъемка сессии)
+LAG_INTERVAL = 0.1 # Сек между замерами лага цикла событий
+SCENARIO_WEIGHTS = {
+    'fight': 35, 'profile': 12, 'inventory': 10, 'healer': 10, 'gambler': 8,
+    'shop': 8, 'boss': 7, 'daily': 5, 'rating': 5,
+}
+
+
+# --- Статистика ---
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    if len(values) == 1:
+        return {'p50': values[0], 'p95': values[0], 'p99': values[0], 'max': values[0]}
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return {'p50': q[49], 'p95': q[94], 'p99': q[98], 'max': max(values)}
+
+
+class LoadStats:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = defaultdict(list) # Хендлер -> мс
+        self.db_statements: dict[str, int] = defaultdict(int)
+        self.db_connections: dict[str, int] = defaultdict(int)
+        self.db_rows: dict[str, int] = defaultdict(int)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.loop_lag: list[float] = [] # мс
+
+    def record(self, name: str, ms: float, queries: UpdateQueries, error: bool):
+        self.latency[name].append(ms)
+        self.db_statements[name] += queries.queries
+        self.db_connections[name] += queries.connections
+        self.db_rows[name] += queries.rows
+        if error:
+            self.errors[name] += 1
+
+    def report(self, elapsed: float) -> dict:
+        all_ms = [ms for values in self.latency.values() for ms in values]
+        total = len(all_ms)
+        handlers = {}
+        routers: dict[str, list[float]] = defaultdict(list)
+        for name, values in sorted(self.latency.items(), key=lambda kv: -len(kv[1])):
+            handlers[name] = {'count': len(values), 'errors': self.errors.get(name, 0), **_percentiles(values),
+                              'db_statements_avg': self.db_statements[name] / len(values),
+                              'db_connections_avg': self.db_connections[name] / len(values),
+                              'db_rows_avg': self.db_rows[name] / len(values)}
+            routers[name.split(".", 1)[0]].extend(values)
+        return {
+            'updates': total, 'errors': sum(self.errors.values()), 'throughput_ups': total / elapsed if elapsed else 0.0,
+            'latency_ms': _percentiles(all_ms),
+            'db_statements_per_update': sum(self.db_statements.values()) / total if total else 0.0,
+            'db_connections_per_update': sum(self.db_connections.values()) / total if total else 0.0,
+            'db_rows_per_update': sum(self.db_rows.values()) / total if total else 0.0,
+            'loop_lag_ms': _percentiles(self.loop_lag),
+            'routers': {name: {'count': len(values), **_percentiles(values)}
+                        for name, values in sorted(routers.items(), key=lambda kv: -len(kv[1]))},
+            'handlers': handlers,
+        }
+
+
+# --- Генератор ---
+class LoadGenerator:
+    def __init__(self, dp, bot: Bot, api, args):
+        self.dp = dp
+        self.bot = bot
+        self.api = api
+        self.args = args
+        self.stats = LoadStats()
+        self.random = random.Random(args.seed)
+        self._update_id = 0
+        self._stop_at = 0.0
+        self._bucket = None
+        if args.rate:
+            from outbound import TokenBucket # Общий лимит подачи апдейтов
+            self._bucket = TokenBucket(args.rate, max(1.0, args.rate / 10), time.monotonic())
+
+    @property
+    def running(self) -> bool:
+        return time.monotonic() < self._stop_at
+
+    async def feed(self, raw: dict):
+        """Подать апдейт и дождаться конца обработки (игрок ждет ответа, как в клиенте Telegram)."""
+        if self._bucket is not None:
+            while (wait := self._bucket.wait_time(time.monotonic())) > 0:
+                await asyncio.sleep(wait)
+            self._bucket.take(time.monotonic())
+        update = Update.model_validate(raw, context={"bot": self.bot})
+        error = False
+        # Счетчики БД апдейта; query_budget внутри диспетчера пишет в этот же объект (и хендлер)
+        with update_scope() as queries:
+            started = time.perf_counter()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                error = True
+                logging.warning("Update %s failed: %s", raw['update_id'], e, exc_info=True)
+            ms = (time.perf_counter() - started) * 1000
+        self.stats.record(queries.handler or UNHANDLED, ms, queries, error)
+
+    def next_update_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    async def monitor_loop_lag(self):
+        while True:
+            expected = time.perf_counter() + LAG_INTERVAL
+            await asyncio.sleep(LAG_INTERVAL)
+            self.stats.loop_lag.append(max(0.0, time.perf_counter() - expected) * 1000)
+
+    async def run(self) -> float:
+        players = [VirtualPlayer(self, FIRST_USER_ID + i) for i in range(self.args.players)]
+        started = time.monotonic()
+        self._stop_at = started + self.args.ramp + self.args.duration
+        lag = asyncio.create_task(self.monitor_loop_lag())
+        tasks = [asyncio.create_task(p.run(self.args.ramp * i / len(players))) for i, p in enumerate(players)]
+        await asyncio.gather(*tasks)
+        lag.cancel()
+        return time.monotonic() - started
+
+
+class VirtualPlayer:
+    def __init__(self, gen: LoadGenerator, user_id: int):
+        self.gen = gen
+        self.user_id = user_id
+        self.random = random.Random(gen.random.random())
+
+    async def think(self, scale: float = 1.0):
+        await asyncio.sleep(self.random.expovariate(1000 / (self.gen.args.think_ms * scale)))
+
+    async def text(self, text: str):
+        update_id = self.gen.next_update_id()
+        await self.gen.feed(make_message_update(update_id, self.user_id, text))
+
+    def _buttons(self, prefix: str, avoid: tuple = (), search: bool = False) -> tuple[int, list[str]]:
+        """
+        Последнее сообщение чата с inline-клавиатурой: (message_id, подходящие callback_data).
+        search - последнее сообщение, где такие кнопки есть (вернуться к бою после другого меню).
+        """
+        messages = self.gen.api.messages.get(str(self.user_id), {})
+        for message_id in sorted(messages, reverse=True):
+            markup = messages[message_id]['reply_markup']
+            if markup and 'inline_keyboard' in markup:
+                data = [b.get('callback_data') or "" for row in markup['inline_keyboard'] for b in row]
+                choices = [d for d in data if d.startswith(prefix) and not d.startswith(avoid)]
+                if choices or not search:
+                    return message_id, choices
+        return 0, []
+
+    async def press(self, prefix: str, avoid: tuple = (), search: bool = False) -> bool:
+        """Нажать случайную кнопку с таким префиксом в последней клавиатуре; False - такой кнопки нет."""
+        message_id, choices = self._buttons(prefix, avoid, search)
+        if not choices:
+            return False
+        await self.gen.feed(make_callback_update(self.gen.next_update_id(), self.user_id, message_id, self.random.choice(choices)))
+        return True
+
+    # --- Сценарии ---
+    async def fight(self):
+        await self.text("⚔️ Бой с монстром")
+        auto = self.random.random() < 0.2
+        # Иногда игрок посреди боя надевает предмет - бой продолжается с пересъемкой статов
+        equip_turn = self.random.randrange(1, 6) if self.random.random() < MID_FIGHT_EQUIP_CHANCE else None
+        for turn in range(MAX_FIGHT_TURNS):
+            await self.think(0.5)
+            if turn == equip_turn:
+                await self.inventory(action="inv:equip:")
+                await self.think(0.5)
+            prefix = "fight_action:auto_attack:" if auto else "fight_action:attack:"
+            if not await self.press(prefix, search=turn == equip_turn) or not self.gen.running:
+                break
+
+    async def boss(self):
+        await self.text("💀 Бой с боссом")
+        await self.think(0.5)
+        if not await self.press("boss_select:", avoid=("boss_select:cancel",)):
+            await self.press("boss_select:cancel")
+            return
+        for _ in range(MAX_FIGHT_TURNS):
+            await self.think(0.5)
+            if not await self.press("boss_action:attack:") or not self.gen.running:
+                break
+
+    async def shop(self):
+        shop_type = self.random.choice(("weapon", "armor"))
+        await self.text("🛒 Магазин оружия" if shop_type == "weapon" else "🛡️ Магазин брони")
+        await self.think(0.5)
+        if not await self.press(f"shop:{shop_type}:buy:"):
+            await self.press(f"shop:{shop_type}:close")
+
+    async def gambler(self):
+        await self.text("🎲 Гемблер")
+        await self.think(0.5)
+        if not await self.press("gamble:", avoid=("gamble:info", "gamble:close")):
+            await self.press("gamble:close")
+
+    async def inventory(self, action: str | None = None):
+        await self.text("🎒 Инвентарь")
+        await self.think(0.5)
+        action = action or self.random.choice(("inv:equip:", "inv:sell:"))
+        if await self.press(action) and action == "inv:equip:":
+            await self.think(0.5)
+            await self.press("equip_slot:") # Кольцо/слот, если бот спросил (иногда - отмена)
+
+    async def healer(self):
+        await self.text("⚕️ Лекарь")
+        await self.think(0.5)
+        await self.press("heal:", avoid=("heal:cancel",))
+
+    async def profile(self):
+        await self.text("👤 Профиль")
+
+    async def daily(self):
+        await self.text("🎁 Ежедневная награда")
+
+    async def rating(self):
+        await self.text("🏆 Рейтинг")
+        await self.think(0.5)
+        await self.press("rank:", avoid=("rank:close",))
+
+    async def run(self, delay: float):
+        await asyncio.sleep(delay)
+        await self.text("/start")
+        names = list(SCENARIO_WEIGHTS)
+        weights = list(SCENARIO_WEIGHTS.values())
+        while self.gen.running:
+            await self.think()
+            if not self.gen.running:
+                break
+            await getattr(self, self.random.choices(names, weights)[0])()
+
+
+# --- Запуск ---
+def replay_combat_log(directory: str) -> dict:
+    """
+    Переигровка всех боев прогона по журналу (combat_log.replay_fight). Бой с пересъемкой статов
+    посреди боя (надел предмет) - два отрезка: до пересъемки и продолженный (resumed) с новым START.
+    """
+    from combat_log import load_all_fights, replay_fight
+    fights = load_all_fights(directory)
+    mismatches = []
+    resumed = 0
+    for (user_id, fight_id), events in fights.items():
+        resumed += bool(events[0].data.get('resumed'))
+        result = replay_fight(events)
+        if not result['ok']:
+            mismatches.append(f"user {user_id} fight {fight_id:08x}: {result['mismatch']}")
+    return {'fights': len(fights), 'resumed': resumed, 'mismatches': len(mismatches), 'examples': mismatches[:5]}
+
+async def run_load(args) -> dict:
+    import bot as bot_module # Диспетчер, middleware и роутеры - как в боте
+    import database.db_manager as dbm
+    from combat_log import combat_events
+    from combat_session import combat_sessions
+    from fsm_storage import SQLiteStorage
+    from outbound import outbound
+
+    workdir = tempfile.mkdtemp(prefix="load_gen_")
+    dbm.DB_NAME = os.path.join(workdir, "poe_bot.db")
+    if args.db:
+        shutil.copy(args.db, dbm.DB_NAME) # Исходная БД не меняется
+    await dbm.init_db()
+    combat_events.directory = os.path.join(workdir, "combat_log")
+    storage = SQLiteStorage(os.path.join(workdir, "fsm_state.db"))
+    await storage.restore()
+
+    api = FakeBotAPI(latency=args.api_latency_ms / 1000, jitter=args.api_jitter_ms / 1000, record_params=False, seed=args.seed)
+    runner, url = await start_fake_api(api)
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(url)), default=DefaultBotProperties(parse_mode="HTML"))
+    if not args.no_outbound:
+        bot.session.middleware(outbound)
+    dp = bot_module.build_dispatcher(storage)
+
+    background = [asyncio.create_task(storage.run_flush_loop()), asyncio.create_task(combat_events.run_flush_loop()),
+                  asyncio.create_task(combat_sessions.run_expiry_loop())]
+    gen = LoadGenerator(dp, bot, api, args)
+    try:
+        elapsed = await gen.run()
+    finally:
+        for task in background:
+            task.cancel()
+        await combat_sessions.checkpoint_all()
+        await storage.close()
+        await combat_events.close()
+        await outbound.close()
+        await bot.session.close()
+        await runner.cleanup()
+        replay = replay_combat_log(combat_events.directory) # Журнал - до удаления каталога
+        if args.keep:
+            print(f"Work directory kept: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = gen.stats.report(elapsed)
+    return {'started': datetime.now().isoformat(timespec="seconds"), 'elapsed_s': elapsed,
+            'config': {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+            **report, 'db_budget': {'queries': query_budget.queries, 'connections': query_budget.connections,
+                                    'rows': query_budget.rows, 'top_handlers': query_budget.report()},
+            'api': api.stats(), 'outbound': outbound.stats(), 'replay': replay}
+
+
+def print_report(result: dict, previous: dict | None = None):
+    lat = result['latency_ms']
+    print(f"updates {result['updates']} in {result['elapsed_s']:.1f}s: {result['throughput_ups']:.1f} upd/s, "
+          f"errors {result['errors']}, p50/p95/p99 {lat['p50']:.1f}/{lat['p95']:.1f}/{lat['p99']:.1f} ms")
+    print(f"db: {result['db_statements_per_update']:.1f} statements, {result['db_connections_per_update']:.2f} connections, "
+          f"{result['db_rows_per_update']:.1f} rows per update; "
+          f"loop lag p50/p99/max {result['loop_lag_ms']['p50']:.1f}/{result['loop_lag_ms']['p99']:.1f}/{result['loop_lag_ms']['max']:.1f} ms")
+    replay = result['replay']
+    print(f"combat log replay: {replay['fights']} fights ({replay['resumed']} resumed), {replay['mismatches']} mismatch(es)")
+    for example in replay['examples']:
+        print(f"    {example}")
+    for section in ("routers", "handlers"):
+        old = (previous or {}).get(section, {})
+        print(f"\n{section[:-1]:<40} {'count':>7} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} {'max_ms':>8}"
+              + (f" {'db/upd':>7} {'err':>5}" if section == "handlers" else "") + (f" {'p95_was':>8}" if previous else ""))
+        for name, row in result[section].items():
+            line = f"{name:<40} {row['count']:>7} {row['p50']:>8.1f} {row['p95']:>8.1f} {row['p99']:>8.1f} {row['max']:>8.1f}"
+            if section == "handlers":
+                line += f" {row['db_statements_avg']:>7.1f} {row['errors']:>5}"
+            if previous:
+                line += f" {old[name]['p95']:>8.1f}" if name in old else f" {'-':>8}"
+            print(line)
+    budget = result['db_budget']
+    print(f"\ntop DB handlers (budget {budget['queries']} queries, {budget['connections']} connections, {budget['rows']} rows per update)")
+    print(f"{'handler':<40} {'updates':>7} {'over':>6} {'q_avg':>6} {'q_max':>6} {'conn':>5} {'rows':>7}  worst update calls")
+    for row in budget['top_handlers']:
+        print(f"{row['handler']:<40} {row['updates']:>7} {row['over_budget']:>6} {row['queries_avg']:>6.1f} {row['queries_max']:>6} "
+              f"{row['connections_avg']:>5.1f} {row['rows_avg']:>7.1f}  {row['worst_calls']}")
+    if previous:
+        print(f"\nthroughput {previous['throughput_ups']:.1f} -> {result['throughput_ups']:.1f} upd/s, "
+              f"p95 {previous['latency_ms']['p95']:.1f} -> {lat['p95']:.1f} ms, "
+              f"db/update {previous['db_statements_per_update']:.1f} -> {result['db_statements_per_update']:.1f}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tools.load_gen", description="Synthetic player traffic load test.")
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load after ramp-up")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds to spread player starts over")
+    parser.add_argument("--think-ms", type=float, default=1500.0, help="mean pause between player actions")
+    parser.add_argument("--rate", type=float, default=0.0, help="cap on updates per second (0 - players' own pace)")
+    parser.add_argument("--api-latency-ms", type=float, default=30.0, help="fake Bot API response latency")
+    parser.add_argument("--api-jitter-ms", type=float, default=20.0)
+    parser.add_argument("--no-outbound", action="store_true", help="send directly, without the outbound rate limiter")
+    parser.add_argument("--db", default=None, help="start from a copy of this database (default: empty)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--log-file", default=None)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary work directory")
+    parser.add_argument("--out", default=None, help="save the result as JSON")
+    parser.add_argument("--compare", default=None, help="previous JSON result to compare with")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.log_level, args.log_file)
+    result = asyncio.run(run_load(args))
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+    print_report(result, previous)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=1)
+        print(f"\nSaved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# tools/refresh_replay_check.py
+"""
+Проверка журнала боя при пересъемке сессии (combat_sessions.refresh) посреди боя.
+Игрок бьет монстра через настоящие хендлеры (диспетчер из bot.py, поддельный Bot API), на ходу
+REFRESH_AFTER_TURNS надевает предмет, меняющий статы боя (силу и макс. HP), и добивает монстра.
+Затем все бои журнала переигрываются (combat_log.replay_fight): бой должен распасться на отрезок
+до пересъемки (END suspended) и продолженный с новым START (resumed), оба - без расхождений.
+Контроль: те же ходы, склеенные под первым START (как писалось до пересъемки), обязаны разойтись -
+иначе проверка ничего не ловит (предмет не повлиял на бой).
+
+Запуск из папки PoeGame (БД, FSM и журнал - во временном каталоге):
+    python -m tools.refresh_replay_check
+"""
+import os
+import asyncio
+import logging
+import argparse
+import tempfile
+import shutil
+from types import SimpleNamespace
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from log_setup import setup_logging
+from tools.fake_bot_api import FakeBotAPI, start_fake_api
+from tools.load_gen import TOKEN, FIRST_USER_ID, LoadGenerator, VirtualPlayer
+
+ITEM_ID = "leg_chs_002" # Нагрудник: +сила (урон атаки) и +макс. HP
+REFRESH_AFTER_TURNS = 2
+MAX_TURNS = 60
+MAX_FIGHTS = 10 # Боев на попытку дождаться пересъемки посреди боя
+
+
+def check_fights(fights: dict) -> dict:
+    """Переигровка боев журнала + контрольная склейка отрезков боя с пересъемкой."""
+    from combat_log import EVENT_START, EVENT_END, replay_fight
+    results = {key: replay_fight(events) for key, events in fights.items()}
+    resumed = [key for key, events in fights.items() if events[0].data.get('resumed')]
+    control = None
+    if resumed:
+        # Предыдущий отрезок того же игрока - закончился SUSPENDED прямо перед resumed START
+        user_id, fight_id = resumed[0]
+        tail = fights[(user_id, fight_id)]
+        head = next(events for (u, _), events in fights.items()
+                    if u == user_id and events[-1].kind == EVENT_END and events[-1].data['outcome'] == "suspended"
+                    and events[-1].ts_ms <= tail[0].ts_ms)
+        merged = head[:-1] + [event for event in tail if event.kind != EVENT_START]
+        control = replay_fight(merged)
+    return {'fights': len(fights), 'resumed': len(resumed),
+            'mismatches': [f"{key[1]:08x}: {r['mismatch']}" for key, r in results.items() if not r['ok']],
+            'control_ok': None if control is None else control['ok']}
+
+
+async def run_check(seed: int) -> dict:
+    import bot as bot_module # Диспетчер, middleware и роутеры - как в боте
+    import database.db_manager as dbm
+    from combat_log import combat_events, load_all_fights
+    from fsm_storage import SQLiteStorage
+
+    workdir = tempfile.mkdtemp(prefix="refresh_check_")
+    dbm.DB_NAME = os.path.join(workdir, "poe_bot.db")
+    await dbm.init_db()
+    combat_events.directory = os.path.join(workdir, "combat_log")
+    storage = SQLiteStorage(os.path.join(workdir, "fsm_state.db"))
+    await storage.restore()
+    api = FakeBotAPI(record_params=False, seed=seed)
+    runner, url = await start_fake_api(api)
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(url)), default=DefaultBotProperties(parse_mode="HTML"))
+    dp = bot_module.build_dispatcher(storage)
+    gen = LoadGenerator(dp, bot, api, SimpleNamespace(seed=seed, rate=0, think_ms=1.0))
+    player = VirtualPlayer(gen, FIRST_USER_ID)
+    try:
+        await dbm.add_player(player.user_id, "refresh_check")
+        await dbm.add_item_to_inventory(player.user_id, ITEM_ID)
+        refreshed = False
+        for _ in range(MAX_FIGHTS): # Бой кончился раньше хода с пересъемкой - следующий
+            await player.text("⚔️ Бой с монстром")
+            for turn in range(MAX_TURNS):
+                if turn == REFRESH_AFTER_TURNS:
+                    # Инвентарь посреди боя: надеть нагрудник (слот один - без выбора слота)
+                    await player.inventory(action="inv:equip:")
+                    refreshed = await player.press("fight_action:attack:", search=True)
+                    if not refreshed:
+                        break
+                elif not await player.press("fight_action:attack:"):
+                    break
+            if refreshed:
+                break
+        await storage.close()
+        await combat_events.close()
+        result = check_fights(load_all_fights(combat_events.directory))
+        result['errors'] = sum(gen.stats.errors.values())
+        return result
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tools.refresh_replay_check", description="Replay a fight with a mid-fight stat refresh.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    setup_logging(logging.WARNING, queued=False)
+    result = asyncio.run(run_check(args.seed))
+    print(f"{result['fights']} logged fight segment(s), {result['resumed']} resumed after refresh, "
+          f"{len(result['mismatches'])} mismatch(es), handler errors {result['errors']}")
+    for mismatch in result['mismatches']:
+        print(f"    {mismatch}")
+    control = {None: "not run", True: "replays OK - the check is blind", False: "mismatch, as expected"}[result['control_ok']]
+    print(f"control (segments merged under the first START): {control}")
+    if not result['resumed'] or result['mismatches'] or result['errors'] or result['control_ok'] is not False:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
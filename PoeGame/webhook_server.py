@@ -0,0 +1,108 @@
+# webhook_server.py
+"""
+Режим вебхука: aiohttp-приложение, куда Telegram шлет апдейты POST-запросами.
+Запрос проверяется по секретному токену (X-Telegram-Bot-Api-Secret-Token); в фоне апдейт
+обрабатывается сразу после ответа 200. Лимит одновременных обработок и их учет для остановки -
+в middleware shutdown.in_flight (общий с polling), здесь только публичный API aiogram.
+GET /healthz - проверка живости для балансировщика/оркестратора.
+"""
+import time
+import asyncio
+import logging
+from typing import Any
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from combat_session import combat_sessions
+from middlewares.callback_guard import callback_guard
+from middlewares.user_lock import user_locks
+from outbound import outbound
+from shutdown import in_flight
+from config import SHUTDOWN_DRAIN_TIMEOUT
+
+HEALTH_PATH = "/healthz"
+
+
+class WebhookRequestHandler(SimpleRequestHandler):
+    """SimpleRequestHandler, который не закрывает сессию бота при остановке сервера."""
+
+    async def close(self) -> None:
+        # Сессию бота закрывает bot.py после контрольных точек боев
+        pass
+
+
+def build_app(dp: Dispatcher, bot: Bot, path: str, secret_token: str | None,
+              handle_in_background: bool = True) -> tuple[web.Application, WebhookRequestHandler]:
+    """aiohttp-приложение с обработчиком вебхука и /healthz."""
+    app = web.Application()
+    handler = WebhookRequestHandler(dp, bot, handle_in_background=handle_in_background, secret_token=secret_token)
+    handler.register(app, path=path)
+    started = time.monotonic()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            "uptime": round(time.monotonic() - started, 1),
+            "pending_updates": len(in_flight),
+            "accepted_updates": in_flight.accepted,
+            "combat_sessions": len(combat_sessions),
+            "user_locks": user_locks.table.stats(),
+            "callback_guard": callback_guard.stats(),
+            "outbound": outbound.stats(),
+        })
+
+    app.router.add_get(HEALTH_PATH, health)
+    setup_application(app, dp, bot=bot)
+    return app, handler
+
+
+class WebhookServer:
+    """Запущенный сервер вебхука; остановка по шагам (bot.py замеряет каждый)."""
+
+    def __init__(self, runner: web.AppRunner, site: web.TCPSite, handler: WebhookRequestHandler):
+        self.runner = runner
+        self.site = site
+        self.handler = handler
+
+    async def stop_accepting(self):
+        await self.site.stop() # Новые апдейты не принимаем (Telegram повторит их позже)
+
+    async def cleanup(self):
+        await self.runner.cleanup()
+        logging.info("Webhook server stopped.")
+
+
+async def start_webhook(dp: Dispatcher, bot: Bot, allowed_updates: list[str], *, url: str, path: str,
+                        host: str, port: int, secret_token: str | None, handle_in_background: bool = True,
+                        max_connections: int = 40, set_webhook: bool = True,
+                        drop_pending_updates: bool = False) -> WebhookServer:
+    """Поднимает веб-сервер и регистрирует вебхук в Telegram."""
+    app, handler = build_app(dp, bot, path, secret_token, handle_in_background)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, host=host, port=port)
+    await site.start()
+    server = WebhookServer(runner, site, handler)
+    logging.info(f"Webhook server listening on {host}:{port}{path} (background={handle_in_background}).")
+    if set_webhook:
+        try:
+            await bot.set_webhook(url=url, secret_token=secret_token, allowed_updates=allowed_updates,
+                                  max_connections=max_connections, drop_pending_updates=drop_pending_updates)
+        except BaseException:
+            await server.cleanup()
+            raise
+        logging.info(f"Webhook set to {url}.")
+    return server
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, allowed_updates: list[str], **kwargs: Any):
+    """start_webhook и работа до отмены задачи (бенчмарки; bot.py останавливает сервер по фазам сам)."""
+    server = await start_webhook(dp, bot, allowed_updates, **kwargs)
+    try:
+        await asyncio.Event().wait() # До отмены
+    finally:
+        await server.stop_accepting()
+        await in_flight.drain(SHUTDOWN_DRAIN_TIMEOUT)
+        await server.cleanup()